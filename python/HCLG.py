@@ -11,25 +11,53 @@ USAGE: python HCLG.py language
 """
 
 import os,sys
+import gzip
 import subprocess
 import shutil
+import filecmp
+import collections.abc
 import SpeechCorpus
 import kaldi
+import arpa
+import decode_server
+import decodestore
+import monophone
+import ngram
+import prepare_lang
+import profiler
+import wer
 
 ########## H fst ##################################################
 class Hfst:
     '''This class defines an H FST (a set of triphone or senone hidden Markov models)'''
     def __init__(self, modeldir):
-        '''USAGE: hfst=Hfst(logdir)'''
+        '''USAGE: hfst=Hfst(modeldir)'''
         self.modeldir = modeldir
-        os.makedirs(logdir, exist_ok=True)
+        os.makedirs(modeldir, exist_ok=True)
         
-    def train_mono(self, corpus, langdir, kaldi_cmd):
-        cmd=['local/train_mono.sh','--nj',str(kaldi_cmd.nproc),'--cmd',
-             kaldi_cmd.train_cmd, corpus.datadir(),
-             langdir, self.modeldir ]
-        kaldi.convert_if_newer(os.path.join(langdir,'L.fst'),os.path.join(self.modeldir,'final.mdl'),
-                               cmd, sys.stdout, sys.stderr)
+    def train_mono(self, corpus, langdir, kaldi_cmd, engine='kaldi', devcorpus=None, totgauss=monophone.TOTGAUSS):
+        '''USAGE: trainer = H.train_mono(corpus, langdir, kaldi_cmd, engine, devcorpus, totgauss)
+        engine = 'kaldi' to run local/train_mono.sh, or
+          'native' to run each iteration from Python (see monophone.py), checkpointed, so that a killed run
+          resumes where it stopped, and stopped early when the log-likelihood of devcorpus stops improving.
+        Returns the monophone.Trainer, whose report() lists each iteration, or None for engine='kaldi'.'''
+        datadir = corpus.datadir()
+        if engine=='kaldi':
+            nj = SpeechCorpus.num_jobs(datadir, kaldi_cmd.nproc)
+            corpus.split_data(nj)
+            cmd=['local/train_mono.sh','--nj',str(nj),'--cmd',
+                 kaldi_cmd.train_cmd, datadir, langdir, self.modeldir ]
+            inputs = ([ os.path.join(langdir,f) for f in ('topo','L.fst','words.txt','phones.txt','oov.int','phones/sets.int') ] +
+                      [ os.path.join(datadir,f) for f in ('feats.scp','cmvn.scp','text','utt2spk') ])
+            kaldi.convert_if_newer(inputs, os.path.join(self.modeldir,'final.mdl'), cmd, sys.stdout, sys.stderr)
+            return(None)
+        if engine!='native':
+            raise ValueError(__name__+': unknown train_mono engine {}'.format(engine))
+        devdir = devcorpus.datadir() if devcorpus is not None else None
+        trainer = monophone.Trainer(datadir, langdir, self.modeldir, kaldi_cmd, totgauss=totgauss, devdir=devdir)
+        trainer.train()
+        print(trainer.report())
+        return(trainer)
 
                 
 ########## C fst ##################################################
@@ -46,7 +74,7 @@ class Lfst:
     '''This class defines an L FST (a lexicon, i.e., a mapping from phones to words)'''
     def __init__(self,lexicon,nonsilence_phones=[],silence_phones=[],extra_questions=[],optional_silence=[]):
         '''USAGE: L = Lfst(lexicon,...)  
-        lexicon: a dict, or a filename
+        lexicon: a dict (whose values are pronunciations, or lists of alternate pronunciations), or a filename
         nonsilence_phones: a list of strings, or a filename
         silence_phones, extra_questions, optional_silence: likewise
         '''
@@ -58,7 +86,7 @@ class Lfst:
 
     def read_lexicons(self):
         '''Read lexicon and phone definitions from files, into dict and list data'''
-        lexicon = kaldi.read_dict_from_file(self.lexicon) if isinstance(self.lexicon,str) else self.lexicon
+        lexicon = kaldi.read_dict_from_file(self.lexicon, multi=True) if isinstance(self.lexicon,str) else self.lexicon
         nonsilence_phones = kaldi.read_list_from_file(self.nonsilence_phones) if isinstance(self.nonsilence_phones,str) else self.nonsilence_phones
         silence_phones = kaldi.read_list_from_file(self.silence_phones) if isinstance(self.silence_phones,str) else self.silence_phones
         extra_questions = kaldi.read_list_from_file(self.extra_questions) if isinstance(self.extra_questions,str) else self.extra_questions
@@ -72,7 +100,7 @@ class Lfst:
                    silence_phones=os.path.join(dictdir,'silence_phones.txt'),
                    extra_questions=os.path.join(dictdir,'extra_questions.txt'),
                    optional_silence=os.path.join(dictdir,'optional_silence.txt'))
-        lexicon = kaldi.read_dict_from_file(self.lexicon) if isinstance(self.lexicon,str) else self.lexicon
+        lexicon = kaldi.read_dict_from_file(self.lexicon, multi=True) if isinstance(self.lexicon,str) else self.lexicon
         kaldi.write_dict_to_file(lexicon, other.lexicon)
         nonsilence_phones = kaldi.read_list_from_file(self.nonsilence_phones) if isinstance(self.nonsilence_phones,str) else self.nonsilence_phones
         kaldi.write_list_to_file(nonsilence_phones, other.nonsilence_phones, '\n')
@@ -92,12 +120,42 @@ class Lfst:
         else:
             raise ValueError(__name__+': lexicon is not a filename, it is {}'.format(self.lexicon))
         
-    def lexicon2fst(self,lexiconp, language, oov_word, langdir):
-        if os.path.exists(lexiconp) and os.path.getmtime(self.lexicon) > os.path.getmtime(lexiconp):
-            os.remove(lexiconp)
+    def lexicon2fst(self,lexiconp, language, oov_word, langdir, engine='kaldi'):
+        '''USAGE: L.lexicon2fst(lexiconp, language, oov_word, langdir, engine)
+        Build langdir (phones.txt, words.txt, phones/*, L.fst, L_disambig.fst, ...) from the dict directory.
+        engine = 'kaldi' to run utils/prepare_lang.sh, or
+          'native' to build it in this process (see prepare_lang.py), when the lexicon or phone lists change.'''
         dictdir = self.dictdir()
-        cmd=['utils/prepare_lang.sh',dictdir,oov_word, os.path.join(langdir,'tmp'), langdir]
-        kaldi.convert_if_newer(self.lexicon, os.path.join(langdir,'L_disambig.fst'),cmd,sys.stdout,sys.stderr)
+        fstfiles = [ os.path.join(langdir,f) for f in ('L.fst','L_disambig.fst') ]
+        if engine=='kaldi':
+            if os.path.exists(lexiconp) and os.path.getmtime(self.lexicon) > os.path.getmtime(lexiconp):
+                os.remove(lexiconp)
+            cmd=['utils/prepare_lang.sh',dictdir,oov_word, os.path.join(langdir,'tmp'), langdir]
+            kaldi.convert_if_newer(dictdir, fstfiles, cmd,sys.stdout,sys.stderr)
+            return
+        if engine!='native':
+            raise ValueError(__name__+': unknown lexicon2fst engine {}'.format(engine))
+        # prepare_lang.py itself is an input, so that a lang directory it built differently is rebuilt
+        inputs = [ self.lexicon, self.nonsilence_phones, self.silence_phones, self.extra_questions, self.optional_silence,
+                   prepare_lang.__file__ ]
+        cmd = [ 'prepare_lang.py', 'oov_word={}'.format(oov_word), 'sil_prob={}'.format(prepare_lang.SIL_PROB) ]
+        cache = kaldi.STAGE_CACHE
+        stage = os.path.abspath(fstfiles[0])
+        if cache is not None:
+            key = cache.stage_key(inputs, cmd)
+            current = cache.is_current(stage, inputs, cmd, fstfiles, key)
+        else:
+            current = not any(kaldi.newer_than(inputs, f) for f in fstfiles)
+        if current:
+            print(__name__+': doing nothing because L.fst is newer than '+dictdir)
+            return
+        with profiler.span('lexicon2fst', 'stage', dictdir=dictdir):
+            L = self.read_lexicons()
+            lang = prepare_lang.Lang(L.lexicon, L.nonsilence_phones, L.silence_phones, L.optional_silence,
+                                     L.extra_questions, oov_word)
+            lang.write(langdir)
+        if cache is not None:
+            cache.record(stage, inputs, cmd, fstfiles, key)
 
     
 ########## G FST ##################################################
@@ -109,17 +167,58 @@ class Gfst:
         self.words = words
         
     def move_to_langdir(self, langdir):
-        '''Create a new Gfst with files in langdir'''
+        '''Create a new Gfst with files in langdir.  The LM is copied to langdir/lm.arpa.gz
+        (gzipped on the way, if it is not already), only if it is newer than the copy.'''
         other = Gfst(lm=os.path.join(langdir,'lm.arpa.gz'),words=os.path.join(langdir,'words.txt'))
         if kaldi.newer_than(self.lm, other.lm):
-            shutil.copy2(self.lm, other.lm)
-            (basename, ext) = os.path.splitext(other.lm)
-            if ext != 'gz':
-                subprocess.run(['gzip',other.lm])
-                other.lm += '.gz'
+            (basename, ext) = os.path.splitext(self.lm)
+            if ext == '.gz':
+                shutil.copy2(self.lm, other.lm)
+            else:
+                with open(self.lm,'rb') as fin, gzip.open(other.lm,'wb') as fout:
+                    shutil.copyfileobj(fin, fout)
         if kaldi.newer_than(self.words,other.words):
             shutil.copy2(self.words,other.words)
         return(other)
+
+    @classmethod
+    def from_text(cls, texts, langdir, words, order=3, nj=1, min_counts=None):
+        '''USAGE: G=Gfst.from_text(texts, langdir, words, order, nj, min_counts)
+        Train an interpolated modified Kneser-Ney LM (see ngram.py) on texts, over the vocabulary in
+        words, into langdir/lm.arpa.gz, unless it is already current.  texts = a text-table filename,
+        or a dict from utterance ID to transcription, which is first written to langdir/lm_text
+        (only if it has changed, so that an unchanged dict does not cause retraining).'''
+        os.makedirs(langdir, exist_ok=True)
+        other = Gfst(lm=os.path.join(langdir,'lm.arpa.gz'),words=os.path.join(langdir,'words.txt'))
+        if kaldi.newer_than(words,other.words):
+            shutil.copy2(words,other.words)
+        if isinstance(texts, collections.abc.Mapping):
+            textfile = os.path.join(langdir,'lm_text')
+            kaldi.write_dict_to_file(texts, textfile+'.tmp')
+            if os.path.exists(textfile) and filecmp.cmp(textfile+'.tmp', textfile, shallow=False):
+                os.remove(textfile+'.tmp')
+            else:
+                os.replace(textfile+'.tmp', textfile)
+            texts = textfile
+        inputs = [ texts, other.words ]
+        cmd = [ 'ngram.py', 'order={}'.format(order), 'min_counts={}'.format(min_counts) ]
+        cache = kaldi.STAGE_CACHE
+        stage = os.path.abspath(other.lm)
+        if cache is not None:
+            key = cache.stage_key(inputs, cmd)
+            current = cache.is_current(stage, inputs, cmd, [ other.lm ], key)
+        else:
+            current = not kaldi.newer_than(inputs, other.lm)
+        if current:
+            print(__name__+': doing nothing because {} is newer than {}'.format(other.lm, texts))
+            return(other)
+        with profiler.span('train_lm', 'stage', texts=texts, order=order):
+            trie = ngram.train(texts, order, other.words, nj, min_counts)
+            print('train_lm: {}'.format(', '.join('{} {}-grams'.format(n, k) for (k, n) in enumerate(trie.num_ngrams(), start=1))))
+            trie.write_arpa(other.lm)
+        if cache is not None:
+            cache.record(stage, inputs, cmd, [ other.lm ], key)
+        return(other)
             
     def langdir(self):
         '''Return the directoryname in which lm occurs, if lm is a str, else raise error'''
@@ -129,10 +228,54 @@ class Gfst:
         else:
             raise ValueError(__name__+': lexicon is not a filename, it is {}'.format(self.lexicon))
         
-    def lm2fst(self, lexicon):
+    def lm2fst(self, lexicon, engine='kaldi', fst_format='binary', prune_threshold=0.0):
+        '''USAGE: G.lm2fst(lexicon, engine, fst_format, prune_threshold)
+        Compile self.lm into G.fst in self.langdir(), if it is newer than G.fst.
+        engine = 'kaldi' to run format_lm.sh, or
+          'native' to compile it in this process (see arpa.py).  The parsed LM is cached beside
+          self.lm, so that building G.fst again, e.g. with another prune_threshold, does not reparse it.
+        fst_format = with engine='native', 'binary' to write G.fst directly, or
+          'text' to write G.txt in OpenFST text form, then fstcompile and fstarcsort it, as format_lm.sh does
+        prune_threshold = with engine='native', if > 0, entropy-prune the LM first, as SRILM ngram -prune does
+        '''
         langdir=self.langdir()
-        cmd=['format_lm.sh',langdir, self.lm, lexicon, langdir ]
-        kaldi.convert_if_newer(self.lm, os.path.join(langdir,'G.fst'), cmd, sys.stdout, sys.stderr)
+        fstfile = os.path.join(langdir,'G.fst')
+        inputs = [ self.lm, lexicon, self.words ]
+        if engine=='kaldi':
+            cmd=['format_lm.sh',langdir, self.lm, lexicon, langdir ]
+            kaldi.convert_if_newer(inputs, fstfile, cmd, sys.stdout, sys.stderr)
+            return
+        if engine!='native':
+            raise ValueError(__name__+': unknown lm2fst engine {}'.format(engine))
+        cmd = [ 'arpa.py', fst_format, 'prune_threshold={}'.format(prune_threshold) ]
+        cache = kaldi.STAGE_CACHE
+        stage = os.path.abspath(fstfile)
+        if cache is not None:
+            key = cache.stage_key(inputs, cmd)
+            current = cache.is_current(stage, inputs, cmd, [ fstfile ], key)
+        else:
+            current = not kaldi.newer_than(inputs, fstfile)
+        if current:
+            print(__name__+': doing nothing because G.fst is newer than '+self.lm)
+            return
+        with profiler.span('lm2fst', 'stage', lm=self.lm, fst_format=fst_format, prune_threshold=prune_threshold):
+            trie = arpa.load(self.lm, self.words)
+            if prune_threshold > 0:
+                num_pruned = trie.prune_entropy(prune_threshold)
+                print('lm2fst: pruned {} n-grams, leaving {}'.format(num_pruned, trie.num_ngrams()))
+            if fst_format=='binary':
+                trie.write_fst(fstfile)
+            elif fst_format=='text':
+                txtfile = os.path.join(langdir,'G.txt')
+                trie.write_fst_text(txtfile)
+                for c in (['fstcompile',txtfile,fstfile+'.tmp'], ['fstarcsort','--sort_type=ilabel',fstfile+'.tmp',fstfile]):
+                    if profiler.run(c).returncode != 0:
+                        raise RuntimeError(__name__+': {} failed'.format(' '.join(c)))
+                os.remove(fstfile+'.tmp')
+            else:
+                raise ValueError(__name__+': unknown fst_format {}'.format(fst_format))
+        if cache is not None:
+            cache.record(stage, inputs, cmd, [ fstfile ], key)
 
             
 ########## HCLG Object ##################################################
@@ -146,17 +289,72 @@ class HCLG:
         self.G = G
         
     def mkgraph(self):
-        '''Compile the graph specified by H, C, L, and G'''
+        '''Compile the graph specified by H, C, L, and G, unless graph/HCLG.fst is already current:
+        that is, unless the tree, lexicon (L_disambig.fst, phones and words) or G.fst have changed since it was made.'''
         graphdir = os.path.join(self.H.modeldir, 'graph')
         os.makedirs(graphdir, exist_ok=True)
         cmd=['utils/mkgraph.sh', self.G.langdir(), self.H.modeldir, graphdir]
-        subprocess.run(cmd)
+        langdir = self.G.langdir()
+        inputs = [ os.path.join(self.H.modeldir,'tree') ] + [ os.path.join(langdir,f) for f in
+                   ('L_disambig.fst','G.fst','words.txt','phones.txt','topo','phones/disambig.int') ]
+        outputs = [ os.path.join(graphdir,'HCLG.fst') ]
+        cache = kaldi.STAGE_CACHE
+        stage = os.path.abspath(outputs[0])
+        if cache is not None:
+            key = cache.stage_key(inputs, cmd)
+            current = cache.is_current(stage, inputs, cmd, outputs, key)
+        else:
+            current = not kaldi.newer_than(inputs, outputs[0])
+        if current:
+            print(__name__+': doing nothing because {} is newer than the tree, L and G'.format(outputs[0]))
+            return(graphdir)
+        c = profiler.run(cmd)
+        if c.returncode != 0:
+            raise RuntimeError(__name__+': mkgraph.sh failed with code {}'.format(c.returncode))
+        if cache is not None:
+            cache.record(stage, inputs, cmd, outputs, key)
         return(graphdir)
     
     def decode(self, graphdir, corpus, logdir, kaldi_cmd):
-        cmd=['steps/decode.sh','--nj',str(kaldi_cmd.nproc),'--cmd',kaldi_cmd.decode_cmd,graphdir,
-             corpus.datadir(),logdir]
-        subprocess.run(cmd)
+        '''USAGE: best = hclg.decode(graphdir, corpus, logdir, kaldi_cmd)
+        Decode corpus into logdir, then score the LMWT x word-insertion-penalty grid with wer.py.
+        Lattices are kept per utterance in logdir/decode_store.sqlite (see decodestore.py), so only the utterances
+        whose features, CMVN statistics, model, graph or decoding options have changed are decoded again;
+        they are merged with the others into logdir/lat.*.gz before scoring.  Returns the best wer.Result.'''
+        datadir = corpus.datadir()
+        opts = [ 'steps/decode.sh', '--skip_scoring', 'true' ]
+        store = decodestore.DecodeStore(os.path.join(logdir,'decode_store.sqlite'))
+        keys = store.fingerprints(datadir, os.path.join(self.H.modeldir,'final.mdl'), graphdir, opts)
+        missing = store.missing(keys)
+        print(__name__+': decoding {} of {} utterances; the others are current'.format(len(missing), len(keys)))
+        if missing:
+            if len(missing) == len(keys):
+                (subdir, nj) = (datadir, SpeechCorpus.num_jobs(datadir, kaldi_cmd.nproc))
+                corpus.split_data(nj)
+            else:
+                subdir = os.path.join(logdir,'data')
+                shutil.rmtree(subdir, ignore_errors=True)
+                nj = max(1, min(kaldi_cmd.nproc, decodestore.subset_data_dir(datadir, missing, subdir)))
+                SpeechCorpus.split_data_dir(subdir, nj)
+            newdir = logdir.rstrip('/') + '.new'     # decode.sh finds the model in the parent of its decode directory
+            shutil.rmtree(newdir, ignore_errors=True)
+            cmd = opts[:1] + ['--nj',str(nj),'--cmd',kaldi_cmd.decode_cmd] + opts[1:] + [graphdir,subdir,newdir]
+            c = profiler.run(cmd)
+            if c.returncode != 0:
+                raise RuntimeError(__name__+': decode.sh failed with code {}'.format(c.returncode))
+            store.add(newdir, keys, kaldi_cmd)
+            shutil.rmtree(newdir, ignore_errors=True)
+        store.prune(keys)
+        store.write_lattices(keys, logdir, kaldi_cmd.nproc)
+        store.close()
+        with profiler.span('score','stage',decodedir=logdir):
+            best = wer.score_decode_dir(datadir, graphdir, logdir, kaldi_cmd)
+        return(best)
+
+    def server(self, graphdir, socket_path, nworkers=2, batch_size=8):
+        '''USAGE: server = hclg.server(graphdir, socket_path, nworkers, batch_size); server.serve_forever()
+        A decode_server.DecodeServer that keeps the model and graph loaded, for decoding one request at a time.'''
+        return(decode_server.DecodeServer(self.H.modeldir, graphdir, socket_path, nworkers, batch_size))
 
                 
 
@@ -7,6 +7,7 @@
    c1.write_dicts_to_dictfiles
    c1.make_mfcc
    c1.compute_cmvn_stats
+   c1.split_data          # persistent speaker-whole shards, reused by every parallel stage
 """
 
 import os
@@ -14,6 +15,20 @@ import subprocess
 import re
 import shutil
 import kaldi
+import profiler
+import resample
+import mfcc
+import cmvn
+import frontend
+import audio
+import concurrent.futures
+import collections.abc
+import numpy as np
+
+INDEX_FILE = '.corpus_index.npz'
+SHARD_FILE = '.spk2shard'
+UTT_TABLES = ('utt2spk','feats.scp','text','wav.scp','utt2dur','utt2num_frames','segments')
+SPK_TABLES = ('spk2utt','cmvn.scp','spk2gender')
 
 ########## auxilary functions ##################################################
 def get_utt_from_filename(ifile):
@@ -26,74 +41,570 @@ def get_spk_from_utt(utt):
     spk = re.sub(r'-.*','', utt)
     return(spk)
         
+def get_utt2dur(wav_scp, nj=1):
+    '''USAGE: utt2dur = get_utt2dur(wav_scp, nj)
+    Return a dict from utterance ID to duration in seconds, for every utterance in the file wav_scp.
+    Durations are read from audio headers, by nj threads, and cached in the file utt2dur beside wav_scp;
+    the number of MFCC frames per utterance, for conf/mfcc.conf, is cached in utt2num_frames.
+    The cache is reused if it is newer than wav_scp and lists every utterance.
+    '''
+    datadir = os.path.dirname(wav_scp)
+    utt2dur_file = os.path.join(datadir,'utt2dur')
+    utt2wav = kaldi.read_dict_from_file(wav_scp)
+    if os.path.exists(utt2dur_file) and not kaldi.newer_than(wav_scp, utt2dur_file):
+        utt2dur = { u:float(d) for (u,d) in kaldi.read_dict_from_file(utt2dur_file).items() }
+        if set(utt2wav.keys()) <= set(utt2dur.keys()):
+            return({ u:utt2dur[u] for u in utt2wav })
+    utt2dur = read_durations(utt2wav, nj)
+    write_utt2dur(utt2dur, datadir)
+    return(utt2dur)
+
+def read_durations(utt2wav, nj=1):
+    '''USAGE: utt2dur = read_durations(utt2wav, nj)
+    Duration in seconds of each audio file in the dict utt2wav, read from its header by nj threads.
+    Files that cannot be read are left out.'''
+    def header(w):
+        try:
+            return(audio.info(w))
+        except (OSError, ValueError):
+            return(None)
+    with concurrent.futures.ThreadPoolExecutor(max(1,nj)) as pool:
+        infos = dict(zip(utt2wav.keys(), pool.map(header, utt2wav.values())))
+    return({ u:i[2]/i[0] for (u,i) in infos.items() if i is not None })
+
+def write_utt2dur(utt2dur, datadir):
+    '''USAGE: write_utt2dur(utt2dur, datadir)
+    Write datadir/utt2dur, and datadir/utt2num_frames for conf/mfcc.conf if it exists.'''
+    kaldi.write_dict_to_file({ u:'%.3f'%d for (u,d) in utt2dur.items() }, os.path.join(datadir,'utt2dur'))
+    mfcc_config = os.path.join(os.getcwd(), 'conf', 'mfcc.conf')
+    if os.path.exists(mfcc_config):
+        extractor = mfcc.Extractor(mfcc.read_config(mfcc_config))
+        fs = extractor.opts['sample_frequency']
+        kaldi.write_dict_to_file({ u:extractor.num_frames(int(round(d*fs))) for (u,d) in utt2dur.items() },
+                                 os.path.join(datadir,'utt2num_frames'))
+
+def write_cmvn_stats(datadir, mfccdir, utt2feat, nj=1, acc=None):
+    '''USAGE: write_cmvn_stats(datadir, mfccdir, utt2feat, nj, acc)
+    Add the per-speaker CMVN statistics of the features in utt2feat (a dict from utterance to feats.scp entry)
+    to acc, if given, and write them, as steps/compute_cmvn_stats.sh does, to mfccdir/cmvn_{name}.ark and .scp,
+    and datadir/cmvn.scp, where name is the basename of datadir.
+    '''
+    name = os.path.basename(datadir)
+    ark = os.path.join(mfccdir,'cmvn_%s.ark'%name)
+    scp = os.path.join(mfccdir,'cmvn_%s.scp'%name)
+    utt2spk = kaldi.read_dict_from_file(os.path.join(datadir,'utt2spk'))
+    acc = cmvn.compute_cmvn_stats(utt2feat, utt2spk, ark, scp, nj, acc)
+    shutil.copyfile(scp, os.path.join(datadir,'cmvn.scp'))
+    print('Succeeded creating CMVN stats for {} speakers of {}'.format(len(acc.stats), name))
+
+########## sharded data directories ##################################################
+def speaker_durations(utt2spk, utt2dur):
+    '''Total duration of the utterances of each speaker; an utterance of unknown duration counts as 1 second'''
+    spk2dur = {}
+    for (u,s) in utt2spk.items():
+        spk2dur[s] = spk2dur.get(s,0.0) + utt2dur.get(u,1.0)
+    return(spk2dur)
+
+def assign_shards(spk2dur, nj, old=None):
+    '''USAGE: spk2shard = assign_shards(spk2dur, nj, old)
+    Assign each speaker of spk2dur (a dict from speaker to total duration) to one of the shards 1...nj,
+    keeping their total durations balanced.  A speaker keeps its shard in the assignment old, if that is
+    still one of 1...nj; the others (new speakers, and those of shards that no longer exist) go, longest
+    first, to the shard with the least load.  Then speakers are moved to the shard with the least load
+    from heavier ones, as long as that evens the loads, so that changing nj moves few speakers.'''
+    nj = max(1, int(nj))
+    old = old or {}
+    spk2shard = { s:old[s] for s in spk2dur if 1 <= old.get(s,0) <= nj }
+    loads = { n:0.0 for n in range(1,nj+1) }
+    members = { n:set() for n in range(1,nj+1) }
+    def move(s, n):
+        if s in spk2shard:
+            loads[spk2shard[s]] -= spk2dur[s]
+            members[spk2shard[s]].discard(s)
+        spk2shard[s] = n
+        loads[n] += spk2dur[s]
+        members[n].add(s)
+    for (s,n) in spk2shard.items():
+        loads[n] += spk2dur[s]
+        members[n].add(s)
+    for s in sorted((s for s in spk2dur if s not in spk2shard), key=lambda s: (-spk2dur[s], s)):
+        move(s, min(loads, key=lambda n: (loads[n], n)))
+    # Each move of a speaker shorter than the gap between two shards reduces the sum of squared loads
+    for iteration in range(len(spk2dur)*nj):
+        light = min(loads, key=lambda n: (loads[n], n))
+        best = None
+        for heavy in sorted(loads, key=lambda n: (-loads[n], n)):
+            gap = loads[heavy] - loads[light]
+            movable = [ s for s in members[heavy] if 0 < spk2dur[s] < gap ]
+            if movable:
+                best = min(movable, key=lambda s: (abs(gap/2 - spk2dur[s]), s))
+                break
+        if best is None:
+            break
+        move(best, light)
+    return(spk2shard)
+
+def read_spk2shard(datadir, nj):
+    '''The speaker-to-shard assignment into nj shards saved in datadir/split{nj} by split_data_dir
+    or make_features, or {}'''
+    shard_file = os.path.join(datadir, 'split%d'%nj, SHARD_FILE)
+    if not os.path.exists(shard_file):
+        return({})
+    return({ s:int(n) for (s,n) in kaldi.read_dict_from_file(shard_file).items() })
+
+def write_spk2shard(spk2shard, datadir, nj):
+    os.makedirs(os.path.join(datadir, 'split%d'%nj), exist_ok=True)
+    kaldi.write_dict_to_file({ s:str(n) for (s,n) in spk2shard.items() }, os.path.join(datadir, 'split%d'%nj, SHARD_FILE))
+
+def previous_spk2shard(datadir, nj):
+    '''The assignment to start from when sharding datadir into nj shards: the one saved for nj, or if there
+    is none, the most recently saved one for any other number of shards, so that a new nj moves few speakers.'''
+    saved = [ f for f in os.listdir(datadir) if re.fullmatch(r'split\d+', f)
+              and os.path.exists(os.path.join(datadir, f, SHARD_FILE)) ] if os.path.isdir(datadir) else []
+    if 'split%d'%nj in saved or not saved:
+        return(read_spk2shard(datadir, nj))
+    latest = max(saved, key=lambda f: os.path.getmtime(os.path.join(datadir, f, SHARD_FILE)))
+    return(read_spk2shard(datadir, int(latest[len('split'):])))
+
+def _write_if_changed(filename, text):
+    '''Write text to filename, unless it already contains exactly that, so unchanged shards keep their mtimes'''
+    if os.path.exists(filename):
+        with open(filename) as f:
+            if f.read() == text:
+                return(False)
+    with open(filename,'w') as f:
+        f.write(text)
+    return(True)
+
+def num_jobs(datadir, nj):
+    '''USAGE: nj = num_jobs(datadir, nj)
+    nj, or the number of speakers in datadir if that is smaller: the most shards split_data_dir can make,
+    since each speaker is kept whole.'''
+    num_spk = len(set(kaldi.read_dict_from_file(os.path.join(datadir,'utt2spk')).values()))
+    return(max(1, min(int(nj), num_spk)))
+
+def split_data_dir(datadir, nj):
+    '''USAGE: sdata = split_data_dir(datadir, nj)
+    Shard the data directory into nj subdirectories sdata/1 ... sdata/nj, where sdata is datadir/split{nj},
+    in the layout of utils/split_data.sh, so that scripts run with --nj nj use it rather than re-splitting.
+    Speakers are kept whole, and are assigned to shards by bin packing on their total duration.  The assignment
+    is saved in sdata/.spk2shard, and is reused: nothing is done if sdata is newer than every table,
+    a changed table is re-sharded without moving any speaker, and a new nj moves only the speakers it must.
+    Each table is read once, line by line, and a shard's file is rewritten only if its contents change.
+    Raises ValueError if datadir has fewer than nj speakers, since a shard with no utterances makes Kaldi
+    programs fail; callers choose nj with num_jobs.'''
+    sdata = os.path.join(datadir,'split%d'%nj)
+    shard_file = os.path.join(sdata, SHARD_FILE)
+    tables = [ f for f in UTT_TABLES+SPK_TABLES if os.path.exists(os.path.join(datadir,f)) ]
+    if (os.path.exists(shard_file) and os.path.exists(os.path.join(sdata,str(nj),'utt2spk'))
+        and not kaldi.newer_than([ os.path.join(datadir,f) for f in tables ]+[ shard_file ], sdata)):
+        return(sdata)
+    utt2spk = kaldi.read_dict_from_file(os.path.join(datadir,'utt2spk'))
+    num_spk = len(set(utt2spk.values()))
+    if nj > num_spk:
+        raise ValueError(__name__+': cannot split {} into {} shards: it has only {} speakers'.format(datadir, nj, num_spk))
+    wav_scp = os.path.join(datadir,'wav.scp')
+    if os.path.exists(wav_scp):
+        utt2dur = get_utt2dur(wav_scp, nj)
+    elif os.path.exists(os.path.join(datadir,'utt2dur')):
+        utt2dur = { u:float(d) for (u,d) in kaldi.read_dict_from_file(os.path.join(datadir,'utt2dur')).items() }
+    else:
+        utt2dur = {}
+    spk2dur = speaker_durations(utt2spk, utt2dur)
+    old = previous_spk2shard(datadir, nj)
+    spk2shard = assign_shards(spk2dur, nj, old)
+    loads = [ 0.0 ] * nj
+    for (s,n) in spk2shard.items():
+        loads[n-1] += spk2dur[s]
+    moved = sum(1 for s in spk2shard if s in old and old[s] != spk2shard[s])
+    print('split_data: {} speakers in {} shards, {} moved; job imbalance (longest/mean) predicted from durations {:.2f}'.format(
+        len(spk2shard), nj, moved, kaldi.imbalance(loads)))
+    utt2shard = { u:spk2shard[s] for (u,s) in utt2spk.items() }
+    for n in range(1,nj+1):
+        os.makedirs(os.path.join(sdata,str(n)), exist_ok=True)
+    for f in tables:
+        shard_of = spk2shard if f in SPK_TABLES else utt2shard
+        lines = [ [] for n in range(nj+1) ]
+        with open(os.path.join(datadir,f)) as fin:
+            for line in fin:
+                words = line.split(None,1)
+                if words and words[0] in shard_of:
+                    lines[shard_of[words[0]]].append(line)
+        for n in range(1,nj+1):
+            _write_if_changed(os.path.join(sdata,str(n),f), ''.join(lines[n]))
+    for f in UTT_TABLES+SPK_TABLES:
+        if f not in tables:
+            for n in range(1,nj+1):
+                if os.path.exists(os.path.join(sdata,str(n),f)):
+                    os.remove(os.path.join(sdata,str(n),f))
+    write_spk2shard(spk2shard, datadir, nj)
+    # Scripts re-split unless the split directory is newer than feats.scp
+    os.utime(sdata)
+    return(sdata)
+
+########## corpus index ##################################################
+def file_signature(filenames):
+    '''USAGE: sig = file_signature(filenames)
+    The absolute path, size and mtime of each file, as an array of strings: what a saved CorpusIndex was built from.'''
+    sig = []
+    for f in filenames:
+        st = os.stat(f)
+        sig.append('{}\t{}\t{}'.format(os.path.abspath(f), st.st_size, st.st_mtime_ns))
+    return(np.array(sig, dtype=str))
+
+class StringColumn:
+    '''An array of strings stored as one utf-8 byte buffer and an array of offsets into it.'''
+    def __init__(self, data, offsets):
+        '''USAGE: col = StringColumn(data, offsets); data is a uint8 array, offsets an int64 array of len(col)+1'''
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [ x.encode('utf-8') for x in strings ]
+        offsets = np.zeros(len(encoded)+1, dtype=np.int64)
+        np.cumsum([ len(e) for e in encoded ], out=offsets[1:])
+        return(cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets))
+
+    def __len__(self):
+        return(len(self.offsets)-1)
+
+    def __getitem__(self, i):
+        return(self.data[self.offsets[i]:self.offsets[i+1]].tobytes().decode('utf-8'))
+
+    def take(self, indices):
+        '''A new StringColumn containing the strings at indices, gathered without a python loop'''
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices+1] - starts
+        offsets = np.zeros(len(indices)+1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        gather = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return(StringColumn(self.data[gather], offsets))
+
+class ColumnView(collections.abc.Mapping):
+    '''Read-only dict view, from utterance ID to one column of a CorpusIndex.'''
+    def __init__(self, index, column):
+        self.index = index
+        self.column = column
+
+    def __getitem__(self, utt):
+        i = self.index.find(utt)
+        if i < 0:
+            raise KeyError(utt)
+        return(self.index.value(self.column, i))
+
+    def __iter__(self):
+        return(iter(self.index.utts.tolist()))
+
+    def __len__(self):
+        return(len(self.index.utts))
+
+class CorpusIndex:
+    '''Columnar index of a corpus: utterance IDs (sorted) and speaker IDs (sorted) as numpy arrays,
+    the speaker of each utterance as an integer code, waveform and text columns as StringColumns,
+    and a CSR table (spk_ptr, spk_utts) listing the utterances of each speaker.
+    USAGE:
+      index = CorpusIndex.from_dicts(utt2wav, utt2spk, utt2txt)
+      index.utt2wav['utt1'], index.spk2utt['spk1']   # dict-like views
+      sub = index.subset(utts); parts = index.split(nj)
+      index.save(filename, sources); index = CorpusIndex.load(filename, sources)
+    '''
+    def __init__(self, utts, spks, utt_spk, wav, txt):
+        '''USAGE: index = CorpusIndex(utts, spks, utt_spk, wav, txt); utts must be sorted'''
+        self.utts = utts
+        self.spks = spks
+        self.utt_spk = utt_spk
+        self.wav = wav
+        self.txt = txt
+        # CSR table: the utterances of speaker s are spk_utts[spk_ptr[s]:spk_ptr[s+1]]
+        self.spk_utts = np.argsort(utt_spk, kind='stable').astype(np.int32)
+        self.spk_ptr = np.zeros(len(spks)+1, dtype=np.int64)
+        np.cumsum(np.bincount(utt_spk, minlength=len(spks)), out=self.spk_ptr[1:])
+        self.utt2wav = ColumnView(self, 'wav')
+        self.utt2spk = ColumnView(self, 'spk')
+        self.utt2txt = ColumnView(self, 'txt')
+
+    @classmethod
+    def from_dicts(cls, utt2wav, utt2spk, utt2txt):
+        '''Index the utterances that appear in all three dicts'''
+        common = sorted(set(utt2wav.keys()) & set(utt2spk.keys()) & set(utt2txt.keys()))
+        spk_of = [ utt2spk[u] for u in common ]
+        (spks, utt_spk) = np.unique(np.array(spk_of, dtype=str), return_inverse=True)
+        return(cls(np.array(common, dtype=str), spks, utt_spk.astype(np.int32).reshape(-1),
+                   StringColumn.from_strings([ utt2wav[u] for u in common ]),
+                   StringColumn.from_strings([ utt2txt[u] for u in common ])))
+
+    def find(self, utt):
+        '''Position of utt in self.utts, or -1'''
+        i = int(np.searchsorted(self.utts, utt))
+        return(i if i < len(self.utts) and self.utts[i]==utt else -1)
+
+    def value(self, column, i):
+        if column=='spk':
+            return(str(self.spks[self.utt_spk[i]]))
+        return((self.wav if column=='wav' else self.txt)[i])
+
+    def __len__(self):
+        return(len(self.utts))
+
+    @property
+    def spk2utt(self):
+        '''dict from speaker ID to the space-separated list of its utterances'''
+        return({ str(s):' '.join(self.utts[self.spk_utts[self.spk_ptr[n]:self.spk_ptr[n+1]]])
+                 for (n,s) in enumerate(self.spks) })
+
+    def take(self, positions):
+        '''A new CorpusIndex of the utterances at the sorted array of positions; unused speakers are dropped'''
+        positions = np.asarray(positions, dtype=np.int64)
+        (used, utt_spk) = np.unique(self.utt_spk[positions], return_inverse=True)
+        return(CorpusIndex(self.utts[positions], self.spks[used], utt_spk.astype(np.int32).reshape(-1),
+                           self.wav.take(positions), self.txt.take(positions)))
+
+    def subset(self, utts):
+        '''A new CorpusIndex of the utterances in utts that are also in this index'''
+        return(self.take(np.nonzero(np.isin(self.utts, np.array(list(utts), dtype=str)))[0]))
+
+    def intersect(self, other):
+        '''A new CorpusIndex of the utterances that are also in the CorpusIndex other'''
+        return(self.subset(other.utts))
+
+    def split(self, nj, utt2dur=None):
+        '''USAGE: parts = index.split(nj, utt2dur)
+        Split into nj CorpusIndexes, keeping speakers whole, balanced by total duration if utt2dur is given
+        (a dict, or an array aligned with self.utts), else by number of utterances.'''
+        if utt2dur is None:
+            weights = np.ones(len(self.utts))
+        elif isinstance(utt2dur, np.ndarray):
+            weights = utt2dur
+        else:
+            weights = np.array([ utt2dur.get(u,0.0) for u in self.utts.tolist() ])
+        spk_weights = np.bincount(self.utt_spk, weights=weights, minlength=len(self.spks))
+        (splits, loads) = kaldi.split_lpt(dict(enumerate(spk_weights.tolist())), nj)
+        job_of_spk = np.zeros(len(self.spks), dtype=np.int64)
+        for (n, spks) in enumerate(splits):
+            job_of_spk[spks] = n
+        job_of_utt = job_of_spk[self.utt_spk]
+        return([ self.take(np.nonzero(job_of_utt==n)[0]) for n in range(len(splits)) ])
+
+    def write_table(self, column, filename):
+        '''Write one column as a Kaldi table (utt value lines, sorted by utt), e.g., wav.scp'''
+        values = ( self.value(column, i) for i in range(len(self.utts)) )
+        with open(filename,'w') as f:
+            f.writelines( '{}\t{}\n'.format(u,v) for (u,v) in zip(self.utts.tolist(), values) )
+
+    def save(self, filename, sources=()):
+        '''Save to a single uncompressed .npz file, with the file_signature of the files in sources,
+        from which the index was built'''
+        with open(filename,'wb') as f:
+            np.savez(f, utts=self.utts, spks=self.spks, utt_spk=self.utt_spk,
+                     wav_data=self.wav.data, wav_offsets=self.wav.offsets,
+                     txt_data=self.txt.data, txt_offsets=self.txt.offsets,
+                     sources=file_signature(sources))
+
+    @classmethod
+    def load(cls, filename, sources=None):
+        '''Load an index saved by save.  If sources is given, return None unless the index was saved
+        with the same file_signature of sources: the same files, with the same sizes and mtimes.'''
+        with np.load(filename, allow_pickle=False) as z:
+            if sources is not None and ('sources' not in z or not np.array_equal(z['sources'], file_signature(sources))):
+                return(None)
+            return(cls(z['utts'], z['spks'], z['utt_spk'], StringColumn(z['wav_data'], z['wav_offsets']),
+                       StringColumn(z['txt_data'], z['txt_offsets'])))
+
 ########## corpus object ##################################################
 class corpus:
-    '''This class defines a speech corpus'''
+    '''This class defines a speech corpus.  Its tables are stored in a CorpusIndex:
+    if the corpus is made from dicts, utt2wav, utt2spk and utt2txt are dict-like views of that index;
+    if from files, they are the filenames, and the index is read from them (or from the copy that
+    write_dicts_to_dictfiles saved beside them) when it is first needed, and again if they change.'''
     def __init__(self, utt2wav, utt2spk, utt2txt):
         '''USAGE: corpus=SpeechCorpus(utt2wav, utt2spk, utt2txt)
         utt2wav: a dictionary mapping from utt_id to filename, or the name of a file containing such.
         utt2spk: a dictionary mapping from utt_id to spk_id, or the name of a file containing such.
         utt2txt: a dictionary mapping from utt_id to text, or the name of a file containing such.
+        Only the utterances that are in all three are part of the corpus.
         '''
-        self.utt2spk = utt2spk
-        self.utt2txt = utt2txt
-        self.utt2wav = utt2wav
+        self._index = None
+        self._signature = None
+        if all(isinstance(x,str) for x in (utt2wav, utt2spk, utt2txt)):
+            (self.utt2wav, self.utt2spk, self.utt2txt) = (utt2wav, utt2spk, utt2txt)
+        else:
+            self._index = CorpusIndex.from_dicts(*[ kaldi.read_dict_from_file(x) if isinstance(x,str) else x
+                                                    for x in (utt2wav, utt2spk, utt2txt) ])
+            (self.utt2wav, self.utt2spk, self.utt2txt) = (self._index.utt2wav, self._index.utt2spk, self._index.utt2txt)
         # Make sure that the waveform files exist; if not, throw an error!
-        u2w = kaldi.read_dict_from_file(utt2wav) if isinstance(utt2wav, str) else utt2wav
-        for (u,w) in u2w.items():
+        index = self.index()
+        for (u,w) in zip(index.utts.tolist(), (index.wav[i] for i in range(len(index)))):
+            if w.endswith('|'):
+                continue  # A Kaldi pipe, e.g. from make_features; its input is checked when it is run
             x = re.sub(r':.*','',w)  # Eliminate the index-into-file part, to test file existence
             if not os.path.exists(x):
                 raise FileNotFoundError('SpeechCorpus: {} -> {}, but file {} not found'.format(u,w,x))
         
-    def downsample(self, fs, logdir, wavdir):
-        '''USAGE: other = self.downsample(fs, logdir, wavdir)
+    def downsample(self, fs, logdir, wavdir, kaldi_cmd=None, nj=None, engine='sox'):
+        '''USAGE: other = self.downsample(fs, logdir, wavdir, kaldi_cmd, engine)
         fs = output sampling rate
         logdir = directory for logfiles describing downsampling errors
         wavdir = downsampled files will go into wavdir
+        kaldi_cmd = if given, run kaldi_cmd.nproc sox processes at a time
+        nj = number of simultaneous sox processes; overrides kaldi_cmd.nproc (default: 1)
+        engine = 'sox' to run one sox process per file, or
+          'numpy' to resample in batches in nj worker processes (see resample.py)
         '''
-        utt2wav = kaldi.read_dict_from_file(self.utt2wav) if isinstance(self.utt2wav, str) else self.utt2wav
-        soxerr = []
-        valid_wavs = {}
+        utt2wav = dict(self.index().utt2wav)
+        if nj is None:
+            nj = kaldi_cmd.nproc if kaldi_cmd else 1
         os.makedirs(wavdir,exist_ok=True)
         os.makedirs(logdir,exist_ok=True)
-        with open(os.path.join(logdir,'sox_stderr.txt'),'w') as sox_stderr:
-            with open(os.path.join(logdir,'sox_stdout.txt'),'w') as sox_stdout:                
-                for (utt, ifile) in utt2wav.items():
-                    (wavhead, wavtail) = os.path.split(ifile)
-                    (wavroot, wavext) = os.path.splitext(wavtail)
-                    ofile = os.path.join(wavdir,wavroot+'.wav')
-                    cmd = ['sox',ifile,'-R','-r',str(fs),'-t','wav',ofile]
-                    returncode = kaldi.convert_if_newer(ifile, ofile, cmd, sox_stdout, sox_stderr)
-                    if returncode==0:
-                        valid_wavs[utt]=ofile
+        tasks = []
+        for (utt, ifile) in utt2wav.items():
+            (wavhead, wavtail) = os.path.split(ifile)
+            (wavroot, wavext) = os.path.splitext(wavtail)
+            ofile = os.path.join(wavdir,wavroot+'.wav')
+            cmd = ['sox',ifile,'-R','-r',str(fs),'-t','wav',ofile]
+            tasks.append((utt, ifile, ofile, cmd))
+        if engine=='sox':
+            returncodes = kaldi.convert_all_if_newer(tasks, nj, os.path.join(logdir,'sox'))
+        elif engine=='numpy':
+            returncodes = resample.resample_all(tasks, fs, nj, os.path.join(logdir,'sox'))
+        else:
+            raise ValueError(__name__+': unknown downsample engine {}'.format(engine))
+        valid_wavs = { utt:ofile for (utt, ifile, ofile, cmd) in tasks if returncodes.get(utt)==0 }
         other = corpus(utt2wav = valid_wavs, utt2spk=self.utt2spk, utt2txt=self.utt2txt)
         return(other)
     
+    def make_features(self, fs, kaldi_cmd, logdir, datadir, mfccdir, wavdir=None):
+        '''USAGE: other = self.make_features(fs, kaldi_cmd, logdir, datadir, mfccdir, wavdir)
+        Fused replacement for downsample, write_dicts_to_dictfiles, make_mfcc and compute_cmvn_stats:
+        each utterance of self is decoded, resampled to fs, converted to MFCC and added to its speaker's
+        CMVN statistics in one pass, by kaldi_cmd.nproc worker processes (see frontend.py).
+        Only feature and CMVN archives are written, to mfccdir; logs go in logdir.
+        datadir gets wav.scp, utt2spk, spk2utt, text, utt2dur, feats.scp and cmvn.scp.
+        wavdir = if given, the resampled waveforms are also saved there, and listed in wav.scp;
+          otherwise wav.scp lists pipes that resample the original files on the fly, with the same
+          resampler (resample.py), so that features recomputed from wav.scp by Kaldi match these.
+        other.utt2wav is set to datadir/feats.scp.
+        Nothing is recomputed if feats.scp and cmvn.scp are newer than every source file, and
+        feats.scp lists exactly the utterances of self.
+        '''
+        index = self.index()
+        utt2src = dict(index.utt2wav)
+        if not os.path.isabs(mfccdir):
+            mfccdir = os.path.join(os.getcwd(),mfccdir)
+        for d in (datadir, mfccdir, logdir) + ((wavdir,) if wavdir else ()):
+            os.makedirs(d, exist_ok=True)
+        name = os.path.basename(datadir)
+        (utt2spk_file, utt2txt_file) = (os.path.join(datadir,'utt2spk'), os.path.join(datadir,'text'))
+        (utt2feat_file, cmvn_file) = (os.path.join(datadir,'feats.scp'), os.path.join(datadir,'cmvn.scp'))
+        sources = sorted(set(re.sub(r':\d+$','',w) for w in utt2src.values()))
+        if (os.path.exists(utt2feat_file) and os.path.exists(cmvn_file)
+            and not kaldi.newer_than(sources, utt2feat_file) and not kaldi.newer_than(utt2feat_file, cmvn_file)
+            and set(kaldi.read_dict_from_file(utt2feat_file).keys()) == set(utt2src.keys())):
+            print(__name__+': doing nothing because features newer than sources in '+datadir)
+            return(corpus(utt2wav=utt2feat_file, utt2spk=utt2spk_file, utt2txt=utt2txt_file))
+        mfcc_config = os.path.join(os.getcwd(), 'conf', 'mfcc.conf')
+        if not os.path.exists(mfcc_config):
+            raise FileNotFoundError('SpeechCorpus.corpus.make_features requires '+mfcc_config)
+        opts = mfcc.read_config(mfcc_config)
+        utt2spk = dict(index.utt2spk)
+        utt2out = { u:os.path.join(wavdir,get_utt_from_filename(w)+'.wav') for (u,w) in utt2src.items() } if wavdir else {}
+
+        # The jobs are the shards that split_data_dir will reuse, so each speaker's CMVN statistics come from one job
+        src2dur = read_durations(utt2src, kaldi_cmd.nproc)
+        spk2dur = speaker_durations(utt2spk, src2dur)
+        nj = max(1, min(kaldi_cmd.nproc, len(spk2dur)))
+        spk2shard = assign_shards(spk2dur, nj, previous_spk2shard(datadir, nj))
+        write_spk2shard(spk2shard, datadir, nj)
+        splits = [ [] for n in range(nj) ]
+        for u in sorted(utt2src):
+            splits[spk2shard[utt2spk[u]]-1].append(u)
+        loads = [ sum(src2dur.get(u,0.0) for u in split) for split in splits ]
+        jobs = []
+        for n in range(0,nj):
+            jobs.append(({ u:utt2src[u] for u in splits[n] },
+                         os.path.join(mfccdir,'raw_mfcc_%s.%d.ark'%(name,n+1)), os.path.join(mfccdir,'raw_mfcc_%s.%d.scp'%(name,n+1)),
+                         os.path.join(logdir,'make_features_%s.%d.log'%(name,n+1)),
+                         { u:utt2spk[u] for u in splits[n] }, { u:utt2out[u] for u in splits[n] if u in utt2out }))
+        utt2dur = {}
+        acc = cmvn.Accumulator()
+        for (num_done, num_frames, job_utt2dur, stats) in frontend.run_jobs(jobs, fs, opts, nj):
+            utt2dur.update(job_utt2dur)
+            acc.merge(stats)
+        print('make_features: job imbalance (longest/mean) predicted from durations {:.2f}, actual {:.2f}'.format(
+            kaldi.imbalance(loads), kaldi.imbalance(kaldi.job_times(os.path.join(logdir,'make_features_%s.JOB.log'%name), nj))))
+
+        # Write the data directory, limited to the utterances whose features were computed
+        utt2feat = {}
+        for (utt2job, ark, scp, log, s, o) in jobs:
+            utt2feat.update(kaldi.read_dict_from_file(scp))
+        if wavdir:
+            utt2wav = { u:utt2out[u] for u in utt2feat }
+        else:
+            utt2wav = { u:resample.pipe(utt2src[u], fs) for u in utt2feat }
+        kaldi.write_dict_to_file(utt2wav, os.path.join(datadir,'wav.scp'))
+        done = index.subset(utt2feat.keys())
+        done.write_table('spk', utt2spk_file)
+        done.write_table('txt', utt2txt_file)
+        kaldi.write_dict_to_file(done.spk2utt, os.path.join(datadir,'spk2utt'))
+        write_utt2dur(utt2dur, datadir)
+        kaldi.write_dict_to_file(utt2feat, utt2feat_file)
+        acc.write(os.path.join(mfccdir,'cmvn_%s.ark'%name), os.path.join(mfccdir,'cmvn_%s.scp'%name))
+        shutil.copyfile(os.path.join(mfccdir,'cmvn_%s.scp'%name), cmvn_file)
+        if len(utt2feat) < int(0.95*len(utt2src)):
+            print("Less than 95\% the features were successfully generated.  Probably a serious error.")
+        print("Succeeded creating MFCC features and CMVN stats for %s (%d of %d utterances)" % (name, len(utt2feat), len(utt2src)))
+        return(corpus(utt2wav=utt2feat_file, utt2spk=utt2spk_file, utt2txt=utt2txt_file))
+
+    def index(self):
+        '''USAGE: index=self.index()
+        Return the CorpusIndex of the utterances common to utt2wav, utt2spk and utt2txt.
+        If they are files, the index saved beside them by write_dicts_to_dictfiles is loaded,
+        if it was built from the same files, unchanged since; otherwise the files are read.
+        '''
+        names = (self.utt2wav, self.utt2spk, self.utt2txt)
+        if not all(isinstance(x,str) for x in names):
+            return(self._index)
+        signature = file_signature(names)
+        if self._index is not None and np.array_equal(signature, self._signature):
+            return(self._index)
+        index_file = os.path.join(os.path.dirname(self.utt2spk), INDEX_FILE)
+        index = CorpusIndex.load(index_file, names) if os.path.exists(index_file) else None
+        if index is None:
+            index = CorpusIndex.from_dicts(*[ kaldi.read_dict_from_file(x) for x in names ])
+        (self._index, self._signature) = (index, signature)
+        return(index)
+
     def write_dicts_to_dictfiles(self, utt2wav, utt2spk, spk2utt, utt2txt):
         '''USAGE: other=self.write_dicts_to_dictfiles(utt2wav, utt2spk, spk2utt, utt2txt)
         This creates a new SpeechCorpus in which self.utt2wav, self.utt2spk, and self.utt2txt
         have been written to the files named utt2wav, utt2spk, and utt2txt,
         and a corresponding file spk2utt has also been created.
         Utterance IDs in every output dictionary are limited to the set intersection of the 
-        inputs.
+        inputs.  The CorpusIndex is also saved, as INDEX_FILE in the directory of utt2spk.
         '''
-        u2w = kaldi.read_dict_from_file(self.utt2wav) if isinstance(self.utt2wav, str) else self.utt2wav
-        u2s = kaldi.read_dict_from_file(self.utt2spk) if isinstance(self.utt2spk, str) else self.utt2spk
-        u2t = kaldi.read_dict_from_file(self.utt2txt) if isinstance(self.utt2txt, str) else self.utt2txt 
-        common_keys = sorted(list(set.intersection(set(u2w.keys()), set(u2s.keys()), set(u2t.keys()))))
-        kaldi.write_dict_to_file({ k:u2w[k] for k in common_keys }, utt2wav)
-        kaldi.write_dict_to_file({ k:u2s[k] for k in common_keys }, utt2spk)
-        kaldi.write_dict_to_file({ k:u2t[k] for k in common_keys }, utt2txt)
-        s2u = {s:' '.join([u for u in common_keys if u2s[u]==s]) for s in set(self.utt2spk.values())}
-        kaldi.write_dict_to_file(s2u, spk2utt)
+        index = self.index()
+        index.write_table('wav', utt2wav)
+        index.write_table('spk', utt2spk)
+        index.write_table('txt', utt2txt)
+        kaldi.write_dict_to_file(index.spk2utt, spk2utt)
+        index.save(os.path.join(os.path.dirname(utt2spk), INDEX_FILE), (utt2wav, utt2spk, utt2txt))
         # Create a new corpus with filenames instead of dicts, and return it
         return(corpus(utt2wav=utt2wav, utt2spk=utt2spk, utt2txt=utt2txt))
         
-    def make_mfcc(self, kaldi_cmd, logdir, mfccdir):
-        '''USAGE: other=self.make_mfcc(kaldi_cmd, logdir, mfccdir)
-        Create MFCCs in mfccdir, put logs in logdir, if the feature files do not already exist.
+    def make_mfcc(self, kaldi_cmd, logdir, mfccdir, engine='kaldi', with_cmvn=False):
+        '''USAGE: other=self.make_mfcc(kaldi_cmd, logdir, mfccdir, engine, with_cmvn)
+        Create MFCCs in mfccdir, put logs in logdir, for utterances whose features do not already exist.
         self.utt2wav must be a wav.scp filename.
         other.utt2wav is set to the corresponding feats.scp filename.
+        engine = 'kaldi' to run compute-mfcc-feats through kaldi_cmd.train_cmd, or
+          'numpy' to compute the same features in a pool of kaldi_cmd.nproc processes (see mfcc.py)
+        with_cmvn = True to also write cmvn.scp, as compute_cmvn_stats does.  With engine='numpy',
+          the statistics of new features are accumulated as they are computed, so only reused
+          features are read back.
+        Only utterances that are missing from feats.scp, or whose wav.scp entry, waveform, or mfcc.conf
+        changed since their features were computed, are computed.  Their features go into a new set of
+        archives, and feats.scp is rewritten to reference both old and new archives; see compact_mfcc.
         '''
         (datadir, wav_scp) = os.path.split(self.utt2wav)
         utt2wav = kaldi.read_dict_from_file(self.utt2wav)
@@ -106,78 +617,198 @@ class corpus:
         # use "name" as part of name of the archive.
         name=os.path.basename(datadir)
 
+        mfcc_config = os.path.join(os.getcwd(), 'conf', 'mfcc.conf')
+        if not os.path.exists(mfcc_config):
+            raise FileNotFoundError('SpeechCorpus.corpus.make_mfcc requires '+mfcc_config)
+
         # Check if feats.scp already exists.
-        # If so, load it as a dictionary, so we can compare its mtimes to wav.scp files
+        # If so, keep the features whose wav.scp entry is unchanged, and which are newer than their waveform.
         utt2feat_file = os.path.join(datadir,'feats.scp')
+        sources_file = os.path.join(datadir,'.mfcc_sources')
         utt2feat = {}
         if os.path.exists(utt2feat_file):
-            utt2feat = kaldi.read_dict_from_file(utt2feat_file)
-            # If utt2feat has 95% of the keys of utt2wav, and its files are all newer, then return
-            missing_utts = list(set(utt2wav.keys())-set(utt2feat.keys()))
-            if len(missing_utts) < 0.05*len(utt2wav):
-                wt = max([ os.path.getmtime(w) for w in utt2wav.values() ])
-                ft = min([ os.path.getmtime(re.sub(r':.*','',f)) for f in utt2feat.values() ])
-                print('Max wav time is {}, min feat time is {}'.format(wt,ft))
-                if ft > wt:
-                    print(__name__+': doing nothing because mfcc newer than wavs in '+datadir)
-                    return(other)
-            else:
-                print('Utts not in feat: {}, including {}'.format(len(missing_utts),missing_utts[0]))
-    
+            old_feats = kaldi.read_dict_from_file(utt2feat_file)
+            sources = kaldi.read_dict_from_file(sources_file) if os.path.exists(sources_file) else {}
+            config_time = os.path.getmtime(mfcc_config)
+            ark_times = {}
+            for (utt, f) in old_feats.items():
+                ark = re.sub(r':.*','',f)
+                if ark not in ark_times:
+                    ark_times[ark] = os.path.getmtime(ark) if os.path.exists(ark) else -1
+                if (utt in utt2wav and sources.get(utt)==utt2wav[utt] and ark_times[ark] > config_time
+                    and ark_times[ark] > os.path.getmtime(re.sub(r':.*','',utt2wav[utt]))):
+                    utt2feat[utt] = f
+        todo = { u:w for (u,w) in utt2wav.items() if u not in utt2feat }
+        if len(todo)==0:
+            print(__name__+': doing nothing because mfcc newer than wavs in '+datadir)
+            if with_cmvn and kaldi.newer_than(utt2feat_file, os.path.join(datadir,'cmvn.scp')):
+                write_cmvn_stats(datadir, mfccdir, utt2feat, kaldi_cmd.nproc)
+            return(corpus(utt2wav=utt2feat_file, utt2spk=self.utt2spk, utt2txt=self.utt2txt))
+        if len(utt2feat) > 0:
+            print('make_mfcc: reusing {} utterances, computing {} new or changed, including {}'.format(
+                len(utt2feat), len(todo), sorted(todo)[0]))
             os.makedirs(os.path.join(datadir,'.backup'),exist_ok=True)
-            print("make_mfcc: moving feats.scp to {}/.backup".format(datadir))
-            shutil.move(utt2feat_file,os.path.join(datadir,'.backup','feats.scp'))
+            print("make_mfcc: copying feats.scp to {}/.backup".format(datadir))
+            shutil.copy2(utt2feat_file,os.path.join(datadir,'.backup','feats.scp'))
 
-        mfcc_config = os.path.join(os.getcwd(), 'conf', 'mfcc.conf')
-        if not os.path.exists(mfcc_config):
-            raise FileNotFoundError('SpeechCorpus.corpus.make_mfcc requires '+mfcc_config)
+        # New features go into a new shard of archives, raw_mfcc_{tag}.JOB.ark; old shards are left alone.
+        tag = name
+        increment = 0
+        while os.path.exists(os.path.join(mfccdir,'raw_mfcc_%s.1.scp'%tag)) and len(utt2feat) > 0:
+            increment += 1
+            tag = '%s_inc%d'%(name,increment)
 
         print(__name__+": [info]: this function assumes wav.scp indexed by utterance, not segments")
-        split_scps=[ os.path.join(logdir,'wav_{}.{}.scp'.format(name,n)) for n in range(1,kaldi_cmd.nproc+1) ]
-        scp_lines = [ '%s %s\n' % (k,v) for (k,v) in utt2wav.items() ]
-        num_per_job = float(len(scp_lines))/kaldi_cmd.nproc
-        for n in range(0,kaldi_cmd.nproc):
-            with open(split_scps[n],'w') as f:
-                f.writelines(scp_lines[int(n*num_per_job):int((n+1)*num_per_job)])
-
-        # This is done using run.pl to parallelize, just to make other queue managers easier
-        cmd = [ kaldi_cmd.train_cmd, 'JOB=1:%d'%(kaldi_cmd.nproc), os.path.join(logdir,'make_mfcc_%s.JOB.log'%name),
-                'compute-mfcc-feats',  '--verbose=2', '--config=%s'%mfcc_config, 
-                'scp,p:%s/wav_%s.JOB.scp'%(logdir,name), 'ark:-', '|',
-                'copy-feats', '--compress=true', 'ark:-',
-                'ark,scp:%s/raw_mfcc_%s.JOB.ark,%s/raw_mfcc_%s.JOB.scp'%(mfccdir,name,mfccdir,name)
-        ]
-        subprocess.run(cmd)
-
-        assert (not os.path.exists(os.path.join(logdir,'.error.'+name))),'%s: Error producing mfcc features for %s, see %s/make_mfcc_%s.1.log'%(__name__,name,logdir,name)
+        # Balance the jobs by total duration, so that no one job holds up the rest
+        utt2dur = get_utt2dur(self.utt2wav, kaldi_cmd.nproc)
+        utt2spk_file = os.path.join(datadir,'utt2spk')
+        num_spk = len(set(kaldi.read_dict_from_file(utt2spk_file).values())) if os.path.exists(utt2spk_file) else 0
+        if len(todo)==len(utt2wav) and num_spk >= kaldi_cmd.nproc:
+            # Every utterance is computed, so the jobs are the shards of the data directory, which later stages reuse
+            nj = kaldi_cmd.nproc
+            sdata = split_data_dir(datadir, nj)
+            split_scps = [ os.path.join(sdata,str(n),'wav.scp') for n in range(1,nj+1) ]
+            scp_pattern = os.path.join(sdata,'JOB','wav.scp')
+            loads = [ sum(utt2dur.get(u,0.0) for u in kaldi.read_dict_from_file(f)) for f in split_scps ]
+            temporary_scps = []
+        else:
+            # Only some utterances are computed, in lists of their own
+            nj = max(1, min(kaldi_cmd.nproc, len(todo)))
+            (splits, loads) = kaldi.split_lpt({ u:utt2dur.get(u,0.0) for u in todo }, nj)
+            split_scps=[ os.path.join(logdir,'wav_{}.{}.scp'.format(tag,n)) for n in range(1,nj+1) ]
+            scp_pattern = os.path.join(logdir,'wav_%s.JOB.scp'%tag)
+            for n in range(0,nj):
+                with open(split_scps[n],'w') as f:
+                    f.writelines([ '%s %s\n' % (u,todo[u]) for u in splits[n] ])
+            temporary_scps = split_scps
 
-        utt2feat = {}
-        for n in range(1,kaldi_cmd.nproc):
-            utt2feat.update(kaldi.read_dict_from_file(os.path.join(mfccdir,'raw_mfcc_%s.%d.scp'%(name,n))))
+        reused = dict(utt2feat)
+        new_stats = cmvn.Accumulator()
+        # Failure of this increment's jobs is marked as make_mfcc.sh marks it, in .error.{tag}
+        error_marker = os.path.join(logdir,'.error.'+tag)
+        if os.path.exists(error_marker):
+            os.remove(error_marker)
+        if engine=='kaldi':
+            # This is done using run.pl to parallelize, just to make other queue managers easier
+            cmd = [ 'compute-mfcc-feats',  '--verbose=2', '--config=%s'%mfcc_config, 
+                    'scp,p:%s'%scp_pattern, 'ark:-', '|',
+                    'copy-feats', '--compress=true', 'ark:-',
+                    'ark,scp:%s/raw_mfcc_%s.JOB.ark,%s/raw_mfcc_%s.JOB.scp'%(mfccdir,tag,mfccdir,tag)
+            ]
+            if kaldi_cmd.run('JOB=1:%d'%(nj), os.path.join(logdir,'make_mfcc_%s.JOB.log'%tag), cmd) != 0:
+                open(error_marker,'w').close()
+        elif engine=='numpy':
+            jobs = range(1,nj+1)
+            utt2spk = kaldi.read_dict_from_file(os.path.join(datadir,'utt2spk')) if with_cmvn else None
+            results = mfcc.compute_mfcc_jobs(split_scps,
+                                   [ ('%s/raw_mfcc_%s.%d.ark'%(mfccdir,tag,n), '%s/raw_mfcc_%s.%d.scp'%(mfccdir,tag,n))
+                                     for n in jobs ],
+                                   mfcc.read_config(mfcc_config), nj,
+                                   [ os.path.join(logdir,'make_mfcc_%s.%d.log'%(tag,n)) for n in jobs ],
+                                   utt2spk)
+            for (num_done, num_frames, stats) in results:
+                new_stats.merge(stats)
+        else:
+            raise ValueError(__name__+': unknown make_mfcc engine {}'.format(engine))
+
+        assert (not os.path.exists(error_marker)),'%s: Error producing mfcc features for %s, see %s/make_mfcc_%s.1.log'%(__name__,name,logdir,tag)
+
+        for n in range(1,nj+1):
+            new_feats = kaldi.read_dict_from_file(os.path.join(mfccdir,'raw_mfcc_%s.%d.scp'%(tag,n)))
+            utt2feat.update({ u:f for (u,f) in new_feats.items() if u in todo })
         kaldi.write_dict_to_file(utt2feat, utt2feat_file)
+        kaldi.write_dict_to_file({ u:utt2wav[u] for u in utt2feat }, sources_file)
 
-        for f in split_scps:
+        for f in temporary_scps:
             os.remove(f)
+        print('make_mfcc: job imbalance (longest/mean) predicted from durations {:.2f}, actual {:.2f}'.format(
+            kaldi.imbalance(loads), kaldi.imbalance(kaldi.job_times(os.path.join(logdir,'make_mfcc_%s.JOB.log'%tag), nj))))
 
         if len(utt2feat)!=len(utt2wav):
             print("Not all feature files successfully processed (%d<%d);"%(len(utt2feat),len(utt2wav)))
             print("Calling utils/fix_data_dir.sh %s" % datadir)
             cmd = ['utils/fix_data_dir.sh',datadir]
-            subprocess.run(cmd)
+            profiler.run(cmd)
         if len(utt2feat) < int(0.95*len(utt2wav)):
             print("Less than 95\% the features were successfully generated.  Probably a serious error.")
+        if with_cmvn:
+            if engine=='numpy':
+                write_cmvn_stats(datadir, mfccdir, reused, kaldi_cmd.nproc, new_stats)
+            else:
+                write_cmvn_stats(datadir, mfccdir, utt2feat, kaldi_cmd.nproc)
         print("Succeeded creating MFCC features for %s" % name)
         return(corpus(utt2wav=utt2feat_file, utt2spk=self.utt2spk, utt2txt=self.utt2txt))
+
+    def compact_mfcc(self, kaldi_cmd, mfccdir):
+        '''USAGE: other=self.compact_mfcc(kaldi_cmd, mfccdir)
+        Rewrite the features listed in feats.scp, which may be spread over many archives by incremental
+        calls to make_mfcc, into kaldi_cmd.nproc archives raw_mfcc_{name}.JOB.ark in mfccdir, then
+        delete the archives that are no longer referenced.  Features are copied byte for byte, except that
+        of an entry with a range (e.g., ark:1234[0:99]), only the rows and columns in the range are copied.
+        self.utt2wav must be a wav.scp or feats.scp filename.
+        '''
+        (datadir, scp) = os.path.split(self.utt2wav)
+        name = os.path.basename(datadir)
+        if not os.path.isabs(mfccdir):
+            mfccdir = os.path.join(os.getcwd(),mfccdir)
+        utt2feat_file = os.path.join(datadir,'feats.scp')
+        utt2feat = kaldi.read_dict_from_file(utt2feat_file)
+        old_arks = set(re.sub(r':.*','',f) for f in utt2feat.values())
+        utts = sorted(utt2feat.keys())
+        nj = max(1, min(kaldi_cmd.nproc, len(utts)))
+        num_per_job = float(len(utts))/nj
+        new_feats = {}
+        for n in range(0,nj):
+            ark = os.path.join(mfccdir,'raw_mfcc_%s.%d.ark'%(name,n+1))
+            scp = os.path.join(mfccdir,'raw_mfcc_%s.%d.scp'%(name,n+1))
+            with kaldi.ArkWriter(ark+'.tmp', scp+'.tmp') as writer:
+                for utt in utts[int(n*num_per_job):int((n+1)*num_per_job)]:
+                    writer.write_bytes(utt, kaldi.read_object_bytes(utt2feat[utt]))
+            for (u,f) in kaldi.read_dict_from_file(scp+'.tmp').items():
+                new_feats[u] = f.replace(ark+'.tmp:', ark+':')
+        kaldi.release_arks()
+        for n in range(0,nj):
+            for ext in ('ark','scp'):
+                f = os.path.join(mfccdir,'raw_mfcc_%s.%d.%s'%(name,n+1,ext))
+                os.replace(f+'.tmp', f)
+                if ext=='scp':
+                    kaldi.write_dict_to_file({ u:new_feats[u] for u in kaldi.read_dict_from_file(f) }, f)
+        kaldi.write_dict_to_file(new_feats, utt2feat_file)
+        new_arks = set(re.sub(r':.*','',f) for f in new_feats.values())
+        for ark in old_arks - new_arks:
+            if os.path.exists(ark):
+                os.remove(ark)
+            if os.path.exists(re.sub(r'\.ark$','.scp',ark)):
+                os.remove(re.sub(r'\.ark$','.scp',ark))
+        print("compact_mfcc: rewrote {} utterances from {} into {} archives".format(len(utts), len(old_arks), nj))
+        return(corpus(utt2wav=utt2feat_file, utt2spk=self.utt2spk, utt2txt=self.utt2txt))
                 
-    def compute_cmvn_stats(self, logdir, mfccdir):
-        '''USAGE: self.compute_cmvn_stats(logdir, mfccdir)
+    def compute_cmvn_stats(self, logdir, mfccdir, engine='kaldi', nj=1):
+        '''USAGE: self.compute_cmvn_stats(logdir, mfccdir, engine, nj)
         Compute cepstral mean and variance normalization stats for the MFCCs in mfcdir.
         self.utt2wav, self.utt2spk must be files in the same directory.
+        engine = 'kaldi' to run steps/compute_cmvn_stats.sh, or
+          'numpy' to accumulate the same statistics in a pool of nj processes (see cmvn.py)
         '''
         (datadir, wav_scp) = os.path.split(self.utt2wav)
-        cmd=['steps/compute_cmvn_stats.sh',datadir,logdir,mfccdir]
-        subprocess.run(cmd)
+        if engine=='kaldi':
+            cmd=['steps/compute_cmvn_stats.sh',datadir,logdir,mfccdir]
+            profiler.run(cmd)
+        elif engine=='numpy':
+            if not os.path.isabs(mfccdir):
+                mfccdir = os.path.join(os.getcwd(),mfccdir)
+            os.makedirs(mfccdir, exist_ok=True)
+            write_cmvn_stats(datadir, mfccdir, kaldi.read_dict_from_file(os.path.join(datadir,'feats.scp')), nj)
+        else:
+            raise ValueError(__name__+': unknown compute_cmvn_stats engine {}'.format(engine))
         
+    def split_data(self, nj):
+        '''USAGE: sdata=self.split_data(nj)
+        Shard the data directory into nj subdirectories sdata/1 ... sdata/nj, where sdata is datadir/split{nj},
+        or reuse the shards made before; see split_data_dir.
+        '''
+        return(split_data_dir(self.datadir(), nj))
+
     def datadir(self):
         '''USAGE datadir=SpeechCorpus.corpus.datadir()
         Returns the directory in which the file utt2spk resides.
@@ -0,0 +1,459 @@
+#!/usr/bin/python3
+"""
+USAGE:
+  import arpa
+  trie = arpa.load(lm, words)          # lm.arpa or lm.arpa.gz; parsed once, then cached in lm+'.trie.npz'
+  trie.prune_entropy(1e-8)             # optional: Stolcke entropy pruning, as SRILM ngram -prune
+  trie.prune_count(2)                  # optional: only for tries that carry counts
+  trie.write_fst('data/lang/G.fst')    # binary VectorFst, as arpa2fst writes it
+  trie.write_fst_text('data/lang/G.txt')   # OpenFST text form, for fstcompile
+  logprobs = trie.score(contexts, words)   # log10 p(word | context), with backoff
+  If called from the command line, compiles an ARPA LM to G.fst (or, if the output ends in .txt, to text):
+  python arpa.py lm.arpa.gz words.txt G.fst [entropy_threshold]
+
+Native replacement for arpa2fst --disambig-symbol=#0, as run by format_lm.sh.
+The ARPA file is read one line at a time, gzipped or not.  N-grams with words not in
+words.txt are skipped, as arpa2fst does when given a symbol table.  The n-grams of each order
+k are stored in three arrays, sorted by key = (index of the (k-1)-gram context)*V + word id,
+where V is the size of words.txt: the children of any n-gram are a contiguous run of keys, so
+every lookup is a binary search, done for whole arrays of n-grams at a time.
+In G.fst, each n-gram that is the context of a longer one, or has a backoff weight, is a state;
+</s> is a final weight, <s> is the start state, and each state backs off to its longest suffix that is a state,
+through an arc with #0 on the input side and <eps> on the output side.  Weights are -ln(p).
+"""
+
+import os,sys
+import re
+import gzip
+import math
+import time
+import array
+import struct
+import numpy as np
+import kaldi
+import stagecache
+
+LN10 = math.log(10.0)
+EPSILON = 1e-12     # floor for backoff numerators and denominators
+FST_MAGIC = 2125659606
+FST_VERSION = 2     # VectorFst file version
+FST_PROPERTIES = 0x3    # kExpanded | kMutable; all other properties are left for OpenFST to compute
+
+########## symbols ##################################################
+def read_symbols(words):
+    '''USAGE: word2id = read_symbols('data/lang/words.txt'); a dict from each word to its integer ID'''
+    return({ w:int(i) for (w,i) in kaldi.read_dict_from_file(words).items() })
+
+########## trie ##################################################
+class NgramTrie:
+    '''A backoff n-gram LM, stored order by order in sorted arrays.
+    keys[k-1], logprobs[k-1], backoffs[k-1] hold the n-grams of order k; logprobs and backoffs are log10.
+    counts, if not None, holds each n-gram's count (e.g., from a trainer), for prune_count.'''
+    def __init__(self, word2id, keys, logprobs, backoffs, counts=None):
+        '''USAGE: trie = NgramTrie(word2id, keys, logprobs, backoffs, counts)'''
+        for w in ('<s>','</s>'):
+            if w not in word2id:
+                raise ValueError('arpa: the symbol table has no {}'.format(w))
+        self.word2id = word2id
+        self.V = max(word2id.values()) + 1
+        self.keys = keys
+        self.logprobs = logprobs
+        self.backoffs = backoffs
+        self.counts = counts
+        self.order = len(keys)
+        (self.bos, self.eos, self.disambig) = (word2id['<s>'], word2id['</s>'], word2id.get('#0'))
+
+    @classmethod
+    def from_ngrams(cls, word2id, ngrams, counts=None):
+        '''USAGE: trie = NgramTrie.from_ngrams(word2id, ngrams, counts)
+        ngrams: list, for each order k, of (word IDs array (m,k), log10 prob array, log10 backoff array).
+        N-grams whose context is missing are dropped.'''
+        trie = cls(word2id, [], [], [], [] if counts is not None else None)
+        for (k, (W, lp, bo)) in enumerate(ngrams, start=1):
+            W = np.asarray(W, dtype=np.int64).reshape(-1, k)
+            ctx = np.zeros(len(W), dtype=np.int64)
+            found = np.ones(len(W), dtype=bool)
+            for j in range(1, k):
+                idx = trie._lookup(j, ctx, W[:,j-1])
+                found &= idx >= 0
+                ctx = np.where(found, idx, 0)
+            if not found.all():
+                print('arpa: dropping {} {}-grams whose context is missing'.format(int((~found).sum()), k))
+            key = (ctx*trie.V + W[:,k-1])[found]
+            order = np.argsort(key, kind='stable')
+            trie.keys.append(key[order])
+            trie.logprobs.append(np.asarray(lp, dtype=np.float32)[found][order])
+            trie.backoffs.append(np.asarray(bo, dtype=np.float32)[found][order])
+            if counts is not None:
+                trie.counts.append(np.asarray(counts[k-1], dtype=np.int64)[found][order])
+        trie.order = len(trie.keys)
+        return(trie)
+
+    @classmethod
+    def from_arpa(cls, filename, word2id):
+        '''USAGE: trie = NgramTrie.from_arpa(filename, word2id)
+        Parse an ARPA file (gzipped if its name ends in .gz), one line at a time.'''
+        opener = gzip.open if filename.endswith('.gz') else open
+        ngrams = []
+        skipped = 0
+        n = 0
+        get = word2id.get
+        with opener(filename,'rt',encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('\\'):
+                    m = re.match(r'^\\(\d+)-grams:', line)
+                    if m:
+                        n = int(m.group(1))
+                        while len(ngrams) < n:
+                            ngrams.append((array.array('q'), array.array('f'), array.array('f')))
+                        (ids, lps, bows) = ngrams[n-1]
+                    elif line.startswith('\\end\\'):
+                        break
+                    continue
+                if n == 0:
+                    continue
+                parts = line.split()
+                if len(parts) < n+1:
+                    continue
+                words = [ get(w, -1) for w in parts[1:n+1] ]
+                if -1 in words:
+                    skipped += 1
+                    continue
+                ids.extend(words)
+                lps.append(float(parts[0]))
+                bows.append(float(parts[n+1]) if len(parts) > n+1 else 0.0)
+        if skipped:
+            print('arpa: skipped {} n-grams with words not in the symbol table'.format(skipped))
+        result = []
+        bos_id = word2id.get('<s>')
+        eos_id = word2id.get('</s>')
+        for (k, (ids, lps, bows)) in enumerate(ngrams, start=1):
+            W = np.frombuffer(ids, dtype=np.int64).reshape(-1, k)
+            # <s> may only begin an n-gram, and </s> only end one (format_lm.sh removes the rest)
+            valid = ~((W[:,1:] == bos_id).any(axis=1) | (W[:,:-1] == eos_id).any(axis=1))
+            result.append((W[valid], np.frombuffer(lps, dtype=np.float32)[valid], np.frombuffer(bows, dtype=np.float32)[valid]))
+        return(cls.from_ngrams(word2id, result))
+
+    ########## cache ##################################################
+    def save(self, filename, key=''):
+        '''USAGE: trie.save(filename, key); key is stored with the arrays, for load_cached to check'''
+        arrays = { 'key':np.array(key), 'order':np.array(self.order) }
+        for k in range(self.order):
+            arrays.update({ 'keys%d'%k:self.keys[k], 'logprobs%d'%k:self.logprobs[k], 'backoffs%d'%k:self.backoffs[k] })
+            if self.counts is not None:
+                arrays['counts%d'%k] = self.counts[k]
+        with open(filename+'.tmp','wb') as f:
+            np.savez(f, **arrays)
+        os.replace(filename+'.tmp', filename)
+
+    @classmethod
+    def load_cached(cls, filename, word2id, key=''):
+        '''USAGE: trie = NgramTrie.load_cached(filename, word2id, key); None if missing, unreadable or saved with another key'''
+        try:
+            with np.load(filename) as data:
+                if str(data['key']) != key:
+                    return(None)
+                N = int(data['order'])
+                counts = [ data['counts%d'%k] for k in range(N) ] if 'counts0' in data else None
+                return(cls(word2id, [ data['keys%d'%k] for k in range(N) ], [ data['logprobs%d'%k] for k in range(N) ],
+                           [ data['backoffs%d'%k].copy() for k in range(N) ], counts))
+        except (OSError, KeyError, ValueError):
+            return(None)
+
+    ########## lookup ##################################################
+    def num_ngrams(self):
+        '''List of the number of n-grams of each order'''
+        return([ len(k) for k in self.keys ])
+
+    def _lookup(self, k, ctx, words):
+        '''Index in order k of the n-gram (context ctx, an index in order k-1, then word), or -1'''
+        keys = self.keys[k-1]
+        target = ctx*self.V + words
+        if len(keys) == 0:
+            return(np.full(len(target), -1, dtype=np.int64))
+        idx = np.minimum(np.searchsorted(keys, target), len(keys)-1)
+        return(np.where((ctx >= 0) & (keys[idx] == target), idx, -1))
+
+    def find(self, W):
+        '''USAGE: idx = trie.find(W)
+        W: word IDs (m,k).  idx: index of each row's n-gram in order k, or -1 if it is not in the LM.'''
+        W = np.asarray(W, dtype=np.int64)
+        idx = np.zeros(len(W), dtype=np.int64)
+        for j in range(1, W.shape[1]+1):
+            idx = self._lookup(j, idx, W[:,j-1])
+        return(idx)
+
+    def ngrams(self, k):
+        '''USAGE: W = trie.ngrams(k); word IDs (m,k) of the n-grams of order k, in their stored order'''
+        W = np.empty((len(self.keys[k-1]), k), dtype=np.int64)
+        idx = np.arange(len(self.keys[k-1]))
+        for j in range(k, 0, -1):
+            key = self.keys[j-1][idx]
+            W[:,j-1] = key % self.V
+            idx = key // self.V
+        return(W)
+
+    def is_context(self, k):
+        '''Boolean mask of the n-grams of order k that are the context of some n-gram of order k+1'''
+        mask = np.zeros(len(self.keys[k-1]), dtype=bool)
+        if k < self.order:
+            mask[self.keys[k] // self.V] = True
+        return(mask)
+
+    def score(self, contexts, words):
+        '''USAGE: logprobs = trie.score(contexts, words)
+        log10 p(word | context) for each row, backing off as far as necessary.
+        contexts: word IDs (m,c), with c >= 0; words: word IDs (m,).  Words not in the LM get -99.'''
+        contexts = np.asarray(contexts, dtype=np.int64)
+        if contexts.ndim < 2:
+            contexts = contexts.reshape(len(words), -1)
+        words = np.asarray(words, dtype=np.int64)
+        c = contexts.shape[1]
+        result = np.zeros(len(words), dtype=np.float64)
+        done = np.zeros(len(words), dtype=bool)
+        for j in range(min(c, self.order-1), -1, -1):
+            node = self.find(contexts[:,c-j:]) if j > 0 else np.zeros(len(words), dtype=np.int64)
+            full = self._lookup(j+1, node, words)
+            hit = (full >= 0) & ~done
+            result[hit] += self.logprobs[j][full[hit]]
+            miss = ~done & ~hit & (node >= 0)
+            if j > 0:
+                result[miss] += self.backoffs[j-1][node[miss]]
+            done |= hit
+        result[~done] = -99.0
+        return(result)
+
+    def history_probs(self, k):
+        '''Probability of each n-gram of order k as a word sequence, p(w1) p(w2|w1) ..., with p(<s>)=1'''
+        p = 10.0**self.logprobs[0].astype(np.float64)
+        p[self.keys[0] == self.bos] = 1.0
+        for j in range(2, k+1):
+            p = p[self.keys[j-1] // self.V] * 10.0**self.logprobs[j-1].astype(np.float64)
+        return(p)
+
+    ########## pruning ##################################################
+    def _backoff_sums(self, k):
+        '''For the n-grams of order k, their contexts, their probabilities, and their probabilities
+        under the backoff distribution; and, per context, 1 minus the totals of each'''
+        W = self.ngrams(k)
+        ctx = self.keys[k-1] // self.V
+        p = 10.0**self.logprobs[k-1].astype(np.float64)
+        plow = 10.0**self.score(W[:,1:k-1], W[:,k-1])
+        nh = len(self.keys[k-2])
+        num = np.maximum(1.0 - np.bincount(ctx, p, nh), EPSILON)
+        den = np.maximum(1.0 - np.bincount(ctx, plow, nh), EPSILON)
+        return(ctx, p, plow, num, den)
+
+    def _remove(self, k, keep):
+        '''Remove the n-grams of order k where keep is False; none of them may be a context'''
+        remap = np.cumsum(keep) - 1
+        self.keys[k-1] = self.keys[k-1][keep]
+        self.logprobs[k-1] = self.logprobs[k-1][keep]
+        self.backoffs[k-1] = self.backoffs[k-1][keep]
+        if self.counts is not None:
+            self.counts[k-1] = self.counts[k-1][keep]
+        if k < self.order:
+            key = self.keys[k]
+            self.keys[k] = remap[key // self.V]*self.V + key % self.V
+
+    def recompute_backoffs(self):
+        '''Set the backoff weight of every n-gram so that its distribution sums to one (0, if it is not a context)'''
+        for k in range(1, self.order):
+            (ctx, p, plow, num, den) = self._backoff_sums(k+1)
+            self.backoffs[k-1] = np.log10(num/den).astype(np.float32)
+
+    def prune_entropy(self, threshold):
+        '''USAGE: num_pruned = trie.prune_entropy(threshold)
+        Remove each n-gram (of order 2 or more, and not the context of another) whose removal, with
+        the other n-grams kept, raises perplexity by a relative amount less than threshold
+        (Stolcke, 1998; as SRILM ngram -prune threshold).  Backoff weights are then recomputed.'''
+        num_pruned = 0
+        for k in range(self.order, 1, -1):
+            (ctx, p, plow, num, den) = self._backoff_sums(k)
+            new_num = num[ctx] + p
+            new_den = den[ctx] + plow
+            log_alpha = np.log(num[ctx]/den[ctx])
+            new_log_alpha = np.log(new_num/new_den)
+            delta = -self.history_probs(k-1)[ctx] * (p*(np.log(plow) + new_log_alpha - np.log(p))
+                                                      + num[ctx]*(new_log_alpha - log_alpha))
+            keep = self.is_context(k) | (np.expm1(delta) >= threshold)
+            num_pruned += int((~keep).sum())
+            self._remove(k, keep)
+        if num_pruned:
+            self.recompute_backoffs()
+        return(num_pruned)
+
+    def prune_count(self, min_count):
+        '''USAGE: num_pruned = trie.prune_count(min_count)
+        Remove each n-gram (of order 2 or more, and not the context of another) seen fewer than
+        min_count times; min_count may be a list, one threshold for each order from 2 up.
+        Only tries built with counts (e.g., by a trainer) can be pruned this way; ARPA files have none.'''
+        if self.counts is None:
+            raise ValueError('arpa: this LM has no counts; use prune_entropy')
+        thresholds = list(min_count) if isinstance(min_count, (list, tuple)) else [ min_count ]*(self.order-1)
+        num_pruned = 0
+        for k in range(self.order, 1, -1):
+            keep = self.is_context(k) | (self.counts[k-1] >= thresholds[min(k-2, len(thresholds)-1)])
+            num_pruned += int((~keep).sum())
+            self._remove(k, keep)
+        if num_pruned:
+            self.recompute_backoffs()
+        return(num_pruned)
+
+    def write_arpa(self, filename):
+        '''USAGE: trie.write_arpa(filename)
+        Write the LM in ARPA format, gzipped (at the fastest level) if filename ends in .gz.  Backoff weights are
+        written for the n-grams that are contexts of longer ones.'''
+        id2word = np.empty(self.V, dtype=object)
+        for (w, i) in self.word2id.items():
+            id2word[i] = w
+        f = gzip.open(filename,'wt',encoding='utf-8',compresslevel=1) if filename.endswith('.gz') else open(filename,'w',encoding='utf-8')
+        with f:
+            f.write('\n\\data\\\n')
+            f.writelines('ngram {}={}\n'.format(k, n) for (k, n) in enumerate(self.num_ngrams(), start=1))
+            for k in range(1, self.order+1):
+                f.write('\n\\{}-grams:\n'.format(k))
+                words = [ ' '.join(row) for row in id2word[self.ngrams(k)].tolist() ]
+                logprobs = self.logprobs[k-1].tolist()
+                if k < self.order:
+                    context = self.is_context(k).tolist()
+                    backoffs = self.backoffs[k-1].tolist()
+                    f.writelines('{:.7f}\t{}\t{:.7f}\n'.format(lp, w, bo) if c else '{:.7f}\t{}\n'.format(lp, w)
+                                 for (lp, w, bo, c) in zip(logprobs, words, backoffs, context))
+                else:
+                    f.writelines('{:.7f}\t{}\n'.format(lp, w) for (lp, w) in zip(logprobs, words))
+            f.write('\n\\end\\\n')
+
+    ########## G.fst ##################################################
+    def fst_arrays(self):
+        '''USAGE: (num_states, finals, arcs) = trie.fst_arrays()
+        finals: the final weight of each state (inf if not final); state 0 is the start state.
+        arcs: (src, dst, ilabel, olabel, weight) columns, sorted by source state and then input label.'''
+        if self.disambig is None:
+            raise ValueError('arpa: the symbol table has no #0, which G.fst needs for backoff arcs')
+        N = self.order
+        # Each context is a state, as is any other n-gram with a backoff weight, so that no weight is lost;
+        # they are numbered order by order, then the root (the unigram state)
+        masks = [ self.is_context(k) | (self.backoffs[k-1] != 0) for k in range(1, N) ]
+        state_ids = []
+        next_id = 0
+        for mask in masks:
+            ids = np.full(len(mask), -1, dtype=np.int64)
+            ids[mask] = next_id + np.arange(int(mask.sum()))
+            next_id += int(mask.sum())
+            state_ids.append(ids)
+        root = next_id
+        num_states = next_id + 1
+        bos_node = self._lookup(1, np.zeros(1, dtype=np.int64), np.array([self.bos]))[0]
+        start = state_ids[0][bos_node] if (N > 1 and bos_node >= 0 and state_ids[0][bos_node] >= 0) else root
+        perm = np.arange(num_states)
+        (perm[0], perm[start]) = (start, 0)   # swap the start state with state 0
+        state_ids = [ np.where(ids >= 0, perm[np.maximum(ids, 0)], -1) for ids in state_ids ]
+        root = perm[root]
+
+        def state_of_suffix(W):
+            '''The state of the longest suffix of each row of W that is a state, or the root'''
+            dest = np.full(len(W), -1, dtype=np.int64)
+            for j in range(min(W.shape[1], N-1), 0, -1):
+                idx = self.find(W[:,W.shape[1]-j:])
+                s = np.where(idx >= 0, state_ids[j-1][np.maximum(idx, 0)], -1)
+                dest = np.where(dest < 0, s, dest)
+            return(np.where(dest < 0, root, dest))
+
+        finals = np.full(num_states, np.inf, dtype=np.float32)
+        columns = []
+        for k in range(1, N+1):
+            W = self.ngrams(k)
+            src = np.full(len(W), root, dtype=np.int64) if k == 1 else state_ids[k-2][self.keys[k-1] // self.V]
+            weight = -self.logprobs[k-1].astype(np.float64)*LN10
+            w = W[:,k-1]
+            eos = w == self.eos
+            finals[src[eos]] = weight[eos]
+            arc = ~eos & (w != self.bos)
+            columns.append((src[arc], state_of_suffix(W[arc]), w[arc], w[arc], weight[arc]))
+            if k < N:
+                mask = masks[k-1]
+                dst = state_of_suffix(W[mask][:,1:]) if k > 1 else np.full(int(mask.sum()), root, dtype=np.int64)
+                columns.append((state_ids[k-1][mask], dst, np.full(len(dst), self.disambig, dtype=np.int64),
+                                np.zeros(len(dst), dtype=np.int64), -self.backoffs[k-1][mask].astype(np.float64)*LN10))
+        (src, dst, ilabel, olabel, weight) = [ np.concatenate([ c[i] for c in columns ]) for i in range(5) ]
+        order = np.lexsort((ilabel, src))
+        return(num_states, finals, (src[order], dst[order], ilabel[order], olabel[order], weight[order]))
+
+    def write_fst_text(self, filename):
+        '''USAGE: trie.write_fst_text(filename)
+        Write G in OpenFST text form, with integer labels (compile it with fstcompile).'''
+        (num_states, finals, arcs) = self.fst_arrays()
+        write_fst_text(filename, finals, arcs)
+
+    def write_fst(self, filename):
+        '''USAGE: trie.write_fst(filename)
+        Write G as a binary OpenFST VectorFst over the standard (tropical) arc type, as arpa2fst does.'''
+        (num_states, finals, arcs) = self.fst_arrays()
+        write_fst(filename, num_states, finals, arcs)
+
+########## FST files ##################################################
+def write_fst_text(filename, finals, arcs):
+    '''USAGE: write_fst_text(filename, finals, (src, dst, ilabel, olabel, weight))
+    Write an FST in OpenFST text form, with integer labels; state 0 is the start state,
+    and finals holds the final weight of each state (inf if not final).'''
+    (src, dst, ilabel, olabel, weight) = arcs
+    with open(filename,'w') as f:
+        f.writelines('{}\t{}\t{}\t{}\t{:.7g}\n'.format(*arc) for arc in
+                     zip(src.tolist(), dst.tolist(), ilabel.tolist(), olabel.tolist(), weight.tolist()))
+        f.writelines('{}\t{:.7g}\n'.format(s, finals[s]) for s in np.flatnonzero(np.isfinite(finals)).tolist())
+
+def write_fst(filename, num_states, finals, arcs):
+    '''USAGE: write_fst(filename, num_states, finals, (src, dst, ilabel, olabel, weight))
+    Write an FST as a binary OpenFST VectorFst over the standard (tropical) arc type.
+    State 0 is the start state; the arcs must be sorted by source state.'''
+    (src, dst, ilabel, olabel, weight) = arcs
+    arcs = np.empty(len(src), dtype=[('ilabel','<i4'),('olabel','<i4'),('weight','<f4'),('nextstate','<i4')])
+    (arcs['ilabel'], arcs['olabel'], arcs['weight'], arcs['nextstate']) = (ilabel, olabel, weight, dst)
+    narcs = np.bincount(src, minlength=num_states)
+    starts = np.concatenate(([0], np.cumsum(narcs)))
+    states = np.empty(num_states, dtype=[('final','<f4'),('narcs','<i8')])
+    (states['final'], states['narcs']) = (finals, narcs)
+    def fst_string(s):
+        return(struct.pack('<i', len(s)) + s.encode('ascii'))
+    with open(filename,'wb') as f:
+        f.write(struct.pack('<i', FST_MAGIC) + fst_string('vector') + fst_string('standard'))
+        f.write(struct.pack('<iiQqqq', FST_VERSION, 0, FST_PROPERTIES, 0, num_states, len(arcs)))
+        state_bytes = states.tobytes()
+        arc_bytes = arcs.tobytes()
+        (ss, sa) = (states.itemsize, arcs.itemsize)
+        f.writelines(state_bytes[s*ss:(s+1)*ss] + arc_bytes[starts[s]*sa:starts[s+1]*sa] for s in range(num_states))
+
+########## public interface ##################################################
+def load(lm, words, cachefile=None):
+    '''USAGE: trie = load(lm, words, cachefile)
+    Load the ARPA file lm, with the word IDs of words.txt, from cachefile (default: lm+'.trie.npz'),
+    if it was saved there from the same lm and words; otherwise parse lm, and save the trie there.'''
+    cachefile = cachefile or lm + '.trie.npz'
+    word2id = read_symbols(words)
+    key = stagecache.hash_file(lm) + ' ' + stagecache.hash_file(words)
+    trie = NgramTrie.load_cached(cachefile, word2id, key)
+    if trie is None:
+        trie = NgramTrie.from_arpa(lm, word2id)
+        trie.save(cachefile, key)
+    return(trie)
+
+########## Called from the operating system ##################################################
+if __name__=="__main__":
+    if len(sys.argv) < 4:
+        print(__doc__)
+        exit(0)
+    (lm, words, fstfile) = sys.argv[1:4]
+    start = time.time()
+    trie = load(lm, words)
+    print('arpa: loaded {} n-grams of orders 1 to {} in {:.2f}s'.format(trie.num_ngrams(), trie.order, time.time()-start))
+    if len(sys.argv) > 4:
+        start = time.time()
+        num_pruned = trie.prune_entropy(float(sys.argv[4]))
+        print('arpa: pruned {} n-grams in {:.2f}s, leaving {}'.format(num_pruned, time.time()-start, trie.num_ngrams()))
+    start = time.time()
+    if fstfile.endswith('.txt'):
+        trie.write_fst_text(fstfile)
+    else:
+        trie.write_fst(fstfile)
+    print('arpa: wrote {} in {:.2f}s'.format(fstfile, time.time()-start))
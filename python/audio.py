@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+"""
+USAGE:
+  import audio
+  (x, fs) = audio.read(rxfilename)
+  (x, fs) = audio.read_segment(rxfilename, start, end)
+  for (block, fs) in audio.iter_blocks(rxfilename, blocksize): ...
+  (fs, nchannels, nframes) = audio.info(rxfilename)
+  bits_per_sample = audio.bits(rxfilename)
+
+Read audio without temporary files or repeated whole-file reads.
+WAV files are memory-mapped once per process (the MAX_MAPS most recently read stay mapped),
+and every read returns a numpy view, of shape (nframes, nchannels), into the mapped file; nothing is copied.
+rxfilename may be a plain filename, or filename:offset, where offset is the byte offset
+of a RIFF header within filename (as in Kaldi's wav.scp), so many utterances can share one file.
+read_segment returns a view of start to end seconds, as listed in a Kaldi segments file.
+FLAC files are decoded block by block, using the soundfile package if it is installed,
+otherwise by streaming raw samples from the flac command-line decoder.
+"""
+
+import os,sys
+import re
+import mmap
+import struct
+import threading
+import subprocess
+import collections
+import numpy as np
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+MAX_MAPS = 64
+_maps = collections.OrderedDict()    # filename -> mmap, shared by all views into that file; least recently used first
+_maps_lock = threading.Lock()
+
+########## auxiliary functions ##################################################
+def parse_rxfilename(rxfilename):
+    '''USAGE: (filename, offset) = parse_rxfilename(rxfilename)
+    Split filename:offset into its parts; offset is 0 if not specified.'''
+    m = re.match(r'^(.*):(\d+)$', rxfilename)
+    if m:
+        return(m.group(1), int(m.group(2)))
+    return(rxfilename, 0)
+
+def get_mmap(filename):
+    '''USAGE: buf = get_mmap(filename)
+    Return a read-only mmap of filename, creating it only if the file is not among the MAX_MAPS most recently used.
+    Older maps are forgotten, and each is unmapped, closing its file descriptor, once no views into it remain,
+    so that reading a batch of any number of files keeps no more than MAX_MAPS of them open.'''
+    with _maps_lock:
+        if filename in _maps:
+            _maps.move_to_end(filename)
+            return(_maps[filename])
+    with open(filename,'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with _maps_lock:
+        buf = _maps.setdefault(filename, buf)
+        _maps.move_to_end(filename)
+        while len(_maps) > MAX_MAPS:
+            _maps.popitem(last=False)
+    return(buf)
+
+def release(filename=None):
+    '''USAGE: release(filename) or release()
+    Forget the mmap of filename (or of all files); it is unmapped once no views remain.'''
+    with _maps_lock:
+        if filename is None:
+            _maps.clear()
+        else:
+            _maps.pop(filename, None)
+
+def is_flac(filename):
+    return(os.path.splitext(filename)[1].lower()=='.flac')
+
+def _int24_to_int32(b):
+    '''Convert an (n,3) array of little-endian 24-bit samples to int32, scaled to the full 32-bit range'''
+    return((b[:,0].astype(np.int32)<<8) | (b[:,1].astype(np.int32)<<16) | (b[:,2].astype(np.int32)<<24))
+
+########## WAV ##################################################
+def _wav_dtype(fmt, bits, filename):
+    if fmt==WAVE_FORMAT_PCM and bits in (8,16,32):
+        return({8:np.uint8, 16:np.dtype('<i2'), 32:np.dtype('<i4')}[bits])
+    if fmt==WAVE_FORMAT_IEEE_FLOAT and bits in (32,64):
+        return({32:np.dtype('<f4'), 64:np.dtype('<f8')}[bits])
+    if fmt==WAVE_FORMAT_PCM and bits==24:
+        return(None)
+    raise ValueError('audio: {} has unsupported format {} with {} bits/sample'.format(filename,fmt,bits))
+
+def parse_wav_header(buf, offset, filename):
+    '''USAGE: (fs, nchannels, bits, fmt, data_start, data_bytes) = parse_wav_header(buf, offset, filename)
+    Parse the RIFF header that starts at byte offset of buf.'''
+    if buf[offset:offset+4] != b'RIFF' or buf[offset+8:offset+12] != b'WAVE':
+        raise ValueError('audio: {} has no RIFF/WAVE header at byte {}'.format(filename, offset))
+    pos = offset + 12
+    fmt = None
+    while pos + 8 <= len(buf):
+        (chunk_id, chunk_size) = struct.unpack_from('<4sI', buf, pos)
+        if chunk_id == b'fmt ':
+            (fmt, nchannels, fs, byte_rate, block_align, bits) = struct.unpack_from('<HHIIHH', buf, pos+8)
+            if fmt == WAVE_FORMAT_EXTENSIBLE:
+                fmt = struct.unpack_from('<H', buf, pos+32)[0]
+        elif chunk_id == b'data':
+            if fmt is None:
+                raise ValueError('audio: {} has a data chunk before its fmt chunk'.format(filename))
+            data_start = pos + 8
+            # Streamed WAVs may have a placeholder data size; never read past the end of the file
+            data_bytes = min(chunk_size, len(buf) - data_start)
+            return(fs, nchannels, bits, fmt, data_start, data_bytes)
+        pos += 8 + chunk_size + (chunk_size & 1)
+    raise ValueError('audio: {} has no data chunk after byte {}'.format(filename, offset))
+
+def read_wav(filename, offset=0):
+    '''USAGE: (x, fs) = read_wav(filename, offset)
+    x: numpy view (nframes, nchannels) of the WAV whose header starts at byte offset of filename.
+    24-bit PCM has no numpy dtype, so it is the one case that is copied (left-justified into int32).'''
+    return(read_buffer(get_mmap(filename), offset, filename))
+
+def read_buffer(buf, offset=0, filename='<buffer>'):
+    '''USAGE: (x, fs) = read_buffer(buf, offset, filename)
+    As read_wav, for a WAV already in memory (bytes, or any buffer); x is a view into buf.'''
+    (fs, nchannels, bits, fmt, data_start, data_bytes) = parse_wav_header(buf, offset, filename)
+    dtype = _wav_dtype(fmt, bits, filename)
+    frame_bytes = nchannels * bits // 8
+    nframes = data_bytes // frame_bytes
+    if dtype is None:
+        b = np.frombuffer(buf, dtype=np.uint8, count=nframes*frame_bytes, offset=data_start).reshape(-1,3)
+        x = _int24_to_int32(b)
+        return(x.reshape(nframes, nchannels), fs)
+    x = np.frombuffer(buf, dtype=dtype, count=nframes*nchannels, offset=data_start)
+    return(x.reshape(nframes, nchannels), fs)
+
+########## FLAC ##################################################
+def flac_info(filename):
+    '''USAGE: (fs, nchannels, bits, nframes) = flac_info(filename)
+    Parse the STREAMINFO metadata block at the start of a FLAC file.'''
+    with open(filename,'rb') as f:
+        head = f.read(4)
+        if head[0:3] == b'ID3':  # skip an ID3v2 tag
+            rest = f.read(6)
+            size = (rest[2]<<21) | (rest[3]<<14) | (rest[4]<<7) | rest[5]
+            f.seek(10+size)
+            head = f.read(4)
+        if head != b'fLaC':
+            raise ValueError('audio: {} is not a FLAC file'.format(filename))
+        block_header = f.read(4)
+        if (block_header[0] & 0x7F) != 0:
+            raise ValueError('audio: {} does not begin with STREAMINFO'.format(filename))
+        info = f.read(34)
+    bits = int.from_bytes(info[10:18], 'big')
+    fs = bits >> 44
+    nchannels = ((bits >> 41) & 0x7) + 1
+    bits_per_sample = ((bits >> 36) & 0x1F) + 1
+    nframes = bits & 0xFFFFFFFFF
+    return(fs, nchannels, bits_per_sample, nframes)
+
+def iter_flac(filename, blocksize=65536):
+    '''USAGE: for (x, fs) in iter_flac(filename, blocksize): ...
+    Decode a FLAC file in blocks of blocksize frames; each x is an array (nframes, nchannels).
+    Only one block is in memory at a time.'''
+    (fs, nchannels, bits, nframes) = flac_info(filename)
+    dtype = np.dtype('<i2') if bits <= 16 else np.dtype('<i4')
+    if soundfile is not None:
+        # soundfile scales every sample format to the full range of the requested dtype
+        for x in soundfile.blocks(filename, blocksize=blocksize, dtype=dtype.name, always_2d=True):
+            yield(x, fs)
+        return
+    cmd = ['flac','--decode','--stdout','--silent','--force-raw-format',
+           '--endian=little','--sign=signed',filename]
+    sample_bytes = (bits+7)//8
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE) as p:
+        while True:
+            data = p.stdout.read(blocksize * nchannels * sample_bytes)
+            if not data:
+                break
+            if sample_bytes == 1:
+                x = np.frombuffer(data, dtype=np.int8).astype(np.int16) << 8
+            elif sample_bytes == 3:
+                x = _int24_to_int32(np.frombuffer(data, dtype=np.uint8).reshape(-1,3))
+            else:
+                x = np.frombuffer(data, dtype=dtype)
+            yield(x.reshape(-1, nchannels), fs)
+    if p.returncode != 0:
+        raise RuntimeError('audio: flac failed with returncode {} on {}'.format(p.returncode, filename))
+
+########## public interface ##################################################
+def info(rxfilename):
+    '''USAGE: (fs, nchannels, nframes) = info(rxfilename)
+    Read only the header; the samples are not touched.'''
+    (filename, offset) = parse_rxfilename(rxfilename)
+    if is_flac(filename):
+        (fs, nchannels, bits, nframes) = flac_info(filename)
+        return(fs, nchannels, nframes)
+    (fs, nchannels, bits, fmt, data_start, data_bytes) = parse_wav_header(get_mmap(filename), offset, filename)
+    return(fs, nchannels, data_bytes // (nchannels * bits // 8))
+
+def bits(rxfilename):
+    '''USAGE: bits_per_sample = bits(rxfilename)
+    The sample width of the file, from its header; read returns 24-bit samples left-justified in int32.'''
+    (filename, offset) = parse_rxfilename(rxfilename)
+    if is_flac(filename):
+        return(flac_info(filename)[2])
+    return(parse_wav_header(get_mmap(filename), offset, filename)[2])
+
+def read(rxfilename):
+    '''USAGE: (x, fs) = read(rxfilename)
+    x: array (nframes, nchannels).  For WAV, a zero-copy view into the mmap of the file.'''
+    (filename, offset) = parse_rxfilename(rxfilename)
+    if is_flac(filename):
+        blocks = list(iter_flac(filename))
+        fs = blocks[0][1] if blocks else flac_info(filename)[0]
+        return(np.concatenate([ b for (b, fs) in blocks ]), fs)
+    return(read_wav(filename, offset))
+
+def read_segment(rxfilename, start, end=None):
+    '''USAGE: (x, fs) = read_segment(rxfilename, start, end)
+    Return start to end seconds of the recording (to its end, if end is None or negative,
+    as in Kaldi segments files).  For WAV, x is a view, so many segments share one mmap.'''
+    (x, fs) = read(rxfilename)
+    first = int(round(start*fs))
+    last = len(x) if (end is None or end < 0) else min(len(x), int(round(end*fs)))
+    return(x[first:last], fs)
+
+def iter_blocks(rxfilename, blocksize=65536):
+    '''USAGE: for (x, fs) in iter_blocks(rxfilename, blocksize): ...
+    Iterate over blocks of at most blocksize frames: views for WAV, streamed decoding for FLAC.'''
+    (filename, offset) = parse_rxfilename(rxfilename)
+    if is_flac(filename):
+        yield from iter_flac(filename, blocksize)
+        return
+    (x, fs) = read_wav(filename, offset)
+    for start in range(0, len(x), blocksize):
+        yield(x[start:start+blocksize], fs)
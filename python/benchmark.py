@@ -0,0 +1,391 @@
+#!/usr/bin/python3
+"""
+USAGE:
+  python benchmark.py [--utts N] [--audio-utts N] [--vocab N] [--format wav|flac] [--signal tone|noise]
+                      [--nj N] [--latency S] [--utt-latency S] [--repeat N] [--cases name,...]
+                      [--workdir DIR] [--output FILE]
+  python benchmark.py --list          # list the cases
+  import benchmark
+  benchmark.make_corpus(corpusdir, num_utts, num_audio, vocab_size, format, signal)
+  results = benchmark.run_cases(names, ctx)
+
+Benchmarks of the data-preparation stages on a synthetic corpus, without Kaldi, sox or SRILM.
+make_corpus writes a corpus of num_utts utterances: wav.scp, utt2spk and text, a lexicon,
+phone lists and a toy bigram ARPA LM.  Only num_audio audio files (tones or noise, WAV or FLAC)
+are written, and the other utterances share them, so that table-level stages can be timed at
+a million utterances while the audio stages run on a manageable subset.  The corpus is reused
+by later runs with the same parameters.  External programs are replaced by the stand-ins in
+standins.py, whose latency is set by --latency and --utt-latency.
+Each case runs in a fresh process, so that its peak RSS is its own.  One JSON object per case
+and repeat is appended to the output file (default benchmarks.jsonl), with the case, its
+parameters, the number of items (utterances, lexicon entries or table lines) processed, wall
+time, throughput, peak RSS of the case's process and of its largest child, and the git version
+of the code, so that results can be compared across versions.
+"""
+
+import os,sys
+import re
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import resource
+import subprocess
+import collections
+import multiprocessing
+import numpy as np
+import kaldi
+import audio
+import resample
+import standins
+import SpeechCorpus
+import HCLG
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+PHONES = [ 'aa','ae','ah','ao','aw','ay','b','ch','d','dh','eh','er','ey','f','g','hh','ih','iy','jh','k',
+           'l','m','n','ng','ow','oy','p','r','s','sh','t','th','uh','uw','v','w','y','z','zh' ]
+UTTS_PER_SPEAKER = 50
+FS_IN = 16000     # sampling rate of the synthetic audio
+FS_OUT = 8000     # rate to which downsample resamples it
+
+########## synthetic corpus ##################################################
+def _synthesize(rng, signal, nsamples):
+    t = np.arange(nsamples)/FS_IN
+    if signal == 'tone':
+        x = sum(3000*np.sin(2*np.pi*rng.uniform(100,3500)*t + rng.uniform(0,2*np.pi)) for k in range(rng.integers(1,4)))
+        x = x + 100*rng.standard_normal(nsamples)
+    elif signal == 'noise':
+        x = 2000*rng.standard_normal(nsamples)
+    else:
+        raise ValueError('benchmark: unknown signal {}'.format(signal))
+    return(x[:,np.newaxis])
+
+def write_flac(filename, x, fs):
+    '''USAGE: write_flac(filename, x, fs)  x is a float array (nsamples, nchannels) in 16-bit scale.
+    Uses the soundfile package if it is installed, else the flac command-line encoder.'''
+    if audio.soundfile is not None:
+        audio.soundfile.write(filename, resample.quantize(x, 2).astype(np.int16), fs, subtype='PCM_16')
+        return
+    if shutil.which('flac') is None:
+        raise RuntimeError('benchmark: writing FLAC requires the soundfile package or the flac command')
+    wavfile = re.sub(r'\.flac$','',filename) + '.tmp.wav'
+    resample.write_wav(wavfile, x, fs, 2)
+    subprocess.run(['flac','--silent','--force','--delete-input-file','-o',filename,wavfile], check=True)
+
+def make_lexicon(rng, vocab_size):
+    '''USAGE: lexicon = make_lexicon(rng, vocab_size); a dict from each pseudo-word to its pronunciation'''
+    lexicon = {}
+    while len(lexicon) < vocab_size:
+        pron = [ PHONES[p] for p in rng.integers(0, len(PHONES), rng.integers(2,8)) ]
+        lexicon.setdefault(''.join(pron), ' '.join(pron))
+    return(lexicon)
+
+def write_arpa(filename, sentences, vocab, discount=0.5):
+    '''USAGE: write_arpa(filename, sentences, vocab, discount)
+    A toy bigram LM: add-one unigrams over vocab, and absolutely discounted bigrams of
+    sentences (lists of words), with the backoff weights that make each history's distribution sum to one.'''
+    unigrams = collections.Counter()
+    bigrams = collections.Counter()
+    for words in sentences:
+        unigrams.update(words + [ '</s>' ])
+        bigrams.update(zip([ '<s>' ] + words, words + [ '</s>' ]))
+    targets = sorted(vocab) + [ '</s>', '<unk>' ]
+    total = sum(unigrams[w] for w in targets) + len(targets)
+    p_uni = { w:(unigrams[w]+1)/total for w in targets }
+    history_count = collections.Counter()
+    history_types = collections.Counter()
+    history_mass = collections.Counter()
+    for ((h, w), c) in bigrams.items():
+        history_count[h] += c
+        history_types[h] += 1
+        history_mass[h] += p_uni[w]
+    def log_backoff(h):
+        return(np.log10(discount*history_types[h]/history_count[h] / max(1e-10, 1.0-history_mass[h])))
+    with open(filename,'w') as f:
+        f.write('\n\\data\\\nngram 1={}\nngram 2={}\n\n\\1-grams:\n'.format(len(targets)+1, len(bigrams)))
+        f.write('-99\t<s>\t{:.6f}\n'.format(log_backoff('<s>')))
+        for w in targets:
+            if w in history_count:
+                f.write('{:.6f}\t{}\t{:.6f}\n'.format(np.log10(p_uni[w]), w, log_backoff(w)))
+            else:
+                f.write('{:.6f}\t{}\n'.format(np.log10(p_uni[w]), w))
+        f.write('\n\\2-grams:\n')
+        for ((h, w), c) in sorted(bigrams.items()):
+            f.write('{:.6f}\t{} {}\n'.format(np.log10((c-discount)/history_count[h]), h, w))
+        f.write('\n\\end\\\n')
+
+def make_corpus(corpusdir, num_utts, num_audio, vocab_size, format='wav', signal='tone', seed=0,
+                min_dur=1.0, max_dur=4.0, lm_sentences=100000):
+    '''USAGE: paths = make_corpus(corpusdir, num_utts, num_audio, vocab_size, format, signal, seed, ...)
+    Write a synthetic corpus to corpusdir, unless one with the same parameters is already there.
+    paths: dict of the filenames written, keyed by wav_scp, audio_scp, utt2spk, text, lexicon,
+      nonsilence_phones, silence_phones, optional_silence, extra_questions, lm, words.
+    audio_scp lists only the first num_audio utterances, each with its own audio file;
+    in wav_scp, utterance n uses audio file n % num_audio.'''
+    params = dict(num_utts=num_utts, num_audio=num_audio, vocab_size=vocab_size, format=format, signal=signal,
+                  seed=seed, min_dur=min_dur, max_dur=max_dur, lm_sentences=lm_sentences)
+    dictdir = os.path.join(corpusdir,'dict')
+    paths = { 'wav_scp':os.path.join(corpusdir,'wav.scp'), 'audio_scp':os.path.join(corpusdir,'audio.scp'),
+              'utt2spk':os.path.join(corpusdir,'utt2spk'), 'text':os.path.join(corpusdir,'text'),
+              'lexicon':os.path.join(dictdir,'lexicon.txt'), 'nonsilence_phones':os.path.join(dictdir,'nonsilence_phones.txt'),
+              'silence_phones':os.path.join(dictdir,'silence_phones.txt'),
+              'optional_silence':os.path.join(dictdir,'optional_silence.txt'),
+              'extra_questions':os.path.join(dictdir,'extra_questions.txt'),
+              'lm':os.path.join(corpusdir,'lm.arpa'), 'words':os.path.join(corpusdir,'words.txt') }
+    params_file = os.path.join(corpusdir,'params.json')
+    if os.path.exists(params_file):
+        with open(params_file) as f:
+            if json.load(f) == params and all(os.path.exists(p) for p in paths.values()):
+                return(paths)
+    if os.path.exists(corpusdir):
+        shutil.rmtree(corpusdir)
+    audiodir = os.path.join(corpusdir,'audio')
+    os.makedirs(audiodir)
+    os.makedirs(dictdir)
+    rng = np.random.default_rng(seed)
+    utts = [ 'spk{:06d}-utt{:07d}'.format(n//UTTS_PER_SPEAKER, n) for n in range(num_utts) ]
+
+    audio_files = []
+    for utt in utts[0:num_audio]:
+        x = _synthesize(rng, signal, int(FS_IN*rng.uniform(min_dur, max_dur)))
+        audio_files.append(os.path.join(audiodir, utt+'.'+format))
+        if format == 'flac':
+            write_flac(audio_files[-1], x, FS_IN)
+        elif format == 'wav':
+            resample.write_wav(audio_files[-1], x, FS_IN, 2)
+        else:
+            raise ValueError('benchmark: unknown audio format {}'.format(format))
+    kaldi.write_dict_to_file({ u:audio_files[n] for (n,u) in enumerate(utts[0:num_audio]) }, paths['audio_scp'], presorted=True)
+    kaldi.write_dict_to_file({ u:audio_files[n % num_audio] for (n,u) in enumerate(utts) }, paths['wav_scp'], presorted=True)
+    kaldi.write_dict_to_file({ u:u.split('-')[0] for u in utts }, paths['utt2spk'], presorted=True)
+
+    # Transcriptions: Zipf-distributed words, 3 to 15 per utterance
+    lexicon = make_lexicon(rng, vocab_size)
+    vocab = list(lexicon)
+    lengths = rng.integers(3, 16, num_utts)
+    word_ids = np.minimum(rng.zipf(1.3, int(lengths.sum())), vocab_size) - 1
+    ends = np.cumsum(lengths)
+    sentences = ( [ vocab[i] for i in word_ids[e-l:e] ] for (l, e) in zip(lengths, ends) )
+    with open(paths['text'],'w') as f:
+        f.writelines('{}\t{}\n'.format(u, ' '.join(s)) for (u, s) in zip(utts, sentences))
+    write_arpa(paths['lm'], [ [ vocab[i] for i in word_ids[e-l:e] ] for (l, e) in zip(lengths[0:lm_sentences], ends) ], vocab)
+
+    kaldi.write_dict_to_file(dict(lexicon, **{ '<unk>':'SPN', '!SIL':'SIL' }), paths['lexicon'])
+    kaldi.write_list_to_file(PHONES, paths['nonsilence_phones'], '\n')
+    kaldi.write_list_to_file([ 'SIL','SPN' ], paths['silence_phones'], '\n')
+    kaldi.write_list_to_file([ 'SIL' ], paths['optional_silence'], ' ')
+    kaldi.write_list_to_file([ 'SIL','SPN' ], paths['extra_questions'], ' ')
+    words = [ '<eps>','!SIL','<unk>' ] + sorted(vocab) + [ '#0','<s>','</s>' ]
+    kaldi.write_list_to_file([ '{} {}'.format(w, n) for (n, w) in enumerate(words) ], paths['words'], '\n')
+    with open(params_file,'w') as f:
+        json.dump(params, f)
+    return(paths)
+
+########## cases ##################################################
+# Each case is a function of ctx (the paths from make_corpus, plus outdir, nj and fs) that does its
+# setup, then times the stage itself, and returns (number of items processed, seconds).
+
+def _corpus(ctx, wav_scp):
+    return(SpeechCorpus.corpus(utt2wav=wav_scp, utt2spk=ctx['utt2spk'], utt2txt=ctx['text']))
+
+def case_table_read(ctx):
+    start = time.time()
+    d = kaldi.read_dict_from_file(ctx['text'])
+    return(len(d), time.time()-start)
+
+def case_table_read_multi(ctx):
+    start = time.time()
+    d = kaldi.read_dict_from_file(ctx['lexicon'], multi=True)
+    return(len(d), time.time()-start)
+
+def case_table_write(ctx):
+    d = kaldi.read_dict_from_file(ctx['text'])
+    start = time.time()
+    kaldi.write_dict_to_file(d, os.path.join(ctx['outdir'],'text'))
+    return(len(d), time.time()-start)
+
+def case_table_sort(ctx):
+    with open(ctx['text']) as f:
+        lines = f.readlines()
+    random.Random(0).shuffle(lines)
+    shuffled = os.path.join(ctx['outdir'],'text.shuffled')
+    with open(shuffled,'w') as f:
+        f.writelines(lines)
+    start = time.time()
+    kaldi.sort_table_file(shuffled, os.path.join(ctx['outdir'],'text.sorted'), run_size=max(1000, len(lines)//8))
+    return(len(lines), time.time()-start)
+
+def case_table_merge(ctx):
+    with open(ctx['text']) as f:
+        lines = f.readlines()
+    parts = [ os.path.join(ctx['outdir'],'text.{}'.format(n)) for n in range(ctx['nj']) ]
+    for (n, p) in enumerate(parts):
+        with open(p,'w') as f:
+            f.writelines(lines[n::len(parts)])
+    start = time.time()
+    kaldi.merge_tables(parts, os.path.join(ctx['outdir'],'text.merged'))
+    return(len(lines), time.time()-start)
+
+def case_write_dicts_to_dictfiles(ctx):
+    c = _corpus(ctx, ctx['wav_scp'])
+    d = ctx['outdir']
+    start = time.time()
+    c.write_dicts_to_dictfiles(os.path.join(d,'wav.scp'), os.path.join(d,'utt2spk'), os.path.join(d,'spk2utt'), os.path.join(d,'text'))
+    return(len(c.index()), time.time()-start)
+
+def _downsample(ctx, engine):
+    c = _corpus(ctx, ctx['audio_scp'])
+    start = time.time()
+    other = c.downsample(FS_OUT, os.path.join(ctx['outdir'],'log'), os.path.join(ctx['outdir'],'wav'), nj=ctx['nj'], engine=engine)
+    return(len(other.utt2wav), time.time()-start)
+
+def case_downsample_sox(ctx):
+    return(_downsample(ctx, 'sox'))
+
+def case_downsample_numpy(ctx):
+    return(_downsample(ctx, 'numpy'))
+
+def _make_mfcc(ctx, engine):
+    datadir = os.path.join(ctx['outdir'],'data')
+    os.makedirs(datadir)
+    c = _corpus(ctx, ctx['audio_scp']).write_dicts_to_dictfiles(
+        *[ os.path.join(datadir,f) for f in ('wav.scp','utt2spk','spk2utt','text') ])
+    kaldi_cmd = kaldi.CMD(ctx['nj'])
+    start = time.time()
+    other = c.make_mfcc(kaldi_cmd, os.path.join(ctx['outdir'],'log'), os.path.join(ctx['outdir'],'mfcc'), engine=engine)
+    return(len(kaldi.read_dict_from_file(other.utt2wav)), time.time()-start)
+
+def case_make_mfcc_kaldi(ctx):
+    return(_make_mfcc(ctx, 'kaldi'))
+
+def case_make_mfcc_numpy(ctx):
+    return(_make_mfcc(ctx, 'numpy'))
+
+def case_lfst_write_to_dictdir(ctx):
+    L = HCLG.Lfst(ctx['lexicon'], ctx['nonsilence_phones'], ctx['silence_phones'], ctx['extra_questions'], ctx['optional_silence'])
+    start = time.time()
+    L.write_to_dictdir(os.path.join(ctx['outdir']))
+    elapsed = time.time()-start
+    with open(ctx['lexicon']) as f:
+        return(sum(1 for line in f), elapsed)
+
+CASES = collections.OrderedDict((name[5:], f) for (name, f) in list(globals().items()) if name.startswith('case_'))
+
+########## running ##################################################
+def _run_case(name, ctx, conn):
+    os.chdir(ctx['workdir'])
+    try:
+        (items, seconds) = CASES[name](ctx)
+        result = { 'items':items, 'seconds':round(seconds,6), 'items_per_second':round(items/seconds,2) if seconds > 0 else None }
+    except Exception as err:
+        result = { 'error':'{}: {}'.format(type(err).__name__, err) }
+    result['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024, 1)
+    result['children_peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024, 1)
+    conn.send(result)
+    conn.close()
+
+def run_case(name, ctx):
+    '''USAGE: result = run_case(name, ctx)
+    Run one case in a fresh process, in an empty ctx['workdir']/out/name directory; return its result dict.'''
+    outdir = os.path.join(ctx['workdir'],'out',name)
+    if os.path.exists(outdir):
+        shutil.rmtree(outdir)
+    os.makedirs(outdir)
+    mp = multiprocessing.get_context('spawn')
+    (parent, child) = mp.Pipe(duplex=False)
+    p = mp.Process(target=_run_case, args=(name, dict(ctx, outdir=outdir), child))
+    p.start()
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        result = None
+    p.join()
+    if result is None:
+        result = { 'error':'case process exited with code {}'.format(p.exitcode) }
+    shutil.rmtree(outdir, ignore_errors=True)
+    return(result)
+
+def _version():
+    c = subprocess.run(['git','describe','--always','--dirty'], cwd=_HERE, capture_output=True, text=True)
+    return(c.stdout.strip() if c.returncode == 0 else None)
+
+def run_cases(names, ctx, repeat=1, output=None):
+    '''USAGE: results = run_cases(names, ctx, repeat, output)
+    Run each case repeat times; return the list of results, and append each, as a JSON line, to output if given.
+    ctx must contain workdir, nj, and the paths returned by make_corpus; ctx['params'], if present,
+    is copied into every result.'''
+    common = { 'version':_version(), 'host':platform.node(), 'python':platform.python_version(),
+               'cpus':os.cpu_count(), 'time':time.strftime('%Y-%m-%dT%H:%M:%S') }
+    results = []
+    for name in names:
+        for r in range(repeat):
+            result = dict(common, case=name, repeat=r, **ctx.get('params',{}))
+            result.update(run_case(name, ctx))
+            results.append(result)
+            if output:
+                with open(output,'a') as f:
+                    f.write(json.dumps(result, sort_keys=True) + '\n')
+    return(results)
+
+def format_results(results):
+    '''USAGE: print(format_results(results))'''
+    lines = [ '{:<24s} {:>9s} {:>10s} {:>12s} {:>9s} {:>9s}'.format('case','items','seconds','items/s','rss(MB)','child(MB)') ]
+    for r in results:
+        if 'error' in r:
+            lines.append('{:<24s} ERROR {}'.format(r['case'], r['error']))
+        else:
+            lines.append('{:<24s} {:>9d} {:>10.3f} {:>12.1f} {:>9.1f} {:>9.1f}'.format(
+                r['case'], r['items'], r['seconds'], r['items_per_second'] or 0, r['peak_rss_mb'], r['children_peak_rss_mb']))
+    return('\n'.join(lines))
+
+########## Called from the operating system ##################################################
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Benchmark data preparation on a synthetic corpus, with stand-in binaries.')
+    parser.add_argument('--utts', type=int, default=1000, help='utterances in the corpus (table-level cases)')
+    parser.add_argument('--audio-utts', type=int, default=1000, help='utterances with their own audio file (audio cases)')
+    parser.add_argument('--vocab', type=int, default=0, help='lexicon size (default: utts/20, at least 1000)')
+    parser.add_argument('--format', choices=('wav','flac'), default='wav')
+    parser.add_argument('--signal', choices=('tone','noise'), default='tone')
+    parser.add_argument('--nj', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every stand-in invocation')
+    parser.add_argument('--utt-latency', type=float, default=0.0, help='seconds added per utterance by the feature stand-ins')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--cases', default=','.join(CASES), help='comma-separated list of cases')
+    parser.add_argument('--workdir', default='benchmark_work')
+    parser.add_argument('--output', default='benchmarks.jsonl')
+    parser.add_argument('--list', action='store_true', help='list the cases and exit')
+    args = parser.parse_args()
+    if args.list:
+        print('\n'.join(CASES))
+        sys.exit(0)
+    names = [ n for n in args.cases.split(',') if n ]
+    unknown = [ n for n in names if n not in CASES ]
+    if unknown:
+        parser.error('unknown cases {}; choose from {}'.format(','.join(unknown), ','.join(CASES)))
+
+    workdir = os.path.abspath(args.workdir)
+    num_audio = max(1, min(args.audio_utts, args.utts))
+    vocab_size = args.vocab or max(1000, args.utts//20)
+    start = time.time()
+    paths = make_corpus(os.path.join(workdir,'corpus_{}_{}_{}_{}_{}'.format(args.utts, num_audio, vocab_size, args.format, args.signal)),
+                        args.utts, num_audio, vocab_size, args.format, args.signal)
+    print('benchmark: corpus ready in {:.1f}s'.format(time.time()-start))
+
+    # Stand-ins go first on the PATH of every case process; the MFCC config matches the synthetic audio
+    os.environ['PATH'] = standins.install(os.path.join(workdir,'bin')) + os.pathsep + os.environ.get('PATH','')
+    os.environ['KALDINI_STANDIN_LATENCY'] = str(args.latency)
+    os.environ['KALDINI_STANDIN_UTT_LATENCY'] = str(args.utt_latency)
+    os.makedirs(os.path.join(workdir,'conf'), exist_ok=True)
+    with open(os.path.join(workdir,'conf','mfcc.conf'),'w') as f:
+        f.write('--use-energy=false\n--sample-frequency={}\n'.format(FS_IN))
+
+    params = { 'utts':args.utts, 'audio_utts':num_audio, 'vocab':vocab_size, 'format':args.format, 'signal':args.signal,
+               'nj':args.nj, 'latency':args.latency, 'utt_latency':args.utt_latency }
+    ctx = dict(paths, workdir=workdir, nj=args.nj, params=params)
+    results = run_cases(names, ctx, args.repeat, args.output)
+    print(format_results(results))
+    print('benchmark: results appended to {}'.format(args.output))
@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+"""
+USAGE:
+  import cmvn
+  acc = cmvn.Accumulator()
+  acc.add(spk, feats)               # once per utterance
+  acc.write(ark, scp)
+  cmvn.compute_cmvn_stats(utt2feat, utt2spk, ark, scp, nj)
+
+Per-speaker cepstral mean and variance normalization statistics, in the format written
+by compute-cmvn-stats: for features of dimension D, a (2, D+1) float64 matrix whose first
+row is the sum of the features with the frame count in its last column, and whose
+second row is the sum of squared features, with 0 in its last column.
+"""
+
+import os,sys
+import multiprocessing
+import numpy as np
+import kaldi
+
+def utterance_stats(feats):
+    '''USAGE: stats = utterance_stats(feats)
+    CMVN statistics of one (num_frames, D) feature matrix, as a (2, D+1) float64 array.'''
+    feats = np.asarray(feats, dtype=np.float64)
+    stats = np.zeros((2, feats.shape[1]+1))
+    stats[0,:-1] = feats.sum(axis=0)
+    stats[1,:-1] = np.einsum('ij,ij->j', feats, feats)
+    stats[0,-1] = feats.shape[0]
+    return(stats)
+
+def apply_cmvn(feats, stats, norm_vars=False):
+    '''USAGE: normalized = apply_cmvn(feats, stats, norm_vars)
+    Subtract the mean in stats (and, if norm_vars, divide by the standard deviation) from each frame, as apply-cmvn does.'''
+    count = stats[0,-1]
+    mean = stats[0,:-1]/count
+    if not norm_vars:
+        return((feats - mean).astype(np.float32))
+    var = np.maximum(stats[1,:-1]/count - mean**2, 1.0e-20)
+    return(((feats - mean)/np.sqrt(var)).astype(np.float32))
+
+class Accumulator:
+    '''Running per-speaker CMVN statistics.'''
+    def __init__(self):
+        '''USAGE: acc = Accumulator()'''
+        self.stats = {}
+
+    def add(self, spk, feats):
+        '''Add the statistics of one utterance's (num_frames, D) features to speaker spk'''
+        s = utterance_stats(feats)
+        if spk in self.stats:
+            self.stats[spk] += s
+        else:
+            self.stats[spk] = s
+
+    def merge(self, other):
+        '''Add in the statistics of another Accumulator (or a dict from speaker to statistics)'''
+        stats = other.stats if isinstance(other, Accumulator) else other
+        for (spk, s) in stats.items():
+            if spk in self.stats:
+                self.stats[spk] += s
+            else:
+                self.stats[spk] = np.array(s)
+
+    def write(self, ark, scp):
+        '''Write the statistics, sorted by speaker, as a Kaldi archive and scp'''
+        with kaldi.ArkWriter(ark, scp) as writer:
+            for spk in sorted(self.stats):
+                writer.write(spk, self.stats[spk])
+
+def _speaker_stats(args):
+    '''Pool worker: statistics of a list of (spk, [rxfilenames]), reading one utterance at a time'''
+    acc = Accumulator()
+    for (spk, rxfiles) in args:
+        for rxfile in rxfiles:
+            acc.add(spk, kaldi.read_mat(rxfile))
+    return(acc.stats)
+
+def compute_cmvn_stats(utt2feat, utt2spk, ark, scp, nj=1, acc=None, speakers_per_task=8):
+    '''USAGE: acc = compute_cmvn_stats(utt2feat, utt2spk, ark, scp, nj, acc)
+    Compute per-speaker statistics from the features listed in utt2feat (a dict from utterance to
+    feats.scp entry), in a pool of nj processes, each holding one utterance at a time;
+    add them to acc (statistics already accumulated for other utterances), if given;
+    write the total to ark and scp, and return the Accumulator.'''
+    spk2feats = {}
+    for (utt, rxfile) in sorted(utt2feat.items()):
+        if utt in utt2spk:
+            spk2feats.setdefault(utt2spk[utt],[]).append(rxfile)
+    spks = sorted(spk2feats.keys())
+    tasks = [ [ (s, spk2feats[s]) for s in spks[n:n+speakers_per_task] ]
+              for n in range(0, len(spks), speakers_per_task) ]
+    acc = acc if acc is not None else Accumulator()
+    if nj <= 1 or len(tasks) <= 1:
+        for t in tasks:
+            acc.merge(_speaker_stats(t))
+    else:
+        with multiprocessing.Pool(nj) as pool:
+            for stats in pool.imap_unordered(_speaker_stats, tasks):
+                acc.merge(stats)
+    acc.write(ark, scp)
+    return(acc)
@@ -0,0 +1,437 @@
+#!/usr/bin/python3
+"""
+USAGE:
+  import decode_server
+  server = decode_server.DecodeServer(modeldir, graphdir, 'exp/decode.sock', nworkers=2, batch_size=8)
+  server.serve_forever()      # until server.shutdown(), or a {"op":"shutdown"} request
+  response = decode_server.request('exp/decode.sock', {'op':'decode', 'wav':'utt1.wav'})
+  If called from the command line:
+  python decode_server.py serve model_dir graph_dir socket [nworkers] [batch_size]
+  python decode_server.py decode socket file.wav ...      # print each hypothesis, with its timing
+  python decode_server.py stats socket                    # print the latency percentiles
+
+A long-running decoder for one compiled graph.  Each of nworkers decoder processes
+(gmm-latgen-faster) loads final.mdl and HCLG.fst once, when the server starts, and then decodes
+features streamed to its stdin for as long as the server runs, so a request pays only for its
+own front end and search.  Requests arrive over a Unix socket, one JSON object per line:
+  {"op":"decode", "wav":filename} or {"op":"decode", "audio":base64 WAV bytes}
+     or {"op":"decode", "feats":rxfilename of raw MFCCs};
+     optionally with "id", and with "spk", whose utterances then share running CMVN statistics;
+  {"op":"stats"}: request counts and latency percentiles, in seconds, of each step;
+  {"op":"shutdown"}.
+Each reply is one JSON object per line: for decode, the "hyp", its "words", and its "timing".
+Requests are batched: a decoder that becomes free takes every request that is waiting, up to
+batch_size (after waiting up to max_wait seconds for more, if there are fewer), computes their
+MFCCs together with the in-process front end (frontend.py), applies CMVN and deltas as the
+training recipe does, and writes them to its decoder in one go.  A request with no frames is
+rejected before it reaches the decoder; a decoder that has not finished a batch within timeout
+seconds is killed (and restarted for the next batch), and its requests fail.
+"""
+
+import os,sys
+import re
+import json
+import time
+import base64
+import socket
+import struct
+import threading
+import socketserver
+import subprocess
+import collections
+import concurrent.futures
+import numpy as np
+import kaldi
+import audio
+import mfcc
+import cmvn
+import resample
+import frontend
+
+DECODE_OPTS = [ '--max-active=7000', '--beam=13.0', '--lattice-beam=6.0', '--acoustic-scale=0.083333',
+                '--allow-partial=true' ]
+DECODE_TIMEOUT = 300.0  # seconds a decoder may take over a batch before it is taken to be stuck, and restarted
+NUM_SAMPLES = 10000   # latencies kept for the percentiles in stats
+PERCENTILES = (50, 90, 99)
+
+_FAILED = re.compile(r'(?:Failed to decode file|Failed to get traceback for utterance|Not producing output for utterance|Zero-length utterance:) (\S+)')
+
+########## auxiliary functions ##################################################
+def matrix_bytes(key, mat):
+    '''USAGE: data = matrix_bytes(key, mat); one entry of a Kaldi binary archive of float32 matrices'''
+    (rows, cols) = mat.shape
+    return(key.encode('utf-8') + b' \0BFM ' + struct.pack('<bibi', 4, rows, 4, cols) +
+           np.ascontiguousarray(mat, dtype='<f4').tobytes())
+
+def percentiles(samples):
+    '''USAGE: d = percentiles(samples); the count, mean and PERCENTILES of a list of latencies'''
+    if not samples:
+        return({ 'count':0 })
+    a = np.array(samples)
+    d = { 'count':len(a), 'mean':float(a.mean()) }
+    d.update({ 'p{}'.format(p):float(v) for (p, v) in zip(PERCENTILES, np.percentile(a, PERCENTILES)) })
+    return(d)
+
+def request(socket_path, req):
+    '''USAGE: response = request(socket_path, req)
+    Send one request (a dict) to the server listening on socket_path, and return its reply (a dict).'''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        f = s.makefile('rwb')
+        f.write(json.dumps(req).encode('utf-8') + b'\n')
+        f.flush()
+        line = f.readline()
+    if not line:
+        raise RuntimeError('decode_server: {} closed the connection without a reply'.format(socket_path))
+    return(json.loads(line.decode('utf-8')))
+
+########## Request ##################################################
+class Request:
+    '''One utterance to decode: its audio (or raw MFCCs), and, once decoded, its hypothesis and timing.'''
+    def __init__(self, utt, spk=None, audio=None, feats=None):
+        '''USAGE: r=Request(utt, spk, audio, feats)
+        audio = (x, fs, sampwidth), as from resample.read_wav; or feats = a (num_frames, num_ceps) array'''
+        self.utt = utt
+        self.spk = spk
+        self.audio = audio
+        self.feats = feats
+        self.future = concurrent.futures.Future()
+        self.times = { 'received':time.time() }
+
+    def timing(self):
+        t = self.times
+        return({ 'queue':t['batched']-t['received'], 'frontend':t['sent']-t['batched'],
+                 'decode':t['decoded']-t['sent'], 'total':t['decoded']-t['received'] })
+
+########## Decoder ##################################################
+class Decoder:
+    '''One gmm-latgen-faster process, which keeps the model and graph loaded, fed one batch at a time.'''
+    def __init__(self, model, fst, words, opts=DECODE_OPTS):
+        '''USAGE: decoder=Decoder(model, fst, words, opts)'''
+        self.cmd = [ 'gmm-latgen-faster' ] + list(opts) + [ '--word-symbol-table='+words, model, fst,
+                                                            'ark:-', 'ark:/dev/null', 'ark,t,f:-' ]
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.proc = None
+        self.stderr_tail = collections.deque(maxlen=20)
+        self.start()
+
+    def start(self):
+        '''Start (or restart) the decoder process, and the threads that read its outputs'''
+        self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.pending = {}    # each process resolves only the utterances that were sent to it
+        for (target, stream) in ((self._read_stdout, self.proc.stdout), (self._read_stderr, self.proc.stderr)):
+            threading.Thread(target=target, args=(self.proc, self.pending, stream), daemon=True).start()
+
+    def alive(self):
+        return(self.proc is not None and self.proc.poll() is None)
+
+    def _resolve(self, pending, utt, result=None, error=None):
+        with self.lock:
+            future = pending.pop(utt, None)
+        if future is None:
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _read_stdout(self, proc, pending, stream):
+        for line in stream:
+            words = line.decode('utf-8').split()
+            if words:
+                self._resolve(pending, words[0], result=words[1:])
+        proc.wait()
+        with self.lock:
+            futures = list(pending.values())
+            pending.clear()
+        error = RuntimeError('decode_server: gmm-latgen-faster exited with code {}: {}'.format(
+            proc.returncode, ' '.join(self.stderr_tail)))
+        for future in futures:
+            future.set_exception(error)
+
+    def _read_stderr(self, proc, pending, stream):
+        for line in stream:
+            line = line.decode('utf-8', errors='replace').rstrip()
+            self.stderr_tail.append(line)
+            m = _FAILED.search(line)
+            if m:
+                self._resolve(pending, m.group(1), error=RuntimeError('decode_server: '+line))
+
+    def decode(self, batch):
+        '''USAGE: futures = decoder.decode(batch); batch is a list of (utt, features) pairs.
+        Each future's result is the list of word ids of the best path.'''
+        if not self.alive():
+            self.start()
+        pending = self.pending
+        futures = []
+        with self.lock:
+            for (utt, feats) in batch:
+                pending[utt] = concurrent.futures.Future()
+                futures.append(pending[utt])
+        try:
+            self.proc.stdin.write(b''.join(matrix_bytes(utt, feats) for (utt, feats) in batch))
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError) as err:
+            for (utt, feats) in batch:
+                self._resolve(pending, utt, error=RuntimeError('decode_server: cannot write to gmm-latgen-faster: {}'.format(err)))
+        return(futures)
+
+    def kill(self):
+        '''Stop a decoder that no longer answers; its pending futures fail, and the next decode restarts it'''
+        if self.alive():
+            self.proc.kill()
+            self.proc.wait()
+
+    def close(self):
+        if self.alive():
+            self.proc.stdin.close()
+            self.proc.wait()
+
+########## DecodeServer ##################################################
+class _Handler(socketserver.StreamRequestHandler):
+    '''Reads JSON requests, one per line, and writes one JSON reply for each'''
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                reply = self.server.decode_server.handle(json.loads(line.decode('utf-8')))
+            except (ValueError, KeyError, OSError, RuntimeError) as err:
+                reply = { 'error':str(err) }
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+            self.wfile.flush()
+            if reply.get('shutdown'):
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+                return
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class DecodeServer:
+    '''Decode requests from a Unix socket with a pool of warm decoders, batching the requests that wait.'''
+    def __init__(self, modeldir, graphdir, socket_path, nworkers=2, batch_size=8, max_wait=0.005,
+                 mfcc_config=None, opts=DECODE_OPTS, timeout=DECODE_TIMEOUT):
+        '''USAGE: server=DecodeServer(modeldir, graphdir, socket_path, nworkers, batch_size, max_wait, mfcc_config, opts, timeout)
+        modeldir = directory of final.mdl; graphdir = directory of HCLG.fst and words.txt
+        nworkers = number of decoder processes; batch_size = most requests sent to one of them at once
+        max_wait = seconds that a free decoder waits for a batch to fill before sending what it has
+        mfcc_config = the front end's options; by default, conf/mfcc.conf
+        timeout = seconds a decoder may take over one batch before its requests fail and it is restarted'''
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.batch_size = max(1, int(batch_size))
+        self.max_wait = max_wait
+        mfcc_config = mfcc_config or os.path.join(os.getcwd(),'conf','mfcc.conf')
+        self.opts = mfcc.read_config(mfcc_config) if os.path.exists(mfcc_config) else dict(mfcc.DEFAULTS)
+        self.extractor = mfcc.Extractor(self.opts)
+        self.delta_order = 2
+        delta_opts = os.path.join(modeldir,'delta_opts')
+        if os.path.exists(delta_opts):
+            m = re.search(r'--delta-order=(\d+)', open(delta_opts).read())
+            self.delta_order = int(m.group(1)) if m else self.delta_order
+        self.id2word = kaldi.read_dict_from_file(os.path.join(graphdir,'words.txt'))
+        self.id2word = { v:k for (k,v) in self.id2word.items() }
+        self.decoders = [ Decoder(os.path.join(modeldir,'final.mdl'), os.path.join(graphdir,'HCLG.fst'),
+                                  os.path.join(graphdir,'words.txt'), opts) for n in range(max(1, int(nworkers))) ]
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.cmvn = cmvn.Accumulator()
+        self.lock = threading.Lock()
+        self.latencies = { k:collections.deque(maxlen=NUM_SAMPLES) for k in ('queue','frontend','decode','total') }
+        self.counts = collections.Counter()
+        self.counter = 0
+        self.start = time.time()
+        self.running = True
+        self.workers = [ threading.Thread(target=self._work, args=(d,), daemon=True) for d in self.decoders ]
+        for w in self.workers:
+            w.start()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.server = _UnixServer(socket_path, _Handler)
+        self.server.decode_server = self
+
+    ########## requests ##################################################
+    def handle(self, req):
+        '''USAGE: reply = server.handle(req); the reply to one request, as a dict'''
+        op = req.get('op','decode')
+        if op == 'stats':
+            return(self.stats())
+        if op == 'shutdown':
+            return({ 'shutdown':True })
+        if op != 'decode':
+            raise ValueError('decode_server: unknown op {}'.format(op))
+        with self.cond:
+            self.counter += 1
+            utt = '{}-{}'.format(re.sub(r'\s+','_',str(req.get('id','utt'))), self.counter)
+        r = Request(utt, req.get('spk'))
+        if 'wav' in req:
+            r.audio = resample.read_wav(req['wav'])
+        elif 'audio' in req:
+            buf = base64.b64decode(req['audio'])
+            (data, fs) = audio.read_buffer(buf, 0, utt)
+            (x, sampwidth) = resample.from_samples(data, utt, audio.parse_wav_header(buf, 0, utt)[2])
+            r.audio = (x, fs, sampwidth)
+        elif 'feats' in req:
+            r.feats = kaldi.read_mat(req['feats'])
+        else:
+            raise ValueError('decode_server: a decode request needs wav, audio or feats')
+        words = self.submit(r).result()
+        return({ 'id':req.get('id'), 'hyp':' '.join(words), 'words':words, 'timing':r.timing() })
+
+    def submit(self, r):
+        '''USAGE: future = server.submit(r); queue the Request r, whose future's result is its list of words'''
+        with self.cond:
+            self.queue.append(r)
+            self.cond.notify()
+        return(r.future)
+
+    def _next_batch(self):
+        '''Wait for a request, then for up to max_wait more, and take up to batch_size of those waiting'''
+        with self.cond:
+            while self.running and not self.queue:
+                self.cond.wait()
+            if not self.running:
+                return([])
+            deadline = time.time() + self.max_wait
+            while len(self.queue) < self.batch_size and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+            return([ self.queue.popleft() for n in range(min(self.batch_size, len(self.queue))) ])
+
+    def _features(self, batch):
+        '''MFCCs (one FFT call for the whole batch), then CMVN and deltas, for each request in batch'''
+        with_audio = [ r for r in batch if r.audio is not None ]
+        items = frontend.downsample([ (r.utt,)+tuple(r.audio) for r in with_audio ], self.opts['sample_frequency'])
+        log = _ErrorLog()
+        feats = { u:f for (u, f, dur) in frontend.extract(items, self.extractor, log) }
+        feats.update({ r.utt:np.asarray(r.feats, dtype=np.float32) for r in batch if r.feats is not None })
+        ready = []
+        for r in batch:
+            if r.utt not in feats:
+                r.future.set_exception(RuntimeError('decode_server: {}'.format(log.messages.get(r.utt, 'no features'))))
+                continue
+            f = feats[r.utt]
+            if f.ndim != 2 or len(f) == 0:
+                # gmm-latgen-faster would skip it with only a warning, and never answer
+                r.future.set_exception(ValueError('decode_server: {} has no frames'.format(r.utt)))
+                continue
+            if r.spk is not None:
+                with self.lock:
+                    self.cmvn.add(r.spk, f)
+                    stats = np.array(self.cmvn.stats[r.spk])
+            else:
+                stats = cmvn.utterance_stats(f)
+            ready.append((r, mfcc.add_deltas(cmvn.apply_cmvn(f, stats), self.delta_order)))
+        return(ready)
+
+    def _work(self, decoder):
+        '''Loop of one decoder's thread: take a batch, and decode it'''
+        while self.running:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                self._decode_batch(decoder, batch)
+            except Exception as err:
+                # Whatever went wrong, no request of the batch may be left waiting for ever
+                for r in batch:
+                    if not r.future.done():
+                        r.future.set_exception(err)
+
+    def _decode_batch(self, decoder, batch):
+        '''Compute the features of batch, decode them, and resolve each request's future'''
+        start = time.time()
+        for r in batch:
+            r.times['batched'] = start
+        ready = self._features(batch)
+        sent = time.time()
+        futures = decoder.decode([ (r.utt, f) for (r, f) in ready ])
+        with self.lock:
+            self.counts['batches'] += 1
+            self.counts['batched_requests'] += len(batch)
+        deadline = sent + self.timeout
+        for ((r, f), future) in zip(ready, futures):
+            r.times['sent'] = sent
+            try:
+                ids = future.result(timeout=max(0.0, deadline - time.time()))
+            except concurrent.futures.TimeoutError:
+                decoder.kill()
+                with self.lock:
+                    self.counts['failed'] += 1
+                r.future.set_exception(RuntimeError('decode_server: no result for {} after {}s; restarting the decoder'.format(
+                    r.utt, self.timeout)))
+                continue
+            except RuntimeError as err:
+                with self.lock:
+                    self.counts['failed'] += 1
+                r.future.set_exception(err)
+                continue
+            r.times['decoded'] = time.time()
+            with self.lock:
+                for (k, v) in r.timing().items():
+                    self.latencies[k].append(v)
+                self.counts['decoded'] += 1
+            r.future.set_result([ self.id2word.get(i, i) for i in ids ])
+
+    ########## stats ##################################################
+    def stats(self):
+        '''USAGE: d = server.stats(); request counts, mean batch size, and latency percentiles of each step'''
+        batches = self.counts['batches']
+        d = { 'uptime':time.time()-self.start, 'workers':len(self.decoders),
+              'alive':sum(1 for dec in self.decoders if dec.alive()),
+              'decoded':self.counts['decoded'], 'failed':self.counts['failed'], 'waiting':len(self.queue),
+              'batches':batches, 'mean_batch_size':self.counts['batched_requests']/batches if batches else 0.0 }
+        with self.lock:
+            d['latency'] = { k:percentiles(list(v)) for (k, v) in self.latencies.items() }
+        return(d)
+
+    ########## running ##################################################
+    def serve_forever(self):
+        '''Answer requests until shutdown() or a shutdown request; then stop the decoders'''
+        print('decode_server: listening on {} with {} decoders'.format(self.socket_path, len(self.decoders)))
+        try:
+            self.server.serve_forever()
+        finally:
+            self.close()
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.server.server_close()
+        for d in self.decoders:
+            d.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+class _ErrorLog:
+    '''A logfile for frontend.extract that keeps its warnings by utterance'''
+    def __init__(self):
+        self.messages = {}
+
+    def write(self, message):
+        words = message.split()
+        if len(words) > 1:
+            self.messages[words[1]] = message.strip()
+
+########## Called from the operating system ##################################################
+if __name__=="__main__":
+    if len(sys.argv) < 3:
+        print(__doc__)
+        exit(0)
+    if sys.argv[1] == 'serve':
+        (modeldir, graphdir, socket_path) = sys.argv[2:5]
+        nworkers = int(sys.argv[5]) if len(sys.argv) > 5 else 2
+        batch_size = int(sys.argv[6]) if len(sys.argv) > 6 else 8
+        DecodeServer(modeldir, graphdir, socket_path, nworkers, batch_size).serve_forever()
+    elif sys.argv[1] == 'decode':
+        for wav in sys.argv[3:]:
+            reply = request(sys.argv[2], { 'op':'decode', 'id':os.path.basename(wav), 'wav':os.path.abspath(wav) })
+            print(json.dumps(reply))
+    elif sys.argv[1] == 'stats':
+        print(json.dumps(request(sys.argv[2], { 'op':'stats' }), indent=1))
+    else:
+        print(__doc__)
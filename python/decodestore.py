@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+"""
+USAGE:
+  import decodestore
+  store = decodestore.DecodeStore('exp/mono/decode_dev/decode_store.sqlite')
+  keys = store.fingerprints(datadir, 'exp/mono/final.mdl', graphdir, opts)
+  missing = store.missing(keys)
+  (decode only the missing utterances into newdir, then)
+  store.add(newdir, keys, kaldi_cmd)
+  store.write_lattices(keys, decodedir, nj)      # lat.*.gz for every utterance, as decode.sh would write them
+  If called from the command line, lists how many utterances of a data directory are current:
+  python decodestore.py store.sqlite data_dir model graph_dir [decoding options...]
+
+Decoding results, stored per utterance, so that a repeated decode only runs the utterances that changed.
+Each utterance's lattice is kept (as zlib-compressed text) under a fingerprint of everything it depends on:
+the bytes of its feature matrix, the CMVN statistics of its speaker, the model, the files in the model's
+directory that decode.sh builds its feature pipeline from (cmvn_opts, delta_opts, splice_opts, final.mat),
+the graph (HCLG.fst and words.txt), and the decoding options.  A lattice is current only if its utterance's fingerprint is
+unchanged.  The hash of each feature matrix is remembered per (scp entry, archive size, archive mtime),
+so unchanged archives are not re-read.
+"""
+
+import os,sys
+import gzip
+import glob
+import zlib
+import sqlite3
+import hashlib
+import threading
+import kaldi
+import stagecache
+
+# Files in the model's directory that steps/decode.sh reads to build the feature pipeline
+FEATURE_FILES = ('cmvn_opts', 'delta_opts', 'splice_opts', 'final.mat')
+
+########## auxiliary functions ##################################################
+def filter_table(infile, outfile, keys):
+    '''USAGE: filter_table(infile, outfile, keys); copy the lines of infile whose first word is in keys'''
+    with open(infile) as fin, open(outfile,'w') as fout:
+        for line in fin:
+            words = line.split(None,1)
+            if words and words[0] in keys:
+                fout.write(line)
+
+def subset_data_dir(datadir, utts, subdir):
+    '''USAGE: num_spk = subset_data_dir(datadir, utts, subdir)
+    Write a data directory with only the utterances utts (and their speakers), as utils/subset_data_dir.sh does.
+    Returns the number of speakers in it.'''
+    os.makedirs(subdir, exist_ok=True)
+    utts = set(utts)
+    utt2spk = { u:s for (u,s) in kaldi.iter_table(os.path.join(datadir,'utt2spk')) if u in utts }
+    spks = set(utt2spk.values())
+    for f in ('feats.scp','text','utt2spk','utt2dur','utt2num_frames'):
+        if os.path.exists(os.path.join(datadir,f)):
+            filter_table(os.path.join(datadir,f), os.path.join(subdir,f), utts)
+    for f in ('cmvn.scp','spk2gender'):
+        if os.path.exists(os.path.join(datadir,f)):
+            filter_table(os.path.join(datadir,f), os.path.join(subdir,f), spks)
+    spk2utt = {}
+    for (u,s) in sorted(utt2spk.items()):
+        spk2utt.setdefault(s,[]).append(u)
+    kaldi.write_list_to_file([ ' '.join([s]+us) for (s,us) in sorted(spk2utt.items()) ], os.path.join(subdir,'spk2utt'), '\n')
+    return(len(spks))
+
+def read_text_lattices(filename):
+    '''USAGE: for (utt, text) in read_text_lattices(filename): ...
+    The entries of a text lattice archive (as written by lattice-copy ark,t:...), each with its terminating blank line.'''
+    (utt, lines) = (None, [])
+    with open(filename) as f:
+        for line in f:
+            if utt is None:
+                if line.strip():
+                    (utt, lines) = (line.split()[0], [ line ])
+                continue
+            lines.append(line)
+            if not line.strip():
+                yield(utt, ''.join(lines))
+                (utt, lines) = (None, [])
+    if utt is not None:
+        yield(utt, ''.join(lines) + '\n')
+
+########## DecodeStore ##################################################
+class DecodeStore:
+    '''A sqlite database of per-utterance lattices, keyed by fingerprints of their inputs.'''
+    def __init__(self, dbfile):
+        '''USAGE: store = DecodeStore(dbfile)'''
+        self.dbfile = dbfile
+        dbdir = os.path.dirname(dbfile)
+        if dbdir:
+            os.makedirs(dbdir, exist_ok=True)
+        self.db = sqlite3.connect(dbfile, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS lattices (utt TEXT PRIMARY KEY, key TEXT, lattice BLOB)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS features (entry TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT)')
+        self.db.commit()
+        self.lock = threading.Lock()
+
+    def _entry_hashes(self, scp):
+        '''dict from each key of the scp file to the hash of the bytes of its archived object'''
+        entries = dict(kaldi.iter_table(scp))
+        stats = {}
+        for rx in entries.values():
+            filename = kaldi.parse_rxfilename(rx)[0]
+            if filename not in stats:
+                st = os.stat(filename)
+                stats[filename] = (st.st_size, st.st_mtime_ns)
+        kaldi.release_arks()    # archives may have been rewritten since this process mapped them
+        with self.lock:
+            known = { row[0]:row[1:] for row in self.db.execute('SELECT entry, size, mtime_ns, hash FROM features') }
+        hashes = {}
+        new_rows = []
+        for (key, rx) in entries.items():
+            (size, mtime_ns) = stats[kaldi.parse_rxfilename(rx)[0]]
+            row = known.get(rx)
+            if row is not None and row[0]==size and row[1]==mtime_ns:
+                hashes[key] = row[2]
+            else:
+                hashes[key] = hashlib.sha256(kaldi.read_object_bytes(rx)).hexdigest()
+                new_rows.append((rx, size, mtime_ns, hashes[key]))
+        if new_rows:
+            with self.lock:
+                self.db.executemany('INSERT OR REPLACE INTO features VALUES (?,?,?,?)', new_rows)
+                self.db.commit()
+        return(hashes)
+
+    def fingerprints(self, datadir, model, graphdir, opts):
+        '''USAGE: keys = store.fingerprints(datadir, model, graphdir, opts)
+        dict from each utterance in datadir/feats.scp to the fingerprint of its features, its speaker's CMVN
+        statistics, the model file, the FEATURE_FILES beside it (absent ones count as absent), graphdir/HCLG.fst
+        and words.txt, and the list of decoding options opts.'''
+        feats = self._entry_hashes(os.path.join(datadir,'feats.scp'))
+        cmvn_scp = os.path.join(datadir,'cmvn.scp')
+        cmvn = self._entry_hashes(cmvn_scp) if os.path.exists(cmvn_scp) else {}
+        utt2spk = dict(kaldi.iter_table(os.path.join(datadir,'utt2spk')))
+        common = hashlib.sha256()
+        for f in (model, os.path.join(graphdir,'HCLG.fst'), os.path.join(graphdir,'words.txt')):
+            common.update('{}\n'.format(stagecache.hash_file(f)).encode('utf-8'))
+        for f in FEATURE_FILES:
+            path = os.path.join(os.path.dirname(model), f)
+            common.update('{} {}\n'.format(f, stagecache.hash_file(path) if os.path.exists(path) else None).encode('utf-8'))
+        common.update(('\0'.join(opts)+'\n').encode('utf-8'))
+        common = common.hexdigest()
+        return({ u:hashlib.sha256('{} {} {}'.format(common, h, cmvn.get(utt2spk.get(u))).encode('utf-8')).hexdigest()
+                 for (u, h) in feats.items() })
+
+    def missing(self, keys):
+        '''USAGE: utts = store.missing(keys); the utterances in keys whose stored lattice is absent or stale'''
+        with self.lock:
+            stored = dict(self.db.execute('SELECT utt, key FROM lattices'))
+        return(sorted(u for (u, k) in keys.items() if stored.get(u) != k))
+
+    def add(self, decodedir, keys, kaldi_cmd):
+        '''USAGE: num_added = store.add(decodedir, keys, kaldi_cmd)
+        Store the lattices that decode.sh wrote in decodedir/lat.*.gz, under their utterances' keys.'''
+        latfiles = sorted(glob.glob(os.path.join(decodedir,'lat.*.gz')))
+        nj = len(latfiles)
+        if nj == 0:
+            raise RuntimeError('decodestore: no lattices in {}'.format(decodedir))
+        cmd = [ 'lattice-copy', 'ark:gunzip -c {}/lat.JOB.gz|'.format(decodedir), 'ark,t:{}/lat.JOB.txt'.format(decodedir) ]
+        logfile = os.path.join(decodedir,'log','lattice_copy.JOB.log')
+        if kaldi_cmd.run('JOB=1:{}'.format(nj), logfile, cmd, decode=True) != 0:
+            raise RuntimeError('decodestore: lattice-copy failed; see {}'.format(logfile))
+        rows = []
+        for n in range(1, nj+1):
+            textfile = os.path.join(decodedir,'lat.{}.txt'.format(n))
+            rows += [ (utt, keys[utt], zlib.compress(text.encode('utf-8'))) for (utt, text) in read_text_lattices(textfile)
+                      if utt in keys ]
+            os.remove(textfile)
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO lattices VALUES (?,?,?)', rows)
+            self.db.commit()
+        return(len(rows))
+
+    def write_lattices(self, keys, decodedir, nj):
+        '''USAGE: num_written = store.write_lattices(keys, decodedir, nj)
+        Replace decodedir/lat.*.gz by nj gzipped text archives of the current lattices of the utterances in keys,
+        which Kaldi reads as it does decode.sh's binary ones.  Utterances with no current lattice (that failed
+        to decode) are left out.'''
+        for f in glob.glob(os.path.join(decodedir,'lat.*.gz')):
+            os.remove(f)
+        with self.lock:
+            rows = [ row for row in self.db.execute('SELECT utt, key, lattice FROM lattices ORDER BY utt') if keys.get(row[0])==row[1] ]
+        nj = max(1, min(nj, len(rows)))
+        for n in range(nj):
+            with gzip.open(os.path.join(decodedir,'lat.{}.gz'.format(n+1)),'wb', compresslevel=1) as f:
+                for (utt, key, lattice) in rows[n::nj]:
+                    f.write(zlib.decompress(lattice))
+        kaldi.write_list_to_file([ str(nj) ], os.path.join(decodedir,'num_jobs'), '\n')
+        return(len(rows))
+
+    def prune(self, keys):
+        '''USAGE: store.prune(keys); forget the lattices of utterances that are not in keys'''
+        with self.lock:
+            stored = [ row[0] for row in self.db.execute('SELECT utt FROM lattices') ]
+            self.db.executemany('DELETE FROM lattices WHERE utt=?', [ (u,) for u in stored if u not in keys ])
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+########## Called from the operating system ##################################################
+if __name__=="__main__":
+    if len(sys.argv) < 5:
+        print(__doc__)
+        exit(0)
+    (dbfile, datadir, model, graphdir) = sys.argv[1:5]
+    store = DecodeStore(dbfile)
+    keys = store.fingerprints(datadir, model, graphdir, sys.argv[5:])
+    missing = store.missing(keys)
+    print('decodestore: {} of {} utterances are current'.format(len(keys)-len(missing), len(keys)))
@@ -0,0 +1,415 @@
+#!/usr/bin/python3
+"""
+USAGE:
+  import executor, kaldi
+  ex = executor.LocalExecutor(max_jobs=8, mem_per_job='2G', retries=2)
+  kaldi_cmd = kaldi.CMD(nproc=8, executor=ex)
+  returncode = kaldi_cmd.run('JOB=1:8', 'exp/log/make_mfcc.JOB.log', ['compute-mfcc-feats', ...])
+  print(ex.report())
+  If called from the command line, it is a drop-in replacement for run.pl, so that Kaldi scripts
+  can use it as --cmd:
+  python executor.py [--max-jobs-run N] [--num-threads N] [--mem 2G] [--retries N] [--no-pin] [--queue DIR] JOB=1:N log cmd...
+  python executor.py --serve DIR [options]     # run the jobs submitted to the file-based queue DIR
+
+Local execution of Kaldi job arrays.  JOB=1:N (or any VAR=start:end) is expanded natively, as
+run.pl does, and the tasks are run at most max_jobs at a time, with these controls:
+ - each task is pinned to its own num_threads CPUs, so that concurrent tasks do not share cores;
+ - a task is started only if the memory reserved by running tasks, plus mem_per_job,
+   fits in the memory that was available when the array was started;
+ - a failed task is rerun, up to retries times, before the array is declared failed;
+ - each task's wall time, user and system CPU time, and peak memory are recorded, in its log
+   (as run.pl's "# Accounting:" line, plus a "# Resources:" line) and in executor.accounting.
+QueueExecutor submits the same tasks to a directory-based queue, served by another process
+(python executor.py --serve DIR), as a stand-in for qsub on a cluster.
+"""
+
+import os,sys
+import re
+import time
+import json
+import uuid
+import shutil
+import functools
+import threading
+import subprocess
+
+########## auxiliary functions ##################################################
+def parse_size(size):
+    '''USAGE: nbytes = parse_size('2G')
+    A memory size with an optional K, M, G or T suffix, as in queue.pl --mem, in bytes.'''
+    if size is None or isinstance(size, (int, float)):
+        return(int(size or 0))
+    m = re.match(r'^\s*([\d.]+)\s*([KMGT]?)B?\s*$', size, flags=re.I)
+    if not m:
+        raise ValueError('executor: cannot parse memory size {}'.format(size))
+    return(int(float(m.group(1)) * 1024**' KMGT'.index(m.group(2).upper() or ' ')))
+
+def mem_available():
+    '''Bytes of memory available for new processes (MemAvailable in /proc/meminfo), or None if unknown.'''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return(int(line.split()[1])*1024)
+    except OSError:
+        pass
+    return(None)
+
+def parse_jobspec(jobspec):
+    '''USAGE: (var, start, end) = parse_jobspec('JOB=1:4'), or None if jobspec is not an array.'''
+    m = re.match(r'^([\w_][\w\d_]*)=(\d+):(\d+)$', jobspec)
+    if not m:
+        m = re.match(r'^([\w_][\w\d_]*)=(\d+)$', jobspec)
+        if not m:
+            return(None)
+        return(m.group(1), int(m.group(2)), int(m.group(2)))
+    return(m.group(1), int(m.group(2)), int(m.group(3)))
+
+def shell_command(words):
+    '''Join words into one shell command, quoting as run.pl does, so that | and > keep their meaning.'''
+    if isinstance(words, str):
+        return(words)
+    parts = []
+    for w in words:
+        if re.match(r'^\S+$', w):
+            parts.append(w)
+        elif '"' in w:
+            parts.append("'"+w+"'")
+        else:
+            parts.append('"'+w+'"')
+    return(' '.join(parts))
+
+########## tasks ##################################################
+class Task:
+    '''One element of a job array, and the record of running it.'''
+    def __init__(self, jobid, cmd, logfile, cpus=1, mem=0):
+        self.jobid = jobid
+        self.cmd = cmd
+        self.logfile = logfile
+        self.cpus = cpus
+        self.mem = mem
+        self.attempts = 0
+        self.returncode = None
+        self.cores = []
+        self.elapsed = 0.0
+        self.utime = 0.0
+        self.stime = 0.0
+        self.maxrss = 0    # kilobytes
+
+    def as_dict(self):
+        return({ k:getattr(self,k) for k in ('jobid','cmd','logfile','cpus','mem','attempts','returncode',
+                                             'cores','elapsed','utime','stime','maxrss') })
+
+    @classmethod
+    def from_dict(cls, d):
+        task = cls(d['jobid'], d['cmd'], d['logfile'], d['cpus'], d['mem'])
+        for (k,v) in d.items():
+            setattr(task, k, v)
+        return(task)
+
+def expand_array(jobspec, logfile, cmd, cpus=1, mem=0):
+    '''USAGE: tasks = expand_array(jobspec, logfile, cmd, cpus, mem)
+    The tasks of a job array: VAR in logfile and in cmd (a shell string or a list of words) is replaced by each index.
+    If jobspec is None, there is one task, and nothing is replaced.'''
+    cmd = shell_command(cmd)
+    spec = parse_jobspec(jobspec) if jobspec else None
+    if spec is None:
+        return([ Task(1, cmd, logfile, cpus, mem) ])
+    (var, start, end) = spec
+    pattern = re.compile(r'\b{}\b'.format(re.escape(var)))
+    return([ Task(n, pattern.sub(str(n), cmd), pattern.sub(str(n), logfile), cpus, mem) for n in range(start, end+1) ])
+
+_PIN = 'import os,sys; os.sched_setaffinity(0, [ int(c) for c in sys.argv[1].split(",") ]); os.execvp(sys.argv[2], sys.argv[2:])'
+
+@functools.lru_cache(maxsize=None)
+def _taskset():
+    return(shutil.which('taskset'))
+
+def run_task(task):
+    '''Run task once, writing a run.pl-style log, and record its resource use.  Returns its returncode.'''
+    logdir = os.path.dirname(task.logfile)
+    if logdir:
+        os.makedirs(logdir, exist_ok=True)
+    task.attempts += 1
+    start = time.time()
+    with open(task.logfile,'w') as log:
+        log.write('# {}\n# Started at {}{}\n#\n'.format(task.cmd, time.ctime(start),
+                  '' if task.attempts==1 else ' (attempt {})'.format(task.attempts)))
+        log.flush()
+        # pipefail, so that a failure anywhere in a pipeline like compute-mfcc-feats | copy-feats is seen, and retried
+        argv = ['bash','-c','set -o pipefail; '+task.cmd]
+        # The affinity is set by the child itself, before it execs bash (with taskset, or else a python one-liner),
+        # rather than by a preexec_fn, which is not safe when, as here, tasks are started from several threads at once
+        if task.cores and hasattr(os,'sched_setaffinity'):
+            cores = ','.join(str(c) for c in task.cores)
+            if _taskset():
+                argv = [ _taskset(), '-c', cores ] + argv
+            else:
+                argv = [ sys.executable, '-c', _PIN, cores ] + argv
+        try:
+            p = subprocess.Popen(argv, stdout=log, stderr=subprocess.STDOUT)
+            # wait4, rather than wait, so that the task's own resource use (and its children's) is known
+            (pid, status, rusage) = os.wait4(p.pid, 0)
+            p.returncode = os.waitstatus_to_exitcode(status)
+            task.returncode = p.returncode
+            task.utime = rusage.ru_utime
+            task.stime = rusage.ru_stime
+            task.maxrss = rusage.ru_maxrss
+        except OSError as err:
+            log.write('executor: {}\n'.format(err))
+            task.returncode = -1
+        task.elapsed = time.time() - start
+        log.write('# Accounting: time={:d} threads={}\n'.format(int(round(task.elapsed)), task.cpus))
+        log.write('# Resources: utime={:.2f} stime={:.2f} maxrss={}kB cores={}\n'.format(
+            task.utime, task.stime, task.maxrss, ','.join(str(c) for c in task.cores) or 'any'))
+        log.write('# Ended (code {}) at {}, elapsed time {:d} seconds\n'.format(
+            task.returncode, time.ctime(), int(round(task.elapsed))))
+    return(task.returncode)
+
+########## local executor ##################################################
+class LocalExecutor:
+    '''Run job arrays as local processes, with CPU pinning, memory-aware admission and retries.'''
+    def __init__(self, max_jobs=None, cpus_per_job=1, mem_per_job=0, retries=0, pin=True):
+        '''USAGE: ex=LocalExecutor(max_jobs, cpus_per_job, mem_per_job, retries, pin)
+        max_jobs = most tasks running at once (default: the number of CPUs this process may use)
+        cpus_per_job = CPUs each task is pinned to (run.pl's --num-threads)
+        mem_per_job = memory each task is expected to need, in bytes or as a string like '2G' (queue.pl's --mem)
+        retries = number of times a failed task is rerun
+        pin = False to let the operating system place tasks on CPUs
+        '''
+        self.cores = sorted(os.sched_getaffinity(0)) if hasattr(os,'sched_getaffinity') else list(range(os.cpu_count() or 1))
+        self.max_jobs = max(1, int(max_jobs)) if max_jobs else len(self.cores)
+        self.cpus_per_job = max(1, int(cpus_per_job))
+        self.mem_per_job = parse_size(mem_per_job)
+        self.retries = int(retries)
+        self.pin = pin
+        self.accounting = []
+        self.lock = threading.Lock()
+
+    def command_line(self):
+        '''The words of a command line that runs this executor from a shell script, e.g. as --cmd'''
+        words = [ sys.executable, os.path.abspath(__file__), '--max-jobs-run', str(self.max_jobs),
+                  '--num-threads', str(self.cpus_per_job), '--retries', str(self.retries) ]
+        if self.mem_per_job:
+            words += [ '--mem', '{}K'.format(self.mem_per_job//1024) ]
+        if not self.pin:
+            words.append('--no-pin')
+        return(words)
+
+    def run(self, jobspec, logfile, cmd):
+        '''USAGE: returncode = ex.run(jobspec, logfile, cmd)
+        Run the job array, as run.pl jobspec logfile cmd would.  Returns 0 if every task eventually succeeded, else 1.'''
+        tasks = expand_array(jobspec, logfile, cmd, self.cpus_per_job, self.mem_per_job)
+        self.run_tasks(tasks)
+        failed = [ t for t in tasks if t.returncode != 0 ]
+        if failed:
+            sys.stderr.write('executor: {} / {} failed, log is in {}\n'.format(len(failed), len(tasks), failed[0].logfile))
+        return(1 if failed else 0)
+
+    def run_tasks(self, tasks):
+        '''Run a list of Tasks to completion, retrying failures; record them in self.accounting.'''
+        queue = list(tasks)
+        running = []
+        free_cores = list(self.cores)
+        budget = mem_available()
+        done = threading.Condition()
+        def worker(task):
+            # Whatever happens, the task must leave running, or the loop below would wait for it forever
+            retry = False
+            try:
+                run_task(task)
+                retry = (task.returncode != 0 and task.attempts <= self.retries)
+            except Exception as err:
+                # e.g., the log cannot be opened: retrying would fail the same way
+                sys.stderr.write('executor: task {} of {}: {}: {}\n'.format(task.jobid, task.logfile, type(err).__name__, err))
+                task.returncode = -1
+            finally:
+                with done:
+                    running.remove(task)
+                    free_cores.extend(task.cores)
+                    if retry:
+                        queue.append(task)
+                    done.notify_all()
+        with done:
+            while queue or running:
+                while queue and self._admit(queue[0], running, free_cores, budget):
+                    task = queue.pop(0)
+                    task.cores = []
+                    if self.pin and len(free_cores) >= task.cpus:
+                        task.cores = sorted(free_cores[0:task.cpus])
+                        del free_cores[0:task.cpus]
+                    running.append(task)
+                    threading.Thread(target=worker, args=(task,), daemon=True).start()
+                done.wait()
+        with self.lock:
+            self.accounting += tasks
+        return(tasks)
+
+    def _admit(self, task, running, free_cores, budget):
+        if not running:
+            return(True)
+        if len(running) >= self.max_jobs:
+            return(False)
+        if budget is not None and task.mem and sum(t.mem for t in running) + task.mem > budget:
+            return(False)
+        return(True)
+
+    def report(self):
+        '''USAGE: print(ex.report())
+        Resource use of every task run so far, and totals.'''
+        with self.lock:
+            tasks = list(self.accounting)
+        lines = [ 'Executor: {} tasks, {} failed, {} retried'.format(
+            len(tasks), sum(1 for t in tasks if t.returncode != 0), sum(1 for t in tasks if t.attempts > 1)) ]
+        lines.append('    wall {:.1f}s, user {:.1f}s, system {:.1f}s, largest peak RSS {:.1f}MB'.format(
+            sum(t.elapsed for t in tasks), sum(t.utime for t in tasks), sum(t.stime for t in tasks),
+            max((t.maxrss for t in tasks), default=0)/1024))
+        for t in sorted(tasks, key=lambda t: -t.elapsed)[0:10]:
+            lines.append('    {:8.1f}s {:8.1f}MB code {} x{}  {}'.format(t.elapsed, t.maxrss/1024, t.returncode,
+                                                                          t.attempts, t.logfile))
+        return('\n'.join(lines))
+
+########## file-based queue ##################################################
+class FileQueue:
+    '''A job queue in a directory: tasks are files that move from pending/ to running/ to done/.
+    Each move is an atomic rename, so any number of submitters and servers can share the directory.'''
+    def __init__(self, queuedir):
+        '''USAGE: q=FileQueue(queuedir)'''
+        self.queuedir = os.path.abspath(queuedir)
+        for d in ('pending','running','done'):
+            os.makedirs(os.path.join(self.queuedir,d), exist_ok=True)
+
+    def _path(self, state, jobname):
+        return(os.path.join(self.queuedir, state, jobname+'.json'))
+
+    def submit(self, task):
+        '''USAGE: jobname = q.submit(task)'''
+        jobname = '{:.6f}-{}'.format(time.time(), uuid.uuid4().hex[0:8])
+        with open(self._path('pending',jobname)+'.tmp','w') as f:
+            json.dump(task.as_dict(), f)
+        os.replace(self._path('pending',jobname)+'.tmp', self._path('pending',jobname))
+        return(jobname)
+
+    def wait(self, jobnames, poll=0.2):
+        '''USAGE: tasks = q.wait(jobnames, poll)
+        Wait until every job in jobnames is done; return their finished Tasks, in the same order.'''
+        results = {}
+        while len(results) < len(jobnames):
+            for j in jobnames:
+                if j not in results and os.path.exists(self._path('done',j)):
+                    with open(self._path('done',j)) as f:
+                        results[j] = Task.from_dict(json.load(f))
+                    os.remove(self._path('done',j))
+            if len(results) < len(jobnames):
+                time.sleep(poll)
+        return([ results[j] for j in jobnames ])
+
+    def claim(self):
+        '''USAGE: [(jobname, task), ...] = q.claim()
+        Move every pending job to running/, and return them; jobs claimed by another server are skipped.'''
+        claimed = []
+        for name in sorted(os.listdir(os.path.join(self.queuedir,'pending'))):
+            if not name.endswith('.json'):
+                continue
+            jobname = name[:-5]
+            try:
+                os.rename(self._path('pending',jobname), self._path('running',jobname))
+            except FileNotFoundError:
+                continue
+            with open(self._path('running',jobname)) as f:
+                claimed.append((jobname, Task.from_dict(json.load(f))))
+        return(claimed)
+
+    def finish(self, jobname, task):
+        with open(self._path('done',jobname)+'.tmp','w') as f:
+            json.dump(task.as_dict(), f)
+        os.replace(self._path('done',jobname)+'.tmp', self._path('done',jobname))
+        os.remove(self._path('running',jobname))
+
+    def serve(self, executor, poll=0.2, stop=None):
+        '''USAGE: q.serve(executor, poll, stop)
+        Run submitted jobs with executor (a LocalExecutor), as they arrive, until stop (a threading.Event) is set.'''
+        while stop is None or not stop.is_set():
+            claimed = self.claim()
+            if not claimed:
+                time.sleep(poll)
+                continue
+            executor.run_tasks([ t for (j,t) in claimed ])
+            for (jobname, task) in claimed:
+                self.finish(jobname, task)
+
+class QueueExecutor:
+    '''Submit job arrays to a FileQueue, as queue.pl submits them to a cluster, and wait for them.'''
+    def __init__(self, queuedir, cpus_per_job=1, mem_per_job=0, retries=0, poll=0.2):
+        '''USAGE: ex=QueueExecutor(queuedir, cpus_per_job, mem_per_job, retries, poll)'''
+        self.queue = FileQueue(queuedir)
+        self.cpus_per_job = max(1, int(cpus_per_job))
+        self.mem_per_job = parse_size(mem_per_job)
+        self.retries = int(retries)
+        self.poll = poll
+        self.accounting = []
+
+    def command_line(self):
+        words = [ sys.executable, os.path.abspath(__file__), '--queue', self.queue.queuedir,
+                  '--num-threads', str(self.cpus_per_job), '--retries', str(self.retries) ]
+        if self.mem_per_job:
+            words += [ '--mem', '{}K'.format(self.mem_per_job//1024) ]
+        return(words)
+
+    def run(self, jobspec, logfile, cmd):
+        '''USAGE: returncode = ex.run(jobspec, logfile, cmd); failed tasks are resubmitted up to retries times'''
+        tasks = expand_array(jobspec, logfile, cmd, self.cpus_per_job, self.mem_per_job)
+        for attempt in range(self.retries+1):
+            todo = [ n for (n,t) in enumerate(tasks) if t.returncode != 0 ]
+            if not todo:
+                break
+            finished = self.queue.wait([ self.queue.submit(tasks[n]) for n in todo ], self.poll)
+            for (n, t) in zip(todo, finished):
+                tasks[n] = t
+        self.accounting += tasks
+        failed = [ t for t in tasks if t.returncode != 0 ]
+        if failed:
+            sys.stderr.write('executor: {} / {} failed, log is in {}\n'.format(len(failed), len(tasks), failed[0].logfile))
+        return(1 if failed else 0)
+
+    report = LocalExecutor.report
+
+########## Called from the operating system ##################################################
+if __name__=="__main__":
+    args = sys.argv[1:]
+    opts = { 'max_jobs':None, 'cpus':1, 'mem':0, 'retries':0, 'pin':True, 'queue':None, 'serve':None }
+    # Options like run.pl's; options this executor does not use (e.g. --gpu, --config) are ignored, as run.pl does
+    while args and args[0].startswith('--'):
+        (name, value) = (args[0], args[1] if len(args) > 1 else None)
+        if name == '--no-pin':
+            (opts['pin'], args) = (False, args[1:])
+            continue
+        args = args[2:]
+        if name in ('--max-jobs-run','--max-jobs'):
+            opts['max_jobs'] = int(value)
+        elif name == '--num-threads':
+            opts['cpus'] = int(value)
+        elif name == '--mem':
+            opts['mem'] = value
+        elif name == '--retries':
+            opts['retries'] = int(value)
+        elif name == '--queue':
+            opts['queue'] = value
+        elif name == '--serve':
+            opts['serve'] = value
+    local = LocalExecutor(opts['max_jobs'], opts['cpus'], opts['mem'], opts['retries'], opts['pin'])
+    if opts['serve']:
+        FileQueue(opts['serve']).serve(local)
+        sys.exit(0)
+    if len(args) < 2:
+        print(__doc__)
+        sys.exit(1)
+    if parse_jobspec(args[0]) is not None:
+        (jobspec, logfile, cmd) = (args[0], args[1], args[2:])
+    else:
+        (jobspec, logfile, cmd) = (None, args[0], args[1:])
+    if opts['queue']:
+        ex = QueueExecutor(opts['queue'], opts['cpus'], opts['mem'], opts['retries'])
+    else:
+        ex = local
+    sys.exit(ex.run(jobspec, logfile, cmd))
@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+"""
+USAGE:
+  import frontend
+  results = frontend.run_jobs(jobs, fs, opts, nj)
+  (num_done, num_frames, utt2dur, cmvn_stats) = frontend.run_job(utt2src, fs, opts, ark, scp, log, utt2spk, utt2out)
+  If called from the command line, compares the fused front end with separate passes on a synthetic corpus:
+  python frontend.py [num_utts] [nj]
+
+Fused front end: each utterance is decoded, resampled, optionally saved as a WAV, converted to
+MFCCs, and added to its speaker's CMVN statistics, in one pass, so that nothing but the
+final feature archive is written.  Each stage is a generator that pulls from the one
+before it, so a worker holds at most one batch of mfcc.BATCH_SIZE utterances at a time, however
+large its share of the corpus; jobs run in a pool of worker processes, one archive per job.
+Features are the same as those that mfcc.compute_mfcc_job computes from WAVs written by
+resample.resample_files.
+"""
+
+import os,sys
+import time
+import multiprocessing
+import numpy as np
+import kaldi
+import resample
+import mfcc
+import cmvn
+
+# Multipliers that bring resample.read_wav's integer scale, for each sample width, to 16 bits, as mfcc.to_int16_scale does
+_INT16_SCALE = { 1:256.0, 2:1.0, 3:1.0/256, 4:1.0/65536 }
+
+########## stages ##################################################
+def decode(utt2src, logfile):
+    '''USAGE: for (utt, x, fs, sampwidth) in decode(utt2src, logfile): ...
+    Read each source file in utt2src (WAV or FLAC, any rxfilename audio.read accepts), one at a time.'''
+    for (utt, src) in utt2src.items():
+        try:
+            (x, fs, sampwidth) = resample.read_wav(src)
+        except (OSError, ValueError, RuntimeError) as err:
+            logfile.write('WARNING: failed to read {}: {}\n'.format(utt, err))
+            continue
+        yield(utt, x, fs, sampwidth)
+
+def downsample(items, fs):
+    '''USAGE: for (utt, x, fs, sampwidth) in downsample(items, fs): ...
+    Resample each waveform to fs, and round it to the sample values its WAV file would contain.'''
+    for (utt, x, fs_in, sampwidth) in items:
+        yield(utt, resample.quantize(resample.resample(x, fs_in, fs), sampwidth), fs, sampwidth)
+
+def save(items, utt2out):
+    '''USAGE: for (utt, x, fs, sampwidth) in save(items, utt2out): ...
+    Write each waveform whose utterance is in utt2out to that filename, and pass it on unchanged.'''
+    for (utt, x, fs, sampwidth) in items:
+        if utt in utt2out:
+            resample.write_wav(utt2out[utt], x, fs, sampwidth)
+        yield(utt, x, fs, sampwidth)
+
+def extract(items, extractor, logfile):
+    '''USAGE: for (utt, feats, duration) in extract(items, extractor, logfile): ...
+    Compute MFCCs, mfcc.BATCH_SIZE utterances per FFT call.'''
+    batch = []
+    def flush():
+        signals = [ x[:,0]*_INT16_SCALE[w] for (u,x,fs,w) in batch ]
+        feats = extractor.compute(signals, [ mfcc._utt_seed(u) for (u,x,fs,w) in batch ])
+        for ((u,x,fs,w), f) in zip(batch, feats):
+            if len(f)==0:
+                logfile.write('WARNING: {} is too short to extract any frames\n'.format(u))
+                continue
+            yield(u, f, len(x)/fs)
+    for item in items:
+        batch.append(item)
+        if len(batch) == mfcc.BATCH_SIZE:
+            yield from flush()
+            batch = []
+    if batch:
+        yield from flush()
+
+########## jobs ##################################################
+def run_job(utt2src, fs, opts, ark, scp, log, utt2spk=None, utt2out=None, compress=True):
+    '''USAGE: (num_done, num_frames, utt2dur, cmvn_stats) = run_job(utt2src, fs, opts, ark, scp, log, utt2spk, utt2out, compress)
+    Run the fused front end on every utterance in utt2src (a dict from utterance to source audio file).
+    Features are written to ark and scp (compressed, as by copy-feats --compress=true, unless compress=False).
+    utt2dur: duration in seconds of each utterance whose features were written.
+    If utt2spk is given, cmvn_stats are the per-speaker CMVN statistics of the features as written, else {}.
+    If utt2out is given, the resampled waveform of each utterance in it is also written to the WAV file it names.
+    '''
+    start_time = time.time()
+    extractor = mfcc.Extractor(opts)
+    if extractor.opts['sample_frequency'] != fs:
+        raise ValueError('frontend: resampling to {} but mfcc sample_frequency is {}'.format(
+            fs, extractor.opts['sample_frequency']))
+    num_done = 0
+    num_frames = 0
+    utt2dur = {}
+    acc = cmvn.Accumulator()
+    with open(log,'w') as logfile, kaldi.ArkWriter(ark, scp) as writer:
+        logfile.write('frontend.run_job {} utterances to {} {}\n'.format(len(utt2src), ark, scp))
+        items = downsample(decode(utt2src, logfile), fs)
+        if utt2out:
+            items = save(items, utt2out)
+        for (utt, f, duration) in extract(items, extractor, logfile):
+            if compress:
+                data = b'\0B' + kaldi.compress_matrix(f)
+                writer.write_bytes(utt, data)
+                f = kaldi.read_object(data, 0)[0]
+            else:
+                writer.write(utt, f)
+            if utt2spk is not None and utt in utt2spk:
+                acc.add(utt2spk[utt], f)
+            utt2dur[utt] = duration
+            num_done += 1
+            num_frames += len(f)
+        logfile.write('Done {} out of {} utterances, {} frames.\n'.format(num_done, len(utt2src), num_frames))
+        logfile.write('# Accounting: time={:.2f} threads=1\n'.format(time.time()-start_time))
+    return(num_done, num_frames, utt2dur, acc.stats)
+
+def _run_job(args):
+    return(run_job(*args))
+
+def run_jobs(jobs, fs, opts, nj):
+    '''USAGE: results = run_jobs(jobs, fs, opts, nj)
+    Run run_job for each job in a pool of nj processes.
+    jobs: list of (utt2src, ark, scp, log, utt2spk, utt2out) tuples, one per output archive.
+    results: list of (num_done, num_frames, utt2dur, cmvn_stats), one per job.
+    '''
+    args = [ (utt2src, fs, opts, ark, scp, log, utt2spk, utt2out) for (utt2src, ark, scp, log, utt2spk, utt2out) in jobs ]
+    if nj <= 1 or len(args) <= 1:
+        return([ run_job(*a) for a in args ])
+    with multiprocessing.Pool(min(nj, len(args))) as pool:
+        return(pool.map(_run_job, args))
+
+########## Called from the operating system ##################################################
+if __name__=="__main__":
+    import tempfile, shutil
+    num_utts = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    nj = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    opts = dict(mfcc.DEFAULTS, sample_frequency=8000.0)
+    workdir = tempfile.mkdtemp()
+    rng = np.random.default_rng(0)
+    utt2src = {}
+    for n in range(num_utts):
+        utt = 'spk{}-utt{:06d}'.format(n%10, n)
+        utt2src[utt] = os.path.join(workdir,utt+'.wav')
+        t = np.arange(int(16000*rng.uniform(2,5)))/16000
+        x = 3000*np.sin(2*np.pi*rng.uniform(100,3500)*t) + 300*rng.standard_normal(len(t))
+        resample.write_wav(utt2src[utt], x[:,np.newaxis], 16000, 2)
+    utt2spk = { u:u.split('-')[0] for u in utt2src }
+    utts = sorted(utt2src)
+    splits = [ utts[n::nj] for n in range(nj) ]
+
+    # Separate passes: resample to WAV files, then MFCC, then CMVN
+    start = time.time()
+    os.makedirs(os.path.join(workdir,'wav'))
+    tasks = [ (u, utt2src[u], os.path.join(workdir,'wav',u+'.wav'), None) for u in utts ]
+    resample.resample_all(tasks, 8000, nj, os.path.join(workdir,'resample'))
+    split_scps = []
+    for n in range(nj):
+        split_scps.append(os.path.join(workdir,'wav.{}.scp'.format(n+1)))
+        kaldi.write_dict_to_file({ u:os.path.join(workdir,'wav',u+'.wav') for u in splits[n] }, split_scps[n])
+    pairs = [ (os.path.join(workdir,'separate.{}.ark'.format(n+1)), os.path.join(workdir,'separate.{}.scp'.format(n+1)))
+              for n in range(nj) ]
+    mfcc.compute_mfcc_jobs(split_scps, pairs, opts, nj,
+                           [ os.path.join(workdir,'mfcc.{}.log'.format(n+1)) for n in range(nj) ])
+    utt2feat = {}
+    for (ark, scp) in pairs:
+        utt2feat.update(kaldi.read_dict_from_file(scp))
+    separate = cmvn.compute_cmvn_stats(utt2feat, utt2spk, os.path.join(workdir,'cmvn_separate.ark'),
+                                       os.path.join(workdir,'cmvn_separate.scp'), nj)
+    elapsed_separate = time.time()-start
+
+    # Fused
+    start = time.time()
+    jobs = [ ({ u:utt2src[u] for u in splits[n] }, os.path.join(workdir,'fused.{}.ark'.format(n+1)),
+              os.path.join(workdir,'fused.{}.scp'.format(n+1)), os.path.join(workdir,'fused.{}.log'.format(n+1)),
+              utt2spk, None) for n in range(nj) ]
+    fused = cmvn.Accumulator()
+    for (num_done, num_frames, utt2dur, stats) in run_jobs(jobs, 8000, opts, nj):
+        fused.merge(stats)
+    fused.write(os.path.join(workdir,'cmvn_fused.ark'), os.path.join(workdir,'cmvn_fused.scp'))
+    elapsed_fused = time.time()-start
+
+    def disk_usage(prefix):
+        return(sum(os.path.getsize(os.path.join(root,f)) for (root,dirs,files) in os.walk(workdir)
+                   for f in files if os.path.relpath(os.path.join(root,f),workdir).startswith(prefix)))
+    print('separate passes: {:.2f}s, {:.1f}MB written'.format(elapsed_separate,
+          sum(disk_usage(p) for p in ('wav/','wav.','separate','cmvn_separate'))/1e6))
+    print('fused: {:.2f}s, {:.1f}MB written'.format(elapsed_fused, sum(disk_usage(p) for p in ('fused','cmvn_fused'))/1e6))
+    fused_feats = {}
+    for n in range(nj):
+        fused_feats.update(kaldi.read_dict_from_file(jobs[n][2]))
+    worst = max(np.max(np.abs(kaldi.read_mat(utt2feat[u]) - kaldi.read_mat(fused_feats[u]))) for u in utt2feat)
+    print('maximum absolute difference between fused and separate features: {:.2e}'.format(worst))
+    print('maximum absolute difference between CMVN stats: {:.2e}'.format(
+        max(np.max(np.abs(separate.stats[s]-fused.stats[s])) for s in separate.stats)))
+    shutil.rmtree(workdir)
@@ -6,7 +6,19 @@ USAGE:
   Use other utils as useful.
 """
 import os,sys
+import re
+import mmap
+import struct
+import collections.abc
+import contextlib
+import heapq
+import itertools
 import subprocess
+import threading
+import queue
+import numpy as np
+import stagecache
+import profiler
 
 def set_path(kaldi_root, srilm_path):
     '''USAGE: kaldi_path.set(kaldi_root, srilm_path)
@@ -61,60 +73,563 @@ def set_path(kaldi_root, srilm_path):
 
 class CMD:
     '''Class that contains optimization information such as nproc, train_cmd, and decode_cmd'''
-    def __init__(self, nproc, train_cmd, decode_cmd):
+    def __init__(self, nproc, train_cmd=None, decode_cmd=None, executor=None):
+        '''USAGE: kaldi_cmd=CMD(nproc, train_cmd, decode_cmd, executor)
+        train_cmd, decode_cmd: job-array commands for Kaldi scripts, e.g., 'run.pl' or 'queue.pl --mem 2G'
+        executor: optionally, an executor.LocalExecutor or executor.QueueExecutor, which then runs
+          the job arrays started by self.run, and, unless train_cmd or decode_cmd are given, those of Kaldi scripts.
+        '''
         self.nproc = nproc
-        self.train_cmd = train_cmd
-        self.decode_cmd = decode_cmd
+        self.executor = executor
+        default_cmd = ' '.join(executor.command_line()) if executor is not None else 'run.pl'
+        self.train_cmd = train_cmd or default_cmd
+        self.decode_cmd = decode_cmd or default_cmd
+
+    def run(self, jobspec, logfile, cmd, decode=False):
+        '''USAGE: returncode = kaldi_cmd.run(jobspec, logfile, cmd, decode)
+        Run the job array cmd (a list of words, in which JOB is replaced by each job number), as
+        train_cmd (or decode_cmd) jobspec logfile cmd would, e.g., run.pl JOB=1:4 log.JOB.txt cmd...
+        With an executor, the array is run in this process, without a run.pl shell-out.'''
+        with profiler.span(os.path.basename(str(cmd[0])), 'array', jobspec=jobspec, logfile=logfile) as s:
+            if self.executor is not None:
+                returncode = self.executor.run(jobspec, logfile, cmd)
+            else:
+                prefix = (self.decode_cmd if decode else self.train_cmd).split()
+                returncode = subprocess.run(prefix + [jobspec, logfile] + list(cmd)).returncode
+            m = re.match(r'^JOB=1:(\d+)$', jobspec)
+            if s.enabled and m:
+                s.jobs(job_times(logfile, int(m.group(1))))
+            s.set(returncode=returncode)
+        return(returncode)
 
 def newer_than(file1,file2):
+    '''True if file2 does not exist, or if file1 (a filename or a list of them) was modified after file2.
+    A directory in file1 stands for every file in it, since rewriting a file does not change its directory's mtime.'''
     if not os.path.exists(file2):
         return(True)
-    if os.path.getmtime(file1) > os.path.getmtime(file1):
-        return(True)
-    else:
-        return(False)
-def read_dict_from_file(filename):
-    '''Read a dictionary from a file.  First word on each line is the key, remainder is the entry.'''
-    dict = {}
+    file1s = stagecache.expand_paths([file1] if isinstance(file1,str) else file1)
+    t2 = os.path.getmtime(file2)
+    return(any(os.path.getmtime(f) > t2 for f in file1s if os.path.exists(f)))
+
+STAGE_CACHE = None
+
+def set_stage_cache(dbfile):
+    '''USAGE: cache = kaldi.set_stage_cache(dbfile)
+    From now on, convert_if_newer decides whether to rerun each stage by the content hashes
+    of its inputs, command and tools, recorded in the database dbfile, instead of by mtimes.
+    set_stage_cache(None) returns to mtime comparisons.'''
+    global STAGE_CACHE
+    if STAGE_CACHE is not None:
+        STAGE_CACHE.close()
+    STAGE_CACHE = stagecache.StageCache(dbfile) if dbfile else None
+    return(STAGE_CACHE)
+
+########## tables ##################################################
+CHUNK_SIZE = 1<<22    # bytes read at a time by read_dict_from_file
+
+def _parse_line(line):
+    '''Split a table line into (key, value), with the value's internal whitespace collapsed to single spaces'''
+    parts = line.split(None,1)
+    if len(parts) < 2:
+        return(parts[0], '')
+    value = parts[1].rstrip()
+    if '\t' in value or '  ' in value:
+        value = ' '.join(value.split())
+    return(parts[0], value)
+
+def iter_table(filename):
+    '''USAGE: for (key, value) in iter_table(filename): ...
+    Lazily read a table: first word on each line is the key, remainder is the entry.  Blank lines are skipped.'''
     with open(filename) as f:
         for line in f:
-            words = line.rstrip().split()
-            dict[words[0]] = ' '.join(words[1:])
+            if line.strip():
+                yield(_parse_line(line))
+
+def read_dict_from_file(filename, multi=False):
+    '''Read a dictionary from a file.  First word on each line is the key, remainder is the entry.
+    The file is read in chunks of CHUNK_SIZE bytes.  A chunk whose lines all have exactly two fields
+    (scp, utt2spk, utt2dur, ...) is split by str.split mapped over its lines, with no Python-level loop;
+    any other chunk is parsed one line at a time.  If a key occurs on more than one line, the last entry
+    wins, unless multi=True, in which case every value is a list of all of that key's entries, in order
+    (e.g., to keep alternate pronunciations in a lexicon).'''
+    dict = {}
+    with open(filename) as f:
+        tail = ''
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            lines = (tail + chunk).split('\n')
+            tail = lines.pop()
+            _add_lines(dict, lines, multi)
+        _add_lines(dict, [tail], multi)
     return(dict)
+
+def _add_lines(dict, lines, multi):
+    if not multi:
+        try:
+            dict.update(map(str.split, lines))
+            return
+        except ValueError:
+            pass    # some line is blank or has more than two fields; re-read the chunk line by line
+    pairs = ( _parse_line(line) for line in lines if line and not line.isspace() )
+    if multi:
+        for (k,v) in pairs:
+            dict.setdefault(k,[]).append(v)
+    else:
+        dict.update(pairs)
+
 def read_list_from_file(filename):
     '''Read a list of words from a file.  Doesn't matter if they're separated by spaces or newlines'''
     with open(filename) as f:
         result = f.read().split()
     return(result)
-def write_dict_to_file(d, filename):
-    '''Write a dictionary to a file: first word on each line is the key, remainder are the entry.'''
+
+def _table_lines(items):
+    for (k,v) in items:
+        if isinstance(v,list):
+            for x in v:
+                yield('{}\t{}\n'.format(k,x))
+        else:
+            yield('{}\t{}\n'.format(k,v))
+
+def write_dict_to_file(d, filename, presorted=False):
+    '''Write a dictionary to a file: first word on each line is the key, remainder are the entry.
+    Lines are sorted by key, unless presorted=True says the dict is already in sorted order.
+    A value that is a list (as from read_dict_from_file(multi=True)) is written as one line per item.'''
+    items = d.items() if presorted else sorted(d.items())
     with open(filename,"w") as f:
-        for (k,v) in sorted(d.items()):
-            f.write('{}\t{}\n'.format(k,v))
+        f.writelines(_table_lines(items))
+
+def merge_tables(filenames, filename):
+    '''USAGE: merge_tables(filenames, filename)
+    k-way merge of tables that are each already sorted by key, into one sorted table,
+    reading each input lazily, so memory use does not depend on the size of the tables.'''
+    with open(filename,'w') as f:
+        f.writelines(_table_lines(heapq.merge(*[ iter_table(x) for x in filenames ], key=lambda kv: kv[0])))
+
+def sort_table_file(infile, outfile, run_size=1000000):
+    '''USAGE: sort_table_file(infile, outfile, run_size)
+    External sort of a table of any size: sort runs of run_size lines in memory, write each
+    to a temporary file, then merge_tables them.'''
+    runs = []
+    table = iter_table(infile)
+    try:
+        while True:
+            run = sorted(itertools.islice(table, run_size), key=lambda kv: kv[0])
+            if not run and runs:
+                break
+            runs.append('{}.run{}'.format(outfile, len(runs)))
+            with open(runs[-1],'w') as f:
+                f.writelines(_table_lines(run))
+            if len(run) < run_size:
+                break
+        merge_tables(runs, outfile)
+    finally:
+        for r in runs:
+            if os.path.exists(r):
+                os.remove(r)
+
 def write_list_to_file(data, filename, separator):
     '''Write a list to a file, with separator between list items'''
     with open(filename,'w') as f:
         f.write(separator.join(data)+'\n')
 
+########## job splitting ##################################################
+def split_lpt(weights, nj):
+    '''USAGE: (splits, loads) = split_lpt(weights, nj)
+    Split the keys of weights (a dict from key to cost, e.g. duration) into nj jobs, using
+    greedy longest-processing-time bin packing: each key, from most to least costly,
+    goes to the job with the smallest load so far.
+    splits: list of nj sorted lists of keys
+    loads: list of nj total costs
+    '''
+    nj = max(1, int(nj))
+    heap = [ (0.0, n) for n in range(nj) ]
+    splits = [ [] for n in range(nj) ]
+    loads = [ 0.0 ] * nj
+    for (k, w) in sorted(weights.items(), key=lambda kw: (-kw[1], kw[0])):
+        (load, n) = heapq.heappop(heap)
+        splits[n].append(k)
+        loads[n] = load + w
+        heapq.heappush(heap, (loads[n], n))
+    return([ sorted(x) for x in splits ], loads)
+
+def imbalance(loads):
+    '''Ratio of the largest to the mean of loads: 1.0 is perfectly balanced'''
+    loads = [ l for l in loads if l is not None ]
+    if len(loads)==0 or sum(loads)==0:
+        return(1.0)
+    return(max(loads) * len(loads) / sum(loads))
+
+def job_times(logpattern, nj):
+    '''USAGE: times = job_times(logpattern, nj)
+    Wall-clock seconds of each job of a JOB=1:nj array, read from the "# Accounting: time=..."
+    line that run.pl writes at the end of each log.  logpattern contains JOB, e.g. exp/log/make_mfcc.JOB.log.
+    Jobs whose log has no such line are None.'''
+    times = []
+    for n in range(1,nj+1):
+        t = None
+        logfile = logpattern.replace('JOB',str(n))
+        if os.path.exists(logfile):
+            with open(logfile) as f:
+                for line in f:
+                    m = re.match(r'^# Accounting: time=([0-9.]+)', line)
+                    if m:
+                        t = float(m.group(1))
+        times.append(t)
+    return(times)
+
+########## Kaldi archives ##################################################
+MAX_ARKS = 64
+_arks = collections.OrderedDict()    # archive filename -> mmap, shared by every matrix read from that archive
+_arks_lock = threading.Lock()
+
+def _get_ark_mmap(filename):
+    '''The mmap of archive filename.  Only the MAX_ARKS most recently used archives stay mapped; an older one is
+    unmapped, and its file descriptor closed, once no matrix views into it remain.'''
+    with _arks_lock:
+        if filename in _arks:
+            _arks.move_to_end(filename)
+            return(_arks[filename])
+    with open(filename,'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with _arks_lock:
+        buf = _arks.setdefault(filename, buf)
+        _arks.move_to_end(filename)
+        while len(_arks) > MAX_ARKS:
+            _arks.popitem(last=False)
+    return(buf)
+
+def release_arks():
+    '''Forget all archive mmaps; each is unmapped once no matrix views into it remain.'''
+    with _arks_lock:
+        _arks.clear()
+
+def parse_rxfilename(rxfile):
+    '''USAGE: (filename, offset, rows, cols) = parse_rxfilename(rxfile)
+    Split a feats.scp entry such as mfcc/raw_mfcc_train.1.ark:1234[0:99,0:12] into its parts.
+    offset is None if there is none; rows and cols are slices, or None.'''
+    m = re.match(r'^(.*?)(?::(\d+))?(?:\[(\d+):(\d+)(?:,(\d+):(\d+))?\])?$', rxfile)
+    if rxfile.endswith('|') or rxfile.startswith('-') or m is None:
+        raise ValueError('kaldi: cannot read {} without running a pipe'.format(rxfile))
+    (filename, offset, r1, r2, c1, c2) = m.groups()
+    rows = slice(int(r1), int(r2)+1) if r1 is not None else None
+    cols = slice(int(c1), int(c2)+1) if c1 is not None else None
+    return(filename, None if offset is None else int(offset), rows, cols)
+
+def _uint16_to_float(min_value, value_range, u):
+    return(min_value + value_range * (1.0/65535.0) * u)
+
+def _read_compressed(buf, pos, token):
+    '''Decode a CompressedMatrix (token CM, CM2 or CM3) whose global header starts at pos.'''
+    (min_value, value_range, rows, cols) = struct.unpack_from('<ffii', buf, pos)
+    pos += 16
+    if token == b'CM2':
+        data = np.frombuffer(buf, dtype='<u2', count=rows*cols, offset=pos).reshape(rows, cols)
+        return(_uint16_to_float(min_value, value_range, data.astype(np.float32)).astype(np.float32), pos+2*rows*cols)
+    if token == b'CM3':
+        data = np.frombuffer(buf, dtype=np.uint8, count=rows*cols, offset=pos).reshape(rows, cols)
+        return((min_value + value_range*(1.0/255.0)*data.astype(np.float32)).astype(np.float32), pos+rows*cols)
+    # CM: per-column headers of four uint16 percentiles, then uint8 data stored column by column
+    headers = np.frombuffer(buf, dtype='<u2', count=4*cols, offset=pos).reshape(cols, 4)
+    pos += 8*cols
+    data = np.frombuffer(buf, dtype=np.uint8, count=rows*cols, offset=pos).reshape(cols, rows).T.astype(np.float32)
+    p = _uint16_to_float(min_value, value_range, headers.astype(np.float32))
+    (p0, p25, p75, p100) = (p[:,0], p[:,1], p[:,2], p[:,3])
+    mat = np.where(data <= 64, p0 + (p25-p0)*data*(1/64.0),
+                   np.where(data <= 192, p25 + (p75-p25)*(data-64)*(1/128.0),
+                            p75 + (p100-p75)*(data-192)*(1/63.0)))
+    return(mat.astype(np.float32), pos+rows*cols)
+
+def _read_text_matrix(buf, pos):
+    '''Parse a text-format matrix "[ 1 2 \n 3 4 ]" starting at pos.'''
+    end = buf.find(b']', pos)
+    text = buf[pos:end].decode('utf-8').strip().lstrip('[')
+    rows = [ r.split() for r in text.split('\n') if r.strip() ]
+    return(np.array(rows, dtype=np.float32), end+1)
+
+def read_object(buf, pos):
+    '''USAGE: (obj, end) = read_object(buf, pos)
+    Read the matrix or vector that starts at byte pos of buf (just after "key ").
+    Uncompressed binary objects are zero-copy numpy views into buf; compressed and text ones are decoded.
+    end is the position just after the object.'''
+    if buf[pos:pos+2] != b'\0B':
+        return(_read_text_matrix(buf, pos))
+    space = buf.find(b' ', pos+2)
+    token = bytes(buf[pos+2:space])
+    pos = space+1
+    if token in (b'CM', b'CM2', b'CM3'):
+        return(_read_compressed(buf, pos, token))
+    if token in (b'FM', b'DM'):
+        dtype = np.dtype('<f4') if token==b'FM' else np.dtype('<f8')
+        (rows, cols) = struct.unpack_from('<xixi', buf, pos)
+        pos += 10
+        mat = np.frombuffer(buf, dtype=dtype, count=rows*cols, offset=pos).reshape(rows, cols)
+        return(mat, pos+rows*cols*dtype.itemsize)
+    if token in (b'FV', b'DV'):
+        dtype = np.dtype('<f4') if token==b'FV' else np.dtype('<f8')
+        (dim,) = struct.unpack_from('<xi', buf, pos)
+        pos += 5
+        return(np.frombuffer(buf, dtype=dtype, count=dim, offset=pos), pos+dim*dtype.itemsize)
+    raise ValueError('kaldi: unsupported object type {} at byte {}'.format(token, pos))
+
+def read_mat(rxfile):
+    '''USAGE: mat = read_mat(rxfile)
+    Read one matrix given its feats.scp entry (filename:offset, optionally with [rows] or [rows,cols]).
+    Only the bytes of that matrix are touched, so random access is O(1) in the archive size.'''
+    (filename, offset, rows, cols) = parse_rxfilename(rxfile)
+    buf = _get_ark_mmap(filename)
+    if offset is None:
+        offset = 0
+        if buf[0:2] != b'\0B' and buf[0:1] != b'[':
+            raise ValueError('kaldi: {} is an archive; give an offset into it'.format(filename))
+    (mat, end) = read_object(buf, offset)
+    if rows is not None:
+        mat = mat[rows]
+    if cols is not None:
+        mat = mat[:,cols]
+    return(mat)
+
+def iter_ark(filename):
+    '''USAGE: for (key, mat) in iter_ark(filename): ...
+    Iterate sequentially through every matrix in an archive.'''
+    return(iter_ark_buffer(_get_ark_mmap(filename)))
+
+def iter_ark_buffer(buf):
+    '''USAGE: for (key, mat) in iter_ark_buffer(buf): ...
+    Iterate through every matrix in an archive already in memory, e.g. read from a pipe.'''
+    pos = 0
+    while pos < len(buf):
+        space = buf.find(b' ', pos)
+        if space < 0:
+            break
+        key = buf[pos:space].decode('utf-8').strip()
+        (mat, pos) = read_object(buf, space+1)
+        while pos < len(buf) and buf[pos:pos+1] in (b'\n', b' '):
+            pos += 1
+        yield(key, mat)
+
+def read_object_bytes(rxfile):
+    '''USAGE: data = read_object_bytes(rxfile)
+    The bytes of one archived object, exactly as stored, e.g. to copy it to another archive.
+    If rxfile has a range ([rows] or [rows,cols]), they are the bytes of just that part of the matrix,
+    compressed again if it was stored compressed, as copy-feats would write it.'''
+    (filename, offset, rows, cols) = parse_rxfilename(rxfile)
+    offset = offset or 0
+    buf = _get_ark_mmap(filename)
+    (obj, end) = read_object(buf, offset)
+    if rows is None and cols is None:
+        return(bytes(buf[offset:end]))
+    return(matrix_bytes(read_mat(rxfile), compress=(buf[offset+2:offset+4] == b'CM')))
+
+class ScpTable(collections.abc.Mapping):
+    '''A read-only dict from utterance ID to matrix, backed by a feats.scp-style file.
+    Matrices are read only when they are looked up.
+    USAGE:
+      feats = kaldi.ScpTable('data/train/feats.scp')
+      mat = feats['spk1-utt1']
+    '''
+    def __init__(self, scp):
+        '''USAGE: table = ScpTable(scp); scp is a filename, or a dict from key to rxfilename'''
+        self.scp = read_dict_from_file(scp) if isinstance(scp,str) else scp
+
+    def __getitem__(self, key):
+        return(read_mat(self.scp[key]))
+
+    def __iter__(self):
+        return(iter(self.scp))
+
+    def __len__(self):
+        return(len(self.scp))
+
+def _float_to_uint16(min_value, value_range, value):
+    f = np.clip((value - min_value)/value_range, 0.0, 1.0)
+    return((f*65535 + 0.499).astype(np.int64))
+
+def compress_matrix(mat):
+    '''USAGE: data = compress_matrix(mat)
+    Encode mat as the bytes of a Kaldi CompressedMatrix, choosing the format as copy-feats --compress=true does:
+    CM (per-column percentiles, one byte per value) for more than 8 rows, else CM2 (two bytes per value).'''
+    mat = np.asarray(mat, dtype=np.float32)
+    (rows, cols) = mat.shape
+    min_value = float(mat.min()) if mat.size else 0.0
+    max_value = float(mat.max()) if mat.size else 0.0
+    if max_value == min_value:
+        max_value = min_value + (1.0 + abs(min_value))
+    value_range = np.float32(max_value - min_value)
+    min_value = np.float32(min_value)
+    if rows <= 8:
+        data = _float_to_uint16(min_value, value_range, mat).astype('<u2')
+        return(b'CM2 ' + struct.pack('<ffii', min_value, value_range, rows, cols) + data.tobytes())
+    s = np.sort(mat, axis=0)
+    quarter = rows//4
+    p0 = np.minimum(_float_to_uint16(min_value, value_range, s[0]), 65532)
+    p25 = np.minimum(np.maximum(_float_to_uint16(min_value, value_range, s[quarter]), p0+1), 65533)
+    p75 = np.minimum(np.maximum(_float_to_uint16(min_value, value_range, s[3*quarter]), p25+1), 65534)
+    p100 = np.maximum(_float_to_uint16(min_value, value_range, s[rows-1]), p75+1)
+    headers = np.stack((p0, p25, p75, p100), axis=1).astype('<u2')
+    (f0, f25, f75, f100) = [ _uint16_to_float(min_value, value_range, p.astype(np.float32)) for p in (p0, p25, p75, p100) ]
+    low = np.clip(((mat - f0)/(f25 - f0)*64 + 0.5).astype(np.int64), 0, 64)
+    mid = np.clip(64 + ((mat - f25)/(f75 - f25)*128 + 0.5).astype(np.int64), 64, 192)
+    high = np.clip(192 + ((mat - f75)/(f100 - f75)*63 + 0.5).astype(np.int64), 192, 255)
+    data = np.where(mat < f25, low, np.where(mat < f75, mid, high)).astype(np.uint8)
+    return(b'CM ' + struct.pack('<ffii', min_value, value_range, rows, cols) + headers.tobytes() + data.T.tobytes())
+
+def matrix_bytes(mat, compress=False):
+    '''USAGE: data = matrix_bytes(mat, compress)
+    The 2-d float32 or float64 numpy array mat in Kaldi binary format, as it follows "key " in an archive.'''
+    if compress:
+        return(b'\0B' + compress_matrix(mat))
+    token = b'DM ' if mat.dtype == np.float64 else b'FM '
+    dtype = '<f8' if mat.dtype == np.float64 else '<f4'
+    (rows, cols) = mat.shape
+    return(b'\0B' + token + struct.pack('<bibi', 4, rows, 4, cols) + np.ascontiguousarray(mat, dtype=dtype).tobytes())
+
+class ArkWriter:
+    '''Write matrices to a Kaldi binary archive, and append each one's scp entry as it is written,
+    so the scp is a valid index of everything written so far.
+    USAGE:
+      with kaldi.ArkWriter(ark, scp, compress) as writer:
+          writer.write(key, matrix)
+    '''
+    def __init__(self, ark, scp, compress=False):
+        '''USAGE: writer=ArkWriter(ark, scp, compress)
+        ark and scp are the output filenames; compress=True writes compressed matrices, like copy-feats --compress=true'''
+        self.arkname = ark
+        self.ark = open(ark,'wb')
+        self.scp = open(scp,'w')
+        self.compress = compress
+
+    def write(self, key, mat):
+        '''Write the 2-d float32 or float64 numpy array mat, as in ark,scp:ark,scp'''
+        self.ark.write(key.encode('utf-8') + b' ')
+        offset = self.ark.tell()
+        self.ark.write(matrix_bytes(mat, self.compress))
+        self.scp.write('{} {}:{}\n'.format(key, self.arkname, offset))
+
+    def write_bytes(self, key, data):
+        '''Write an object already in Kaldi binary format (e.g., from read_object_bytes), unchanged'''
+        self.ark.write(key.encode('utf-8') + b' ')
+        offset = self.ark.tell()
+        self.ark.write(data)
+        self.scp.write('{} {}:{}\n'.format(key, self.arkname, offset))
+
+    def flush(self):
+        '''Flush both files, so that a reader of the scp can already read every entry in it'''
+        self.ark.flush()
+        self.scp.flush()
+
+    def close(self):
+        self.ark.close()
+        self.scp.close()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 def convert_if_newer(ifile, ofile, cmd, stdout_logfile, stderr_logfile):
     '''Create ofile from ifile if ifile is newer.  Pipe errors to logfiles; return the returncode.
+    If set_stage_cache has been called, "newer" means that the content of ifile, cmd, or
+    the tools cmd runs have changed since ofile was last made; otherwise it compares mtimes.
     USAGE:
-    ifile: string, input filename
-    ofile: string, output filename
+    ifile: string, input filename (or directory), or a list of them
+    ofile: string, output filename, or a list of them
     cmd: list of words for the subprocess run
     stdout_logfile: open file object
     stderr_logfile: open file object
     '''
     stdout_logfile.write(' '.join(cmd)+'\n')
     stderr_logfile.write(' '.join(cmd)+'\n')
-    if newer_than(ifile, ofile):
+    ifiles = [ifile] if isinstance(ifile,str) else list(ifile)
+    ofiles = [ofile] if isinstance(ofile,str) else list(ofile)
+    cache = STAGE_CACHE
+    if cache is not None:
+        stage = ' '.join(os.path.abspath(o) for o in ofiles)
+        # The key of the inputs as they are before cmd runs is the one recorded, so that an input
+        # that changes while cmd runs makes the stage stale
+        key = cache.stage_key(ifiles, cmd)
+        rerun = not cache.is_current(stage, ifiles, cmd, ofiles, key)
+    else:
+        rerun = any(newer_than(ifiles, o) for o in ofiles)
+    if rerun:
         try:
-            c = subprocess.run(cmd,stdout=stdout_logfile,stderr=stderr_logfile)
+            c = profiler.run(cmd,stdout=stdout_logfile,stderr=stderr_logfile)
+            if cache is not None and c.returncode==0:
+                cache.record(stage, ifiles, cmd, ofiles, key)
             return(c.returncode)
         except subprocess.CalledProcessError as err:
             stdout_logfile.write(err.stdout)
             stderr_logfile.write(err.stdout)
             return(err.returncode)
     else:
-        return(0)    
-    
+        return(0)
+
+def _conversion_worker(tasks, returncodes, stdout_logfile, stderr_logfile):
+    '''Pull (key, ifile, ofile, cmd) tuples from the tasks queue until a None arrives,
+    run each through convert_if_newer, and store each returncode in returncodes[key].
+    Any exception (e.g., a missing program, or an sqlite error from the stage cache) is written to
+    stderr_logfile, and recorded as returncode -1, so that the worker goes on to the next task.'''
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        (key, ifile, ofile, cmd) = task
+        try:
+            returncodes[key] = convert_if_newer(ifile, ofile, cmd, stdout_logfile, stderr_logfile)
+        except Exception as err:
+            stderr_logfile.write('{}: {}: {}\n'.format(key, type(err).__name__, err))
+            returncodes[key] = -1
+
+def convert_all_if_newer(tasks, nj, logprefix):
+    '''Run convert_if_newer on many files, with at most nj conversions in flight at once.
+    USAGE:
+    returncodes = convert_all_if_newer(tasks, nj, logprefix)
+    tasks: iterable of (key, ifile, ofile, cmd) tuples
+    nj: number of worker threads, each of which runs one subprocess at a time
+    logprefix: each worker logs to logprefix_stdout.N.txt and logprefix_stderr.N.txt;
+      when all are done, these are concatenated into logprefix_stdout.txt and logprefix_stderr.txt,
+      so that output from different files is never interleaved.
+    returncodes: dict mapping each key to the returncode of its conversion
+    If set_stage_cache has been called, the cache is committed once, when all conversions are done.
+    '''
+    nj = max(1, int(nj))
+    cache = STAGE_CACHE
+    with (cache.batch() if cache is not None else contextlib.nullcontext()):
+        return(_convert_all(tasks, nj, logprefix))
+
+def _convert_all(tasks, nj, logprefix):
+    '''The body of convert_all_if_newer: start nj workers, feed them tasks, then gather their logs'''
+    tasks_queue = queue.Queue(maxsize=2*nj)
+    returncodes = {}
+    logfiles = []
+    workers = []
+    for n in range(1,nj+1):
+        stdout_logfile = open('{}_stdout.{}.txt'.format(logprefix,n),'w')
+        stderr_logfile = open('{}_stderr.{}.txt'.format(logprefix,n),'w')
+        logfiles.append((stdout_logfile, stderr_logfile))
+        w = threading.Thread(target=_conversion_worker,
+                             args=(tasks_queue, returncodes, stdout_logfile, stderr_logfile))
+        w.start()
+        workers.append(w)
+    try:
+        for task in tasks:
+            tasks_queue.put(task)   # blocks while 2*nj conversions are already queued
+    finally:
+        for w in workers:
+            tasks_queue.put(None)
+        for w in workers:
+            w.join()
+        for (stdout_logfile, stderr_logfile) in logfiles:
+            stdout_logfile.close()
+            stderr_logfile.close()
+    for stream in ('stdout','stderr'):
+        with open('{}_{}.txt'.format(logprefix,stream),'w') as f:
+            for n in range(1,nj+1):
+                worker_log = '{}_{}.{}.txt'.format(logprefix,stream,n)
+                with open(worker_log) as g:
+                    f.write(g.read())
+                os.remove(worker_log)
+    return(returncodes)
@@ -0,0 +1,373 @@
+#!/usr/bin/python3
+"""
+USAGE:
+  import mfcc
+  opts = mfcc.read_config('conf/mfcc.conf')
+  feats = mfcc.compute_mfcc(x, opts)
+  mfcc.compute_mfcc_jobs(split_scps, ark_scp_pairs, opts, nj, logfiles)
+  If called from the command line, benchmarks frames/second on synthetic audio, and,
+  if compute-mfcc-feats is on the PATH, compares the output to Kaldi's:
+  python mfcc.py [config] [num_utts]
+
+In-process MFCC extraction, following Kaldi's compute-mfcc-feats step by step
+(framing with snip-edges, dither, DC removal, pre-emphasis, Povey window, mel filterbank,
+DCT, liftering, log energy), so the features can be used by Kaldi scripts unchanged.
+Frames from a batch of utterances are transformed together in one FFT call.
+"""
+
+import os,sys
+import re
+import zlib
+import functools
+import time
+import multiprocessing
+import numpy as np
+import kaldi
+import audio
+import cmvn
+
+# Kaldi's defaults for compute-mfcc-feats; conf/mfcc.conf overrides these.
+DEFAULTS = {
+    'sample_frequency':16000.0,
+    'frame_shift':10.0,
+    'frame_length':25.0,
+    'dither':1.0,
+    'preemphasis_coefficient':0.97,
+    'remove_dc_offset':True,
+    'window_type':'povey',
+    'round_to_power_of_two':True,
+    'blackman_coeff':0.42,
+    'snip_edges':True,
+    'num_mel_bins':23,
+    'low_freq':20.0,
+    'high_freq':0.0,
+    'num_ceps':13,
+    'use_energy':True,
+    'energy_floor':0.0,
+    'raw_energy':True,
+    'cepstral_lifter':22.0,
+}
+FLT_EPSILON = np.finfo(np.float32).eps
+BATCH_SIZE = 32    # utterances per FFT call
+
+########## options ##################################################
+@functools.lru_cache(maxsize=None)
+def _read_config_file(filename, size, mtime_ns):
+    '''The (name, value) pairs in a Kaldi config file, parsed once per version (size, mtime) of the file'''
+    pairs = []
+    with open(filename) as f:
+        for line in f:
+            line = re.sub(r'#.*','',line).strip()
+            if not line:
+                continue
+            m = re.match(r'^--([^=]+)=(.*)$', line)
+            if not m:
+                raise ValueError('{}: cannot parse config line {}'.format(filename,line))
+            pairs.append((m.group(1).replace('-','_'), m.group(2).strip()))
+    return(tuple(pairs))
+
+def read_config(filename, **overrides):
+    '''USAGE: opts = read_config(filename, name=value, ...)
+    Read a Kaldi config file (lines like --use-energy=false  # comment) into a dict of options.
+    Options not in the file take Kaldi's defaults; keyword arguments override both.
+    Raises ValueError for options this engine does not implement.
+    '''
+    st = os.stat(filename)
+    opts = dict(DEFAULTS)
+    opts.update(_read_config_file(filename, st.st_size, st.st_mtime_ns))
+    opts.update(overrides)
+    for (k,v) in opts.items():
+        if k not in DEFAULTS:
+            raise ValueError('{}: option --{} is not supported by the numpy MFCC engine'.format(filename,k))
+        default = DEFAULTS[k]
+        if isinstance(default,bool) and isinstance(v,str):
+            opts[k] = (v.lower()=='true')
+        elif not isinstance(default,str):
+            opts[k] = type(default)(v)
+    return(opts)
+
+def _window(opts, length):
+    n = np.arange(length)
+    a = 2*np.pi/(length-1)
+    if opts['window_type']=='povey':
+        return((0.5 - 0.5*np.cos(a*n))**0.85)
+    if opts['window_type']=='hanning':
+        return(0.5 - 0.5*np.cos(a*n))
+    if opts['window_type']=='hamming':
+        return(0.54 - 0.46*np.cos(a*n))
+    if opts['window_type']=='rectangular':
+        return(np.ones(length))
+    if opts['window_type']=='blackman':
+        b = opts['blackman_coeff']
+        return(b - 0.5*np.cos(a*n) + (0.5-b)*np.cos(2*a*n))
+    raise ValueError('mfcc: unknown window type {}'.format(opts['window_type']))
+
+def _mel(f):
+    return(1127.0*np.log(1.0 + f/700.0))
+
+def _mel_banks(opts, padded_length):
+    '''(num_mel_bins, padded_length//2) array of triangular mel filter weights, as in Kaldi's MelBanks'''
+    fs = opts['sample_frequency']
+    nyquist = 0.5*fs
+    high_freq = opts['high_freq'] if opts['high_freq'] > 0 else nyquist + opts['high_freq']
+    mel_low = _mel(opts['low_freq'])
+    mel_high = _mel(high_freq)
+    delta = (mel_high - mel_low)/(opts['num_mel_bins']+1)
+    num_fft_bins = padded_length//2
+    mel = _mel(np.arange(num_fft_bins) * fs/padded_length)
+    left = mel_low + delta*np.arange(opts['num_mel_bins'])[:,np.newaxis]
+    center = left + delta
+    right = center + delta
+    up = (mel - left)/(center - left)
+    down = (right - mel)/(right - center)
+    weights = np.where(mel <= center, up, down)
+    weights[(mel <= left) | (mel >= right)] = 0
+    return(weights)
+
+def _dct_matrix(num_ceps, num_bins):
+    n = np.arange(num_bins)
+    k = np.arange(num_ceps)[:,np.newaxis]
+    m = np.sqrt(2.0/num_bins) * np.cos(np.pi/num_bins * (n+0.5) * k)
+    m[0,:] = np.sqrt(1.0/num_bins)
+    return(m)
+
+class Extractor:
+    '''Precomputed window, filterbank and DCT for one set of options.'''
+    def __init__(self, opts):
+        '''USAGE: extractor = Extractor(opts)'''
+        self.opts = opts
+        fs = opts['sample_frequency']
+        self.frame_length = int(fs*0.001*opts['frame_length'])
+        self.frame_shift = int(fs*0.001*opts['frame_shift'])
+        if opts['round_to_power_of_two']:
+            self.padded_length = 1 << int(np.ceil(np.log2(self.frame_length)))
+        else:
+            self.padded_length = self.frame_length
+        self.window = _window(opts, self.frame_length)
+        self.mel_banks = _mel_banks(opts, self.padded_length)
+        self.dct = _dct_matrix(opts['num_ceps'], opts['num_mel_bins'])
+        q = opts['cepstral_lifter']
+        i = np.arange(opts['num_ceps'])
+        self.lifter = 1.0 + 0.5*q*np.sin(np.pi*i/q) if q != 0 else np.ones(opts['num_ceps'])
+
+    def num_frames(self, nsamples):
+        '''Number of frames in nsamples samples, following Kaldi's NumFrames.'''
+        if self.opts['snip_edges']:
+            if nsamples < self.frame_length:
+                return(0)
+            return(1 + (nsamples - self.frame_length)//self.frame_shift)
+        return((nsamples + self.frame_shift//2)//self.frame_shift)
+
+    def frames(self, x):
+        '''USAGE: frames = extractor.frames(x)
+        Cut the 1-d signal x into a (num_frames, frame_length) array of frames.'''
+        n = self.num_frames(len(x))
+        if self.opts['snip_edges']:
+            starts = np.arange(n)*self.frame_shift
+            idx = starts[:,np.newaxis] + np.arange(self.frame_length)
+            return(x[idx])
+        # Without snip_edges, frames are centered on multiples of frame_shift, reflecting at the edges
+        starts = np.arange(n)*self.frame_shift + self.frame_shift//2 - self.frame_length//2
+        idx = starts[:,np.newaxis] + np.arange(self.frame_length)
+        idx = np.where(idx < 0, -idx-1, idx)
+        idx = np.where(idx >= len(x), 2*len(x)-1-idx, idx)
+        return(x[idx])
+
+    def compute(self, signals, seeds=None):
+        '''USAGE: feats = extractor.compute(signals, seeds)
+        signals: list of 1-d float arrays, in the integer scale of 16-bit audio.
+        seeds: list of integer seeds for the dither noise, one per signal.
+        feats: list of (num_frames, num_ceps) float32 arrays, computed with one batched FFT.
+        '''
+        opts = self.opts
+        if len(signals)==0:
+            return([])
+        framed = [ self.frames(np.asarray(x, dtype=np.float64)) for x in signals ]
+        counts = [ len(f) for f in framed ]
+        frames = np.concatenate(framed)
+        if opts['dither'] != 0:
+            seeds = seeds if seeds is not None else range(len(signals))
+            noise = [ np.random.default_rng(s).standard_normal((c, self.frame_length)) for (s,c) in zip(seeds,counts) ]
+            frames = frames + opts['dither']*np.concatenate(noise)
+        if opts['remove_dc_offset']:
+            frames = frames - frames.mean(axis=1, keepdims=True)
+        if opts['raw_energy']:
+            log_energy = np.log(np.maximum(np.sum(frames**2, axis=1), FLT_EPSILON))
+        p = opts['preemphasis_coefficient']
+        if p != 0:
+            frames = np.concatenate((frames[:,0:1]*(1-p), frames[:,1:] - p*frames[:,:-1]), axis=1)
+        frames = frames * self.window
+        if not opts['raw_energy']:
+            log_energy = np.log(np.maximum(np.sum(frames**2, axis=1), FLT_EPSILON))
+        spectrum = np.fft.rfft(frames, n=self.padded_length, axis=1)
+        power = spectrum.real**2 + spectrum.imag**2
+        mel_energies = power[:,0:self.padded_length//2] @ self.mel_banks.T
+        log_mel = np.log(np.maximum(mel_energies, FLT_EPSILON))
+        ceps = (log_mel @ self.dct.T) * self.lifter
+        if opts['use_energy']:
+            if opts['energy_floor'] > 0:
+                log_energy = np.maximum(log_energy, np.log(opts['energy_floor']))
+            ceps[:,0] = log_energy
+        ceps = ceps.astype(np.float32)
+        return(np.split(ceps, np.cumsum(counts)[:-1]))
+
+def compute_mfcc(x, opts, seed=0):
+    '''USAGE: feats = compute_mfcc(x, opts, seed)
+    MFCCs, as a (num_frames, num_ceps) float32 array, of the 1-d signal x.'''
+    return(Extractor(opts).compute([x],[seed])[0])
+
+def to_int16_scale(x):
+    '''Kaldi computes features from samples in the range of 16-bit integers; rescale other types.
+    Returns channel 0 of x as float64.'''
+    x = x[:,0] if x.ndim==2 else x
+    if x.dtype == np.uint8:
+        return((x.astype(np.float64)-128)*256)
+    if x.dtype == np.int32:
+        return(x.astype(np.float64)/65536)
+    if x.dtype.kind == 'f':
+        return(x.astype(np.float64)*32768)
+    return(x.astype(np.float64))
+
+def delta_scales(order=2, window=2):
+    '''USAGE: scales = delta_scales(order, window)
+    The filter for each order of add-deltas: scales[i] has 2*i*window+1 taps, centered on the current frame.'''
+    scales = [ np.ones(1) ]
+    for i in range(1, order+1):
+        j = np.arange(-window, window+1)
+        scales.append(np.convolve(scales[-1], j)/np.sum(j*j))
+    return(scales)
+
+def add_deltas(feats, order=2, window=2):
+    '''USAGE: out = add_deltas(feats, order, window)
+    Append delta and higher-order features to the (num_frames, D) feats, as add-deltas does;
+    frames past either end are copies of the first or last frame.'''
+    scales = delta_scales(order, window)
+    width = order*window
+    n = len(feats)
+    idx = np.clip(np.arange(-width, n+width), 0, max(n-1, 0))
+    padded = np.asarray(feats, dtype=np.float64)[idx]
+    out = [ np.asarray(feats, dtype=np.float64) ]
+    for s in scales[1:]:
+        offset = width - (len(s)-1)//2
+        out.append(sum(c*padded[offset+k:offset+k+n] for (k, c) in enumerate(s) if c != 0))
+    return(np.concatenate(out, axis=1).astype(np.float32))
+
+########## parallel jobs ##################################################
+def _utt_seed(utt):
+    return(zlib.crc32(utt.encode('utf-8')))
+
+def compute_mfcc_job(scp, ark, scp_out, opts, log, compress=True, utt2spk=None):
+    '''USAGE: (num_done, num_frames, cmvn_stats) = compute_mfcc_job(scp, ark, scp_out, opts, log, compress, utt2spk)
+    Compute MFCCs for every utterance in the wav.scp-format file scp, writing them to
+    Kaldi-format ark and scp_out (compressed, as by copy-feats --compress=true, unless compress=False).
+    Utterances that fail are described in the file log.
+    If utt2spk is given, per-speaker CMVN statistics of the features, as written, are accumulated
+    in the same pass, and returned as cmvn_stats (a dict from speaker to statistics); otherwise it is {}.'''
+    start_time = time.time()
+    extractor = Extractor(opts)
+    utt2wav = kaldi.read_dict_from_file(scp)
+    num_done = 0
+    num_frames = 0
+    acc = cmvn.Accumulator()
+    with open(log,'w') as logfile, kaldi.ArkWriter(ark, scp_out, compress) as writer:
+        logfile.write('mfcc.compute_mfcc_job {} {} {}\n'.format(scp, ark, scp_out))
+        utts = list(utt2wav.keys())
+        for start in range(0, len(utts), BATCH_SIZE):
+            batch = []
+            for utt in utts[start:start+BATCH_SIZE]:
+                try:
+                    (x, fs) = audio.read(utt2wav[utt])
+                except (OSError, ValueError, RuntimeError) as err:
+                    logfile.write('WARNING: failed to read {}: {}\n'.format(utt, err))
+                    continue
+                if fs != opts['sample_frequency']:
+                    logfile.write('WARNING: {} has sampling rate {}, expected {}\n'.format(
+                        utt, fs, opts['sample_frequency']))
+                    continue
+                batch.append((utt, to_int16_scale(x)))
+            feats = extractor.compute([ x for (u,x) in batch ], [ _utt_seed(u) for (u,x) in batch ])
+            for ((utt, x), f) in zip(batch, feats):
+                if len(f)==0:
+                    logfile.write('WARNING: {} is too short to extract any frames\n'.format(utt))
+                    continue
+                if compress and utt2spk is not None:
+                    # Statistics are of the features as stored, so they match a later compute-cmvn-stats
+                    data = b'\0B' + kaldi.compress_matrix(f)
+                    writer.write_bytes(utt, data)
+                    f = kaldi.read_object(data, 0)[0]
+                else:
+                    writer.write(utt, f)
+                if utt2spk is not None and utt in utt2spk:
+                    acc.add(utt2spk[utt], f)
+                num_done += 1
+                num_frames += len(f)
+        logfile.write('Done {} out of {} utterances, {} frames.\n'.format(num_done, len(utts), num_frames))
+        logfile.write('# Accounting: time={:.2f} threads=1\n'.format(time.time()-start_time))
+    return(num_done, num_frames, acc.stats)
+
+def _compute_mfcc_job(args):
+    return(compute_mfcc_job(*args))
+
+def compute_mfcc_jobs(split_scps, ark_scp_pairs, opts, nj, logfiles, utt2spk=None):
+    '''USAGE: results = compute_mfcc_jobs(split_scps, ark_scp_pairs, opts, nj, logfiles, utt2spk)
+    Run compute_mfcc_job for each split scp in a pool of nj processes.
+    ark_scp_pairs: list of (ark, scp) output filenames, one per split scp.
+    logfiles: list of log filenames, one per split scp.
+    utt2spk: if given, CMVN statistics are accumulated in the same pass.
+    results: list of (num_done, num_frames, cmvn_stats), one per split scp.
+    '''
+    def job_utt2spk(s):
+        # each worker gets only its own utterances' speakers
+        return(None if utt2spk is None else { u:utt2spk[u] for u in kaldi.read_dict_from_file(s) if u in utt2spk })
+    args = [ (s, a, o, opts, l, True, job_utt2spk(s)) for (s, (a, o), l) in zip(split_scps, ark_scp_pairs, logfiles) ]
+    if nj <= 1 or len(args) <= 1:
+        return([ compute_mfcc_job(*a) for a in args ])
+    with multiprocessing.Pool(min(nj, len(args))) as pool:
+        return(pool.map(_compute_mfcc_job, args))
+
+########## Called from the operating system ##################################################
+def _read_text_ark(text):
+    '''Parse Kaldi text-format matrices (key  [ rows ]) into a dict of arrays.'''
+    mats = {}
+    for m in re.finditer(r'(\S+)\s+\[([^\]]*)\]', text):
+        rows = [ r.split() for r in m.group(2).strip().split('\n') ]
+        mats[m.group(1)] = np.array(rows, dtype=np.float64)
+    return(mats)
+
+if __name__=="__main__":
+    import tempfile, shutil, subprocess
+    import resample
+    config = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.getcwd(),'conf','mfcc.conf')
+    num_utts = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    opts = read_config(config, dither=0.0)
+    fs = int(opts['sample_frequency'])
+    workdir = tempfile.mkdtemp()
+    rng = np.random.default_rng(0)
+    scp = os.path.join(workdir,'wav.scp')
+    with open(scp,'w') as f:
+        for n in range(num_utts):
+            wav = os.path.join(workdir,'utt{:06d}.wav'.format(n))
+            t = np.arange(int(fs*rng.uniform(2,5)))/fs
+            x = 3000*np.sin(2*np.pi*rng.uniform(100,0.4*fs)*t) + 300*rng.standard_normal(len(t))
+            resample.write_wav(wav, x[:,np.newaxis], fs, 2)
+            f.write('utt{:06d} {}\n'.format(n, wav))
+    ark = os.path.join(workdir,'feats.ark')
+    start = time.time()
+    (num_done, num_frames, stats) = compute_mfcc_job(scp, ark, os.path.join(workdir,'feats.scp'), opts,
+                                              os.path.join(workdir,'mfcc.log'))
+    elapsed = time.time() - start
+    print('numpy: {} utterances, {} frames in {:.2f}s ({:.0f} frames/s)'.format(
+        num_done, num_frames, elapsed, num_frames/elapsed))
+    if shutil.which('compute-mfcc-feats'):
+        start = time.time()
+        c = subprocess.run(['compute-mfcc-feats','--config='+config,'--dither=0','scp:'+scp,'ark,t:-'],
+                           stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, check=True)
+        elapsed = time.time() - start
+        print('kaldi: {} frames in {:.2f}s ({:.0f} frames/s)'.format(num_frames, elapsed, num_frames/elapsed))
+        reference = _read_text_ark(c.stdout)
+        extractor = Extractor(opts)
+        utt2wav = kaldi.read_dict_from_file(scp)
+        worst = max( np.max(np.abs(reference[u] - extractor.compute([to_int16_scale(audio.read(w)[0])])[0]))
+                     for (u,w) in utt2wav.items() )
+        print('maximum absolute difference from compute-mfcc-feats: {:.2e}'.format(worst))
+    shutil.rmtree(workdir)
@@ -0,0 +1,403 @@
+#!/usr/bin/python3
+"""
+USAGE:
+  import monophone
+  trainer = monophone.Trainer(datadir, langdir, modeldir, kaldi_cmd, totgauss=1000, devdir='data/dev')
+  trainer.train()            # resumes from modeldir/checkpoint.json, if an earlier run was killed
+  print(trainer.report())
+  trainer.train(from_iter=20, totgauss=2000)   # retune the Gaussians from iteration 20 on
+  If called from the command line:
+  python monophone.py data_dir lang_dir exp_dir [nj] [--totgauss=N] [--num-iters=N] [--dev=dev_data_dir] [--from-iter=N]
+
+Flat start and monophone training, as local/train_mono.sh does, but driven from Python, one step at a time:
+ - each iteration's statistics are accumulated by nj gmm-acc-stats-ali jobs, run as a job array by kaldi_cmd
+   (so in a pool of processes, with kaldi_cmd.executor), and then summed by a tree of gmm-sum-accs jobs,
+   in ceil(log2(nj)) rounds of parallel pairwise sums, rather than all nj at once by gmm-est;
+ - after each step, the state of training is saved in modeldir/checkpoint.json, so that a run that was
+   killed resumes from the last step that finished;
+ - the checkpoint also keeps, for each iteration, the wall time of each step, the number of Gaussians,
+   and the training-set log-likelihood per frame (and, given devdir, the dev-set one), and every
+   iteration's model is kept, so that training can be restarted from any iteration with other settings;
+ - given devdir, the dev set is aligned with the new model every dev_every iterations, and training
+   stops early when its log-likelihood per frame has not improved by min_improvement for patience checks;
+   final.mdl is then the model that scored best on the dev set.
+"""
+
+import os,sys
+import re
+import json
+import time
+import shutil
+import subprocess
+import kaldi
+import profiler
+import SpeechCorpus
+
+NUM_ITERS = 40       # number of iterations of training
+MAX_ITER_INC = 30    # last iteration to increase the number of Gaussians
+TOTGAUSS = 1000      # target number of Gaussians
+POWER = 0.25         # exponent that determines the number of Gaussians from occupation counts
+BOOST_SILENCE = 1.0  # factor by which to boost silence likelihoods in alignment
+REALIGN_ITERS = (1,2,3,4,5,6,7,8,9,10,12,14,16,18,20,23,26,29,32,35,38)
+SCALE_OPTS = [ '--transition-scale=1.0', '--acoustic-scale=0.1', '--self-loop-scale=0.1' ]
+CHECKPOINT = 'checkpoint.json'
+DONE = 'done'
+
+_ACC_LIKE = re.compile(r'Overall avg like per frame \(Gaussian only\) = (\S+) over (\S+) frames')
+_ALI_LIKE = re.compile(r'Overall log-likelihood per frame is (\S+) over (\S+) frames')
+
+########## auxiliary functions ##################################################
+def feats_rspecifier(sdata):
+    '''USAGE: feats = feats_rspecifier(sdata)
+    CMVN-normalized features with deltas, for the job array JOB=1:nj over the split data directory sdata.'''
+    return('ark,s,cs:apply-cmvn --utt2spk=ark:{0}/JOB/utt2spk scp:{0}/JOB/cmvn.scp scp:{0}/JOB/feats.scp ark:- '
+           '| add-deltas ark:- ark:- |'.format(sdata))
+
+def log_likelihood(logfiles, pattern=_ACC_LIKE):
+    '''USAGE: (like, frames) = log_likelihood(logfiles, pattern)
+    The log-likelihood per frame, averaged over all the frames reported in logfiles, and the number of frames.'''
+    (total, frames) = (0.0, 0.0)
+    for logfile in logfiles:
+        if not os.path.exists(logfile):
+            continue
+        with open(logfile) as f:
+            for m in pattern.finditer(f.read()):
+                total += float(m.group(1)) * float(m.group(2))
+                frames += float(m.group(2))
+    return((total/frames if frames > 0 else None, int(frames)))
+
+def input_signature(files):
+    '''USAGE: sig = input_signature(files); a dict from each file that exists to [size, mtime]'''
+    return({ f:[ os.path.getsize(f), os.path.getmtime(f) ] for f in files if os.path.exists(f) })
+
+def sum_accs(accfiles, outfile, kaldi_cmd, logdir):
+    '''USAGE: sum_accs(accfiles, outfile, kaldi_cmd, logdir)
+    Sum the GMM accumulators accfiles into outfile, by a tree of gmm-sum-accs jobs: each round is one job
+    array, whose job J adds the J'th file to the one half the list away, halving the number left.
+    The accfiles are consumed.'''
+    files = list(accfiles)
+    level = 0
+    while len(files) > 1:
+        half = len(files)//2
+        base = '{}.sum{}'.format(outfile, level)
+        for j in range(half):
+            os.replace(files[j], '{}.{}.a'.format(base, j+1))
+            os.replace(files[j+half], '{}.{}.b'.format(base, j+1))
+        cmd = [ 'gmm-sum-accs', '{}.JOB'.format(base), '{}.JOB.a'.format(base), '{}.JOB.b'.format(base) ]
+        logfile = os.path.join(logdir, '{}.sum{}.JOB.log'.format(os.path.basename(outfile), level))
+        if kaldi_cmd.run('JOB=1:{}'.format(half), logfile, cmd) != 0:
+            raise RuntimeError('monophone: gmm-sum-accs failed; see {}'.format(logfile))
+        for j in range(half):
+            for suffix in ('a','b'):
+                os.remove('{}.{}.{}'.format(base, j+1, suffix))
+        files = [ '{}.{}'.format(base, j+1) for j in range(half) ] + files[2*half:]
+        level += 1
+    os.replace(files[0], outfile)
+
+########## Trainer ##################################################
+class Trainer:
+    '''Monophone GMM training, one checkpointed step at a time.'''
+    def __init__(self, datadir, langdir, modeldir, kaldi_cmd, totgauss=TOTGAUSS, num_iters=NUM_ITERS,
+                 max_iter_inc=MAX_ITER_INC, realign_iters=REALIGN_ITERS, devdir=None, dev_every=5,
+                 patience=2, min_improvement=0.01):
+        '''USAGE: trainer=Trainer(datadir, langdir, modeldir, kaldi_cmd, totgauss, num_iters, max_iter_inc,
+             realign_iters, devdir, dev_every, patience, min_improvement)
+        datadir, langdir = training data and lang directories; the data is split into kaldi_cmd.nproc jobs,
+          or fewer, if datadir or devdir has fewer speakers
+        modeldir = directory in which the models, alignments, logs and checkpoint.json are written
+        totgauss, num_iters, max_iter_inc, realign_iters = as in train_mono.sh
+        devdir = optional held-out data directory, for early stopping
+        dev_every, patience, min_improvement = score the dev set every dev_every iterations; stop when it has not
+          improved by min_improvement (log-likelihood per frame) for patience scores in a row
+        '''
+        self.datadir = datadir
+        self.langdir = langdir
+        self.modeldir = modeldir
+        self.kaldi_cmd = kaldi_cmd
+        # Each job is one shard of the data, which must contain at least one speaker
+        self.nj = SpeechCorpus.num_jobs(datadir, kaldi_cmd.nproc)
+        if devdir is not None:
+            self.nj = SpeechCorpus.num_jobs(devdir, self.nj)
+        self.totgauss = totgauss
+        self.num_iters = num_iters
+        self.max_iter_inc = max_iter_inc
+        self.realign_iters = tuple(realign_iters)
+        self.devdir = devdir
+        self.dev_every = max(1, int(dev_every))
+        self.patience = patience
+        self.min_improvement = min_improvement
+        self.logdir = os.path.join(modeldir,'log')
+        self.sdata = os.path.join(datadir,'split{}'.format(self.nj))
+        self.feats = feats_rspecifier(self.sdata)
+        self.dev_sdata = os.path.join(devdir,'split{}'.format(self.nj)) if devdir is not None else None
+        self.state = None
+
+    ########## checkpoints ##################################################
+    def checkpoint_file(self):
+        return(os.path.join(self.modeldir, CHECKPOINT))
+
+    def inputs(self):
+        '''The files whose change means that training has to start over'''
+        return([ os.path.join(self.datadir,f) for f in ('feats.scp','cmvn.scp','text','utt2spk') ] +
+               [ os.path.join(self.langdir,f) for f in ('topo','L.fst','words.txt','phones/sets.int') ])
+
+    def load(self):
+        '''USAGE: state = trainer.load()
+        The checkpoint left by an earlier run, if it trained on the same inputs with the same number of jobs;
+        otherwise, a fresh state, starting from stage -3.'''
+        fresh = { 'stage':-3, 'nj':self.nj, 'inputs':input_signature(self.inputs()), 'numgauss0':None,
+                  'history':[], 'dev':[] }
+        if not os.path.exists(self.checkpoint_file()):
+            return(fresh)
+        try:
+            with open(self.checkpoint_file()) as f:
+                state = json.load(f)
+        except (OSError, ValueError) as err:
+            print('monophone: ignoring unreadable checkpoint {}: {}'.format(self.checkpoint_file(), err))
+            return(fresh)
+        if state.get('nj') != self.nj or state.get('inputs') != fresh['inputs']:
+            print('monophone: inputs or number of jobs changed since {} was written; starting over'.format(self.checkpoint_file()))
+            return(fresh)
+        return(state)
+
+    def save(self):
+        with open(self.checkpoint_file()+'.tmp','w') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(self.checkpoint_file()+'.tmp', self.checkpoint_file())
+
+    def numgauss(self, x):
+        '''The number of Gaussians to mix up to in iteration x (train_mono.sh adds incgauss after each one).'''
+        numgauss0 = self.state['numgauss0']
+        incgauss = (self.totgauss - numgauss0)//self.max_iter_inc
+        return(numgauss0 + incgauss*min(max(x-1, 0), self.max_iter_inc))
+
+    ########## steps ##################################################
+    def _run(self, jobspec, logname, cmd):
+        logfile = os.path.join(self.logdir, logname)
+        if self.kaldi_cmd.run(jobspec, logfile, cmd) != 0:
+            raise RuntimeError('monophone: {} failed; see {}'.format(cmd[0], logfile))
+
+    def _split(self, datadir):
+        '''Shard datadir into datadir/split{nj}, or reuse the shards made before (see SpeechCorpus.split_data_dir)'''
+        SpeechCorpus.split_data_dir(datadir, self.nj)
+
+    def _model(self, x):
+        return(os.path.join(self.modeldir,'{}.mdl'.format(x)))
+
+    def _job_files(self, pattern):
+        return([ os.path.join(self.modeldir, pattern.format(n)) for n in range(1, self.nj+1) ])
+
+    def init_model(self):
+        '''Stage -3: a flat-start model, from the global statistics of a subset of the features'''
+        example_feats = self.feats.replace('JOB','1')
+        c = profiler.run(['feat-to-dim', example_feats, '-'], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         universal_newlines=True)
+        if c.returncode != 0 or not c.stdout.strip():
+            raise RuntimeError('monophone: error getting feature dimension: {}'.format(c.stderr))
+        feat_dim = c.stdout.strip()
+        self._run('JOB=1', 'init.log',
+                  [ 'gmm-init-mono', '--shared-phones='+os.path.join(self.langdir,'phones','sets.int'),
+                    '--train-feats='+self.feats+' subset-feats --n=10 ark:- ark:-|',
+                    os.path.join(self.langdir,'topo'), feat_dim, self._model(0), os.path.join(self.modeldir,'tree') ])
+        c = profiler.run(['gmm-info', '--print-args=false', self._model(0)], stdout=subprocess.PIPE,
+                         universal_newlines=True)
+        m = re.search(r'gaussians\s+(\d+)', c.stdout)
+        if c.returncode != 0 or not m:
+            raise RuntimeError('monophone: cannot read the number of Gaussians in {}'.format(self._model(0)))
+        self.state['numgauss0'] = int(m.group(1))
+
+    def compile_graphs(self, sdata, prefix):
+        '''Stage -2: a training graph for each utterance of the split data directory sdata'''
+        oov = kaldi.read_list_from_file(os.path.join(self.langdir,'oov.int'))[0]
+        self._run('JOB=1:{}'.format(self.nj), '{}compile_graphs.JOB.log'.format(prefix),
+                  [ 'compile-train-graphs', '--read-disambig-syms='+os.path.join(self.langdir,'phones','disambig.int'),
+                    os.path.join(self.modeldir,'tree'), self._model(0), os.path.join(self.langdir,'L.fst'),
+                    'ark:sym2int.pl --map-oov {} -f 2- {} < {}/JOB/text|'.format(oov, os.path.join(self.langdir,'words.txt'), sdata),
+                    'ark:|gzip -c >{}/{}fsts.JOB.gz'.format(self.modeldir, prefix) ])
+
+    def align_equal(self):
+        '''Stage -1: align the data equally, and accumulate statistics for the first update'''
+        self._run('JOB=1:{}'.format(self.nj), 'align.0.JOB.log',
+                  [ 'align-equal-compiled', 'ark:gunzip -c {}/fsts.JOB.gz|'.format(self.modeldir), self.feats, 'ark,t:-', '|',
+                    'gmm-acc-stats-ali', '--binary=true', self._model(0), self.feats, 'ark:-',
+                    os.path.join(self.modeldir,'0.JOB.acc') ])
+        return(log_likelihood(self._job_files(os.path.join('log','align.0.{}.log'))))
+
+    def align(self, x, beam):
+        '''Realign the training data with model x'''
+        silence = kaldi.read_list_from_file(os.path.join(self.langdir,'phones','optional_silence.csl'))[0]
+        mdl = 'gmm-boost-silence --boost={} {} {} - |'.format(BOOST_SILENCE, silence, self._model(x))
+        self._run('JOB=1:{}'.format(self.nj), 'align.{}.JOB.log'.format(x),
+                  [ 'gmm-align-compiled' ] + SCALE_OPTS +
+                  [ '--beam={}'.format(beam), '--retry-beam={}'.format(10*beam), '--careful=false', mdl,
+                    'ark:gunzip -c {}/fsts.JOB.gz|'.format(self.modeldir), self.feats,
+                    'ark,t:|gzip -c >{}/ali.JOB.gz'.format(self.modeldir) ])
+
+    def accumulate(self, x):
+        '''Accumulate the statistics of model x over the current alignments, one job per split'''
+        self._run('JOB=1:{}'.format(self.nj), 'acc.{}.JOB.log'.format(x),
+                  [ 'gmm-acc-stats-ali', self._model(x), self.feats, 'ark:gunzip -c {}/ali.JOB.gz|'.format(self.modeldir),
+                    os.path.join(self.modeldir,'{}.JOB.acc'.format(x)) ])
+        return(log_likelihood(self._job_files(os.path.join('log','acc.{}.{{}}.log'.format(x)))))
+
+    def update(self, x, numgauss):
+        '''Estimate model x+1 from model x and its summed statistics'''
+        accfile = os.path.join(self.modeldir,'{}.acc'.format(x))
+        sum_accs(self._job_files('{}.{{}}.acc'.format(x)), accfile, self.kaldi_cmd, self.logdir)
+        summed = time.time()
+        opts = [ '--min-gaussian-occupancy=3' ] if x==0 else [ '--write-occs='+os.path.join(self.modeldir,'{}.occs'.format(x+1)) ]
+        self._run('JOB=1', 'update.{}.log'.format(x),
+                  [ 'gmm-est' ] + opts + [ '--mix-up={}'.format(numgauss), '--power={}'.format(POWER),
+                    self._model(x), accfile, self._model(x+1) ])
+        os.remove(accfile)
+        return(summed)
+
+    def score_dev(self, x):
+        '''USAGE: (like, frames) = trainer.score_dev(x); the log-likelihood per frame of the dev set under model x'''
+        self._run('JOB=1:{}'.format(self.nj), 'dev_align.{}.JOB.log'.format(x),
+                  [ 'gmm-align-compiled' ] + SCALE_OPTS +
+                  [ '--beam=10', '--retry-beam=100', self._model(x),
+                    'ark:gunzip -c {}/dev_fsts.JOB.gz|'.format(self.modeldir), feats_rspecifier(self.dev_sdata), 'ark:/dev/null' ])
+        return(log_likelihood(self._job_files(os.path.join('log','dev_align.{}.{{}}.log'.format(x))), _ALI_LIKE))
+
+    def stop_early(self):
+        '''True if the last patience dev scores did not improve on the best one before them by min_improvement'''
+        likes = [ d['like'] for d in self.state['dev'] ]
+        if len(likes) <= self.patience:
+            return(False)
+        best_before = max(likes[:-self.patience])
+        return(all(like < best_before + self.min_improvement for like in likes[-self.patience:]))
+
+    ########## training ##################################################
+    def train(self, from_iter=None, totgauss=None, num_iters=None):
+        '''USAGE: final_mdl = trainer.train(from_iter, totgauss, num_iters)
+        Train, or resume training from the checkpoint; returns modeldir/final.mdl.
+        from_iter = restart from the model of that iteration (which realigns the data first), dropping the
+          history after it, e.g., to try another totgauss or num_iters without redoing the iterations before.'''
+        os.makedirs(self.logdir, exist_ok=True)
+        self.totgauss = totgauss or self.totgauss
+        self.num_iters = num_iters or self.num_iters
+        self.state = self.load()
+        realign = False
+        if from_iter is not None:
+            if from_iter not in [ h['iter']+1 for h in self.state['history'] ] or not os.path.exists(self._model(from_iter)):
+                raise ValueError('monophone: cannot restart from iteration {}, which has no model in {}'.format(from_iter, self.modeldir))
+            self.state['stage'] = from_iter
+            self.state['history'] = [ h for h in self.state['history'] if h['iter'] < from_iter ]
+            self.state['dev'] = [ d for d in self.state['dev'] if d['iter'] <= from_iter ]
+            realign = True
+        elif self.state['stage'] == DONE:
+            print('monophone: doing nothing because {} says training is done'.format(self.checkpoint_file()))
+            return(os.path.join(self.modeldir,'final.mdl'))
+        self.state['config'] = { 'totgauss':self.totgauss, 'num_iters':self.num_iters, 'max_iter_inc':self.max_iter_inc,
+                                 'realign_iters':list(self.realign_iters), 'devdir':self.devdir }
+        with profiler.span('train_mono', 'stage', modeldir=self.modeldir):
+            self._prepare()
+            x = self.state['stage']
+            while x < self.num_iters:
+                self._iteration(x, realign or x in self.realign_iters)
+                realign = False
+                x += 1
+                self.state['stage'] = x
+                if self.devdir is not None and (x % self.dev_every == 0 or x == self.num_iters):
+                    (like, frames) = self.score_dev(x)
+                    self.state['dev'].append({ 'iter':x, 'like':like, 'frames':frames })
+                    if self.stop_early():
+                        print('monophone: stopping at {}.mdl: the dev set log-likelihood has stopped improving'.format(x))
+                        self.save()
+                        break
+                self.save()
+        return(self._finish(x))
+
+    def _prepare(self):
+        '''Stages -3 to 0: the flat start, its training graphs, and the first update, checkpointed after each'''
+        self._split(self.datadir)
+        steps = { -3:self.init_model, -2:lambda: self.compile_graphs(self.sdata, ''), -1:self.align_equal }
+        while self.state['stage'] < 0:
+            stage = self.state['stage']
+            start = time.time()
+            result = steps[stage]()
+            if stage == -1:
+                self.state['history'].append({ 'iter':0, 'realign':True, 'numgauss':self.state['numgauss0'],
+                                               'like':result[0], 'frames':result[1], 'times':{ 'acc':time.time()-start } })
+            self.state['stage'] = stage + 1
+            self.save()
+        if self.devdir is not None and not os.path.exists(os.path.join(self.modeldir,'dev_fsts.1.gz')):
+            self._split(self.devdir)
+            self.compile_graphs(self.dev_sdata, 'dev_')
+        if self.state['stage'] == 0:
+            start = time.time()
+            summed = self.update(0, self.state['numgauss0'])
+            self.state['history'][-1]['times'].update({ 'sum':summed-start, 'est':time.time()-summed })
+            self.state['stage'] = 1
+            self.save()
+
+    def _iteration(self, x, realign):
+        '''One pass of training: realign (if asked), accumulate, sum, and estimate model x+1'''
+        with profiler.span('iteration', 'stage', iter=x, realign=realign):
+            times = {}
+            start = time.time()
+            if realign:
+                self.align(x, 6 if x==1 else 10)
+                times['align'] = time.time() - start
+            acc_start = time.time()
+            (like, frames) = self.accumulate(x)
+            times['acc'] = time.time() - acc_start
+            numgauss = self.numgauss(x)
+            sum_start = time.time()
+            summed = self.update(x, numgauss)
+            times['sum'] = summed - sum_start
+            times['est'] = time.time() - summed
+            self.state['history'].append({ 'iter':x, 'realign':realign, 'numgauss':numgauss, 'like':like,
+                                           'frames':frames, 'times':times })
+        print('monophone: iteration {}: log-likelihood per frame {} with {} Gaussians, in {:.1f}s'.format(
+            x, like, numgauss, sum(times.values())))
+
+    def _finish(self, x):
+        '''Link final.mdl to the last model, or to the one that scored best on the dev set, and write the
+        other files that decoding and later training expect in modeldir.'''
+        final = x
+        if self.state['dev']:
+            final = max(self.state['dev'], key=lambda d: (d['like'] if d['like'] is not None else float('-inf')))['iter']
+        for (name, target) in (('final.mdl','{}.mdl'.format(final)), ('final.occs','{}.occs'.format(final))):
+            link = os.path.join(self.modeldir, name)
+            if os.path.lexists(link):
+                os.remove(link)
+            if os.path.exists(os.path.join(self.modeldir, target)):
+                os.symlink(target, link)
+        kaldi.write_list_to_file([ str(self.nj) ], os.path.join(self.modeldir,'num_jobs'), '\n')
+        kaldi.write_list_to_file([], os.path.join(self.modeldir,'cmvn_opts'), '\n')
+        shutil.copy2(os.path.join(self.langdir,'phones.txt'), os.path.join(self.modeldir,'phones.txt'))
+        self.state['stage'] = DONE
+        self.state['final'] = final
+        self.save()
+        return(os.path.join(self.modeldir,'final.mdl'))
+
+    ########## reports ##################################################
+    def report(self):
+        '''USAGE: print(trainer.report()); the log-likelihood, Gaussians and time of each iteration'''
+        state = self.state or self.load()
+        dev = { d['iter']:d['like'] for d in state['dev'] }
+        lines = [ '{:>4s} {:>7s} {:>8s} {:>10s} {:>10s} {:>8s} {:>8s} {:>8s} {:>8s}'.format(
+            'iter','realign','#gauss','like','dev like','align','acc','sum','est') ]
+        fmt = lambda v: '{:.4f}'.format(v) if v is not None else '-'
+        for h in state['history']:
+            t = h['times']
+            lines.append('{:>4d} {:>7s} {:>8d} {:>10s} {:>10s} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}'.format(
+                h['iter'], 'yes' if h['realign'] else '', h['numgauss'], fmt(h['like']), fmt(dev.get(h['iter']+1)),
+                t.get('align',0.0), t.get('acc',0.0), t.get('sum',0.0), t.get('est',0.0)))
+        return('\n'.join(lines))
+
+########## Called from the operating system ##################################################
+if __name__=="__main__":
+    args = [ a for a in sys.argv[1:] if not a.startswith('--') ]
+    opts = dict(a[2:].split('=',1) for a in sys.argv[1:] if a.startswith('--') and '=' in a)
+    if len(args) < 3:
+        print(__doc__)
+        exit(0)
+    (datadir, langdir, modeldir) = args[:3]
+    nj = int(args[3]) if len(args) > 3 else 1
+    trainer = Trainer(datadir, langdir, modeldir, kaldi.CMD(nproc=nj), totgauss=int(opts.get('totgauss',TOTGAUSS)),
+                      num_iters=int(opts.get('num-iters',NUM_ITERS)), devdir=opts.get('dev'))
+    trainer.train(from_iter=int(opts['from-iter']) if 'from-iter' in opts else None)
+    print(trainer.report())
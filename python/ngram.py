@@ -0,0 +1,245 @@
+#!/usr/bin/python3
+"""
+USAGE:
+  import ngram
+  trie = ngram.train(corpus.utt2txt, order=3, vocab='data/lang/words.txt', nj=4)
+  trie.write_arpa('data/local/lm.arpa.gz')     # or trie.write_fst('data/lang/G.fst'), see arpa.py
+  ppl = ngram.perplexity(trie, dev_utt2txt)
+  If called from the command line, trains an LM from text tables (utterance ID, then the words):
+  python ngram.py lm.arpa.gz order text [text ...] [--vocab=words.txt] [--nj=4] [--min-counts=1,2]
+
+In-process n-gram LM estimation with interpolated modified Kneser-Ney smoothing, as
+SRILM ngram-count -kndiscount -interpolate or KenLM lmplz estimate it, with no external tool.
+Texts are a dict from utterance ID to transcription (e.g., corpus.utt2txt), the name of a file
+holding such a table, or a list of either.  Each sentence is wrapped in <s> ... </s>.
+If vocab (a words.txt file, or a dict from word to ID) is given, the LM covers all of its words,
+and words not in it are mapped to <unk> (or, if there is no <unk>, n-grams containing them are
+not counted); otherwise the vocabulary is the set of words in the texts.
+The sentences are split into shards of SHARD_SIZE, counted in a pool of nj processes, each of
+which packs every n-gram into one integer and counts the distinct ones by sorting; the shard
+counts are merged the same way.  The estimate is computed order by order on whole arrays, and
+stored in an arpa.NgramTrie, with the raw counts, so that it can be pruned by count or entropy.
+"""
+
+import os,sys
+import time
+import collections.abc
+import multiprocessing
+import numpy as np
+import kaldi
+import arpa
+
+SHARD_SIZE = 50000      # sentences counted by each task
+
+########## reading texts ##################################################
+def read_texts(texts):
+    '''USAGE: sentences = read_texts(texts)
+    texts: a dict (or other mapping) from ID to text, a text-table filename, or a list of either.  Returns a list of strings.'''
+    if isinstance(texts, collections.abc.Mapping):
+        return(list(texts.values()))
+    if isinstance(texts, str):
+        return(list(kaldi.read_dict_from_file(texts).values()))
+    sentences = []
+    for t in texts:
+        sentences.extend(read_texts(t))
+    return(sentences)
+
+def build_vocab(sentences):
+    '''USAGE: word2id = build_vocab(sentences); <s>, </s>, then every word in the sentences, sorted'''
+    words = set()
+    for s in sentences:
+        words.update(s.split())
+    words -= { '<s>', '</s>' }
+    return({ w:i for (i,w) in enumerate([ '<s>', '</s>' ] + sorted(words)) })
+
+########## counting ##################################################
+def _unique_rows(W, weights=None):
+    '''Distinct rows of W (m,k), in sorted order, and the total weight (by default, the number) of each.
+    If the word IDs fit, each row is packed into one int64; otherwise the rows are sorted with lexsort.'''
+    (m, k) = W.shape
+    weights = np.ones(m, dtype=np.int64) if weights is None else weights
+    if m == 0:
+        return(W, weights)
+    bits = max(1, int(W.max()).bit_length())
+    if bits*k <= 63:
+        key = np.zeros(m, dtype=np.int64)
+        for j in range(k):
+            key = (key << bits) | W[:,j]
+        order = np.argsort(key, kind='stable')
+        key = key[order]
+        start = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+    else:
+        order = np.lexsort(W.T[::-1])
+        sorted_rows = W[order]
+        start = np.flatnonzero(np.r_[True, (sorted_rows[1:] != sorted_rows[:-1]).any(axis=1)])
+    return(W[order[start]], np.add.reduceat(weights[order], start))
+
+def _tokenize(sentences, get, unk_id, bos, eos):
+    '''Word IDs of all the sentences, each wrapped in <s> ... </s>, concatenated; and the length of each'''
+    tokens = []
+    lengths = []
+    for s in sentences:
+        words = s.split()
+        tokens.append(bos)
+        tokens.extend(get(w, unk_id) for w in words)
+        tokens.append(eos)
+        lengths.append(len(words)+2)
+    return(np.array(tokens, dtype=np.int64), np.array(lengths, dtype=np.int64))
+
+_WORKER = {}
+
+def _init_worker(word2id, unk_id, order):
+    '''Pool initializer: the symbol table and settings every _count_shard task uses'''
+    _WORKER.update(word2id=word2id, unk_id=unk_id, order=order)
+
+def _count_shard(sentences):
+    '''Pool worker: for each order k, the distinct k-grams (m,k) in a list of sentences, and their counts'''
+    (get, unk_id, order) = (_WORKER['word2id'].get, _WORKER['unk_id'], _WORKER['order'])
+    (bos, eos) = (_WORKER['word2id']['<s>'], _WORKER['word2id']['</s>'])
+    (tokens, lengths) = _tokenize(sentences, get, unk_id, bos, eos)
+    remaining = np.repeat(np.cumsum(lengths), lengths) - np.arange(len(tokens))   # tokens left in the sentence, from each one
+    result = []
+    for k in range(1, order+1):
+        starts = np.flatnonzero(remaining >= k)
+        W = np.stack([ tokens[starts+j] for j in range(k) ], axis=1)
+        result.append(_unique_rows(W[(W >= 0).all(axis=1)]))
+    return(result)
+
+def count(sentences, word2id, order=3, nj=1, unk='<unk>'):
+    '''USAGE: counts = count(sentences, word2id, order, nj, unk)
+    counts: list, for each order k, of (distinct k-grams (m,k) of word IDs, sorted; their counts).
+    Counted in a pool of nj processes, SHARD_SIZE sentences per task, and merged.'''
+    unk_id = word2id.get(unk, -1)
+    shards = [ sentences[n:n+SHARD_SIZE] for n in range(0, len(sentences), SHARD_SIZE) ]
+    parts = [ [] for k in range(order) ]
+    if nj <= 1 or len(shards) <= 1:
+        _init_worker(word2id, unk_id, order)
+        for shard in shards:
+            for (k, c) in enumerate(_count_shard(shard)):
+                parts[k].append(c)
+    else:
+        with multiprocessing.Pool(nj, initializer=_init_worker, initargs=(word2id, unk_id, order)) as pool:
+            for counts in pool.imap_unordered(_count_shard, shards):
+                for (k, c) in enumerate(counts):
+                    parts[k].append(c)
+    result = []
+    for k in range(1, order+1):
+        if len(parts[k-1]) == 1:
+            result.append(parts[k-1][0])
+        else:
+            W = np.concatenate([ W for (W, c) in parts[k-1] ]) if parts[k-1] else np.zeros((0,k), dtype=np.int64)
+            c = np.concatenate([ c for (W, c) in parts[k-1] ]) if parts[k-1] else np.zeros(0, dtype=np.int64)
+            result.append(_unique_rows(W, c))
+    return(result)
+
+########## modified Kneser-Ney ##################################################
+def discounts(a):
+    '''USAGE: D = discounts(adjusted_counts)
+    Modified Kneser-Ney discounts (Chen and Goodman, 1998), indexed by count: D[0]=0, D[1], D[2], D[3] for 3 or more.
+    Each is kept in [0, count]; if some counts-of-counts are zero, the missing ones fall back on Y = n1/(n1+2 n2).'''
+    n = [ int(np.count_nonzero(a == i)) for i in (1,2,3,4) ]
+    Y = n[0]/(n[0]+2*n[1]) if n[0]+2*n[1] > 0 else 0.5
+    D = [ 0.0 ]
+    for i in (1,2,3):
+        d = i - (i+1)*Y*n[i]/n[i-1] if n[i-1] > 0 else Y
+        D.append(min(max(d, 0.0), float(i)))
+    return(np.array(D))
+
+def estimate(counts, word2id):
+    '''USAGE: trie = estimate(counts, word2id)
+    Interpolated modified Kneser-Ney estimate from the output of count().
+    N-grams of the highest order, and n-grams that begin with <s>, keep their counts; every other
+    n-gram is counted by the number of distinct words seen before it.  Each order is interpolated
+    with the one below it, and unigrams with the uniform distribution over the vocabulary, i.e.,
+    every word in word2id except <s>, <eps>, and disambiguation symbols (#0, ...).'''
+    order = len(counts)
+    bos = word2id['<s>']
+    vocab = np.array(sorted(i for (w,i) in word2id.items() if w not in ('<s>','<eps>') and not w.startswith('#')), dtype=np.int64)
+    (W1, c1) = counts[0]
+    unseen = np.setdiff1d(np.r_[vocab, bos], W1[:,0])
+    ngrams = [ (np.r_[W1[:,0], unseen], np.zeros(len(W1)+len(unseen)), np.zeros(len(W1)+len(unseen))) ]
+    raw = [ np.r_[c1, np.zeros(len(unseen), dtype=np.int64)] ]
+    for (W, c) in counts[1:]:
+        ngrams.append((W, np.zeros(len(W)), np.zeros(len(W))))
+        raw.append(c)
+    trie = arpa.NgramTrie.from_ngrams(word2id, ngrams, raw)
+    # adjusted counts, in the trie's order
+    adjusted = []
+    for k in range(1, order+1):
+        a = trie.counts[k-1].copy()
+        if k < order:
+            W = trie.ngrams(k+1)
+            continuation = np.bincount(trie.find(W[:,1:]), minlength=len(a))
+            a = np.where(trie.ngrams(k)[:,0] == bos, a, continuation)
+        adjusted.append(a)
+    adjusted[0][trie.keys[0] == bos] = 0
+    # unigrams: interpolated with the uniform distribution
+    a = adjusted[0]
+    D = discounts(a[a > 0])
+    in_vocab = np.isin(trie.keys[0], vocab)
+    total = a[in_vocab].sum()
+    gamma = D[np.minimum(a, 3)][in_vocab].sum() / total
+    p = (a - D[np.minimum(a, 3)])/total + gamma/len(vocab)
+    trie.logprobs[0] = np.where(in_vocab, np.log10(np.maximum(p, 1e-99)), -99.0).astype(np.float32)
+    # each higher order: interpolated with the order below
+    for k in range(2, order+1):
+        a = adjusted[k-1]
+        D = discounts(a)
+        ctx = trie.keys[k-1] // trie.V
+        nh = len(trie.keys[k-2])
+        total = np.bincount(ctx, a, nh)
+        gamma = np.bincount(ctx, D[np.minimum(a, 3)], nh) / np.maximum(total, 1)
+        plow = 10.0**trie.logprobs[k-2].astype(np.float64)[trie.find(trie.ngrams(k)[:,1:])]
+        p = (a - D[np.minimum(a, 3)])/total[ctx] + gamma[ctx]*plow
+        trie.logprobs[k-1] = np.log10(p).astype(np.float32)
+        trie.backoffs[k-2] = np.where(total > 0, np.log10(np.maximum(gamma, 1e-99)), 0.0).astype(np.float32)
+    return(trie)
+
+########## public interface ##################################################
+def train(texts, order=3, vocab=None, nj=1, min_counts=None, unk='<unk>'):
+    '''USAGE: trie = train(texts, order, vocab, nj, min_counts, unk)
+    texts: see read_texts.  vocab: words.txt, a dict from word to ID, or None to use the words in the texts.
+    min_counts: if given, n-grams of order 2 and up seen fewer times are pruned (one number, or one per order,
+    as SRILM -gt2min, -gt3min, ...), and backoff weights are recomputed.  Returns an arpa.NgramTrie.'''
+    sentences = read_texts(texts)
+    if vocab is None:
+        word2id = build_vocab(sentences)
+    else:
+        word2id = arpa.read_symbols(vocab) if isinstance(vocab, str) else dict(vocab)
+    trie = estimate(count(sentences, word2id, order, nj, unk), word2id)
+    if min_counts:
+        trie.prune_count(min_counts)
+    return(trie)
+
+def perplexity(trie, texts, unk='<unk>'):
+    '''USAGE: ppl = perplexity(trie, texts)
+    Perplexity of the LM on the sentences in texts, counting </s> and not <s>; words not in the
+    trie's symbol table are scored as unk, or, if it has no unk, skipped (as SRILM ngram -ppl does).'''
+    (tokens, lengths) = _tokenize(read_texts(texts), trie.word2id.get, trie.word2id.get(unk, -1), trie.bos, trie.eos)
+    sentence = np.repeat(np.arange(len(lengths)), lengths)[tokens >= 0]
+    tokens = tokens[tokens >= 0]
+    lengths = np.bincount(sentence, minlength=len(lengths))
+    position = np.arange(len(tokens)) - np.repeat(np.cumsum(lengths) - lengths, lengths)   # 0 for each <s>
+    width = np.minimum(position, trie.order-1)
+    logprob = 0.0
+    for c in range(1, trie.order):
+        t = np.flatnonzero(width == c)
+        contexts = np.stack([ tokens[t-c+j] for j in range(c) ], axis=1)
+        logprob += trie.score(contexts, tokens[t]).sum()
+    num_words = int((width > 0).sum())
+    return(10.0**(-logprob/max(num_words, 1)))
+
+########## Called from the operating system ##################################################
+if __name__=="__main__":
+    args = [ a for a in sys.argv[1:] if not a.startswith('--') ]
+    opts = dict(a[2:].split('=',1) for a in sys.argv[1:] if a.startswith('--') and '=' in a)
+    if len(args) < 3:
+        print(__doc__)
+        exit(0)
+    (lm, order, texts) = (args[0], int(args[1]), args[2:])
+    start = time.time()
+    trie = train(texts, order, opts.get('vocab'), int(opts.get('nj', 1)),
+                 [ int(c) for c in opts['min-counts'].split(',') ] if 'min-counts' in opts else None)
+    print('ngram: estimated {} in {:.2f}s: {}'.format(
+        lm, time.time()-start, ', '.join('{} {}-grams'.format(n, k) for (k, n) in enumerate(trie.num_ngrams(), start=1))))
+    trie.write_arpa(lm)
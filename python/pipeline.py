@@ -0,0 +1,260 @@
+#!/usr/bin/python3
+"""
+USAGE:
+  import pipeline
+  p = pipeline.Pipeline(cpu_budget=kaldi_cmd.nproc, journal='exp/lang/pipeline.journal')
+  p.add('mfcc_train', lambda results: corpus.make_mfcc(...), cpus=4, outputs=['data/train/feats.scp'])
+  p.add('train_mono', lambda results: H.train_mono(results['mfcc_train'], ...), deps=['mfcc_train'])
+  p.add('swahili/train_mono', ..., group='swahili')    # groups share cpu_budget fairly, in proportion to weights
+  results = p.run()
+  print(p.report())
+
+A dependency graph of stages, run concurrently.
+Each stage is a function of the results of the stages before it, declared with the stages it
+depends on, the number of CPUs it keeps busy, and the files it writes.  Whenever a stage finishes,
+every stage whose dependencies are all done is started, in the order added, as long as the CPUs
+claimed by running stages stay within cpu_budget; a stage that claims more than the whole budget
+is started only when nothing else is running.
+Stages may be put in groups (e.g., one per language, when one pipeline trains several), which share
+the budget fairly: of the stages that are ready, the one started first is the one whose group has
+the fewest CPUs busy, relative to its weight.  With keep_going, a stage that fails stops only the
+stages that depend on it, so that the other groups run to the end.
+After each stage finishes, its result is saved in the journal, so that if the pipeline is run
+again after a crash, stages that finished, whose outputs still exist, and whose dependencies were
+also resumed, are not rerun.  A stage that declares no outputs is always rerun, since nothing shows
+that its work survived; and when a run ends, the journal keeps only the groups that have stages
+left to run (none, if nothing failed), so the next run of any other group starts from the beginning
+(the stage cache decides which of its commands are still current).
+The report lists when each stage ran, and the critical path: the chain of dependent stages whose
+total run time bounds the run time of the whole pipeline.
+"""
+
+import os,sys
+import time
+import pickle
+import threading
+import profiler
+
+class Stage:
+    '''One node of the pipeline.'''
+    def __init__(self, name, func, deps, cpus, outputs, group=None):
+        '''USAGE: stage=Stage(name, func, deps, cpus, outputs, group)'''
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.cpus = cpus
+        self.outputs = list(outputs)
+        self.group = group
+        self.start = None
+        self.end = None
+        self.resumed = False
+        self.recorded = 0.0   # run time in the run that produced a resumed result
+
+    def elapsed(self):
+        return(0.0 if self.start is None or self.end is None else self.end - self.start)
+
+class Pipeline:
+    '''A set of stages, run in dependency order, as many at a time as the CPU budget allows.'''
+    def __init__(self, cpu_budget, journal=None, weights=None, keep_going=False):
+        '''USAGE: p=Pipeline(cpu_budget, journal, weights, keep_going)
+        cpu_budget = maximum number of CPUs claimed, in total, by the stages running at any one time
+        journal = filename in which finished stages are recorded, so that a rerun can resume; None to rerun everything
+        weights = dict from group to its share of the budget, relative to the others (default 1 each)
+        keep_going = True to keep running the stages that do not depend on a failed one
+        '''
+        self.cpu_budget = max(1, int(cpu_budget))
+        self.journal = journal
+        self.weights = dict(weights or {})
+        self.keep_going = keep_going
+        self.stages = {}
+        self.results = {}
+        self.start = None
+        self.end = None
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+
+    def add(self, name, func, deps=(), cpus=1, outputs=(), group=None):
+        '''USAGE: p.add(name, func, deps, cpus, outputs, group)
+        func(results) runs the stage; results is a dict from the name of each finished stage to what it returned.
+        deps = names of stages, already added, that must finish first
+        cpus = number of CPUs the stage keeps busy
+        outputs = files the stage creates; if any is missing, or there are none, the stage is rerun even if it is in the journal
+        group = the group whose share of the CPU budget the stage uses
+        '''
+        if name in self.stages:
+            raise ValueError('pipeline: stage {} was added twice'.format(name))
+        for d in deps:
+            if d not in self.stages:
+                raise ValueError('pipeline: stage {} depends on {}, which has not been added'.format(name, d))
+        self.stages[name] = Stage(name, func, deps, cpus, outputs, group)
+
+    ########## journal ##################################################
+    def _read_journal(self):
+        if self.journal is None or not os.path.exists(self.journal):
+            return({})
+        try:
+            with open(self.journal,'rb') as f:
+                return(pickle.load(f))
+        except (OSError, EOFError, pickle.UnpicklingError) as err:
+            print('pipeline: ignoring unreadable journal {}: {}'.format(self.journal, err))
+            return({})
+
+    def _write_journal(self, groups=None):
+        '''Save the result of every finished stage, or only of those in groups'''
+        if self.journal is None:
+            return
+        entries = { name:{ 'result':self.results[name], 'elapsed':s.elapsed() if not s.resumed else s.recorded }
+                    for (name, s) in self.stages.items()
+                    if name in self.results and (groups is None or s.group in groups) }
+        journaldir = os.path.dirname(self.journal)
+        if journaldir:
+            os.makedirs(journaldir, exist_ok=True)
+        try:
+            with open(self.journal+'.tmp','wb') as f:
+                pickle.dump(entries, f)
+        except (pickle.PicklingError, TypeError, AttributeError) as err:
+            print('pipeline: cannot save results in {}, so this run cannot be resumed: {}'.format(self.journal, err))
+            return
+        os.replace(self.journal+'.tmp', self.journal)
+
+    def _finish_journal(self):
+        '''Keep in the journal only the groups with stages that failed or were skipped; the others have
+        nothing to resume, so their next run starts from the beginning.  With no failures, delete it.'''
+        if self.journal is None:
+            return
+        unfinished = set(s.group for (name, s) in self.stages.items() if name not in self.results)
+        if unfinished:
+            self._write_journal(unfinished)
+        elif os.path.exists(self.journal):
+            os.remove(self.journal)
+
+    def _resume(self):
+        '''Mark, in order, the stages that can be skipped, and load their results'''
+        journal = self._read_journal()
+        for (name, s) in self.stages.items():
+            if (name in journal and s.outputs and all(os.path.exists(o) for o in s.outputs)
+                and all(self.stages[d].resumed for d in s.deps)):
+                s.resumed = True
+                s.recorded = journal[name]['elapsed']
+                self.results[name] = journal[name]['result']
+
+    ########## running ##################################################
+    def _run_stage(self, s, results):
+        error = None
+        try:
+            with profiler.span(s.name, 'stage', cpus=s.cpus):
+                result = s.func(results)
+        except BaseException as err:
+            error = err
+        with self.lock:
+            s.end = time.time()
+            if error is None:
+                self.results[s.name] = result
+                self._write_journal()
+            else:
+                self.errors.append((s.name, error))
+            self.running.remove(s.name)
+            print('pipeline: {} {} in {:.1f}s; {} of {} stages done'.format(
+                'finished' if error is None else 'FAILED', s.name, s.elapsed(), len(self.results), len(self.stages)))
+            self.done.notify_all()
+
+    def _share(self, group):
+        '''CPUs busy in group, relative to its weight'''
+        busy = sum(self.stages[r].cpus for r in self.running if self.stages[r].group == group)
+        return(busy / self.weights.get(group, 1.0))
+
+    def run(self):
+        '''USAGE: results = p.run()
+        Run every stage not resumed from the journal; return the dict of results of all stages.
+        If a stage raises an exception, no more stages are started, the running ones are allowed to
+        finish, and a RuntimeError naming the failed stage is raised.
+        Afterwards, the journal keeps only the groups that did not finish (see _finish_journal).'''
+        self.start = time.time()
+        self._resume()
+        for s in self.stages.values():
+            if s.resumed:
+                print('pipeline: resuming after {}, finished in a previous run'.format(s.name))
+        pending = [ name for (name, s) in self.stages.items() if not s.resumed ]
+        self.running = []
+        self.errors = []
+        self.skipped = []
+        order = { name:n for (n, name) in enumerate(self.stages) }
+        with self.lock:
+            while pending or self.running:
+                if self.errors and self.keep_going:
+                    blocked = set(name for (name, error) in self.errors) | set(self.skipped)
+                    for name in list(pending):     # in the order added, so after the stages they depend on
+                        failed = [ d for d in self.stages[name].deps if d in blocked ]
+                        if failed:
+                            pending.remove(name)
+                            self.skipped.append(name)
+                            blocked.add(name)
+                            print('pipeline: skipping {}, because {} failed'.format(name, failed[0]))
+                if not self.errors or self.keep_going:
+                    busy = sum(self.stages[r].cpus for r in self.running)
+                    while True:
+                        ready = [ name for name in pending if all(d in self.results for d in self.stages[name].deps)
+                                  and not (self.running and busy + self.stages[name].cpus > self.cpu_budget) ]
+                        if not ready:
+                            break
+                        name = min(ready, key=lambda n: (self._share(self.stages[n].group), order[n]))
+                        s = self.stages[name]
+                        pending.remove(name)
+                        self.running.append(name)
+                        busy += s.cpus
+                        s.start = time.time()
+                        print('pipeline: starting {} ({} of {} CPUs busy)'.format(name, busy, self.cpu_budget))
+                        threading.Thread(target=self._run_stage, args=(s, dict(self.results)), daemon=True).start()
+                if not self.running:
+                    break
+                self.done.wait()
+        self.end = time.time()
+        self._finish_journal()
+        if self.errors:
+            (name, error) = self.errors[0]
+            raise RuntimeError('pipeline: {} stages failed, first {}: {}'.format(len(self.errors), name, error)) from error
+        return(dict(self.results))
+
+    ########## reporting ##################################################
+    def critical_path(self):
+        '''USAGE: (path, seconds) = p.critical_path()
+        The chain of stages, in order, with the greatest total run time (as of the run that last ran each one).'''
+        finish = {}
+        best = {}
+        for (name, s) in self.stages.items():   # stages are added after their dependencies
+            t = s.recorded if s.resumed else s.elapsed()
+            before = max(s.deps, key=lambda d: finish[d], default=None)
+            finish[name] = t + (finish[before] if before else 0.0)
+            best[name] = (best[before] if before else []) + [ name ]
+        if not finish:
+            return([], 0.0)
+        last = max(finish, key=lambda n: finish[n])
+        return(best[last], finish[last])
+
+    def report(self):
+        '''USAGE: print(p.report())
+        When each stage ran, relative to the start of the pipeline, and the critical path.'''
+        lines = [ 'Pipeline: {} stages in {:.1f}s, CPU budget {}'.format(
+            len(self.stages), (self.end or time.time()) - self.start, self.cpu_budget) ]
+        for s in sorted(self.stages.values(), key=lambda s: (s.start is None, s.start or 0)):
+            if s.resumed:
+                lines.append('    {:<24s} resumed (took {:.1f}s in a previous run)'.format(s.name, s.recorded))
+            elif s.start is None:
+                lines.append('    {:<24s} not run'.format(s.name))
+            else:
+                lines.append('    {:<24s} {:8.1f}s to {:8.1f}s ({:.1f}s, {} CPUs)'.format(
+                    s.name, s.start-self.start, (s.end or time.time())-self.start, s.elapsed(), s.cpus))
+        (path, seconds) = self.critical_path()
+        lines.append('    critical path ({:.1f}s): {}'.format(seconds, ' -> '.join(path)))
+        groups = sorted(set(s.group for s in self.stages.values() if s.group is not None))
+        if groups:
+            lines.append('    {:<24s} {:>8s} {:>8s} {:>10s} {:>10s}'.format('group','stages','failed','wall','CPU-s'))
+        for g in groups:
+            members = [ s for s in self.stages.values() if s.group == g ]
+            ran = [ s for s in members if s.start is not None ]
+            failed = sum(1 for (name, error) in getattr(self, 'errors', []) if self.stages[name].group == g)
+            done = sum(1 for s in members if s.name in self.results)
+            wall = (max((s.end or time.time()) for s in ran) - min(s.start for s in ran)) if ran else 0.0
+            lines.append('    {:<24s} {:>8s} {:>8d} {:>9.1f}s {:>10.1f}'.format(
+                g, '{}/{}'.format(done, len(members)), failed, wall, sum(s.elapsed()*s.cpus for s in ran)))
+        return('\n'.join(lines))
@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+"""
+USAGE:
+  import prepare_lang
+  lang = prepare_lang.Lang(lexicon, nonsilence_phones, silence_phones, optional_silence, extra_questions, '<unk>')
+  lang.write('data/lang')          # phones.txt, words.txt, phones/*, topo, oov.*, L.fst, L_disambig.fst
+  If called from the command line, reads a dict directory, as utils/prepare_lang.sh does:
+  python prepare_lang.py dictdir oov_word langdir
+
+Native replacement for utils/prepare_lang.sh with its default options (word-position-dependent
+phones, optional silence with probability SIL_PROB, separate roots for every phone, 3-state
+nonsilence and 5-state silence topologies), building the lang directory directly from a lexicon
+in memory: a dict from each word to its pronunciation, or to a list of alternate pronunciations.
+Each phone is given a word-position suffix (_B, _I, _E, or _S); pronunciations that are repeated,
+or that are prefixes of others, get disambiguation symbols #1, #2, ..., as add_lex_disambig.pl gives them.
+As in make_lexicon_fst.pl, L.fst has one path for each pronunciation, from its loop state back to it,
+either directly or through an optional silence; the word is output on the first arc of the path, so
+that composition with G is pruned by G as soon as a word starts (prefixes are shared later, when
+mkgraph.sh determinizes).  L_disambig.fst also has the
+silence disambiguation symbol after the optional silence, and a #0:#0 self-loop on the loop state
+for the backoff arcs of G.  Both are sorted by output label, as prepare_lang.sh leaves them.
+"""
+
+import os,sys
+import math
+import time
+import numpy as np
+import kaldi
+import arpa
+
+SIL_PROB = 0.5
+POSITIONS = ('_B', '_E', '_I', '_S')
+WORD_BOUNDARY = { '':'nonword', '_B':'begin', '_E':'end', '_I':'internal', '_S':'singleton' }
+NONSILENCE_TOPO = ('<State> 0 <PdfClass> 0 <Transition> 0 0.75 <Transition> 1 0.25 </State>',
+                   '<State> 1 <PdfClass> 1 <Transition> 1 0.75 <Transition> 2 0.25 </State>',
+                   '<State> 2 <PdfClass> 2 <Transition> 2 0.75 <Transition> 3 0.25 </State>',
+                   '<State> 3 </State>')
+SILENCE_TOPO = ('<State> 0 <PdfClass> 0 <Transition> 0 0.25 <Transition> 1 0.25 <Transition> 2 0.25 <Transition> 3 0.25 </State>',
+                '<State> 1 <PdfClass> 1 <Transition> 1 0.25 <Transition> 2 0.25 <Transition> 3 0.25 <Transition> 4 0.25 </State>',
+                '<State> 2 <PdfClass> 2 <Transition> 1 0.25 <Transition> 2 0.25 <Transition> 3 0.25 <Transition> 4 0.25 </State>',
+                '<State> 3 <PdfClass> 3 <Transition> 1 0.25 <Transition> 2 0.25 <Transition> 3 0.25 <Transition> 4 0.25 </State>',
+                '<State> 4 <PdfClass> 4 <Transition> 4 0.75 <Transition> 5 0.25 </State>',
+                '<State> 5 </State>')
+
+########## auxiliary functions ##################################################
+def pronunciations(lexicon):
+    '''USAGE: entries = pronunciations(lexicon)
+    (word, tuple of phones) for each distinct pronunciation in lexicon, a dict whose values are
+    pronunciations or lists of them; sorted by word, with each word's pronunciations in the order given.'''
+    entries = []
+    for word in sorted(lexicon):
+        prons = lexicon[word] if isinstance(lexicon[word], (list, tuple)) else [ lexicon[word] ]
+        seen = set()
+        for pron in prons:
+            phones = tuple(pron.split())
+            if phones not in seen:
+                seen.add(phones)
+                entries.append((word, phones))
+    return(entries)
+
+def position_dependent(phones):
+    '''USAGE: ('a_B','b_I','c_E') = position_dependent(('a','b','c')); a single phone gets _S'''
+    if len(phones) == 1:
+        return((phones[0]+'_S',))
+    return(tuple([ phones[0]+'_B' ] + [ p+'_I' for p in phones[1:-1] ] + [ phones[-1]+'_E' ]) if phones else ())
+
+def disambiguate(prons):
+    '''USAGE: (suffixes, max_disambig) = disambiguate(prons)
+    The disambiguation symbol number (0 for none) to append to each pronunciation, as add_lex_disambig.pl
+    assigns them: a pronunciation that occurs more than once, or is a proper prefix of another, gets
+    #1, #2, ... in order of occurrence.'''
+    count = {}
+    prefixes = set()
+    for pron in prons:
+        count[pron] = count.get(pron, 0) + 1
+        for n in range(len(pron)):
+            prefixes.add(pron[:n])
+    last = {}
+    suffixes = []
+    for pron in prons:
+        if pron in prefixes or count[pron] > 1:
+            last[pron] = last.get(pron, 0) + 1
+            suffixes.append(last[pron])
+        else:
+            suffixes.append(0)
+    return(suffixes, max(suffixes, default=0))
+
+########## lang directory ##################################################
+class Lang:
+    '''The contents of a lang directory, built from a lexicon and phone lists in memory.'''
+    def __init__(self, lexicon, nonsilence_phones, silence_phones, optional_silence, extra_questions=(),
+                 oov_word='<unk>', sil_prob=SIL_PROB):
+        '''USAGE: lang = Lang(lexicon, nonsilence_phones, silence_phones, optional_silence, extra_questions, oov_word, sil_prob)
+        lexicon: a dict from word to a pronunciation (a string of phones) or a list of them
+        nonsilence_phones, silence_phones: lists of phones; each is its own set and root
+        optional_silence: a list of one silence phone, which L allows between words with probability sil_prob
+        extra_questions: a list of phones, asked about as one question, as in a one-line extra_questions.txt
+        oov_word: the word that words not in the lexicon are mapped to; it must be in the lexicon'''
+        (self.nonsilence_phones, self.silence_phones) = (list(nonsilence_phones), list(silence_phones))
+        self.optional_silence = list(optional_silence)
+        self.extra_questions = list(extra_questions)
+        (self.oov_word, self.sil_prob) = (oov_word, sil_prob)
+        known = set(self.nonsilence_phones) | set(self.silence_phones)
+        if len(known) != len(self.nonsilence_phones) + len(self.silence_phones):
+            raise ValueError('prepare_lang: the silence and nonsilence phones are not all distinct')
+        if len(self.optional_silence) != 1 or self.optional_silence[0] not in self.silence_phones:
+            raise ValueError('prepare_lang: optional_silence must be one silence phone, not {}'.format(self.optional_silence))
+        if oov_word not in lexicon:
+            raise ValueError('prepare_lang: the OOV word {} is not in the lexicon'.format(oov_word))
+        self.entries = pronunciations(lexicon)
+        for (word, phones) in self.entries:
+            unknown = [ p for p in phones if p not in known ]
+            if unknown:
+                raise ValueError('prepare_lang: the pronunciation of {} has unknown phones {}'.format(word, ' '.join(unknown)))
+        self.prons = [ position_dependent(phones) for (word, phones) in self.entries ]
+        (self.disambig_suffixes, max_disambig) = disambiguate(self.prons)
+        self.sil_disambig = max_disambig + 1      # one more, for the optional silence
+        self.phone_map = { p:[ p ]+[ p+s for s in POSITIONS ] for p in self.silence_phones }
+        self.phone_map.update({ p:[ p+s for s in POSITIONS ] for p in self.nonsilence_phones })
+        self.silence = [ q for p in self.silence_phones for q in self.phone_map[p] ]
+        self.nonsilence = [ q for p in self.nonsilence_phones for q in self.phone_map[p] ]
+        self.disambig = [ '#{}'.format(n) for n in range(self.sil_disambig+1) ]
+        self.phones = [ '<eps>' ] + self.silence + self.nonsilence + self.disambig
+        self.phone2id = { p:i for (i,p) in enumerate(self.phones) }
+        self.words = [ '<eps>' ] + sorted(set(word for (word, phones) in self.entries)) + [ '#0', '<s>', '</s>' ]
+        self.word2id = { w:i for (i,w) in enumerate(self.words) }
+
+    ########## L.fst ##################################################
+    def fst_arrays(self, disambig=False):
+        '''USAGE: (num_states, finals, arcs) = lang.fst_arrays(disambig)
+        L (or, if disambig, L_disambig) as arrays: finals, the final weight of each state;
+        arcs, (src, dst, ilabel, olabel, weight) columns, sorted by source state and then output label.
+        State 0 is the start, 1 the loop state, 2 the state after a word that is followed by silence,
+        3 (if disambig) the state after that silence, and the rest are numbered as make_lexicon_fst.pl
+        numbers them: the states within each pronunciation, in lexicon order.'''
+        phone2id = self.phone2id
+        prons = [ [ phone2id[p] for p in pron ] + ([ phone2id['#{}'.format(n)] ] if disambig and n else [])
+                  for (pron, n) in zip(self.prons, self.disambig_suffixes) ]
+        (start, loop, sil) = (0, 1, 2)
+        first_state = 4 if disambig else 3
+        (nosil_cost, sil_cost) = (-math.log(1.0-self.sil_prob), -math.log(self.sil_prob))
+        silphone = phone2id[self.optional_silence[0]]
+        arcs = [ (start, loop, 0, 0, nosil_cost), (start, sil, 0, 0, sil_cost) ]
+        if disambig:
+            arcs += [ (sil, 3, silphone, 0, 0.0), (3, loop, phone2id['#{}'.format(self.sil_disambig)], 0, 0.0),
+                      (loop, loop, phone2id['#0'], self.word2id['#0'], 0.0) ]
+        else:
+            arcs.append((sil, loop, silphone, 0, 0.0))
+        columns = [ [ np.array(c) for c in zip(*arcs) ] ]
+        # One arc per symbol of each pronunciation: every arc but the last of a pronunciation goes to a new
+        # state, numbered in order, and every arc but the first leaves from the state the one before reached
+        lengths = np.array([ len(p) for p in prons ], dtype=np.int64)
+        symbol = np.fromiter((s for p in prons for s in p), dtype=np.int64, count=int(lengths.sum()))
+        word = np.repeat(np.array([ self.word2id[w] for (w, phones) in self.entries ], dtype=np.int64), lengths)
+        ends = np.cumsum(lengths)
+        is_first = np.zeros(len(symbol), dtype=bool)
+        is_first[ends - lengths] = True
+        is_last = np.zeros(len(symbol), dtype=bool)
+        is_last[ends - 1] = True
+        reached = first_state + np.cumsum(~is_last) - 1    # the new state reached by each arc that is not last
+        src = np.where(is_first, loop, np.roll(reached, 1))
+        olabel = np.where(is_first, word, 0)
+        inner = ~is_last
+        columns.append([ src[inner], reached[inner], symbol[inner], olabel[inner], np.zeros(int(inner.sum())) ])
+        for (dst, cost) in ((loop, nosil_cost), (sil, sil_cost)):
+            columns.append([ src[is_last], np.full(int(is_last.sum()), dst), symbol[is_last], olabel[is_last],
+                             np.full(int(is_last.sum()), cost) ])
+        num_states = first_state + int(inner.sum())
+        (src, dst, ilabel, olabel, weight) = [ np.concatenate([ c[i] for c in columns ]).astype(np.int64 if i < 4 else np.float32)
+                                              for i in range(5) ]
+        order = np.lexsort((olabel, src))
+        finals = np.full(num_states, np.inf, dtype=np.float32)
+        finals[loop] = 0.0
+        return(num_states, finals, (src[order], dst[order], ilabel[order], olabel[order], weight[order]))
+
+    ########## writing ##################################################
+    def write(self, langdir):
+        '''USAGE: lang.write(langdir)
+        Write every file of a lang directory that prepare_lang.sh writes.'''
+        phonesdir = os.path.join(langdir,'phones')
+        os.makedirs(phonesdir, exist_ok=True)
+        (p2i, w2i) = (self.phone2id, self.word2id)
+        kaldi.write_list_to_file([ '{} {}'.format(p,i) for (i,p) in enumerate(self.phones) ], os.path.join(langdir,'phones.txt'), '\n')
+        kaldi.write_list_to_file([ '{} {}'.format(w,i) for (i,w) in enumerate(self.words) ], os.path.join(langdir,'words.txt'), '\n')
+        def write_set(name, phones):
+            kaldi.write_list_to_file(phones, os.path.join(phonesdir,name+'.txt'), '\n')
+            kaldi.write_list_to_file([ str(p2i[p]) for p in phones ], os.path.join(phonesdir,name+'.int'), '\n')
+            kaldi.write_list_to_file([ str(p2i[p]) for p in phones ], os.path.join(phonesdir,name+'.csl'), ':')
+        for (name, phones) in (('silence', self.silence), ('nonsilence', self.nonsilence), ('optional_silence', self.optional_silence),
+                               ('disambig', self.disambig), ('context_indep', self.silence)):
+            write_set(name, phones)
+        def write_lines(name, lines, symtab=p2i, verbatim=0):
+            '''name.txt, and name.int with all but the first verbatim fields of each line mapped through symtab'''
+            kaldi.write_list_to_file([ ' '.join(line) for line in lines ], os.path.join(phonesdir,name+'.txt'), '\n')
+            kaldi.write_list_to_file([ ' '.join(line[:verbatim] + [ str(symtab[x]) for x in line[verbatim:] ]) for line in lines ],
+                                     os.path.join(phonesdir,name+'.int'), '\n')
+        sets = [ self.phone_map[p] for p in self.silence_phones + self.nonsilence_phones ]
+        write_lines('sets', sets)
+        write_lines('roots', [ [ 'shared', 'split' ] + s for s in sets ], verbatim=2)
+        questions = [ [ q for p in self.extra_questions for q in self.phone_map[p] ] ] if self.extra_questions else []
+        questions += [ [ p+s for p in self.nonsilence_phones ] for s in POSITIONS ]
+        questions += [ [ p+s for p in self.silence_phones ] for s in ('',) + POSITIONS ]
+        write_lines('extra_questions', questions)
+        boundaries = [ (q, WORD_BOUNDARY[q[len(p):]]) for p in self.silence_phones + self.nonsilence_phones for q in self.phone_map[p] ]
+        kaldi.write_list_to_file([ '{} {}'.format(q,b) for (q,b) in boundaries ], os.path.join(phonesdir,'word_boundary.txt'), '\n')
+        kaldi.write_list_to_file([ '{} {}'.format(p2i[q],b) for (q,b) in boundaries ], os.path.join(phonesdir,'word_boundary.int'), '\n')
+        kaldi.write_list_to_file([ '#0' ], os.path.join(phonesdir,'wdisambig.txt'), '\n')
+        kaldi.write_list_to_file([ str(p2i['#0']) ], os.path.join(phonesdir,'wdisambig_phones.int'), '\n')
+        kaldi.write_list_to_file([ str(w2i['#0']) ], os.path.join(phonesdir,'wdisambig_words.int'), '\n')
+        align = [ ('<eps>', '<eps>', self.optional_silence[0]) ] + [ (w, w) + pron for ((w, phones), pron) in zip(self.entries, self.prons) ]
+        kaldi.write_list_to_file([ ' '.join(a) for a in align ], os.path.join(phonesdir,'align_lexicon.txt'), '\n')
+        kaldi.write_list_to_file([ ' '.join([ str(w2i[a[0]]), str(w2i[a[1]]) ] + [ str(p2i[p]) for p in a[2:] ]) for a in align ],
+                                 os.path.join(phonesdir,'align_lexicon.int'), '\n')
+        kaldi.write_list_to_file([ self.oov_word ], os.path.join(langdir,'oov.txt'), '\n')
+        kaldi.write_list_to_file([ str(w2i[self.oov_word]) ], os.path.join(langdir,'oov.int'), '\n')
+        with open(os.path.join(langdir,'topo'),'w') as f:
+            f.write('<Topology>\n')
+            for (phones, states) in ((self.nonsilence, NONSILENCE_TOPO), (self.silence, SILENCE_TOPO)):
+                f.write('<TopologyEntry>\n<ForPhones>\n{}\n</ForPhones>\n'.format(' '.join(str(p2i[p]) for p in phones)))
+                f.write('\n'.join(states) + '\n</TopologyEntry>\n')
+            f.write('</Topology>\n')
+        for (name, disambig) in (('L.fst', False), ('L_disambig.fst', True)):
+            (num_states, finals, arcs) = self.fst_arrays(disambig)
+            arpa.write_fst(os.path.join(langdir,name), num_states, finals, arcs)
+
+########## Called from the operating system ##################################################
+if __name__=="__main__":
+    if len(sys.argv) < 4:
+        print(__doc__)
+        exit(0)
+    (dictdir, oov_word, langdir) = sys.argv[1:4]
+    start = time.time()
+    lang = Lang(kaldi.read_dict_from_file(os.path.join(dictdir,'lexicon.txt'), multi=True),
+                *[ kaldi.read_list_from_file(os.path.join(dictdir,f)) for f in
+                   ('nonsilence_phones.txt', 'silence_phones.txt', 'optional_silence.txt', 'extra_questions.txt') ],
+                oov_word=oov_word)
+    lang.write(langdir)
+    print('prepare_lang: wrote {} with {} pronunciations of {} words in {:.2f}s'.format(
+        langdir, len(lang.entries), len(lang.words)-4, time.time()-start))
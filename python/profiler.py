@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+"""
+USAGE:
+  import profiler
+  tracer = profiler.enable('exp/lang/trace.json')
+  with profiler.span('make_mfcc', 'stage'):
+      ...
+  c = profiler.run(cmd, stdout=..., stderr=...)       # subprocess.run, recorded as a span
+  tracer.write()                                       # Chrome/Perfetto trace JSON
+  print(tracer.summary())
+  If called from the command line, prints the summary of a trace file written earlier:
+  python profiler.py exp/lang/trace.json
+
+Stage-level profiling.  Each span records its wall time, the user and system CPU time of child
+processes that finished during it (deltas of getrusage(RUSAGE_CHILDREN)), the peak RSS of this
+process and of its largest child so far, and the bytes read and written, by this process
+(/proc/self/io) and by its finished children (block I/O from getrusage).  Children and
+I/O are counted per process, so spans that overlap in different threads share them.
+Spans that ran a Kaldi job array also list the time of each job, from its log, so that an
+imbalanced array shows up as one long job in the trace and as a high imbalance in the summary.
+When profiling is not enabled, span returns a shared do-nothing object and run is subprocess.run,
+so instrumented code costs one global lookup per call.
+"""
+
+import os,sys
+import json
+import time
+import resource
+import threading
+import subprocess
+
+TRACER = None
+
+########## auxiliary functions ##################################################
+def _self_io():
+    '''(bytes read, bytes written) by this process, from /proc/self/io, or (0, 0) where unavailable'''
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(':') for line in f if ':' in line)
+        return(int(fields['rchar']), int(fields['wchar']))
+    except (OSError, KeyError, ValueError):
+        return(0, 0)
+
+def _snapshot():
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    (rchar, wchar) = _self_io()
+    return({ 'time':time.time(), 'utime':children.ru_utime, 'stime':children.ru_stime,
+             'read':rchar + 512*children.ru_inblock, 'write':wchar + 512*children.ru_oublock,
+             'maxrss':max(me.ru_maxrss, children.ru_maxrss) })
+
+########## spans ##################################################
+class _NullSpan:
+    '''What span returns when profiling is disabled'''
+    enabled = False
+    def __enter__(self):
+        return(self)
+    def __exit__(self, exc_type, exc_value, traceback):
+        return(False)
+    def set(self, **args):
+        pass
+    def jobs(self, times):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class Span:
+    '''One timed region; use through profiler.span'''
+    enabled = True
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = dict(args)
+        self.job_times = None
+
+    def set(self, **args):
+        '''Add arguments, e.g. returncode, to the span's record'''
+        self.args.update(args)
+
+    def jobs(self, times):
+        '''Record the wall time of each job of a job array run during the span (e.g. from kaldi.job_times)'''
+        self.job_times = list(times)
+
+    def __enter__(self):
+        self.tid = threading.get_ident()
+        self.start = _snapshot()
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = _snapshot()
+        if exc_type is not None:
+            self.args['error'] = '{}: {}'.format(exc_type.__name__, exc_value)
+        self.tracer.record(self, end)
+        return(False)
+
+class Tracer:
+    '''Collects spans from every thread, and writes them as a Chrome trace.'''
+    def __init__(self, tracefile):
+        '''USAGE: tracer=Tracer(tracefile)'''
+        self.tracefile = tracefile
+        self.records = []
+        self.lock = threading.Lock()
+        self.origin = time.time()
+        self.threads = {}
+
+    def record(self, span, end):
+        s = span.start
+        rec = { 'name':span.name, 'cat':span.category, 'start':s['time']-self.origin, 'wall':end['time']-s['time'],
+                'user':end['utime']-s['utime'], 'sys':end['stime']-s['stime'],
+                'read':end['read']-s['read'], 'write':end['write']-s['write'], 'maxrss_kb':end['maxrss'],
+                'args':span.args, 'jobs':span.job_times }
+        with self.lock:
+            rec['tid'] = self.threads.setdefault(span.tid, len(self.threads)+1)
+            self.records.append(rec)
+
+    def events(self):
+        '''The records as Chrome trace events (complete events, times in microseconds)'''
+        pid = os.getpid()
+        events = [ { 'name':'thread_name', 'ph':'M', 'pid':pid, 'tid':tid, 'args':{'name':'thread {}'.format(tid)} }
+                   for tid in sorted(self.threads.values()) ]
+        for (i, r) in enumerate(self.records):
+            args = dict(r['args'], user_s=round(r['user'],3), sys_s=round(r['sys'],3), read_bytes=r['read'],
+                        write_bytes=r['write'], peak_rss_kb=r['maxrss_kb'])
+            events.append({ 'name':r['name'], 'cat':r['cat'], 'ph':'X', 'pid':pid, 'tid':r['tid'],
+                            'ts':int(r['start']*1e6), 'dur':int(r['wall']*1e6), 'args':args })
+            # Jobs of an array are drawn as a separate process, one row per job, starting with their span
+            if r['jobs']:
+                jobs_pid = pid*1000 + i
+                events.append({ 'name':'process_name', 'ph':'M', 'pid':jobs_pid, 'args':{'name':'jobs of '+r['name']} })
+            for (n, t) in enumerate(r['jobs'] or []):
+                events.append({ 'name':'{} JOB={}'.format(r['name'], n+1), 'cat':'job', 'ph':'X', 'pid':jobs_pid,
+                                'tid':n+1, 'ts':int(r['start']*1e6), 'dur':int(t*1e6), 'args':{} })
+        return(events)
+
+    def write(self, tracefile=None):
+        '''USAGE: tracer.write()  writes the trace, which chrome://tracing or ui.perfetto.dev can open'''
+        tracefile = tracefile or self.tracefile
+        tracedir = os.path.dirname(tracefile)
+        if tracedir:
+            os.makedirs(tracedir, exist_ok=True)
+        with self.lock:
+            trace = { 'traceEvents':self.events(), 'displayTimeUnit':'ms', 'records':self.records }
+        with open(tracefile,'w') as f:
+            json.dump(trace, f)
+        return(tracefile)
+
+    def summary(self, max_rows=30):
+        '''USAGE: print(tracer.summary())'''
+        with self.lock:
+            records = list(self.records)
+        return(summarize(records, max_rows))
+
+def summarize(records, max_rows=30):
+    '''A table of the spans in records, grouped by category and name, in decreasing order of total wall time.'''
+    groups = {}
+    for r in records:
+        groups.setdefault((r['cat'], r['name']), []).append(r)
+    rows = []
+    for ((cat, name), rs) in groups.items():
+        jobs = [ r['jobs'] for r in rs if r['jobs'] ]
+        imbalance = max((max(j)/(sum(j)/len(j)) for j in jobs if sum(j) > 0), default=None)
+        rows.append((sum(r['wall'] for r in rs), cat, name, len(rs), max(r['wall'] for r in rs),
+                     sum(r['user'] for r in rs), sum(r['sys'] for r in rs), sum(r['read'] for r in rs),
+                     sum(r['write'] for r in rs), max(r['maxrss_kb'] for r in rs), imbalance))
+    rows.sort(key=lambda row: -row[0])
+    lines = [ '{:<10s} {:<28s} {:>5s} {:>9s} {:>9s} {:>9s} {:>9s} {:>9s} {:>9s} {:>9s} {:>9s}'.format(
+        'category','name','count','wall(s)','max(s)','user(s)','sys(s)','read(MB)','write(MB)','rss(MB)','imbalance') ]
+    for (wall, cat, name, count, longest, user, system, read, write, rss, imbalance) in rows[0:max_rows]:
+        lines.append('{:<10s} {:<28s} {:>5d} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9s}'.format(
+            cat[0:10], name[0:28], count, wall, longest, user, system, read/1e6, write/1e6, rss/1024,
+            '' if imbalance is None else '{:.2f}'.format(imbalance)))
+    if len(rows) > max_rows:
+        lines.append('... and {} more'.format(len(rows)-max_rows))
+    return('\n'.join(lines))
+
+########## public interface ##################################################
+def enable(tracefile):
+    '''USAGE: tracer = enable(tracefile); start recording spans'''
+    global TRACER
+    TRACER = Tracer(tracefile)
+    return(TRACER)
+
+def disable():
+    '''Stop recording spans; returns the tracer that was recording, if any'''
+    global TRACER
+    (tracer, TRACER) = (TRACER, None)
+    return(tracer)
+
+def span(name, category='stage', **args):
+    '''USAGE: with span(name, category, key=value, ...) as s: ...
+    Record the region as one span.  s.set(key=value) adds to its arguments.'''
+    tracer = TRACER
+    if tracer is None:
+        return(_NULL_SPAN)
+    return(Span(tracer, name, category, args))
+
+def run(cmd, *popenargs, **kwargs):
+    '''USAGE: c = run(cmd, ...)  exactly as subprocess.run, recorded as a span named after the program'''
+    if TRACER is None:
+        return(subprocess.run(cmd, *popenargs, **kwargs))
+    words = cmd if isinstance(cmd, (list, tuple)) else [ str(cmd) ]
+    with span(os.path.basename(str(words[0])), 'subprocess', cmd=' '.join(str(w) for w in words)) as s:
+        c = subprocess.run(cmd, *popenargs, **kwargs)
+        s.set(returncode=c.returncode)
+    return(c)
+
+########## Called from the operating system ##################################################
+if __name__=="__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        exit(0)
+    with open(sys.argv[1]) as f:
+        print(summarize(json.load(f)['records']))
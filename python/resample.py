@@ -0,0 +1,268 @@
+#!/usr/bin/python3
+"""
+USAGE:
+  import resample
+  y = resample.resample(x, fs_in, fs_out)
+  returncodes = resample.resample_files(tasks, fs_out, stdout_logfile, stderr_logfile)
+  If called from the command line, either resamples one file, as sox ifile -R -r fs -t wav ofile would
+  (ofile may be -, for stdout, as in the pipes of a wav.scp):
+  python resample.py convert ifile fs ofile
+  or runs a throughput benchmark on a synthetic corpus:
+  python resample.py [num_files] [nj]
+
+In-process polyphase resampler, an alternative to one sox process per file.
+Filters are Kaiser-windowed sinc lowpass filters, with passband edge at 95% of the
+lower Nyquist rate, the same bandwidth that sox uses for its default (-q) rate effect.
+Output is rounded to integers with no dither, so files are repeatable (as with sox -R).
+"""
+
+import os,sys
+import io
+import math
+import functools
+import multiprocessing
+import wave
+import numpy as np
+import kaldi
+import audio
+
+# Filter design parameters
+ZERO_CROSSINGS = 32    # half-length of the sinc filter, in zero-crossings of the lower-rate filter
+ROLLOFF = 0.95         # passband edge, as a fraction of the lower Nyquist rate
+KAISER_BETA = 9.0      # roughly 90dB stopband attenuation
+CHUNK_SIZE = 16384     # output samples computed per vectorized step, bounds memory use
+
+########## filter kernels ##################################################
+def _filter_half_length(up, down):
+    return(int(ZERO_CROSSINGS * max(up, down) / ROLLOFF))
+
+@functools.lru_cache(maxsize=None)
+def polyphase_filter(fs_in, fs_out):
+    '''USAGE: (up, down, phases) = polyphase_filter(fs_in, fs_out)
+    Design the lowpass filter for converting fs_in to fs_out, and split it into its polyphase components.
+    up, down: integer factors such that fs_out/fs_in = up/down.
+    phases: (up, taps) array, phases[p,m] = h[p+m*up], where h is the filter at rate fs_in*up.
+    Kernels are cached for each (fs_in, fs_out) pair, so each worker designs each filter once.
+    '''
+    g = math.gcd(int(fs_in), int(fs_out))
+    up = int(fs_out)//g
+    down = int(fs_in)//g
+    cutoff = ROLLOFF * 0.5 / max(up, down)    # in cycles per sample at rate fs_in*up
+    half = _filter_half_length(up, down)
+    n = np.arange(-half, half+1)
+    h = up * 2 * cutoff * np.sinc(2 * cutoff * n) * np.kaiser(2*half+1, KAISER_BETA)
+    taps = int(math.ceil(len(h)/up))
+    h = np.concatenate((h, np.zeros(taps*up - len(h))))
+    phases = np.ascontiguousarray(h.reshape(taps, up).T)
+    phases.setflags(write=False)
+    return(up, down, phases)
+
+def resample(x, fs_in, fs_out):
+    '''USAGE: y = resample(x, fs_in, fs_out)
+    x: float array of shape (nsamples,) or (nsamples, nchannels), sampled at fs_in.
+    y: float array sampled at fs_out, of length ceil(nsamples*fs_out/fs_in), time-aligned with x.
+    '''
+    if fs_in == fs_out:
+        return(np.array(x, dtype=np.float64))
+    (up, down, phases) = polyphase_filter(fs_in, fs_out)
+    (nphase, taps) = phases.shape
+    x = np.asarray(x, dtype=np.float64)
+    squeeze = (x.ndim == 1)
+    if squeeze:
+        x = x[:,np.newaxis]
+    nout = int(math.ceil(len(x)*up/down))
+    # The filter has 2*half+1 nonzero taps, so its center, at rate fs_in*up, is at tap half.
+    half = _filter_half_length(up, down)
+    xpad = np.concatenate((np.zeros((taps, x.shape[1])), x, np.zeros((taps, x.shape[1]))))
+    y = np.empty((nout, x.shape[1]))
+    m = np.arange(taps)
+    for start in range(0, nout, CHUNK_SIZE):
+        k = np.arange(start, min(nout, start+CHUNK_SIZE))
+        t = k*down + half
+        (j0, p) = np.divmod(t, up)
+        idx = (j0 + taps)[:,np.newaxis] - m[np.newaxis,:]
+        y[start:start+len(k)] = np.einsum('km,kmc->kc', phases[p], xpad[idx])
+    return(y[:,0] if squeeze else y)
+
+########## WAV file I/O ##################################################
+_DTYPES = { 1:np.uint8, 2:np.int16, 3:np.int32, 4:np.int32 }
+_SAMPWIDTHS = { np.dtype(np.uint8):1, np.dtype(np.int16):2, np.dtype(np.int32):4 }
+
+def read_wav(rxfilename):
+    '''USAGE: (x, fs, sampwidth) = read_wav(rxfilename)
+    x: float array (nsamples, nchannels), in the integer scale of the file; WAV or FLAC, via audio.read.
+    Raises ValueError if the file does not contain 8, 16, 24 or 32 bit integer samples.
+    '''
+    (data, fs) = audio.read(rxfilename)
+    (x, sampwidth) = from_samples(data, rxfilename, audio.bits(rxfilename))
+    return(x, fs, sampwidth)
+
+def from_samples(data, name, bits=None):
+    '''USAGE: (x, sampwidth) = from_samples(data, name, bits)
+    The integer samples data (e.g., from audio.read or audio.read_buffer) as floats, in the integer scale of the file.
+    bits = the bits per sample in the file, if known; 24-bit samples, which audio.read left-justifies in int32,
+      are scaled back to 24 bits, so that sampwidth is 3 and write_wav writes them as 24 bits again.'''
+    if data.dtype not in _SAMPWIDTHS:
+        raise ValueError('{}: {} samples are not supported'.format(name,data.dtype))
+    x = data.astype(np.float64)
+    if data.dtype == np.uint8:
+        x -= 128
+    if bits == 24 and data.dtype == np.int32:
+        return(x/256, 3)
+    return(x, _SAMPWIDTHS[data.dtype])
+
+def quantize(x, sampwidth):
+    '''USAGE: y = quantize(x, sampwidth)
+    Round and clip x, in the integer scale of sampwidth, to the values write_wav would store.'''
+    if sampwidth == 3:
+        return(np.clip(np.round(x), -(1<<23), (1<<23)-1))
+    info = np.iinfo(np.int8 if sampwidth==1 else _DTYPES[sampwidth])
+    return(np.clip(np.round(x), info.min, info.max))
+
+def write_wav(filename, x, fs, sampwidth):
+    '''USAGE: write_wav(filename, x, fs, sampwidth)
+    x: float array (nsamples, nchannels), in the integer scale of sampwidth; it is rounded and clipped.'''
+    y = quantize(x, sampwidth)
+    if sampwidth == 1:
+        y += 128
+    if sampwidth == 3:
+        frames = y.astype('<i4').view(np.uint8).reshape(-1,4)[:,0:3].tobytes()
+    else:
+        frames = y.astype(_DTYPES[sampwidth]).tobytes()
+    with wave.open(filename,'wb') as w:
+        w.setnchannels(x.shape[1])
+        w.setsampwidth(sampwidth)
+        w.setframerate(fs)
+        w.writeframes(frames)
+
+def convert(ifile, fs, ofile):
+    '''USAGE: convert(ifile, fs, ofile)
+    Resample ifile to fs, and write it to the WAV file ofile, or to stdout if ofile is -.'''
+    (x, fs_in, sampwidth) = read_wav(ifile)
+    y = resample(x, fs_in, fs)
+    if ofile == '-':
+        # wave needs a seekable file, to fill in the header once the data are written
+        buf = io.BytesIO()
+        write_wav(buf, y, fs, sampwidth)
+        sys.stdout.buffer.write(buf.getvalue())
+        sys.stdout.buffer.flush()
+    else:
+        write_wav(ofile, y, fs, sampwidth)
+
+def pipe(ifile, fs):
+    '''USAGE: wav.scp entry = pipe(ifile, fs)
+    A Kaldi input pipe that resamples ifile to fs with convert, for a wav.scp.'''
+    return('{} {} convert {} {} - |'.format(sys.executable, os.path.abspath(__file__), ifile, fs))
+
+########## batch processing ##################################################
+def resample_files(tasks, fs, stdout_logfile, stderr_logfile):
+    '''USAGE: returncodes = resample_files(tasks, fs, stdout_logfile, stderr_logfile)
+    Resample a batch of files in this process.
+    tasks: list of (key, ifile, ofile, cmd) tuples, as for kaldi.convert_all_if_newer.
+      ifile is resampled in-process if audio.read can read it as integer PCM; otherwise cmd is run.
+    fs: output sampling rate
+    returncodes: dict mapping key to 0 (success) or nonzero (failure, described in stderr_logfile)
+    '''
+    returncodes = {}
+    for (key, ifile, ofile, cmd) in tasks:
+        if not kaldi.newer_than(ifile, ofile):
+            returncodes[key] = 0
+            continue
+        stdout_logfile.write('resample {} {} {}\n'.format(ifile, fs, ofile))
+        try:
+            (x, fs_in, sampwidth) = read_wav(ifile)
+        except (ValueError, RuntimeError):
+            returncodes[key] = kaldi.convert_if_newer(ifile, ofile, cmd, stdout_logfile, stderr_logfile)
+            continue
+        except OSError as err:
+            stderr_logfile.write('resample {}: {}\n'.format(ifile, err))
+            returncodes[key] = 1
+            continue
+        try:
+            write_wav(ofile, resample(x, fs_in, fs), fs, sampwidth)
+            returncodes[key] = 0
+        except OSError as err:
+            stderr_logfile.write('resample {}: {}\n'.format(ofile, err))
+            returncodes[key] = 1
+    return(returncodes)
+
+def _resample_batch(args):
+    '''Pool worker: resample one batch, logging to per-batch files.  Returns the batch's returncodes.'''
+    (tasks, fs, logprefix, n) = args
+    stdout_log = '{}_stdout.{}.txt'.format(logprefix,n)
+    stderr_log = '{}_stderr.{}.txt'.format(logprefix,n)
+    with open(stdout_log,'w') as stdout_logfile, open(stderr_log,'w') as stderr_logfile:
+        returncodes = resample_files(tasks, fs, stdout_logfile, stderr_logfile)
+    return(returncodes)
+
+def resample_all(tasks, fs, nj, logprefix, batch_size=64):
+    '''USAGE: returncodes = resample_all(tasks, fs, nj, logprefix, batch_size)
+    Resample many files in a pool of nj worker processes, batch_size files per work item.
+    Arguments and logfiles are as for kaldi.convert_all_if_newer.
+    '''
+    tasks = list(tasks)
+    batches = [ (tasks[n:n+batch_size], fs, logprefix, 1+n//batch_size)
+                for n in range(0, len(tasks), batch_size) ]
+    returncodes = {}
+    nj = max(1, int(nj))
+    if nj == 1:
+        for b in batches:
+            returncodes.update(_resample_batch(b))
+    else:
+        with multiprocessing.Pool(nj) as pool:
+            for r in pool.imap_unordered(_resample_batch, batches):
+                returncodes.update(r)
+    for stream in ('stdout','stderr'):
+        with open('{}_{}.txt'.format(logprefix,stream),'w') as f:
+            for b in batches:
+                batch_log = '{}_{}.{}.txt'.format(logprefix,stream,b[3])
+                with open(batch_log) as g:
+                    f.write(g.read())
+                os.remove(batch_log)
+    return(returncodes)
+
+def snr(reference, test):
+    '''USAGE: snr_db = snr(reference, test)
+    Signal-to-difference ratio, in dB, between two signals (e.g., outputs of sox and of resample).'''
+    n = min(len(reference), len(test))
+    d = np.sum((reference[:n]-test[:n])**2)
+    s = np.sum(reference[:n]**2)
+    return(np.inf if d==0 else 10*np.log10(s/d))
+
+########## Called from the operating system ##################################################
+if __name__=="__main__" and len(sys.argv) == 5 and sys.argv[1] == 'convert':
+    convert(sys.argv[2], int(sys.argv[3]), sys.argv[4])
+elif __name__=="__main__":
+    import tempfile, time, shutil
+    num_files = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    nj = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    workdir = tempfile.mkdtemp()
+    rng = np.random.default_rng(0)
+    tasks = { 'sox':[], 'numpy':[] }
+    for engine in tasks:
+        os.makedirs(os.path.join(workdir,engine))
+    for n in range(num_files):
+        ifile = os.path.join(workdir,'utt{:06d}.wav'.format(n))
+        t = np.arange(int(16000*rng.uniform(2,5)))/16000
+        x = 3000*np.sin(2*np.pi*rng.uniform(100,3500)*t) + 300*rng.standard_normal(len(t))
+        write_wav(ifile, x[:,np.newaxis], 16000, 2)
+        for engine in tasks:
+            ofile = os.path.join(workdir,engine,os.path.basename(ifile))
+            tasks[engine].append((n, ifile, ofile, ['sox',ifile,'-R','-r','8000','-t','wav',ofile]))
+    results = {}
+    for engine in ('numpy','sox'):
+        if engine=='sox' and shutil.which('sox') is None:
+            print('sox not found; skipping the sox engine')
+            continue
+        start = time.time()
+        if engine=='sox':
+            rc = kaldi.convert_all_if_newer(tasks[engine], nj, os.path.join(workdir,engine))
+        else:
+            rc = resample_all(tasks[engine], 8000, nj, os.path.join(workdir,engine))
+        results[engine] = time.time()-start
+        print('{}: {} files in {:.2f}s ({:.1f} files/s), {} failed'.format(
+            engine, num_files, results[engine], num_files/results[engine], sum(1 for v in rc.values() if v)))
+    if 'sox' in results:
+        snrs = [ snr(read_wav(s[2])[0], read_wav(p[2])[0]) for (s,p) in zip(tasks['sox'],tasks['numpy']) ]
+        print('numpy vs. sox: min SNR {:.1f}dB, median SNR {:.1f}dB'.format(min(snrs), np.median(snrs)))
+    shutil.rmtree(workdir)
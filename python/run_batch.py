@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+"""
+USAGE: python run_batch.py manifest [frontend] [--cpus=N] [--kaldi_root=dir] [--srilm_path=dir]
+  If called from the command line, this trains and tests every language listed in the manifest,
+  as run_kaldini.py does for one, all in one pipeline that keeps at most N CPUs busy (default: all of them).
+  [manifest] = a text file with one line per language:
+     language corpus_dir materials_dir [weight]
+     where weight (default 1) is the language's share of the CPUs while the languages compete for them.
+  [frontend] = 'separate' (default) or 'fused', as in run_kaldini.py.
+  Results are stored in exp/[language]/... and data/[language]/..., as by run_kaldini.py; the stage cache,
+  pipeline journal and trace, which all languages share, are exp/stage_cache.sqlite, exp/pipeline.journal
+  and exp/trace.json.
+
+Running the languages one after another leaves most of the machine idle while each runs its
+serial stages (L, G, mkgraph).  In one pipeline, the stages of all languages are scheduled together:
+a stage of one language runs whenever the stages of another leave CPUs free, and while they compete,
+each language gets CPUs in proportion to its weight.  A language that fails does not stop the others,
+and only the failed languages are resumed from the journal by the next batch; every other language is
+run again from the start, so that new data or a changed manifest is picked up (through the stage cache,
+only the commands whose inputs changed are rerun).
+Kaldi's PATH is set, and the stage cache and tracer opened, once for the whole batch.
+"""
+
+import os, sys
+import kaldi
+import pipeline
+import profiler
+import run_kaldini
+
+########## manifest ##################################################
+def read_manifest(filename):
+    '''USAGE: languages = read_manifest(filename)
+    Returns a list of (language, corpus_dir, materials_dir, weight), one per non-blank, non-comment line.'''
+    languages = []
+    with open(filename) as f:
+        for line in f:
+            words = line.split('#')[0].split()
+            if not words:
+                continue
+            if len(words) not in (3, 4):
+                raise ValueError('run_batch: manifest line should be language corpus_dir materials_dir [weight]: {}'.format(line.strip()))
+            weight = float(words[3]) if len(words)==4 else 1.0
+            if weight <= 0:
+                raise ValueError('run_batch: weight of {} should be positive, not {}'.format(words[0], weight))
+            languages.append((words[0], words[1], words[2], weight))
+    names = [ l[0] for l in languages ]
+    if len(set(names)) != len(names):
+        raise ValueError('run_batch: manifest {} lists a language more than once'.format(filename))
+    if not languages:
+        raise ValueError('run_batch: manifest {} lists no languages'.format(filename))
+    return(languages)
+
+########## report ##################################################
+def wer_report(stages, last_stages):
+    '''A table of the best dev-set WER of each language, or why there is none'''
+    lines = [ 'Best dev-set WER of each language:' ]
+    for (language, name) in last_stages.items():
+        if name in stages.results:
+            lines.append('  {:<16s} {}'.format(language, stages.results[name].line()))
+        elif name in stages.skipped:
+            lines.append('  {:<16s} not decoded: an earlier stage failed'.format(language))
+        else:
+            lines.append('  {:<16s} not decoded'.format(language))
+    return('\n'.join(lines))
+
+########## Called from the operating system ##################################################
+if __name__=="__main__":
+    args = [ a for a in sys.argv[1:] if not a.startswith('--') ]
+    flags = dict(a[2:].split('=',1) for a in sys.argv[1:] if a.startswith('--') and '=' in a)
+    if len(args) < 1:
+        print(__doc__)
+        exit(0)
+    languages = read_manifest(args[0])
+    frontend = args[1] if len(args) > 1 else 'separate'
+    cpu_budget = int(flags.get('cpus', os.cpu_count() or 1))
+
+    # Shared by every language: the path to Kaldi programs, the stage cache, the tracer and the pipeline
+    kaldi.set_path(flags.get('kaldi_root', run_kaldini.KALDI_ROOT), flags.get('srilm_path', run_kaldini.SRILM_PATH))
+    expdir = os.path.join(os.getcwd(),'exp')
+    stage_cache = kaldi.set_stage_cache(os.path.join(expdir,'stage_cache.sqlite'))
+    tracer = profiler.enable(os.path.join(expdir,'trace.json'))
+    stages = pipeline.Pipeline(cpu_budget=cpu_budget, journal=os.path.join(expdir,'pipeline.journal'),
+                               weights={ l[0]:l[3] for l in languages }, keep_going=True)
+
+    # Each language's job arrays are as wide as its share of the budget, when all languages are running
+    total_weight = sum(l[3] for l in languages)
+    last_stages = {}
+    for (language, corpus_dir, materials_dir, weight) in languages:
+        nproc = max(1, int(cpu_budget * weight / total_weight))
+        kaldi_cmd = kaldi.CMD(nproc=nproc, train_cmd='run.pl', decode_cmd='run.pl')
+        print('{}: {} CPUs for each job array'.format(language, nproc))
+        last_stages[language] = run_kaldini.add_language(stages, language, corpus_dir, materials_dir, frontend,
+                                                         kaldi_cmd, prefix=language+'/', group=language)
+    try:
+        stages.run()
+    finally:
+        print(stages.report())
+        print(wer_report(stages, last_stages))
+        print(stage_cache.report())
+        print(tracer.summary())
+        print('Trace for chrome://tracing or ui.perfetto.dev is in {}'.format(tracer.write()))
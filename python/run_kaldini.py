@@ -1,6 +1,6 @@
 #!/usr/bin/python3
 """
-USAGE: python run_kaldini.py language
+USAGE: python run_kaldini.py language [frontend]
   If called from the command line, this creates an HCLG object with specified language and corpus,
   accessing Kaldi from the specified kaldi_root and SRILM from the specified path,
   then trains and tests it with default settings from those directories.
@@ -8,27 +8,104 @@ USAGE: python run_kaldini.py language
   [corpus] = directory containing the subdirectories audio and list, and the file transcription.txt.
   [kaldi_root] = directory containing the subdirectories tools and src.
   [srilm_path] = directory containing the binary executable file ngram-count.
+  [frontend] = 'separate' (default) to downsample, make MFCCs, and compute CMVN stats in separate passes,
+     or 'fused' to do all three in one pass, without writing intermediate WAV files.
 """
 
 import os, sys, re
+import functools
 import kaldi
 import HCLG
 import SpeechCorpus
+import pipeline
+import profiler
 
-########## Called from the operating system ##################################################
-if __name__=="__main__":
-    if len(sys.argv) < 2:
-        print(__doc__)
-        exit(0)
-    progname=sys.argv[0]
-    language=sys.argv[1]
-    corpus_dir=os.path.join('/Users','jhasegaw','data','2018jul','2018-07-07_NI_all_'+language)
-    materials_dir=os.path.join('/Users','jhasegaw','data','2018jul',language+'_materials')
-    
-    # Define the path to Kaldi programs
-    kaldi.set_path('/Users/jhasegaw/d/packages/kaldi', '/Users/jhasegaw/d/packages/srilm/bin/macosx')
-    kaldi_cmd = kaldi.CMD(nproc=2, train_cmd='run.pl', decode_cmd='run.pl')
-    
+########## Stages ##################################################
+def preprocess(icorpus, subc, language, frontend, kaldi_cmd, results):
+    '''Downsample, write the data directory, make MFCCs and compute CMVN stats for subset subc.
+    Returns the corpus whose utt2wav is feats.scp.'''
+    print('Preprocessing {}...'.format(subc))
+    datadir=os.path.join(os.getcwd(),'data',language,subc)
+    logdir=os.path.join(os.getcwd(), 'exp', language, subc)
+    mfcdir=os.path.join(datadir,'mfcc')
+    if frontend=='fused':
+        fe_logdir = os.path.join(logdir,'make_features')
+        print('    Downsampling, converting to MFCC in %s, and computing CMVN statistics'%mfcdir)
+        print('       logs in {}'.format(fe_logdir))
+        return(icorpus.make_features(fs=8000,kaldi_cmd=kaldi_cmd,logdir=fe_logdir,datadir=datadir,mfccdir=mfcdir))
+    ds_logdir=os.path.join(logdir,'downsample')
+    ds_wavdir=os.path.join(datadir,'wav')
+    print('    Downsampling to %s'%ds_wavdir)
+    print('       logs in %s'%ds_logdir)
+    ds_corpus = icorpus.downsample(fs=8000,wavdir=ds_wavdir,logdir=ds_logdir,kaldi_cmd=kaldi_cmd)
+    print('    Writing %s/{wav.scp,utt2spk,spk2utt,text}'%datadir)
+    fi_corpus = ds_corpus.write_dicts_to_dictfiles(utt2wav=os.path.join(datadir,'wav.scp'),
+                                                   utt2spk=os.path.join(datadir,'utt2spk'),
+                                                   spk2utt=os.path.join(datadir,'spk2utt'),
+                                                   utt2txt=os.path.join(datadir,'text'))
+    mf_logdir = os.path.join(logdir,'make_mfcc')
+    print('    Converting to MFCC in %s'%mfcdir)
+    print('       logs in {}'.format(mf_logdir))
+    mf_corpus = fi_corpus.make_mfcc(kaldi_cmd=kaldi_cmd,logdir=mf_logdir,mfccdir=mfcdir)
+    cmvn_logdir = os.path.join(logdir,'compute_cmvn_stats')
+    print('    Computing CMVN statistics, logs in {}'.format(cmvn_logdir))
+    mf_corpus.compute_cmvn_stats(logdir=cmvn_logdir, mfccdir=mfcdir)
+    return(mf_corpus)
+
+def make_L(materials_dir, LG_base, language, langdir, results):
+    '''Create the L, with a given lexicon.  Returns the Lfst whose files are in the dict directory.'''
+    L1 = HCLG.Lfst(lexicon=os.path.join(materials_dir,'dict','%s_lexicon.txt'%LG_base),
+                   nonsilence_phones=os.path.join(materials_dir,'dict','%s_phones.txt'%LG_base),
+                   silence_phones=['sil','laughter','noise','oov'],
+                   extra_questions=['sil','laughter','noise','oov'],
+                   optional_silence=['sil'])
+    L2 = L1.read_lexicons()
+    L2.lexicon['<unk>'] = 'oov'
+    dictdir=os.path.join(os.getcwd(),'data',language,'dict')
+    L3 = L2.write_to_dictdir(dictdir)
+    lexiconp = os.path.join(dictdir,'lexiconp.txt')
+    L3.lexicon2fst(lexiconp=lexiconp,language=language,oov_word='<unk>',langdir=langdir,engine='native')
+    return(L3)
+
+def make_G(materials_dir, LG_base, langdir, L, utt2txt):
+    '''Create the G, with the given language model or, if there is none, with a trigram trained
+    on utt2txt, the training transcriptions.  Returns the Gfst whose files are in langdir.'''
+    lm = os.path.join(materials_dir,'lang','%s_lm.arpa.gz'%LG_base)
+    words = os.path.join(materials_dir,'lang','%s_words.txt'%LG_base)
+    if os.path.exists(lm):
+        G2 = HCLG.Gfst(lm=lm, words=words).move_to_langdir(langdir)
+    else:
+        print('    No language model {}; training one on the training transcriptions'.format(lm))
+        G2 = HCLG.Gfst.from_text(utt2txt, langdir, words, order=3)
+    G2.lm2fst(L.lexicon, engine='native')
+    return(G2)
+
+def train_mono(corpus, G, modeldir, kaldi_cmd):
+    '''Monophone training.  Returns the Hfst.'''
+    H1 = HCLG.Hfst(modeldir=modeldir)
+    H1.train_mono(corpus=corpus, langdir=G.langdir(), kaldi_cmd=kaldi_cmd, engine='native')
+    return(H1)
+
+def mkgraph(H, L, G):
+    '''Compile HCLG; for monophones, C is null.  Returns the graph directory.'''
+    hclg = HCLG.HCLG(H=H,C=HCLG.Cfst(tree={}),L=L,G=G)
+    return(hclg.mkgraph())
+
+def decode(H, L, G, graphdir, corpus, logdir, kaldi_cmd):
+    '''Decode corpus, putting results in logdir.  Returns the best wer.Result.'''
+    hclg = HCLG.HCLG(H=H,C=HCLG.Cfst(tree={}),L=L,G=G)
+    best = hclg.decode(graphdir=graphdir, corpus=corpus, logdir=logdir, kaldi_cmd=kaldi_cmd)
+    print(best.line(os.path.join(logdir,'wer_{}_{}'.format(best.lmwt, best.wip))))
+    return(best)
+
+########## One language ##################################################
+KALDI_ROOT = '/Users/jhasegaw/d/packages/kaldi'
+SRILM_PATH = '/Users/jhasegaw/d/packages/srilm/bin/macosx'
+DATA_ROOT = os.path.join('/Users','jhasegaw','data','2018jul')
+
+def read_corpora(corpus_dir):
+    '''Read corpus_dir/transcription.txt and list the audio in corpus_dir/out, then split the utterances
+    that have both into train (80%), dev (10%) and eval (10%).  Returns a dict of three SpeechCorpus.corpus.'''
     # Read the input transcription file, assume it contains all transcriptions
     transcription_file = os.path.join(corpus_dir,'transcription.txt')
     if not os.path.isfile(transcription_file):
@@ -76,63 +153,73 @@ if __name__=="__main__":
                                                utt2spk={ u:utt2spk[u] for u in eval_utts },
                                                utt2txt={ u:utt2txt[u] for u in eval_utts })
     print('    Eval corpus is utts {} to {}'.format(eval_utts[0],eval_utts[-1]))
-    
-    # Create the input corpora, then downsample, then convert to MFCC
-    corpora = {}
+    return(icorp)
+
+def add_language(stages, language, corpus_dir, materials_dir, frontend, kaldi_cmd, prefix='', group=None):
+    '''USAGE: last_stage = add_language(stages, language, corpus_dir, materials_dir, frontend, kaldi_cmd, prefix, group)
+    Add the stages that preprocess, train and test one language to the pipeline.Pipeline stages.
+    Stage names start with prefix, and their CPUs are charged to group, so that several languages can share
+    one pipeline.  Returns the name of the last stage, whose result is the best dev-set wer.Result.'''
+    icorp = read_corpora(corpus_dir)
+    num_utts = sum(len(icorp[subc].utt2spk) for subc in icorp)
+    def add(name, func, deps=(), cpus=1, outputs=()):
+        stages.add(prefix+name, func, deps=[ prefix+d for d in deps ], cpus=cpus, outputs=outputs, group=group)
+
+    # The three subsets are preprocessed at the same time, sharing the CPUs in proportion to their size,
+    # as run.sh does by putting its three make_mfcc.sh jobs in the background.
     for subc in ('train', 'dev', 'eval'):
-        print('Preprocessing {}...'.format(subc))
-        datadir=os.path.join(os.getcwd(),'data',language,subc)
-        logdir=os.path.join(os.getcwd(), 'exp', language, subc)
-        ds_logdir=os.path.join(logdir,'downsample')
-        ds_wavdir=os.path.join(datadir,'wav')
-        print('    Downsampling to %s'%ds_wavdir)
-        print('       logs in %s'%ds_logdir)
-        ds_corpus = icorp[subc].downsample(fs=8000,wavdir=ds_wavdir,logdir=ds_logdir)
-        print('    Writing %s/{wav.scp,utt2spk,spk2utt,text}'%datadir)
-        fi_corpus = ds_corpus.write_dicts_to_dictfiles(utt2wav=os.path.join(datadir,'wav.scp'),
-                                                       utt2spk=os.path.join(datadir,'utt2spk'),
-                                                       spk2utt=os.path.join(datadir,'spk2utt'),
-                                                       utt2txt=os.path.join(datadir,'text'))
-        mfcdir=os.path.join(datadir,'mfcc')
-        mf_logdir = os.path.join(logdir,'make_mfcc')
-        print('    Converting to MFCC in %s'%mfcdir)
-        print('       logs in {}'.format(mf_logdir))
-        corpora[subc] = fi_corpus.make_mfcc(kaldi_cmd=kaldi_cmd,logdir=mf_logdir,mfccdir=mfcdir)
-        cmvn_logdir = os.path.join(logdir,'compute_cmvn_stats')
-        print('    Computing CMVN statistics, logs in {}'.format(cmvn_logdir))
-        corpora[subc].compute_cmvn_stats(logdir=cmvn_logdir, mfccdir=mfcdir)
-
-    # Create the L, with a given lexicon
+        nproc = max(1, int(kaldi_cmd.nproc * len(icorp[subc].utt2spk) / num_utts))
+        subc_cmd = kaldi.CMD(nproc=nproc, train_cmd=kaldi_cmd.train_cmd, decode_cmd=kaldi_cmd.decode_cmd,
+                             executor=kaldi_cmd.executor)
+        datadir = os.path.join(os.getcwd(),'data',language,subc)
+        add('preprocess_'+subc, functools.partial(preprocess, icorp[subc], subc, language, frontend, subc_cmd),
+            cpus=nproc, outputs=[ os.path.join(datadir,'feats.scp'), os.path.join(datadir,'cmvn.scp') ])
+
+    # L and G do not depend on the features, so they are compiled while the features are computed
     LG_base = '2018-07-02_%s_cog' % language
-    L1 = HCLG.Lfst(lexicon=os.path.join(materials_dir,'dict','%s_lexicon.txt'%LG_base),
-                   nonsilence_phones=os.path.join(materials_dir,'dict','%s_phones.txt'%LG_base),
-                   silence_phones=['sil','laughter','noise','oov'],
-                   extra_questions=['sil','laughter','noise','oov'],
-                   optional_silence=['sil'])
-    L2 = L1.read_lexicons()
-    L2.lexicon['<unk>'] = 'oov'
-    dictdir=os.path.join(os.getcwd(),'data',language,'dict')
-    L3 = L2.write_to_dictdir(dictdir)
-    lexiconp = os.path.join(dictdir,'lexiconp.txt')
     langdir=os.path.join(os.getcwd(),'data',language,'lang')
-    L3.lexicon2fst(lexiconp=lexiconp,language=language,oov_word='<unk>',langdir=langdir)
+    add('L', functools.partial(make_L, materials_dir, LG_base, language, langdir),
+        outputs=[ os.path.join(langdir,'L.fst') ])
+    add('G', lambda results: make_G(materials_dir, LG_base, langdir, results[prefix+'L'], icorp['train'].utt2txt),
+        deps=['L'], outputs=[ os.path.join(langdir,'G.fst') ])
 
-    # Create the G, with a given language model
-    G1 = HCLG.Gfst(lm=os.path.join(materials_dir,'lang','%s_lm.arpa.gz'%LG_base),
-                   words=os.path.join(materials_dir,'lang','%s_words.txt'%LG_base))
-    G2 = G1.move_to_langdir(langdir)
-    G2.lm2fst(L3.lexicon)
-    
-    # For monophone: C is null
-    C1 = HCLG.Cfst(tree={})
-                
-    # Monophone training.
+    # Monophone training, then decode the dev data
     modeldir = os.path.join(os.getcwd(), 'exp', language, 'mono')
-    H1 = HCLG.Hfst(modeldir=modeldir)
-    H1.train_mono(corpus=corpora['train'], langdir=G2.langdir(), kaldi_cmd=kaldi_cmd)
+    add('train_mono', lambda results: train_mono(results[prefix+'preprocess_train'], results[prefix+'G'], modeldir, kaldi_cmd),
+        deps=['preprocess_train','G'], cpus=kaldi_cmd.nproc, outputs=[ os.path.join(modeldir,'final.mdl') ])
+    add('mkgraph', lambda results: mkgraph(results[prefix+'train_mono'], results[prefix+'L'], results[prefix+'G']),
+        deps=['train_mono','L','G'], outputs=[ os.path.join(modeldir,'graph','HCLG.fst') ])
+    add('decode_dev', lambda results: decode(results[prefix+'train_mono'], results[prefix+'L'], results[prefix+'G'],
+                                             results[prefix+'mkgraph'], results[prefix+'preprocess_dev'],
+                                             os.path.join(modeldir,'decode_dev'), kaldi_cmd),
+        deps=['mkgraph','preprocess_dev'], cpus=kaldi_cmd.nproc)
+    return(prefix+'decode_dev')
 
-    # Decode the dev data
-    logdir = os.path.join(modeldir,'decode_dev')
-    hclg = HCLG.HCLG(H=H1,C=C1,L=L3, G=G2)
-    graphdir = hclg.mkgraph()
-    hclg.decode(graphdir=graphdir, corpus=corpora['dev'], logdir=logdir, kaldi_cmd=kaldi_cmd)
+########## Called from the operating system ##################################################
+if __name__=="__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        exit(0)
+    progname=sys.argv[0]
+    language=sys.argv[1]
+    frontend=sys.argv[2] if len(sys.argv) > 2 else 'separate'
+    corpus_dir=os.path.join(DATA_ROOT,'2018-07-07_NI_all_'+language)
+    materials_dir=os.path.join(DATA_ROOT,language+'_materials')
+    
+    # Define the path to Kaldi programs
+    kaldi.set_path(KALDI_ROOT, SRILM_PATH)
+    kaldi_cmd = kaldi.CMD(nproc=2, train_cmd='run.pl', decode_cmd='run.pl')
+    stage_cache = kaldi.set_stage_cache(os.path.join(os.getcwd(),'exp',language,'stage_cache.sqlite'))
+    tracer = profiler.enable(os.path.join(os.getcwd(),'exp',language,'trace.json'))
+    
+    # Declare the stages and what each depends on, then run as many at a time as kaldi_cmd.nproc allows
+    stages = pipeline.Pipeline(cpu_budget=kaldi_cmd.nproc,
+                               journal=os.path.join(os.getcwd(),'exp',language,'pipeline.journal'))
+    add_language(stages, language, corpus_dir, materials_dir, frontend, kaldi_cmd)
+    try:
+        stages.run()
+    finally:
+        print(stages.report())
+        print(stage_cache.report())
+        print(tracer.summary())
+        print('Trace for chrome://tracing or ui.perfetto.dev is in {}'.format(tracer.write()))
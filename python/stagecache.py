@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+"""
+USAGE:
+  import stagecache
+  cache = stagecache.StageCache('exp/stage_cache.sqlite')
+  key = cache.stage_key(inputs, cmd)
+  if not cache.is_current(stage, inputs, cmd, outputs, key):
+      (run the stage)
+      cache.record(stage, inputs, cmd, outputs, key)
+  print(cache.report())
+
+A persistent record of which stages have been run, on what.
+Each stage is keyed by a content hash of its input files, its command line, and the
+executables it runs; a stage is current only if that key is unchanged and all of its
+outputs exist.  A script (e.g., utils/prepare_lang.sh) may run any program on PATH, so the
+executables it runs are taken to be those in its own directory and in every directory on PATH
+under $KALDI_ROOT; programs it runs from elsewhere (e.g., /usr/bin) are not hashed.  Content hashes are remembered per (path, size, mtime), so unchanged files
+are not re-read; large files are hashed in blocks, and many files are hashed at once,
+in parallel threads.
+"""
+
+import os,sys
+import hashlib
+import shutil
+import functools
+import contextlib
+import sqlite3
+import threading
+import concurrent.futures
+
+BLOCK_SIZE = 1<<20           # bytes read at a time
+PARALLEL_BLOCK_SIZE = 1<<26  # files larger than this are hashed in parallel blocks of this size
+NUM_THREADS = 8
+
+########## hashing ##################################################
+def _hash_range(path, start, length):
+    h = hashlib.sha256()
+    with open(path,'rb') as f:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(BLOCK_SIZE, length))
+            if not data:
+                break
+            h.update(data)
+            length -= len(data)
+    return(h.digest())
+
+def hash_file(path, executor=None):
+    '''USAGE: hexdigest = hash_file(path, executor)
+    Content hash of path.  Files larger than PARALLEL_BLOCK_SIZE are hashed as a list of
+    block hashes, computed in parallel by executor if one is given.'''
+    size = os.path.getsize(path)
+    if size <= PARALLEL_BLOCK_SIZE:
+        return(_hash_range(path, 0, size).hex())
+    starts = range(0, size, PARALLEL_BLOCK_SIZE)
+    if executor is None:
+        blocks = [ _hash_range(path, s, PARALLEL_BLOCK_SIZE) for s in starts ]
+    else:
+        blocks = list(executor.map(lambda s: _hash_range(path, s, PARALLEL_BLOCK_SIZE), starts))
+    return(hashlib.sha256(b''.join(blocks)).hexdigest())
+
+def expand_paths(paths):
+    '''List every file named in paths, descending into directories, in sorted order.'''
+    files = []
+    for p in paths:
+        if os.path.isdir(p):
+            for (root, dirs, names) in os.walk(p):
+                dirs.sort()
+                files += [ os.path.join(root,n) for n in sorted(names) ]
+        else:
+            files.append(p)
+    return(files)
+
+@functools.lru_cache(maxsize=None)
+def _which(word, search_path):
+    '''The real path of the executable file that word resolves to through search_path, or None.
+    Remembered per (word, PATH), because every stage of every language names the same few tools.'''
+    path = shutil.which(word, path=search_path)
+    if path is not None and os.path.isfile(path):
+        return(os.path.realpath(path))
+    return(None)
+
+def _is_script(path):
+    try:
+        with open(path,'rb') as f:
+            return(f.read(2)==b'#!')
+    except OSError:
+        return(False)
+
+def _executables_in(dirname):
+    if not os.path.isdir(dirname):
+        return([])
+    paths = [ os.path.join(dirname,n) for n in sorted(os.listdir(dirname)) ]
+    return([ p for p in paths if os.path.isfile(p) and os.access(p, os.X_OK) ])
+
+def tools_in(cmd):
+    '''The executables named in cmd: words that resolve, through PATH or directly, to executable files.
+    If any of them is a script, then also every executable in its directory, and in each directory
+    on PATH that is under $KALDI_ROOT, so that upgrading Kaldi changes the key of every stage that runs it.'''
+    tools = []
+    search_path = os.environ.get('PATH', os.defpath)
+    for word in cmd:
+        if not word or word.startswith('-') or ' ' in word:
+            continue
+        path = _which(word, search_path)
+        if path is not None:
+            tools.append(path)
+    scripts = [ t for t in tools if _is_script(t) ]
+    if scripts:
+        dirs = [ os.path.dirname(t) for t in scripts ]
+        kaldi_root = os.environ.get('KALDI_ROOT')
+        if kaldi_root:
+            kaldi_root = os.path.join(os.path.realpath(kaldi_root), '')
+            dirs += [ d for d in search_path.split(os.pathsep) if os.path.realpath(d).startswith(kaldi_root) ]
+        for d in sorted(set(os.path.realpath(d) for d in dirs)):
+            tools += _executables_in(d)
+    return(sorted(set(tools)))
+
+########## stage cache ##################################################
+class StageCache:
+    '''A small sqlite database of stage keys and file hashes.  Safe to share between threads.'''
+    def __init__(self, dbfile):
+        '''USAGE: cache = StageCache(dbfile)'''
+        self.dbfile = dbfile
+        dbdir = os.path.dirname(dbfile)
+        if dbdir:
+            os.makedirs(dbdir, exist_ok=True)
+        self.db = sqlite3.connect(dbfile, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS stages (stage TEXT PRIMARY KEY, key TEXT)')
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.batch_depth = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(NUM_THREADS)
+        self.hits = []
+        self.misses = []
+
+    def _commit(self):
+        '''Commit, unless inside batch(); the caller holds self.lock'''
+        if self.batch_depth == 0:
+            self.db.commit()
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''USAGE: with cache.batch(): (many calls to is_current and record)
+        Commit once, at the end, rather than once for every file hashed and every stage recorded.
+        A crash inside the batch loses its records, so those stages are rerun.'''
+        with self.lock:
+            self.batch_depth += 1
+        try:
+            yield(self)
+        finally:
+            with self.lock:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    self.db.commit()
+
+    def _file_hash(self, path):
+        st = os.stat(path)
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime_ns, hash FROM files WHERE path=?', (path,)).fetchone()
+        if row is not None and row[0]==st.st_size and row[1]==st.st_mtime_ns:
+            return(row[2])
+        h = hash_file(path, self.executor if st.st_size > PARALLEL_BLOCK_SIZE else None)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?,?,?,?)', (path, st.st_size, st.st_mtime_ns, h))
+            self._commit()
+        return(h)
+
+    def hash_files(self, paths):
+        '''USAGE: hashes = cache.hash_files(paths)
+        dict mapping each file in paths (directories expanded) to its content hash, or None if missing.
+        Files are hashed in parallel; files unchanged since they were last hashed are not read.'''
+        files = [ os.path.abspath(f) for f in expand_paths(paths) ]
+        def one(f):
+            return(self._file_hash(f) if os.path.isfile(f) else None)
+        if len(files) <= 1:
+            return({ f:one(f) for f in files })
+        with concurrent.futures.ThreadPoolExecutor(NUM_THREADS) as pool:
+            return(dict(zip(files, pool.map(one, files))))
+
+    def stage_key(self, inputs, cmd):
+        '''USAGE: key = cache.stage_key(inputs, cmd)
+        Hash of the contents of inputs, the words of cmd, and the executables cmd runs.'''
+        h = hashlib.sha256()
+        for (f, fh) in sorted(self.hash_files(inputs).items()):
+            h.update('input {} {}\n'.format(f, fh).encode('utf-8'))
+        h.update(('cmd '+'\0'.join(cmd)+'\n').encode('utf-8'))
+        for (f, fh) in sorted(self.hash_files(tools_in(cmd)).items()):
+            h.update('tool {} {}\n'.format(f, fh).encode('utf-8'))
+        return(h.hexdigest())
+
+    def is_current(self, stage, inputs, cmd, outputs, key=None):
+        '''USAGE: if cache.is_current(stage, inputs, cmd, outputs, key): (skip the stage)
+        True if every output exists and the stage was last recorded with the same key
+        (by default, the stage_key of inputs and cmd, computed now).
+        Each call is counted as a hit or a miss in the report.'''
+        current = False
+        if all(os.path.exists(o) for o in outputs):
+            key = key or self.stage_key(inputs, cmd)
+            with self.lock:
+                row = self.db.execute('SELECT key FROM stages WHERE stage=?', (stage,)).fetchone()
+            current = (row is not None and row[0]==key)
+        with self.lock:
+            (self.hits if current else self.misses).append(stage)
+        return(current)
+
+    def record(self, stage, inputs, cmd, outputs, key=None):
+        '''USAGE: cache.record(stage, inputs, cmd, outputs, key)
+        Record that stage has just been run successfully.  key should be the stage_key computed
+        before the stage was run: if an input changed while it ran, the stage must not be recorded
+        as having been run on the new content.  By default, it is computed now.'''
+        key = key or self.stage_key(inputs, cmd)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO stages VALUES (?,?)', (stage, key))
+            self._commit()
+
+    def forget(self, stage):
+        '''Remove the record of stage, so that it will be rerun.'''
+        with self.lock:
+            self.db.execute('DELETE FROM stages WHERE stage=?', (stage,))
+            self._commit()
+
+    def report(self, max_listed=20):
+        '''USAGE: print(cache.report())
+        Summary of the stages skipped (hits) and rerun (misses) since this cache was opened.'''
+        lines = [ 'Stage cache {}: {} hits, {} misses'.format(self.dbfile, len(self.hits), len(self.misses)) ]
+        for (label, stages) in (('recomputed', self.misses), ('skipped', self.hits)):
+            for stage in stages[0:max_listed]:
+                lines.append('    {}: {}'.format(label, stage))
+            if len(stages) > max_listed:
+                lines.append('    {}: ... and {} more'.format(label, len(stages)-max_listed))
+        return('\n'.join(lines))
+
+    def close(self):
+        self.executor.shutdown()
+        self.db.close()
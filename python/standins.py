@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+"""
+USAGE:
+  import standins
+  bindir = standins.install('bench/bin')     # then put bindir first in os.environ['PATH']
+  If called from the command line, runs one stand-in:
+  python standins.py sox|compute-mfcc-feats|copy-feats|run.pl [arguments as for the real program]
+
+Lightweight stand-ins for the external programs that SpeechCorpus uses, so that its stages can be
+run and timed without a Kaldi or sox installation.  Each accepts the arguments that SpeechCorpus
+passes to the real program, reads and writes files in the same formats, and does a token amount
+of work in place of the real computation:
+ - sox ifile [-R] [-r fs] -t wav ofile: resamples by picking the nearest sample (ofile may be -);
+ - compute-mfcc-feats [--config=c] rspecifier wspecifier: writes pseudo-random features,
+   with as many frames and coefficients as the real program would compute;
+ - copy-feats [--compress=true] rspecifier wspecifier: copies features, compressing them as asked;
+ - run.pl: runs the job array with executor.py, without CPU pinning, as run.pl would.
+Latency is controlled by environment variables, in seconds:
+ KALDINI_STANDIN_LATENCY, added once to every invocation (process start-up, in a real binary), and
+ KALDINI_STANDIN_UTT_LATENCY, added for every utterance that compute-mfcc-feats and copy-feats process.
+"""
+
+import os,sys
+import re
+import io
+import time
+import struct
+import numpy as np
+import kaldi
+import audio
+import resample
+import mfcc
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+########## auxiliary functions ##################################################
+def _latency(name):
+    return(float(os.environ.get(name, '0') or 0))
+
+def _split_options(args):
+    '''Split --name=value options, as Kaldi binaries take them, from positional arguments'''
+    opts = {}
+    positional = []
+    for a in args:
+        m = re.match(r'^--([\w-]+)(?:=(.*))?$', a)
+        if m:
+            opts[m.group(1).replace('_','-')] = m.group(2) if m.group(2) is not None else 'true'
+        else:
+            positional.append(a)
+    return(opts, positional)
+
+def _parse_specifier(spec):
+    '''USAGE: (types, filenames) = _parse_specifier('ark,scp:a.ark,a.scp'); types is a set, e.g. {'ark','scp'}'''
+    (prefix, names) = spec.split(':',1)
+    types = set(prefix.split(','))
+    return(types, names.split(',') if 'scp' in types and 'ark' in types else [ names ])
+
+def _read_table(rspecifier):
+    '''Yield (key, matrix) from an ark or scp rspecifier; ark:- reads stdin'''
+    (types, (filename,)) = _parse_specifier(rspecifier)
+    if 'scp' in types:
+        for (key, rxfile) in kaldi.read_dict_from_file(filename).items():
+            yield(key, kaldi.read_mat(rxfile))
+    elif filename == '-':
+        yield from kaldi.iter_ark_buffer(sys.stdin.buffer.read())
+    else:
+        yield from kaldi.iter_ark(filename)
+
+class _TableWriter:
+    '''Write (key, matrix) to an ark, ark,scp or ark:- wspecifier'''
+    def __init__(self, wspecifier, compress):
+        (types, filenames) = _parse_specifier(wspecifier)
+        self.compress = compress
+        self.writer = kaldi.ArkWriter(filenames[0], filenames[1], compress) if 'scp' in types else None
+        if self.writer is None:
+            self.stream = sys.stdout.buffer if filenames[0] == '-' else open(filenames[0],'wb')
+
+    def write(self, key, mat):
+        if self.writer is not None:
+            self.writer.write(key, mat)
+        elif self.compress:
+            self.stream.write(key.encode('utf-8') + b' \0B' + kaldi.compress_matrix(mat))
+        else:
+            (rows, cols) = mat.shape
+            self.stream.write(key.encode('utf-8') + b' \0BFM ' + struct.pack('<bibi', 4, rows, 4, cols))
+            self.stream.write(np.ascontiguousarray(mat, dtype='<f4').tobytes())
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        else:
+            self.stream.flush()
+            if self.stream is not sys.stdout.buffer:
+                self.stream.close()
+
+########## stand-ins ##################################################
+def sox(args):
+    '''USAGE: returncode = sox(['in.flac','-R','-r','8000','-t','wav','out.wav'])'''
+    (ifile, ofile) = (args[0], args[-1])
+    fs_out = int(args[args.index('-r')+1]) if '-r' in args[1:-1] else None
+    try:
+        (x, fs, sampwidth) = resample.read_wav(ifile)
+    except (OSError, ValueError, RuntimeError) as err:
+        sys.stderr.write('sox FAIL formats: can\'t open input file `{}\': {}\n'.format(ifile, err))
+        return(2)
+    if fs_out and fs_out != fs:
+        x = x[np.minimum(np.round(np.arange(int(len(x)*fs_out/fs))*fs/fs_out).astype(np.int64), len(x)-1)]
+        fs = fs_out
+    if ofile == '-':
+        buf = io.BytesIO()
+        resample.write_wav(buf, x, fs, sampwidth)
+        sys.stdout.buffer.write(buf.getvalue())
+        sys.stdout.buffer.flush()
+    else:
+        resample.write_wav(ofile, x, fs, sampwidth)
+    return(0)
+
+def compute_mfcc_feats(args):
+    '''USAGE: returncode = compute_mfcc_feats(['--config=conf/mfcc.conf','scp,p:wav.scp','ark:-'])'''
+    (opts, (rspecifier, wspecifier)) = _split_options(args)
+    extractor = mfcc.Extractor(mfcc.read_config(opts['config']) if 'config' in opts else dict(mfcc.DEFAULTS))
+    num_ceps = extractor.opts['num_ceps']
+    utt_latency = _latency('KALDINI_STANDIN_UTT_LATENCY')
+    (types, (scp,)) = _parse_specifier(rspecifier)
+    utt2wav = kaldi.read_dict_from_file(scp)
+    writer = _TableWriter(wspecifier, opts.get('compress')=='true')
+    num_done = 0
+    for (utt, wav) in utt2wav.items():
+        try:
+            (x, fs) = audio.read(wav)
+        except (OSError, ValueError, RuntimeError) as err:
+            sys.stderr.write('WARNING (compute-mfcc-feats): failed to read {}: {}\n'.format(utt, err))
+            continue
+        if fs != extractor.opts['sample_frequency']:
+            sys.stderr.write('WARNING (compute-mfcc-feats): sample frequency mismatch for {}: {} vs. {}\n'.format(
+                utt, fs, extractor.opts['sample_frequency']))
+            continue
+        rows = extractor.num_frames(len(x))
+        writer.write(utt, np.random.default_rng(mfcc._utt_seed(utt)).standard_normal((rows, num_ceps), dtype=np.float32))
+        time.sleep(utt_latency)
+        num_done += 1
+    writer.close()
+    sys.stderr.write('LOG (compute-mfcc-feats): Done {} out of {} utterances.\n'.format(num_done, len(utt2wav)))
+    return(0 if num_done > 0 else 1)
+
+def copy_feats(args):
+    '''USAGE: returncode = copy_feats(['--compress=true','ark:-','ark,scp:a.ark,a.scp'])'''
+    (opts, (rspecifier, wspecifier)) = _split_options(args)
+    utt_latency = _latency('KALDINI_STANDIN_UTT_LATENCY')
+    writer = _TableWriter(wspecifier, opts.get('compress')=='true')
+    num_done = 0
+    for (key, mat) in _read_table(rspecifier):
+        writer.write(key, mat)
+        time.sleep(utt_latency)
+        num_done += 1
+    writer.close()
+    sys.stderr.write('LOG (copy-feats): Copied {} feature matrices.\n'.format(num_done))
+    return(0 if num_done > 0 else 1)
+
+def run_pl(args):
+    '''USAGE: run_pl(['JOB=1:4','log.JOB','cmd',...])  replaces this process with executor.py'''
+    sys.stdout.flush()
+    os.execv(sys.executable, [ sys.executable, os.path.join(_HERE,'executor.py'), '--no-pin' ] + list(args))
+
+STANDINS = { 'sox':sox, 'compute-mfcc-feats':compute_mfcc_feats, 'copy-feats':copy_feats, 'run.pl':run_pl }
+
+########## public interface ##################################################
+def main(name, args):
+    '''USAGE: returncode = main(name, args); run the stand-in for the program name'''
+    time.sleep(_latency('KALDINI_STANDIN_LATENCY'))
+    return(STANDINS[name](args))
+
+def install(bindir):
+    '''USAGE: bindir = install(bindir)
+    Write an executable for each stand-in into bindir, named after the program it replaces.'''
+    os.makedirs(bindir, exist_ok=True)
+    for name in STANDINS:
+        path = os.path.join(bindir, name)
+        with open(path,'w') as f:
+            f.write('#!{}\nimport sys\nsys.path.insert(0, {!r})\nimport standins\nsys.exit(standins.main({!r}, sys.argv[1:]))\n'.format(
+                sys.executable, _HERE, name))
+        os.chmod(path, 0o755)
+    return(bindir)
+
+########## Called from the operating system ##################################################
+if __name__=="__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in STANDINS:
+        print(__doc__)
+        sys.exit(1)
+    sys.exit(main(sys.argv[1], sys.argv[2:]))
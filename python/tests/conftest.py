@@ -0,0 +1,3 @@
+import os,sys
+# The modules of kaldini are flat files in the directory above this one
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+"""
+USAGE: python tests/make_references.py
+  Rewrites the test signals and reference outputs in tests/data.
+
+Reference MFCCs, for each tests/data/mfcc_{name}.conf, go in tests/data/mfcc_{name}.txt, a text archive
+as written by compute-mfcc-feats --config=mfcc_{name}.conf scp:... ark,t:-.  compute-mfcc-feats is used
+if it is on the PATH; otherwise kaldi_native_fbank (pip install kaldi-native-fbank), a C++ port of
+Kaldi's feature extraction that computes the same features, prints them in the same format.
+The reference resampling of speechlike_16k.wav to 8kHz goes in tests/data/sox_speechlike_8k.wav, written
+by sox -R -r 8000 if sox is on the PATH; otherwise by soxr (pip install soxr), the library version of
+the resampler of sox's rate effect, at sox's default (high) quality, rounded to 16 bits.
+"""
+
+import os,sys
+import wave
+import subprocess
+import shutil
+import numpy as np
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+SIGNALS = { 16000:'speechlike_16k.wav', 8000:'speechlike_8k.wav' }
+
+def speechlike(fs, seconds, seed):
+    '''A deterministic int16 signal with a voiced part (harmonics of a gliding pitch), silence, and noise'''
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(fs*seconds))/fs
+    f0 = 110 + 40*t/seconds
+    phase = 2*np.pi*np.cumsum(f0)/fs
+    voiced = sum(np.sin(h*phase)/h for h in range(1, 30) if h*f0[-1] < fs/2)
+    envelope = np.where((t > 0.1) & (t < 0.6*seconds), 1.0, 0.02)
+    x = 4000*envelope*voiced + 30*rng.standard_normal(len(t))
+    return(np.clip(np.round(x), -32768, 32767).astype('<i2'))
+
+def write_signal(filename, x, fs):
+    with wave.open(filename,'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(fs)
+        w.writeframes(x.tobytes())
+
+def read_conf(filename):
+    opts = {}
+    with open(filename) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line:
+                (k, v) = line[2:].split('=',1)
+                opts[k.replace('-','_')] = v.strip()
+    return(opts)
+
+def knf_mfcc(x, conf):
+    import kaldi_native_fbank as knf
+    c = read_conf(conf)
+    o = knf.MfccOptions()
+    f = o.frame_opts
+    f.dither = float(c.get('dither', 1.0))
+    f.samp_freq = float(c.get('sample_frequency', 16000))
+    f.frame_shift_ms = float(c.get('frame_shift', 10))
+    f.frame_length_ms = float(c.get('frame_length', 25))
+    f.preemph_coeff = float(c.get('preemphasis_coefficient', 0.97))
+    f.remove_dc_offset = c.get('remove_dc_offset', 'true') == 'true'
+    f.window_type = c.get('window_type', 'povey')
+    f.round_to_power_of_two = c.get('round_to_power_of_two', 'true') == 'true'
+    f.blackman_coeff = float(c.get('blackman_coeff', 0.42))
+    f.snip_edges = c.get('snip_edges', 'true') == 'true'
+    o.mel_opts.num_bins = int(c.get('num_mel_bins', 23))
+    o.mel_opts.low_freq = float(c.get('low_freq', 20))
+    o.mel_opts.high_freq = float(c.get('high_freq', 0))
+    o.num_ceps = int(c.get('num_ceps', 13))
+    o.use_energy = c.get('use_energy', 'true') == 'true'
+    o.energy_floor = float(c.get('energy_floor', 0))
+    o.raw_energy = c.get('raw_energy', 'true') == 'true'
+    o.cepstral_lifter = float(c.get('cepstral_lifter', 22))
+    m = knf.OnlineMfcc(o)
+    m.accept_waveform(f.samp_freq, x.astype(np.float32).tolist())
+    m.input_finished()
+    return(np.array([ m.get_frame(i) for i in range(m.num_frames_ready) ], dtype=np.float32))
+
+def text_ark(key, feats):
+    '''A matrix in the text format of Kaldi's ark,t: writer'''
+    rows = [ ' '.join('{:g}'.format(v) for v in row) for row in feats ]
+    return('{}  [\n  '.format(key) + ' \n  '.join(rows) + ' ]\n')
+
+def make_mfcc_references():
+    confs = sorted(f for f in os.listdir(DATA) if f.startswith('mfcc_') and f.endswith('.conf'))
+    for conf in confs:
+        conf = os.path.join(DATA, conf)
+        fs = int(float(read_conf(conf).get('sample_frequency', 16000)))
+        wav = os.path.join(DATA, SIGNALS[fs])
+        if shutil.which('compute-mfcc-feats'):
+            text = subprocess.run(['compute-mfcc-feats','--config='+conf,'scp:echo speechlike {} |'.format(wav),'ark,t:-'],
+                                  stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        else:
+            with wave.open(wav) as w:
+                x = np.frombuffer(w.readframes(w.getnframes()), dtype='<i2')
+            text = text_ark('speechlike', knf_mfcc(x, conf))
+        with open(conf[:-len('.conf')]+'.txt','w') as f:
+            f.write(text)
+        print('wrote {}'.format(conf[:-len('.conf')]+'.txt'))
+
+def make_sox_reference():
+    (wav, out) = (os.path.join(DATA, SIGNALS[16000]), os.path.join(DATA, 'sox_speechlike_8k.wav'))
+    if shutil.which('sox'):
+        subprocess.run(['sox', wav, '-R', '-r', '8000', '-t', 'wav', out], check=True)
+    else:
+        import soxr
+        with wave.open(wav) as w:
+            x = np.frombuffer(w.readframes(w.getnframes()), dtype='<i2').astype(np.float64)
+        y = soxr.resample(x, 16000, 8000, 'HQ')
+        write_signal(out, np.clip(np.round(y), -32768, 32767).astype('<i2'), 8000)
+    print('wrote {}'.format(out))
+
+if __name__=="__main__":
+    for (fs, name) in SIGNALS.items():
+        write_signal(os.path.join(DATA, name), speechlike(fs, 0.8, fs), fs)
+    make_mfcc_references()
+    make_sox_reference()
@@ -0,0 +1,97 @@
+import os
+import math
+import numpy as np
+import arpa
+
+# A bigram LM over a and b, normalized by hand: p(</s>)=.2, p(a)=.4, p(b)=.4, and
+# p(a|<s>)=.6, p(b|<s>)=.3, so bow(<s>) = .1/.2; p(a|a)=.2, p(b|a)=.5, so bow(a) = .3/.2;
+# p(</s>|b)=.5, so bow(b) = .5/.8
+LM = '''
+\\data\\
+ngram 1=4
+ngram 2=5
+
+\\1-grams:
+-99\t<s>\t{bos}
+{p_eos}\t</s>
+{p_a}\ta\t{a}
+{p_b}\tb\t{b}
+
+\\2-grams:
+{p_aa}\ta a
+{p_ab}\ta b
+{p_b_eos}\tb </s>
+{p_bos_a}\t<s> a
+{p_bos_b}\t<s> b
+
+\\end\\
+'''.format(bos=math.log10(.5), a=math.log10(1.5), b=math.log10(.625), p_eos=math.log10(.2), p_a=math.log10(.4),
+           p_b=math.log10(.4), p_aa=math.log10(.2), p_ab=math.log10(.5), p_b_eos=math.log10(.5),
+           p_bos_a=math.log10(.6), p_bos_b=math.log10(.3))
+WORDS = '<eps> 0\na 1\nb 2\n#0 3\n<s> 4\n</s> 5\n'
+
+def write_lm(tmp_path):
+    (lm, words) = (str(tmp_path / 'lm.arpa'), str(tmp_path / 'words.txt'))
+    with open(lm,'w') as f:
+        f.write(LM)
+    with open(words,'w') as f:
+        f.write(WORDS)
+    return(lm, words)
+
+def distribution(trie, context):
+    '''p(w | context) for every word that can follow a context'''
+    words = [ trie.word2id[w] for w in ('a','b','</s>') ]
+    contexts = [ [ trie.word2id[w] for w in context ] ] * len(words)
+    return(dict(zip(('a','b','</s>'), 10.0**trie.score(contexts, words))))
+
+def test_scores(tmp_path):
+    trie = arpa.load(*write_lm(tmp_path))
+    assert trie.num_ngrams() == [4, 5]
+    expected = { ('<s>',):{ 'a':.6, 'b':.3, '</s>':.5*.2 }, ('a',):{ 'a':.2, 'b':.5, '</s>':1.5*.2 },
+                 ('b',):{ 'a':.625*.4, 'b':.625*.4, '</s>':.5 }, ():{ 'a':.4, 'b':.4, '</s>':.2 } }
+    for (context, probs) in expected.items():
+        got = distribution(trie, context)
+        assert all(abs(got[w] - p) < 1e-6 for (w, p) in probs.items())
+        assert abs(sum(got.values()) - 1.0) < 1e-6
+
+def test_round_trip(tmp_path):
+    (lm, words) = write_lm(tmp_path)
+    trie = arpa.load(lm, words)
+    assert os.path.exists(lm + '.trie.npz')
+    cached = arpa.load(lm, words)
+    for k in range(trie.order):
+        assert np.array_equal(cached.keys[k], trie.keys[k]) and np.array_equal(cached.logprobs[k], trie.logprobs[k])
+    trie.write_arpa(str(tmp_path / 'out.arpa.gz'))
+    again = arpa.NgramTrie.from_arpa(str(tmp_path / 'out.arpa.gz'), trie.word2id)
+    assert again.num_ngrams() == trie.num_ngrams()
+    for k in range(trie.order):
+        assert np.array_equal(again.keys[k], trie.keys[k])
+        assert np.allclose(again.logprobs[k], trie.logprobs[k], atol=1e-6)
+        assert np.allclose(again.backoffs[k], trie.backoffs[k], atol=1e-6)
+
+def relative_perplexity_change(trie, bigram):
+    '''exp(D)-1, where D = -P(h) sum_w p(w|h) ln(p'(w|h)/p(w|h)), p' being the LM without bigram, with its
+    context's backoff weight renormalized'''
+    (h, w) = bigram
+    W = trie.ngrams(2)
+    keep = ~((W[:,0] == trie.word2id[h]) & (W[:,1] == trie.word2id[w]))
+    pruned = arpa.NgramTrie.from_ngrams(trie.word2id, [ (trie.ngrams(1), trie.logprobs[0], trie.backoffs[0]),
+                                                       (W[keep], trie.logprobs[1][keep], trie.backoffs[1][keep]) ])
+    pruned.recompute_backoffs()
+    (before, after) = (distribution(trie, (h,)), distribution(pruned, (h,)))
+    p_h = 1.0 if h == '<s>' else 10.0**trie.score(np.zeros((1,0)), [ trie.word2id[h] ])[0]
+    return(math.expm1(-p_h * sum(before[v] * math.log(after[v]/before[v]) for v in before)))
+
+def test_prune_entropy(tmp_path):
+    trie = arpa.load(*write_lm(tmp_path))
+    changes = { (h,w):relative_perplexity_change(trie, (h,w)) for (h,w) in
+                [ ('a','a'), ('a','b'), ('b','</s>'), ('<s>','a'), ('<s>','b') ] }
+    ranked = sorted(changes, key=changes.get)
+    threshold = (changes[ranked[1]] + changes[ranked[2]]) / 2
+    assert trie.prune_entropy(threshold) == 2
+    id2word = { i:w for (w,i) in trie.word2id.items() }
+    assert set(tuple(id2word[i] for i in row) for row in trie.ngrams(2).tolist()) == set(ranked[2:])
+    for context in (('<s>',), ('a',), ('b',)):
+        assert abs(sum(distribution(trie, context).values()) - 1.0) < 1e-6
+    assert trie.prune_entropy(1e9) == 3
+    assert trie.num_ngrams() == [4, 0]
@@ -0,0 +1,53 @@
+import os
+import wave
+import resource
+import numpy as np
+import pytest
+import audio
+import resample
+import SpeechCorpus
+
+def write_wavs(dirname, num_files, fs=16000):
+    rng = np.random.default_rng(0)
+    utt2wav = {}
+    for n in range(num_files):
+        filename = os.path.join(dirname, 'utt{:04d}.wav'.format(n))
+        with wave.open(filename,'wb') as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(fs)
+            w.writeframes((rng.standard_normal(fs//10+n)*1000).astype('<i2').tobytes())
+        utt2wav['utt{:04d}'.format(n)] = filename
+    return(utt2wav)
+
+@pytest.fixture
+def fd_limit():
+    '''Lower the soft limit on open files to 128 for the duration of a test'''
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (128, hard))
+    audio.release()
+    yield(128)
+    audio.release()
+    resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+def test_read_durations_of_more_files_than_fd_limit(tmp_path, fd_limit):
+    utt2wav = write_wavs(str(tmp_path), 3*fd_limit)
+    utt2dur = SpeechCorpus.read_durations(utt2wav, nj=4)
+    assert sorted(utt2dur) == sorted(utt2wav)
+    assert utt2dur['utt0010'] == pytest.approx((1600+10)/16000)
+
+def test_read_more_files_than_fd_limit(tmp_path, fd_limit):
+    utt2wav = write_wavs(str(tmp_path), 3*fd_limit)
+    for (n, filename) in enumerate(sorted(utt2wav.values())):
+        (x, fs) = audio.read(filename)
+        assert x.shape == (1600+n, 1)
+    assert len(audio._maps) <= audio.MAX_MAPS
+
+def test_resample_more_files_than_fd_limit(tmp_path, fd_limit):
+    utt2wav = write_wavs(str(tmp_path), 3*fd_limit)
+    outdir = tmp_path / 'out'
+    outdir.mkdir()
+    tasks = [ (u, w, str(outdir / (u+'.wav')), ['false']) for (u, w) in sorted(utt2wav.items()) ]
+    returncodes = resample.resample_all(tasks, 8000, 1, str(tmp_path / 'resample'))
+    assert sorted(returncodes) == sorted(utt2wav)
+    assert all(c == 0 for c in returncodes.values())
@@ -0,0 +1,69 @@
+import os
+import sys
+import numpy as np
+import pytest
+import decode_server
+
+# Stands in for gmm-latgen-faster: reads float matrices from stdin, and prints the word ids 1 2 for each,
+# except that it never answers for an utterance whose name contains "hang"
+STANDIN = r'''
+import sys, struct
+stdin = sys.stdin.buffer
+while True:
+    key = b''
+    c = stdin.read(1)
+    while c and c != b' ':
+        key += c
+        c = stdin.read(1)
+    if not c:
+        break
+    header = stdin.read(15)         # \0B, FM and a space, then the rows and columns
+    (rows, cols) = struct.unpack('<xixi', header[5:15])
+    stdin.read(4*rows*cols)
+    if rows == 0:
+        sys.stderr.write('WARNING (gmm-latgen-faster) Zero-length utterance: {}\n'.format(key.decode()))
+    elif b'hang' not in key:
+        sys.stdout.write('{} 1 2\n'.format(key.decode()))
+    sys.stdout.flush()
+    sys.stderr.flush()
+'''
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    bindir = tmp_path / 'bin'
+    bindir.mkdir()
+    standin = bindir / 'gmm-latgen-faster'
+    standin.write_text('#!{}\n{}'.format(sys.executable, STANDIN))
+    os.chmod(str(standin), 0o755)
+    monkeypatch.setenv('PATH', str(bindir) + os.pathsep + os.environ['PATH'])
+    (tmp_path / 'words.txt').write_text('<eps> 0\nhello 1\nworld 2\n')
+    s = decode_server.DecodeServer(str(tmp_path), str(tmp_path), str(tmp_path / 'decode.sock'), nworkers=1,
+                                   batch_size=4, mfcc_config=str(tmp_path / 'none.conf'), timeout=2.0)
+    yield(s)
+    s.close()
+
+def submit(server, utt, rows):
+    feats = np.random.default_rng(0).standard_normal((rows, 13)).astype(np.float32)
+    return(server.submit(decode_server.Request(utt, feats=feats)))
+
+def test_decode(server):
+    assert submit(server, 'utt1', 50).result(timeout=10) == [ 'hello', 'world' ]
+
+def test_zero_frames_are_rejected(server):
+    futures = [ submit(server, 'empty', 0), submit(server, 'utt2', 50) ]
+    with pytest.raises(ValueError):
+        futures[0].result(timeout=10)
+    assert futures[1].result(timeout=10) == [ 'hello', 'world' ]
+
+def test_decoder_that_never_answers_times_out(server):
+    with pytest.raises(RuntimeError):
+        submit(server, 'hang', 50).result(timeout=10)
+    # The decoder is restarted for the next batch
+    assert submit(server, 'utt3', 50).result(timeout=10) == [ 'hello', 'world' ]
+
+def test_unexpected_error_fails_the_batch(server, monkeypatch):
+    def broken(batch):
+        raise KeyError('broken front end')
+    monkeypatch.setattr(server, '_features', broken)
+    with pytest.raises(KeyError):
+        submit(server, 'utt4', 50).result(timeout=10)
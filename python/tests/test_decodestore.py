@@ -0,0 +1,63 @@
+import os
+import zlib
+import numpy as np
+import kaldi
+import decodestore
+
+def make_decode_inputs(tmp_path):
+    datadir = str(tmp_path / 'data')
+    os.makedirs(datadir)
+    utt2spk = { 'a-1':'a', 'a-2':'a', 'b-1':'b' }
+    kaldi.write_dict_to_file(utt2spk, os.path.join(datadir,'utt2spk'))
+    with kaldi.ArkWriter(os.path.join(datadir,'feats.ark'), os.path.join(datadir,'feats.scp')) as writer:
+        for (n, u) in enumerate(sorted(utt2spk)):
+            writer.write(u, np.full((5+n, 13), n, dtype=np.float32))
+    modeldir = str(tmp_path / 'mono')
+    os.makedirs(modeldir)
+    with open(os.path.join(modeldir,'final.mdl'),'w') as f:
+        f.write('model\n')
+    with open(os.path.join(modeldir,'cmvn_opts'),'w') as f:
+        f.write('--norm-means=true\n')
+    graphdir = str(tmp_path / 'graph')
+    os.makedirs(graphdir)
+    for name in ('HCLG.fst','words.txt'):
+        with open(os.path.join(graphdir,name),'w') as f:
+            f.write(name+'\n')
+    return(datadir, os.path.join(modeldir,'final.mdl'), graphdir)
+
+def store_lattices(store, keys):
+    store.db.executemany('INSERT OR REPLACE INTO lattices VALUES (?,?,?)',
+                         [ (u, k, zlib.compress('{} lattice\n\n'.format(u).encode('utf-8'))) for (u, k) in keys.items() ])
+    store.db.commit()
+
+def test_hit_and_miss(tmp_path):
+    (datadir, model, graphdir) = make_decode_inputs(tmp_path)
+    modeldir = os.path.dirname(model)
+    store = decodestore.DecodeStore(str(tmp_path / 'store.sqlite'))
+    opts = [ '--beam=13.0' ]
+    keys = store.fingerprints(datadir, model, graphdir, opts)
+    assert store.missing(keys) == sorted(keys)
+    store_lattices(store, keys)
+    assert store.fingerprints(datadir, model, graphdir, opts) == keys
+    assert store.missing(keys) == []
+    # Every input the lattices depend on changes the fingerprint
+    assert store.missing(store.fingerprints(datadir, model, graphdir, [ '--beam=10.0' ])) == sorted(keys)
+    with open(os.path.join(modeldir,'cmvn_opts'),'w') as f:
+        f.write('--norm-vars=true\n')
+    assert store.missing(store.fingerprints(datadir, model, graphdir, opts)) == sorted(keys)
+    keys = store.fingerprints(datadir, model, graphdir, opts)
+    store_lattices(store, keys)
+    with open(os.path.join(modeldir,'delta_opts'),'w') as f:
+        f.write('--delta-order=1\n')
+    assert store.missing(store.fingerprints(datadir, model, graphdir, opts)) == sorted(keys)
+    keys = store.fingerprints(datadir, model, graphdir, opts)
+    store_lattices(store, keys)
+    # A changed feature matrix misses only its own utterance
+    with kaldi.ArkWriter(os.path.join(datadir,'new.ark'), os.path.join(datadir,'new.scp')) as writer:
+        writer.write('a-2', np.zeros((4, 13), dtype=np.float32))
+    utt2feat = kaldi.read_dict_from_file(os.path.join(datadir,'feats.scp'))
+    utt2feat.update(kaldi.read_dict_from_file(os.path.join(datadir,'new.scp')))
+    kaldi.write_dict_to_file(utt2feat, os.path.join(datadir,'feats.scp'))
+    assert store.missing(store.fingerprints(datadir, model, graphdir, opts)) == [ 'a-2' ]
+    store.close()
+    kaldi.release_arks()
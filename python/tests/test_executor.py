@@ -0,0 +1,42 @@
+import os
+import threading
+import pytest
+import executor
+
+needs_affinity = pytest.mark.skipif(not hasattr(os,'sched_getaffinity'), reason='no CPU affinity on this platform')
+
+def run_pinned(tmp_path, n, core):
+    task = executor.Task(n, 'grep Cpus_allowed_list /proc/self/status', str(tmp_path / 'task.{}.log'.format(n)), 1, 0)
+    task.cores = [ core ]
+    assert executor.run_task(task) == 0
+    with open(task.logfile) as f:
+        return([ line.split()[-1] for line in f if line.startswith('Cpus_allowed_list') ][0])
+
+@needs_affinity
+@pytest.mark.parametrize('taskset', [ True, False ], ids=[ 'taskset', 'python' ])
+def test_tasks_started_from_threads_are_pinned(tmp_path, monkeypatch, taskset):
+    if not taskset:
+        monkeypatch.setattr(executor, '_taskset', lambda: None)
+    elif executor._taskset() is None:
+        pytest.skip('taskset is not installed')
+    cores = sorted(os.sched_getaffinity(0))
+    results = {}
+    def run(n):
+        results[n] = run_pinned(tmp_path, n, cores[n % len(cores)])
+    threads = [ threading.Thread(target=run, args=(n,)) for n in range(8) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == { n:str(cores[n % len(cores)]) for n in range(8) }
+
+def test_task_that_raises_does_not_hang_the_array(tmp_path):
+    (tmp_path / 'notadir').write_text('')
+    tasks = [ executor.Task(1, 'true', str(tmp_path / 'notadir' / 'task.1.log'), 1, 0),
+              executor.Task(2, 'true', str(tmp_path / 'task.2.log'), 1, 0) ]
+    ex = executor.LocalExecutor(max_jobs=2, retries=2, pin=False)
+    t = threading.Thread(target=ex.run_tasks, args=(tasks,), daemon=True)
+    t.start()
+    t.join(timeout=30)
+    assert not t.is_alive()
+    assert [ task.returncode for task in tasks ] == [ -1, 0 ]
@@ -0,0 +1,87 @@
+import os
+import resource
+import time
+import numpy as np
+import kaldi
+
+def test_newer_than_looks_inside_directories(tmp_path):
+    dictdir = tmp_path / 'dict'
+    dictdir.mkdir()
+    lexicon = dictdir / 'lexicon.txt'
+    lexicon.write_text('a a\n')
+    output = tmp_path / 'L_disambig.fst'
+    output.write_text('')
+    past = time.time() - 10
+    os.utime(str(lexicon), (past, past))
+    os.utime(str(dictdir), (past, past))
+    assert not kaldi.newer_than(str(dictdir), str(output))
+    # Rewriting a file in place changes its mtime, but not its directory's
+    kaldi.write_dict_to_file({ 'a':'a', 'b':'b' }, str(lexicon))
+    os.utime(str(dictdir), (past, past))
+    assert kaldi.newer_than(str(dictdir), str(output))
+    assert kaldi.newer_than([ str(dictdir) ], str(output))
+
+def test_conversion_errors_are_recorded(tmp_path, monkeypatch):
+    convert = kaldi.convert_if_newer
+    def failing(ifile, ofile, cmd, stdout_logfile, stderr_logfile):
+        if ifile.endswith('3'):
+            raise ValueError('bad input')
+        return(convert(ifile, ofile, cmd, stdout_logfile, stderr_logfile))
+    monkeypatch.setattr(kaldi, 'convert_if_newer', failing)
+    tasks = []
+    for n in range(6):
+        ifile = tmp_path / 'in{}'.format(n)
+        ifile.write_text('x')
+        tasks.append((n, str(ifile), str(tmp_path / 'out{}'.format(n)), [ 'cp', str(ifile), str(tmp_path / 'out{}'.format(n)) ]))
+    logprefix = str(tmp_path / 'convert')
+    returncodes = kaldi.convert_all_if_newer(tasks, 2, logprefix)
+    assert returncodes == { 0:0, 1:0, 2:0, 3:-1, 4:0, 5:0 }
+    with open(logprefix+'_stderr.txt') as f:
+        assert '3: ValueError: bad input' in f.read()
+
+def test_read_more_archives_than_fd_limit(tmp_path):
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    kaldi.release_arks()
+    resource.setrlimit(resource.RLIMIT_NOFILE, (128, hard))
+    try:
+        for n in range(3*128):
+            (ark, scp) = (str(tmp_path / 'feats{}.ark'.format(n)), str(tmp_path / 'feats{}.scp'.format(n)))
+            with kaldi.ArkWriter(ark, scp) as writer:
+                writer.write('utt{}'.format(n), np.full((n+1, 13), n, dtype=np.float32))
+            rxfile = kaldi.read_dict_from_file(scp)['utt{}'.format(n)]
+            mat = kaldi.read_mat(rxfile)
+            assert mat.shape == (n+1, 13) and mat[0,0] == n
+            assert [ key for (key, m) in kaldi.iter_ark(ark) ] == [ 'utt{}'.format(n) ]
+        assert len(kaldi._arks) <= kaldi.MAX_ARKS
+    finally:
+        kaldi.release_arks()
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+def test_read_object_bytes_applies_range(tmp_path):
+    mat = np.arange(40*13, dtype=np.float32).reshape(40, 13)
+    for compress in (False, True):
+        (ark, scp) = (str(tmp_path / 'feats{}.ark'.format(compress)), str(tmp_path / 'feats{}.scp'.format(compress)))
+        with kaldi.ArkWriter(ark, scp, compress=compress) as writer:
+            writer.write('utt', mat)
+        rxfile = kaldi.read_dict_from_file(scp)['utt']
+        assert kaldi.read_object_bytes(rxfile) == open(ark,'rb').read()[len('utt '):]
+        data = kaldi.read_object_bytes(rxfile + '[10:19,2:4]')
+        assert data[2:4] == (b'CM' if compress else b'FM')
+        part = kaldi.read_object(data, 0)[0]
+        assert part.shape == (10, 3)
+        assert np.allclose(part, kaldi.read_mat(rxfile)[10:20,2:5], atol=(0.5 if compress else 0))
+    kaldi.release_arks()
+
+def test_read_dict_from_file_matches_line_parser(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'table')
+    with open(filename, 'w') as f:
+        f.write(''.join('utt{}\t/wav/{}.wav\n'.format(n, n) for n in range(200)))
+        f.write('utt7  sox  in.flac -t wav - |\n\n   \nkeyonly\nutt3 x\r\n')
+        f.write(''.join('utt{} {}\n'.format(n, -n) for n in range(150, 300)))
+        f.write('last no newline')
+    expected = dict(kaldi.iter_table(filename))
+    for chunk_size in (7, 100, 1<<22):
+        monkeypatch.setattr(kaldi, 'CHUNK_SIZE', chunk_size)
+        table = kaldi.read_dict_from_file(filename)
+        assert table == expected and list(table) == list(expected)
+    assert expected['utt7'] == 'sox in.flac -t wav - |' and expected['keyonly'] == '' and expected['utt200'] == '-200'
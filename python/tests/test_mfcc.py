@@ -0,0 +1,48 @@
+import os
+import glob
+import numpy as np
+import pytest
+import audio
+import mfcc
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+CONFS = sorted(glob.glob(os.path.join(DATA,'mfcc_*.conf')))
+SIGNALS = { 16000:'speechlike_16k.wav', 8000:'speechlike_8k.wav' }
+
+def reference(conf):
+    '''The features of tests/data/speechlike_*.wav computed by compute-mfcc-feats (see make_references.py)'''
+    with open(conf[:-len('.conf')]+'.txt') as f:
+        return(mfcc._read_text_ark(f.read())['speechlike'])
+
+def compute(conf):
+    opts = mfcc.read_config(conf)
+    (x, fs) = audio.read(os.path.join(DATA, SIGNALS[int(opts['sample_frequency'])]))
+    return(mfcc.Extractor(opts).compute([ mfcc.to_int16_scale(x) ])[0])
+
+@pytest.mark.parametrize('conf', CONFS, ids=[ os.path.basename(c) for c in CONFS ])
+def test_matches_compute_mfcc_feats(conf):
+    ref = reference(conf)
+    feats = compute(conf)
+    assert feats.shape == ref.shape
+    # The reference is printed with 6 significant digits; the rest is float32 rounding
+    np.testing.assert_allclose(feats, ref, rtol=1e-4, atol=2e-3)
+
+def test_reference_settings_are_covered():
+    opts = [ mfcc.read_config(c) for c in CONFS ]
+    assert all(o['dither'] == 0 for o in opts)
+    assert { o['use_energy'] for o in opts } == { True, False }
+    assert { o['raw_energy'] for o in opts if o['use_energy'] } == { True, False }
+    assert { o['window_type'] for o in opts } >= { 'povey', 'hamming' }
+    assert { o['cepstral_lifter'] for o in opts } >= { 0.0, 22.0 }
+    assert { o['snip_edges'] for o in opts } == { True, False }
+
+def test_dither_changes_features_by_a_little():
+    conf = os.path.join(DATA,'mfcc_default.conf')
+    opts = mfcc.read_config(conf, dither=1.0)
+    (x, fs) = audio.read(os.path.join(DATA, SIGNALS[16000]))
+    (a, b) = mfcc.Extractor(opts).compute([ mfcc.to_int16_scale(x) ]*2, seeds=[ 0, 1 ])
+    ref = reference(conf)
+    assert not np.array_equal(a, b)
+    voiced = ref[:,0] > 12    # frames well above the dither noise
+    assert np.max(np.abs(a[voiced,0] - ref[voiced,0])) < 0.01
+    assert np.mean(np.abs(a[voiced] - ref[voiced])) < 0.1
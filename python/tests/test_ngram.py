@@ -0,0 +1,58 @@
+import numpy as np
+import ngram
+
+TEXTS = { 'u1':'the cat sat on the mat', 'u2':'the dog sat on the cat', 'u3':'a cat and a dog',
+          'u4':'the mat', 'u5':'on the dog sat a cat', 'u6':'the cat' }
+
+def probability(trie, context, word):
+    contexts = np.array([ [ trie.word2id[w] for w in context ] ], dtype=np.int64).reshape(1, len(context))
+    return(10.0**trie.score(contexts, [ trie.word2id[word] ])[0])
+
+def test_hand_computed_bigram():
+    # Continuation counts a:1, b:2, </s>:1 give unigram discounts D1=.5, D2=2, so p(a)=p(</s>)=.375, p(b)=.25;
+    # bigram counts 1,1,1,2 give D1=.6, D2=2, so p(a|<s>) = (1-.6)/2 + .6*.375, and p(</s>|b) = 0 + 1*.375
+    trie = ngram.train({ 'u1':'a b', 'u2':'b' }, order=2)
+    expected = { ((),'a'):.375, ((),'b'):.25, ((),'</s>'):.375, (('<s>',),'a'):.425, (('<s>',),'b'):.35,
+                 (('<s>',),'</s>'):.225, (('b',),'</s>'):.375, (('b',),'a'):.375 }
+    for ((context, word), p) in expected.items():
+        assert abs(probability(trie, context, word) - p) < 1e-6
+
+def test_distributions_sum_to_one():
+    for order in (2, 3, 4):
+        trie = ngram.train(TEXTS, order=order)
+        words = [ w for w in trie.word2id if w != '<s>' ]
+        id2word = { i:w for (w,i) in trie.word2id.items() }
+        contexts = [ () ]
+        for k in range(1, order):
+            contexts += [ tuple(id2word[i] for i in row) for row in trie.ngrams(k)[trie.is_context(k)].tolist() ]
+        # Histories never seen as contexts back off, and must sum to one too
+        contexts += [ ('sat', 'sat'), ('mat',) ]
+        for context in contexts:
+            total = sum(probability(trie, context, w) for w in words)
+            assert abs(total - 1.0) < 1e-4, (order, context, total)
+
+def test_vocab_and_pruning_keep_distributions_normalized():
+    vocab = { w:i for (i,w) in enumerate([ '<eps>', '<s>', '</s>', '<unk>', 'the', 'cat', 'dog', 'sat', 'on', 'mat', '#0' ]) }
+    trie = ngram.train(TEXTS, order=3, vocab=vocab, min_counts=2)
+    words = [ w for w in vocab if w not in ('<eps>', '<s>', '#0') ]
+    for context in [ (), ('the',), ('<s>', 'the'), ('the', 'cat'), ('<unk>', 'cat') ]:
+        assert abs(sum(probability(trie, context, w) for w in words) - 1.0) < 1e-4
+    assert probability(trie, ('the',), 'mat') > 0
+
+def test_sharded_counts_match(monkeypatch):
+    sentences = ngram.read_texts(TEXTS)
+    word2id = ngram.build_vocab(sentences)
+    single = ngram.count(sentences, word2id, order=3, nj=1)
+    monkeypatch.setattr(ngram, 'SHARD_SIZE', 2)
+    sharded = ngram.count(sentences, word2id, order=3, nj=2)
+    for ((W1, c1), (W2, c2)) in zip(single, sharded):
+        assert np.array_equal(W1, W2) and np.array_equal(c1, c2)
+    # The trigram counts are those of a direct count
+    tokens = [ [ '<s>' ] + s.split() + [ '</s>' ] for s in sentences ]
+    trigrams = {}
+    for t in tokens:
+        for n in range(len(t)-2):
+            key = tuple(word2id[w] for w in t[n:n+3])
+            trigrams[key] = trigrams.get(key, 0) + 1
+    (W, c) = single[2]
+    assert dict(zip(map(tuple, W.tolist()), c.tolist())) == trigrams
@@ -0,0 +1,86 @@
+import os
+import pytest
+import pipeline
+
+def make_pipeline(tmp_path, calls, fail=None):
+    '''Three stages: write data (an output file), count it (no outputs), and report'''
+    datafile = str(tmp_path / 'data.txt')
+    source = tmp_path / 'source.txt'
+    def write(results):
+        calls.append('write')
+        with open(datafile,'w') as f:
+            f.write(source.read_text())
+        return(datafile)
+    def count(results):
+        calls.append('count')
+        if fail == 'count':
+            raise ValueError('count failed')
+        with open(results['write']) as f:
+            return(len(f.read().split()))
+    def report(results):
+        calls.append('report')
+        return('{} words'.format(results['count']))
+    p = pipeline.Pipeline(cpu_budget=2, journal=str(tmp_path / 'pipeline.journal'))
+    p.add('write', write, outputs=[ datafile ])
+    p.add('count', count, deps=['write'])
+    p.add('report', report, deps=['count'])
+    return(p)
+
+def test_rerun_after_success_sees_changed_inputs(tmp_path):
+    (tmp_path / 'source.txt').write_text('a b c')
+    calls = []
+    assert make_pipeline(tmp_path, calls).run()['report'] == '3 words'
+    assert not os.path.exists(str(tmp_path / 'pipeline.journal'))
+    (tmp_path / 'source.txt').write_text('a b c d')
+    calls = []
+    assert make_pipeline(tmp_path, calls).run()['report'] == '4 words'
+    assert calls == [ 'write', 'count', 'report' ]
+
+def test_resume_after_failure(tmp_path):
+    (tmp_path / 'source.txt').write_text('a b c')
+    calls = []
+    with pytest.raises(RuntimeError):
+        make_pipeline(tmp_path, calls, fail='count').run()
+    assert calls == [ 'write', 'count' ]
+    assert os.path.exists(str(tmp_path / 'pipeline.journal'))
+    calls = []
+    p = make_pipeline(tmp_path, calls)
+    assert p.run()['report'] == '3 words'
+    assert p.stages['write'].resumed
+    assert calls == [ 'count', 'report' ]
+
+def test_stage_without_outputs_is_not_resumed(tmp_path):
+    (tmp_path / 'source.txt').write_text('a b c')
+    p = make_pipeline(tmp_path, [])
+    p.results = { 'write':str(tmp_path / 'data.txt'), 'count':3 }
+    (tmp_path / 'data.txt').write_text('a b c')
+    p._write_journal()
+    calls = []
+    p = make_pipeline(tmp_path, calls)
+    p.run()
+    assert calls == [ 'count', 'report' ]
+
+def test_journal_keeps_only_unfinished_groups(tmp_path):
+    calls = []
+    def stage(name, fail=False):
+        def func(results):
+            calls.append(name)
+            if fail:
+                raise ValueError(name+' failed')
+            with open(str(tmp_path / name),'w') as f:
+                f.write(name)
+            return(name)
+        return(func)
+    def make(fail):
+        p = pipeline.Pipeline(cpu_budget=2, journal=str(tmp_path / 'pipeline.journal'), keep_going=True)
+        for language in ('swahili', 'zulu'):
+            p.add(language+'_lang', stage(language+'_lang'), outputs=[ str(tmp_path / (language+'_lang')) ], group=language)
+            p.add(language+'_mono', stage(language+'_mono', fail and language=='zulu'),
+                  deps=[ language+'_lang' ], outputs=[ str(tmp_path / (language+'_mono')) ], group=language)
+        return(p)
+    with pytest.raises(RuntimeError):
+        make(fail=True).run()
+    calls.clear()
+    make(fail=False).run()
+    assert sorted(calls) == [ 'swahili_lang', 'swahili_mono', 'zulu_mono' ]
+    assert not os.path.exists(str(tmp_path / 'pipeline.journal'))
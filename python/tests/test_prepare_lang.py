@@ -0,0 +1,67 @@
+import math
+import os
+import pytest
+import prepare_lang
+
+LEXICON = { '<unk>':'SPN', 'a':'a', 'ab':[ 'a b', 'a b' ], 'abc':'a b c', 'ba':'b a', 'bah':'b a', 'sil':'SIL' }
+
+def make_lang():
+    return(prepare_lang.Lang(LEXICON, [ 'a', 'b', 'c' ], [ 'SIL', 'SPN' ], [ 'SIL' ], oov_word='<unk>'))
+
+def make_lexicon_fst(lang, disambig):
+    '''make_lexicon_fst.pl, with a silence probability (and, if disambig, its silence disambiguation
+    symbol), followed by fstaddselfloops, as prepare_lang.sh runs them; arcs as (src, dst, ilabel, olabel)'''
+    p2i = lang.phone2id
+    (nosil_cost, sil_cost) = (-math.log(1-lang.sil_prob), -math.log(lang.sil_prob))
+    (loop, sil) = (1, 2)
+    arcs = [ (0, loop, 0, 0, nosil_cost), (0, sil, 0, 0, sil_cost) ]
+    if disambig:
+        arcs += [ (sil, 3, p2i['SIL'], 0, 0.0), (3, loop, p2i['#{}'.format(lang.sil_disambig)], 0, 0.0) ]
+        nextstate = 4
+    else:
+        arcs.append((sil, loop, p2i['SIL'], 0, 0.0))
+        nextstate = 3
+    for ((word, phones), pron, n) in zip(lang.entries, lang.prons, lang.disambig_suffixes):
+        symbols = [ p2i[p] for p in pron ] + ([ p2i['#{}'.format(n)] ] if disambig and n else [])
+        (s, olabel) = (loop, lang.word2id[word])
+        for (k, p) in enumerate(symbols):
+            if k < len(symbols)-1:
+                arcs.append((s, nextstate, p, olabel, 0.0))
+                (s, olabel, nextstate) = (nextstate, 0, nextstate+1)
+            else:
+                arcs += [ (s, loop, p, olabel, nosil_cost), (s, sil, p, olabel, sil_cost) ]
+    if disambig:
+        arcs.append((loop, loop, p2i['#0'], lang.word2id['#0'], 0.0))
+    return(nextstate, sorted(arcs))
+
+@pytest.mark.parametrize('disambig', [ False, True ])
+def test_lexicon_fst_matches_make_lexicon_fst(disambig):
+    lang = make_lang()
+    (num_states, finals, arcs) = lang.fst_arrays(disambig)
+    (ref_states, ref_arcs) = make_lexicon_fst(lang, disambig)
+    assert num_states == ref_states
+    got = sorted(zip(*[ c.tolist() for c in arcs ]))
+    assert [ a[:4] for a in got ] == [ a[:4] for a in ref_arcs ]
+    assert [ a[4] for a in got ] == pytest.approx([ a[4] for a in ref_arcs ])
+    assert finals[1] == 0 and all(math.isinf(f) for (n, f) in enumerate(finals) if n != 1)
+
+def test_words_are_output_on_the_first_arc():
+    lang = make_lang()
+    (num_states, finals, (src, dst, ilabel, olabel, weight)) = lang.fst_arrays(True)
+    # Every word is output on the first arc of each of its pronunciations, which leaves the loop state,
+    # so that composition with G is pruned at once; a one-phone pronunciation has two first arcs (to silence, or not)
+    expected = [ lang.word2id[w] for (w, phones) in lang.entries for n in range(2 if len(phones)==1 else 1) ]
+    assert sorted(olabel[olabel > 0].tolist()) == sorted(expected + [ lang.word2id['#0'] ])
+    assert set(src[olabel > 0].tolist()) == { 1 }
+    # The arcs are sorted by source state and then output label
+    assert all((s1, o1) <= (s2, o2) for (s1, o1, s2, o2) in zip(src, olabel, src[1:], olabel[1:]))
+
+def test_disambiguation_symbols():
+    lang = make_lang()
+    suffixes = { (w, ' '.join(p)):n for ((w, phones), p, n) in zip(lang.entries, lang.prons, lang.disambig_suffixes) }
+    # Homophones get #1, #2; with word-position phones, no pronunciation is a prefix of another
+    assert suffixes[('ba', 'b_B a_E')] == 1
+    assert suffixes[('bah', 'b_B a_E')] == 2
+    assert suffixes[('abc', 'a_B b_I c_E')] == 0
+    assert suffixes[('ab', 'a_B b_E')] == 0
+    assert lang.sil_disambig == 3
@@ -0,0 +1,50 @@
+import os
+import io
+import wave
+import numpy as np
+import audio
+import resample
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+def test_matches_sox():
+    '''Compare with sox -R -r 8000 (see make_references.py): same length and alignment, small difference'''
+    (x, fs, sampwidth) = resample.read_wav(os.path.join(DATA,'speechlike_16k.wav'))
+    (ref, fs_ref, w) = resample.read_wav(os.path.join(DATA,'sox_speechlike_8k.wav'))
+    y = resample.quantize(resample.resample(x, fs, 8000), sampwidth)
+    assert (fs_ref, w, sampwidth) == (8000, 2, 2)
+    assert y.shape == ref.shape
+    assert resample.snr(ref, y) > 40
+    assert np.max(np.abs(ref - y)) < 0.01*np.max(np.abs(ref))
+
+def write_24bit(filename, samples, fs):
+    b = samples.astype('<i4').view(np.uint8).reshape(-1,4)[:,0:3]
+    with wave.open(filename,'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(3)
+        w.setframerate(fs)
+        w.writeframes(b.tobytes())
+
+def test_24bit_stays_24bit(tmp_path):
+    samples = np.array([ 0, 1, -1, 4000000, -4000000, (1<<23)-1, -(1<<23) ] * 1000)
+    (ifile, ofile) = (str(tmp_path / 'in.wav'), str(tmp_path / 'out.wav'))
+    write_24bit(ifile, samples, 16000)
+    (x, fs, sampwidth) = resample.read_wav(ifile)
+    assert sampwidth == 3
+    np.testing.assert_array_equal(x[:,0], samples)
+    resample.write_wav(ofile, x, fs, sampwidth)
+    with wave.open(ofile) as w:
+        assert w.getsampwidth() == 3
+    np.testing.assert_array_equal(resample.read_wav(ofile)[0][:,0], samples)
+    assert audio.bits(ofile) == 24
+
+def test_resample_files_keeps_sample_width(tmp_path):
+    rng = np.random.default_rng(0)
+    samples = np.round(rng.standard_normal(16000)*1e5)
+    (ifile, ofile) = (str(tmp_path / 'in.wav'), str(tmp_path / 'out.wav'))
+    write_24bit(ifile, samples, 16000)
+    (out, err) = (io.StringIO(), io.StringIO())
+    returncodes = resample.resample_files([ ('utt', ifile, ofile, ['false']) ], 8000, out, err)
+    assert returncodes == { 'utt':0 }
+    with wave.open(ofile) as w:
+        assert (w.getsampwidth(), w.getframerate(), w.getnframes()) == (3, 8000, 8000)
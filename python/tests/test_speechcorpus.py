@@ -0,0 +1,150 @@
+import os,sys
+import time
+import subprocess
+import numpy as np
+import pytest
+import kaldi
+import audio
+import resample
+import frontend
+import monophone
+import SpeechCorpus
+
+def make_data_dir(datadir, num_spk, utts_per_spk=3):
+    os.makedirs(datadir)
+    utt2spk = { 's{:02d}-u{}'.format(s,u):'s{:02d}'.format(s) for s in range(num_spk) for u in range(utts_per_spk) }
+    kaldi.write_dict_to_file(utt2spk, os.path.join(datadir,'utt2spk'))
+    kaldi.write_dict_to_file({ u:'{:.2f}'.format(1+len(u)%3) for u in utt2spk }, os.path.join(datadir,'utt2dur'))
+    kaldi.write_dict_to_file({ u:'/feats.ark:{}'.format(n) for (n,u) in enumerate(sorted(utt2spk)) }, os.path.join(datadir,'feats.scp'))
+    kaldi.write_dict_to_file({ s:'/cmvn.ark:{}'.format(s[1:]) for s in set(utt2spk.values()) }, os.path.join(datadir,'cmvn.scp'))
+    return(utt2spk)
+
+def shards(sdata, nj, table):
+    return([ kaldi.read_dict_from_file(os.path.join(sdata,str(n),table)) for n in range(1,nj+1) ])
+
+def test_speakers_are_kept_whole(tmp_path):
+    datadir = str(tmp_path / 'data')
+    utt2spk = make_data_dir(datadir, 10)
+    sdata = SpeechCorpus.split_data_dir(datadir, 4)
+    parts = shards(sdata, 4, 'utt2spk')
+    assert sorted(u for p in parts for u in p) == sorted(utt2spk)
+    assert all(len(p) > 0 for p in parts)
+    for (p, cmvn) in zip(parts, shards(sdata, 4, 'cmvn.scp')):
+        assert set(p.values()) == set(cmvn)
+
+def test_reuse_and_reshard(tmp_path):
+    datadir = str(tmp_path / 'data')
+    make_data_dir(datadir, 12)
+    sdata = SpeechCorpus.split_data_dir(datadir, 4)
+    mtimes = [ os.path.getmtime(os.path.join(sdata,str(n),'feats.scp')) for n in range(1,5) ]
+    before = SpeechCorpus.read_spk2shard(datadir, 4)
+    time.sleep(0.01)
+    os.utime(os.path.join(datadir,'feats.scp'))
+    assert SpeechCorpus.split_data_dir(datadir, 4) == sdata
+    assert mtimes == [ os.path.getmtime(os.path.join(sdata,str(n),'feats.scp')) for n in range(1,5) ]
+    SpeechCorpus.split_data_dir(datadir, 5)
+    after = SpeechCorpus.read_spk2shard(datadir, 5)
+    assert sum(1 for s in before if before[s] != after[s]) <= 12//5 + 1
+    # Each split keeps its own assignment, so the split4 shards still match the one saved for them
+    assert SpeechCorpus.read_spk2shard(datadir, 4) == before
+    assert SpeechCorpus.split_data_dir(datadir, 4) == sdata
+    assert mtimes == [ os.path.getmtime(os.path.join(sdata,str(n),'feats.scp')) for n in range(1,5) ]
+    for (n, part) in enumerate(shards(sdata, 4, 'utt2spk')):
+        assert all(before[s] == n+1 for s in part.values())
+
+def test_more_shards_than_speakers(tmp_path):
+    datadir = str(tmp_path / 'data')
+    make_data_dir(datadir, 2)
+    with pytest.raises(ValueError):
+        SpeechCorpus.split_data_dir(datadir, 4)
+    assert not os.path.exists(os.path.join(datadir,'split4'))
+    assert SpeechCorpus.num_jobs(datadir, 4) == 2
+    assert SpeechCorpus.num_jobs(datadir, 1) == 1
+
+def test_trainer_uses_no_more_jobs_than_speakers(tmp_path):
+    (datadir, devdir) = (str(tmp_path / 'train'), str(tmp_path / 'dev'))
+    make_data_dir(datadir, 5)
+    make_data_dir(devdir, 3)
+    kaldi_cmd = kaldi.CMD(nproc=8)
+    assert monophone.Trainer(datadir, 'lang', str(tmp_path / 'mono'), kaldi_cmd).nj == 5
+    trainer = monophone.Trainer(datadir, 'lang', str(tmp_path / 'mono'), kaldi_cmd, devdir=devdir)
+    assert trainer.nj == 3
+    assert trainer.sdata == os.path.join(datadir,'split3')
+
+def write_sources(srcdir, utts, fs=16000):
+    os.makedirs(srcdir, exist_ok=True)
+    rng = np.random.default_rng(0)
+    utt2src = {}
+    for (n, u) in enumerate(utts):
+        utt2src[u] = os.path.join(srcdir, u+'.wav')
+        t = np.arange(int(fs*(0.5+0.1*n)))/fs
+        x = 3000*np.sin(2*np.pi*(300+100*n)*t) + 300*rng.standard_normal(len(t))
+        resample.write_wav(utt2src[u], x[:,np.newaxis], fs, 2)
+    return(utt2src)
+
+def make_features(tmp_path, utt2src):
+    c = SpeechCorpus.corpus({ u:w for (u,w) in utt2src.items() }, { u:u.split('-')[0] for u in utt2src },
+                            { u:'hello' for u in utt2src })
+    return(c.make_features(8000, kaldi.CMD(nproc=1), str(tmp_path / 'log'), str(tmp_path / 'data'), str(tmp_path / 'mfcc')))
+
+def test_make_features_sees_added_utterances(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    os.makedirs('conf')
+    with open('conf/mfcc.conf','w') as f:
+        f.write('--sample-frequency=8000\n')
+    utt2src = write_sources(str(tmp_path / 'src'), [ 'a-1', 'a-2', 'b-1' ])
+    make_features(tmp_path, utt2src)
+    # A source added later, but older than the features, must still get features
+    past = time.time() - 100
+    utt2src.update(write_sources(str(tmp_path / 'src2'), [ 'b-2' ]))
+    for w in utt2src.values():
+        os.utime(w, (past, past))
+    make_features(tmp_path, utt2src)
+    assert sorted(kaldi.read_dict_from_file(str(tmp_path / 'data' / 'feats.scp'))) == sorted(utt2src)
+
+def test_wav_scp_pipe_matches_front_end(tmp_path):
+    utt2src = write_sources(str(tmp_path / 'src'), [ 'a-1' ])
+    pipe = resample.pipe(utt2src['a-1'], 8000)
+    assert pipe.endswith('|')
+    data = subprocess.run(pipe[:-1], shell=True, stdout=subprocess.PIPE, check=True).stdout
+    (x, fs) = audio.read_buffer(data)
+    (utt, y, fs_out, sampwidth) = next(frontend.downsample(frontend.decode(utt2src, sys.stderr), 8000))
+    assert fs == fs_out == 8000
+    assert np.array_equal(x.astype(np.float64), y)
+
+def write_corpus_files(datadir, utt2src):
+    os.makedirs(datadir, exist_ok=True)
+    names = [ os.path.join(datadir,f) for f in ('wav.scp','utt2spk','text') ]
+    kaldi.write_dict_to_file(utt2src, names[0])
+    kaldi.write_dict_to_file({ u:u.split('-')[0] for u in utt2src }, names[1])
+    kaldi.write_dict_to_file({ u:'hello' for u in utt2src }, names[2])
+    return(names)
+
+def test_saved_index_is_keyed_on_its_files(tmp_path):
+    utt2src = write_sources(str(tmp_path / 'src'), [ 'a-1', 'a-2', 'b-1' ])
+    datadir = str(tmp_path / 'data')
+    os.makedirs(datadir)
+    c = SpeechCorpus.corpus(*write_corpus_files(str(tmp_path / 'in'), utt2src))
+    c.write_dicts_to_dictfiles(*[ os.path.join(datadir,f) for f in ('wav.scp','utt2spk','spk2utt','text') ])
+    names = [ os.path.join(datadir,f) for f in ('wav.scp','utt2spk','text') ]
+    assert SpeechCorpus.CorpusIndex.load(os.path.join(datadir,SpeechCorpus.INDEX_FILE), names) is not None
+    # Other tables in the same directory, older than the saved index, are not indexed by it
+    subset = { u:w for (u,w) in utt2src.items() if u != 'a-2' }
+    others = [ os.path.join(datadir,f) for f in ('other_wav.scp','other_utt2spk','other_text') ]
+    kaldi.write_dict_to_file(subset, others[0])
+    kaldi.write_dict_to_file({ u:u.split('-')[0] for u in subset }, others[1])
+    kaldi.write_dict_to_file({ u:'hello' for u in subset }, others[2])
+    past = time.time() - 100
+    for f in others:
+        os.utime(f, (past, past))
+    assert sorted(SpeechCorpus.corpus(*others).index().utts.tolist()) == [ 'a-1', 'b-1' ]
+
+def test_corpus_tables_are_views_of_its_index(tmp_path):
+    utt2src = write_sources(str(tmp_path / 'src'), [ 'a-1', 'a-2', 'b-1' ])
+    c = SpeechCorpus.corpus(utt2src, { u:u.split('-')[0] for u in utt2src }, { u:'hello' for u in utt2src if u != 'b-1' })
+    assert isinstance(c.utt2spk, SpeechCorpus.ColumnView) and c.utt2spk.index is c.index()
+    assert sorted(c.utt2wav) == [ 'a-1', 'a-2' ]
+    assert c.utt2spk['a-2'] == 'a' and c.utt2wav['a-1'] == utt2src['a-1']
+    # Consumers of the dicts accept the views
+    import ngram
+    assert ngram.read_texts(c.utt2txt) == [ 'hello', 'hello' ]
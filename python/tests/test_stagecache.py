@@ -0,0 +1,79 @@
+import os
+import sqlite3
+import stagecache
+import kaldi
+
+def write_executable(path, text):
+    with open(path,'w') as f:
+        f.write(text)
+    os.chmod(path, 0o755)
+
+def test_kaldi_upgrade_changes_key_of_scripts(tmp_path, monkeypatch):
+    kaldi_root = tmp_path / 'kaldi'
+    bindir = kaldi_root / 'src' / 'bin'
+    bindir.mkdir(parents=True)
+    utils = tmp_path / 'utils'
+    utils.mkdir()
+    write_executable(str(bindir / 'compile-questions'), 'version 1\n')
+    write_executable(str(utils / 'prepare_lang.sh'), '#!/bin/bash\ncompile-questions\n')
+    monkeypatch.setenv('KALDI_ROOT', str(kaldi_root))
+    monkeypatch.setenv('PATH', os.pathsep.join([ os.environ['PATH'], str(bindir), str(utils) ]))
+    cache = stagecache.StageCache(str(tmp_path / 'cache.sqlite'))
+    try:
+        cmd = [ 'prepare_lang.sh', 'data/local/dict', 'data/lang' ]
+        assert str(bindir / 'compile-questions') in stagecache.tools_in(cmd)
+        key = cache.stage_key([], cmd)
+        write_executable(str(bindir / 'compile-questions'), 'version 2\n')
+        assert cache.stage_key([], cmd) != key
+    finally:
+        cache.close()
+
+def test_batch_commits_once(tmp_path):
+    dbfile = str(tmp_path / 'cache.sqlite')
+    ifile = tmp_path / 'in.txt'
+    ifile.write_text('x')
+    cache = stagecache.StageCache(dbfile)
+    try:
+        with cache.batch():
+            cache.record('stage1', [ str(ifile) ], [ 'cp' ], [])
+            cache.record('stage2', [ str(ifile) ], [ 'cp' ], [])
+            other = sqlite3.connect(dbfile)
+            assert other.execute('SELECT COUNT(*) FROM stages').fetchone()[0] == 0
+        assert other.execute('SELECT COUNT(*) FROM stages').fetchone()[0] == 2
+        other.close()
+    finally:
+        cache.close()
+
+def test_convert_all_if_newer_through_cache(tmp_path):
+    cache = kaldi.set_stage_cache(str(tmp_path / 'cache.sqlite'))
+    try:
+        tasks = []
+        for n in range(4):
+            ifile = tmp_path / 'in{}'.format(n)
+            ifile.write_text(str(n))
+            ofile = str(tmp_path / 'out{}'.format(n))
+            tasks.append((n, str(ifile), ofile, [ 'cp', str(ifile), ofile ]))
+        logprefix = str(tmp_path / 'convert')
+        assert kaldi.convert_all_if_newer(tasks, 2, logprefix) == { n:0 for n in range(4) }
+        assert cache.batch_depth == 0
+        assert len(cache.misses) == 4
+        kaldi.convert_all_if_newer(tasks, 2, logprefix)
+        assert len(cache.hits) == 4
+    finally:
+        kaldi.set_stage_cache(None)
+
+def test_input_changed_while_converting_is_stale(tmp_path):
+    cache = kaldi.set_stage_cache(str(tmp_path / 'cache.sqlite'))
+    try:
+        ifile = tmp_path / 'in.txt'
+        ifile.write_text('old')
+        ofile = str(tmp_path / 'out.txt')
+        # The command copies the input, then rewrites it, as if it changed while the stage ran
+        cmd = [ 'sh', '-c', 'cp {0} {1}; echo new > {0}'.format(str(ifile), ofile) ]
+        log = open(str(tmp_path / 'log.txt'),'w')
+        assert kaldi.convert_if_newer(str(ifile), ofile, cmd, log, log) == 0
+        key = cache.stage_key([ str(ifile) ], cmd)
+        assert not cache.is_current(' '.join([ os.path.abspath(ofile) ]), [ str(ifile) ], cmd, [ ofile ], key)
+        log.close()
+    finally:
+        kaldi.set_stage_cache(None)
@@ -0,0 +1,57 @@
+import os
+import numpy as np
+import kaldi
+import wer
+
+# (ref, hyp, alignment worked out by hand)
+CASES = [
+    ('a b c d', 'a x c d e', [ ('a','a','C'), ('b','x','S'), ('c','c','C'), ('d','d','C'), ('***','e','I') ]),
+    ('a b c', 'a c', [ ('a','a','C'), ('b','***','D'), ('c','c','C') ]),
+    ('a b', '', [ ('a','***','D'), ('b','***','D') ]),
+    ('', 'x y', [ ('***','x','I'), ('***','y','I') ]),
+    # Two substitutions, rather than an insertion and a deletion, as compute-wer prefers
+    ('a b', 'b a', [ ('a','b','S'), ('b','a','S') ]),
+    ('the sat', 'the cat sat', [ ('the','the','C'), ('***','cat','I'), ('sat','sat','C') ]),
+]
+
+def test_align():
+    for (ref, hyp, pairs) in CASES:
+        assert wer.align(ref.split(), hyp.split()) == pairs
+
+def test_edit_distances_match_alignments(monkeypatch):
+    word2id = {}
+    refs = [ np.array([ word2id.setdefault(w, len(word2id)) for w in r.split() ], dtype=np.int64) for (r, h, p) in CASES ]
+    hyps = [ np.array([ word2id.get(w, -1) for w in h.split() ], dtype=np.int64) for (r, h, p) in CASES ]
+    monkeypatch.setattr(wer, 'BATCH_SIZE', 4)
+    (errors, ins, dels, subs) = wer.edit_distances(refs, hyps)
+    for (n, (r, h, pairs)) in enumerate(CASES):
+        ops = [ op for (x, y, op) in pairs ]
+        assert (ins[n], dels[n], subs[n]) == (ops.count('I'), ops.count('D'), ops.count('S'))
+        assert errors[n] == ins[n] + dels[n] + subs[n]
+
+def test_edit_distances_are_minimal():
+    rng = np.random.default_rng(0)
+    refs = [ rng.integers(0, 4, rng.integers(0, 8)) for n in range(300) ]
+    hyps = [ rng.integers(0, 4, rng.integers(0, 8)) for n in range(300) ]
+    (errors, ins, dels, subs) = wer.edit_distances(refs, hyps)
+    for (r, h, e) in zip(refs, hyps, errors):
+        # Plain Levenshtein distance
+        row = list(range(len(h)+1))
+        for (i, x) in enumerate(r, start=1):
+            prev, row = row, [ i ]
+            for (j, y) in enumerate(h, start=1):
+                row.append(min(prev[j-1] + (x != y), prev[j] + 1, row[j-1] + 1))
+        assert e == row[-1]
+    assert ((ins - dels) == np.array([ len(h) - len(r) for (r, h) in zip(refs, hyps) ])).all()
+
+def test_score_and_details(tmp_path):
+    (ref_text, hypfile) = (str(tmp_path / 'text'), str(tmp_path / '10.txt'))
+    kaldi.write_dict_to_file({ 'u1':'a b c d', 'u2':'a b c', 'u3':'a' }, ref_text)
+    kaldi.write_dict_to_file({ 'u1':'a x c d e', 'u2':'a c' }, hypfile)
+    results = wer.score_grid(ref_text, { (10, '0.0'):hypfile })
+    result = results[(10, '0.0')]
+    assert result.report() == ('%WER 42.86 [ 3 / 7, 1 ins, 1 del, 1 sub ]\n%SER 100.00 [ 2 / 2 ]\n'
+                               'Scored 2 sentences, 1 not present in hyp.\n')
+    assert wer.per_utt_details(result, ref_text) == [
+        'u1 ref  a b c d ***', 'u1 hyp  a x c d e', 'u1 op   C S C C I', 'u1 #csid 3 1 1 0',
+        'u2 ref  a b   c', 'u2 hyp  a *** c', 'u2 op   C D   C', 'u2 #csid 2 0 0 1' ]
@@ -0,0 +1,277 @@
+#!/usr/bin/python3
+"""
+USAGE:
+  import wer
+  best = wer.score_decode_dir('data/dev', 'exp/mono/graph', 'exp/mono/decode_dev', kaldi_cmd)
+  print(best.line())              # e.g. %WER 23.45 [ 123 / 524, 10 ins, 20 del, 93 sub ] ...
+  results = wer.score_grid('data/dev/text', { (lmwt, wip):hypfile, ... }, nj=4)
+  If called from the command line, scores the hypotheses already in decode_dir/scoring_kaldi:
+  python wer.py data_dir decode_dir [nj]
+
+Native replacement for the scoring half of local/score.sh: compute-wer for every
+(LM weight, word insertion penalty) pair, best_wer.sh, and the per-utterance and per-speaker
+details.  The best path for each pair is still found by lattice-best-path, one job array per
+penalty, as score.sh does.  Words are mapped to integers, and the edit distances of whole
+batches of utterances (sorted by reference length) are computed at once: row i of the
+Levenshtein table is found for every utterance of the batch and every hypothesis position
+together, the insertions along the row by a running minimum.  Each cost is
+errors*INS_SCALE + insertions, so that among the alignments with the fewest errors the one with
+the fewest insertions (and therefore deletions) is chosen, as compute-wer prefers substitutions.
+The grid is scored in a pool of nj processes, each holding the integer references.
+Results are written where score.sh writes them: decode_dir/wer_LMWT_WIP, and, in
+decode_dir/scoring_kaldi, best_wer and wer_details/{lmwt,wip,per_utt,per_spk}.
+"""
+
+import os,sys
+import time
+import multiprocessing
+import numpy as np
+import kaldi
+
+LMWTS = list(range(9, 21))
+WIPS = [ '0.0', '0.5', '1.0' ]
+INS_SCALE = 1<<20      # the cost of one error; more than the number of words in any hypothesis
+BATCH_SIZE = 2000      # utterances aligned at a time
+SPECIAL = '***'        # marks an insertion or deletion in alignments, as align-text --special-symbol does
+
+########## edit distance ##################################################
+def _pad(seqs, width, fill):
+    out = np.full((len(seqs), width), fill, dtype=np.int64)
+    for (n, s) in enumerate(seqs):
+        out[n,:len(s)] = s
+    return(out)
+
+def edit_distances(refs, hyps):
+    '''USAGE: (errors, ins, dels, subs) = edit_distances(refs, hyps)
+    refs, hyps: lists of integer arrays (words not in the references should be negative in hyps).
+    Returns the counts of each utterance's minimum-error alignment, as arrays.'''
+    n = len(refs)
+    lr = np.array([ len(r) for r in refs ], dtype=np.int64)
+    lh = np.array([ len(h) for h in hyps ], dtype=np.int64)
+    cost = np.zeros(n, dtype=np.int64)
+    order = np.argsort(lr, kind='stable')
+    for start in range(0, n, BATCH_SIZE):
+        batch = order[start:start+BATCH_SIZE]
+        (maxr, maxh) = (int(lr[batch].max(initial=0)), int(lh[batch].max(initial=0)))
+        R = _pad([ refs[b] for b in batch ], maxr, -2)
+        H = _pad([ hyps[b] for b in batch ], maxh, -3)
+        step = np.arange(maxh+1, dtype=np.int64) * (INS_SCALE+1)
+        row = np.tile(step, (len(batch), 1))          # row 0: every hypothesis word inserted
+        at = np.arange(len(batch))
+        done = lr[batch] == 0
+        cost[batch[done]] = row[at[done], lh[batch[done]]]
+        for i in range(1, maxr+1):
+            sub = np.where(R[:,i-1,None] == H, 0, INS_SCALE)
+            best = np.empty_like(row)
+            best[:,0] = row[:,0] + INS_SCALE
+            best[:,1:] = np.minimum(row[:,1:] + INS_SCALE, row[:,:-1] + sub)
+            row = step + np.minimum.accumulate(best - step, axis=1)
+            done = lr[batch] == i
+            cost[batch[done]] = row[at[done], lh[batch[done]]]
+    errors = cost // INS_SCALE
+    ins = cost % INS_SCALE
+    dels = ins - (lh - lr)
+    return(errors, ins, dels, errors - ins - dels)
+
+def align(ref, hyp):
+    '''USAGE: pairs = align(ref, hyp)
+    ref, hyp: lists of words.  The minimum-error alignment, as in edit_distances, as a list of
+    (ref word, hyp word, op), op being C, S, I or D, and SPECIAL standing in for a missing word.'''
+    (m, n) = (len(ref), len(hyp))
+    D = [ [ j*(INS_SCALE+1) for j in range(n+1) ] ]
+    for i in range(1, m+1):
+        (prev, row) = (D[-1], [ i*INS_SCALE ])
+        for j in range(1, n+1):
+            row.append(min(prev[j-1] + (0 if ref[i-1]==hyp[j-1] else INS_SCALE), prev[j] + INS_SCALE, row[j-1] + INS_SCALE+1))
+        D.append(row)
+    pairs = []
+    (i, j) = (m, n)
+    while i > 0 or j > 0:
+        if i > 0 and j > 0 and D[i][j] == D[i-1][j-1] + (0 if ref[i-1]==hyp[j-1] else INS_SCALE):
+            pairs.append((ref[i-1], hyp[j-1], 'C' if ref[i-1]==hyp[j-1] else 'S'))
+            (i, j) = (i-1, j-1)
+        elif i > 0 and D[i][j] == D[i-1][j] + INS_SCALE:
+            pairs.append((ref[i-1], SPECIAL, 'D'))
+            i -= 1
+        else:
+            pairs.append((SPECIAL, hyp[j-1], 'I'))
+            j -= 1
+    return(pairs[::-1])
+
+########## results ##################################################
+class Result:
+    '''The score of one (LM weight, word insertion penalty) setting: per-utterance counts, and their totals.'''
+    def __init__(self, lmwt, wip, hypfile, utts, num_words, errors, ins, dels, subs, num_missing):
+        '''USAGE: result = Result(lmwt, wip, hypfile, utts, num_words, errors, ins, dels, subs, num_missing)'''
+        (self.lmwt, self.wip, self.hypfile) = (lmwt, wip, hypfile)
+        (self.utts, self.num_words) = (utts, num_words)
+        (self.errors, self.ins, self.dels, self.subs) = (errors, ins, dels, subs)
+        self.num_missing = num_missing
+
+    def wer(self):
+        return(100.0 * self.errors.sum() / max(1, self.num_words.sum()))
+
+    def ser(self):
+        return(100.0 * (self.errors > 0).sum() / max(1, len(self.utts)))
+
+    def report(self):
+        '''The summary that compute-wer --mode=present prints'''
+        return('%WER {:.2f} [ {} / {}, {} ins, {} del, {} sub ]\n%SER {:.2f} [ {} / {} ]\nScored {} sentences, {} not present in hyp.\n'.format(
+            self.wer(), self.errors.sum(), self.num_words.sum(), self.ins.sum(), self.dels.sum(), self.subs.sum(),
+            self.ser(), int((self.errors > 0).sum()), len(self.utts), len(self.utts), self.num_missing))
+
+    def line(self, werfile=None):
+        '''The %WER line, followed by the name of the file it is in, as best_wer.sh prints it'''
+        return('%WER {:.2f} [ {} / {}, {} ins, {} del, {} sub ] {}'.format(
+            self.wer(), self.errors.sum(), self.num_words.sum(), self.ins.sum(), self.dels.sum(), self.subs.sum(),
+            werfile or 'wer_{}_{}'.format(self.lmwt, self.wip)))
+
+########## scoring ##################################################
+_WORKER = {}
+
+def _init_worker(word2id, ref_ids):
+    '''Pool initializer: the reference word IDs, shared by every _score task'''
+    _WORKER.update(word2id=word2id, ref_ids=ref_ids)
+
+def _score(task):
+    '''Pool worker: the Result of one (lmwt, wip, hypfile)'''
+    (lmwt, wip, hypfile) = task
+    (get, ref_ids) = (_WORKER['word2id'].get, _WORKER['ref_ids'])
+    hyps = kaldi.read_dict_from_file(hypfile)
+    unknown = [ u for u in hyps if u not in ref_ids ]
+    if unknown:
+        raise ValueError('wer: {} has utterances with no reference, e.g. {}'.format(hypfile, unknown[0]))
+    utts = sorted(hyps)
+    refs = [ ref_ids[u] for u in utts ]
+    (errors, ins, dels, subs) = edit_distances(refs, [ np.array([ get(w, -1) for w in hyps[u].split() ], dtype=np.int64) for u in utts ])
+    num_words = np.array([ len(r) for r in refs ], dtype=np.int64)
+    return(Result(lmwt, wip, hypfile, utts, num_words, errors, ins, dels, subs, len(ref_ids) - len(utts)))
+
+def score_grid(ref_text, hypfiles, nj=1):
+    '''USAGE: results = score_grid(ref_text, hypfiles, nj)
+    ref_text: a text table (or dict) of reference transcriptions.
+    hypfiles: dict from (lmwt, wip) to a text table of hypotheses.
+    Returns a dict from (lmwt, wip) to its Result, scored in a pool of nj processes.'''
+    refs = kaldi.read_dict_from_file(ref_text) if isinstance(ref_text, str) else ref_text
+    word2id = {}
+    ref_ids = { u:np.array([ word2id.setdefault(w, len(word2id)) for w in t.split() ], dtype=np.int64) for (u,t) in refs.items() }
+    tasks = [ (lmwt, wip, f) for ((lmwt, wip), f) in hypfiles.items() ]
+    if nj <= 1 or len(tasks) <= 1:
+        _init_worker(word2id, ref_ids)
+        results = [ _score(t) for t in tasks ]
+    else:
+        with multiprocessing.Pool(min(nj, len(tasks)), initializer=_init_worker, initargs=(word2id, ref_ids)) as pool:
+            results = pool.map(_score, tasks)
+    return({ (r.lmwt, r.wip):r for r in results })
+
+def best_result(results):
+    '''USAGE: result = best_result(results); the lowest WER, ties going to the first setting in results'''
+    return(min(results.values(), key=lambda r: (r.errors.sum()/max(1, r.num_words.sum()))))
+
+########## details ##################################################
+def per_utt_details(result, ref_text):
+    '''USAGE: lines = per_utt_details(result, ref_text)
+    The alignment of each utterance, in the format of utils/scoring/wer_per_utt_details.pl:
+    ref, hyp and op lines, aligned in columns, then the counts of correct words, substitutions, insertions and deletions.'''
+    refs = kaldi.read_dict_from_file(ref_text) if isinstance(ref_text, str) else ref_text
+    hyps = kaldi.read_dict_from_file(result.hypfile)
+    lines = []
+    for u in result.utts:
+        pairs = align(refs[u].split(), hyps[u].split())
+        widths = [ max(len(r), len(h)) for (r, h, op) in pairs ]
+        for (name, col) in (('ref', 0), ('hyp', 1), ('op', 2)):
+            lines.append('{} {:<4s} {}'.format(u, name, ' '.join(p[col].ljust(w) for (p, w) in zip(pairs, widths)).rstrip()))
+        counts = { op:sum(1 for p in pairs if p[2]==op) for op in 'CSID' }
+        lines.append('{} #csid {} {} {} {}'.format(u, counts['C'], counts['S'], counts['I'], counts['D']))
+    return(lines)
+
+def per_spk_details(result, utt2spk):
+    '''USAGE: lines = per_spk_details(result, utt2spk)
+    Per-speaker counts and rates, in the format of utils/scoring/wer_per_spk_details.pl: for each
+    speaker, then for all of them (SUM), a raw line of counts and a sys line of percentages.'''
+    utt2spk = kaldi.read_dict_from_file(utt2spk) if isinstance(utt2spk, str) else utt2spk
+    spk = np.array([ utt2spk.get(u, u) for u in result.utts ], dtype=object)
+    fmt = '{:<15s} {:>4s} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}'
+    lines = [ fmt.format('SPEAKER', 'id', '#SENT', '#WORD', 'Corr', 'Sub', 'Ins', 'Del', 'Err', 'S.Err') ]
+    for s in sorted(set(spk)) + [ 'SUM' ]:
+        mask = (spk == s) if s != 'SUM' else np.ones(len(spk), dtype=bool)
+        (sents, words) = (int(mask.sum()), int(result.num_words[mask].sum()))
+        (ins, dels, subs, errs) = [ int(a[mask].sum()) for a in (result.ins, result.dels, result.subs, result.errors) ]
+        serrs = int((result.errors[mask] > 0).sum())
+        corr = words - subs - dels
+        lines.append(fmt.format(s, 'raw', sents, words, corr, subs, ins, dels, errs, serrs))
+        pct = lambda x, total: '{:.2f}'.format(100.0*x/max(1, total))
+        lines.append(fmt.format(s, 'sys', sents, words, pct(corr, words), pct(subs, words), pct(ins, words),
+                                pct(dels, words), pct(errs, words), pct(serrs, sents)))
+    return(lines)
+
+def write_results(results, decodedir, ref_text, utt2spk=None):
+    '''USAGE: best = write_results(results, decodedir, ref_text, utt2spk)
+    Write decodedir/wer_LMWT_WIP for every result, and, in decodedir/scoring_kaldi, best_wer and
+    wer_details/{lmwt,wip,per_utt,per_spk} for the best one, which is returned.'''
+    for r in results.values():
+        with open(os.path.join(decodedir,'wer_{}_{}'.format(r.lmwt, r.wip)),'w') as f:
+            f.write(r.report())
+    best = best_result(results)
+    detailsdir = os.path.join(decodedir,'scoring_kaldi','wer_details')
+    os.makedirs(detailsdir, exist_ok=True)
+    kaldi.write_list_to_file([ best.line(os.path.join(decodedir,'wer_{}_{}'.format(best.lmwt, best.wip))) ],
+                             os.path.join(decodedir,'scoring_kaldi','best_wer'), '\n')
+    kaldi.write_list_to_file([ str(best.lmwt) ], os.path.join(detailsdir,'lmwt'), '\n')
+    kaldi.write_list_to_file([ str(best.wip) ], os.path.join(detailsdir,'wip'), '\n')
+    kaldi.write_list_to_file(per_utt_details(best, ref_text), os.path.join(detailsdir,'per_utt'), '\n')
+    if utt2spk is not None:
+        kaldi.write_list_to_file(per_spk_details(best, utt2spk), os.path.join(detailsdir,'per_spk'), '\n')
+    return(best)
+
+########## decoding directories ##################################################
+def hyp_files(decodedir, lmwts=LMWTS, wips=WIPS):
+    '''USAGE: hypfiles = hyp_files(decodedir, lmwts, wips); dict from (lmwt, wip) to scoring_kaldi/penalty_WIP/LMWT.txt'''
+    return({ (lmwt, wip):os.path.join(decodedir,'scoring_kaldi','penalty_{}'.format(wip),'{}.txt'.format(lmwt))
+             for wip in wips for lmwt in lmwts })
+
+def best_paths(graphdir, decodedir, kaldi_cmd, lmwts=LMWTS, wips=WIPS):
+    '''USAGE: hypfiles = best_paths(graphdir, decodedir, kaldi_cmd, lmwts, wips)
+    Find the best path through the lattices in decodedir for each setting, as score.sh does:
+    one job array over the LM weights (lmwts must be consecutive) for each word insertion penalty.'''
+    symtab = os.path.join(graphdir,'words.txt')
+    for wip in wips:
+        penaltydir = os.path.join(decodedir,'scoring_kaldi','penalty_{}'.format(wip))
+        os.makedirs(os.path.join(penaltydir,'log'), exist_ok=True)
+        cmd = [ 'lattice-scale', '--inv-acoustic-scale=LMWT', 'ark:gunzip -c {}/lat.*.gz|'.format(decodedir), 'ark:-', '|',
+                'lattice-add-penalty', '--word-ins-penalty={}'.format(wip), 'ark:-', 'ark:-', '|',
+                'lattice-best-path', '--word-symbol-table={}'.format(symtab), 'ark:-', 'ark,t:-', '|',
+                'utils/int2sym.pl', '-f', '2-', symtab, '>', os.path.join(penaltydir,'LMWT.txt') ]
+        returncode = kaldi_cmd.run('LMWT={}:{}'.format(min(lmwts), max(lmwts)),
+                                   os.path.join(penaltydir,'log','best_path.LMWT.log'), cmd, decode=True)
+        if returncode != 0:
+            raise RuntimeError('wer: lattice-best-path failed; see {}'.format(os.path.join(penaltydir,'log')))
+    return(hyp_files(decodedir, lmwts, wips))
+
+def score_decode_dir(datadir, graphdir, decodedir, kaldi_cmd, lmwts=LMWTS, wips=WIPS):
+    '''USAGE: best = score_decode_dir(datadir, graphdir, decodedir, kaldi_cmd, lmwts, wips)
+    Replaces local/score.sh: find the best paths for every (lmwt, wip), score them all against
+    datadir/text, write the results, and return the best Result.'''
+    hypfiles = best_paths(graphdir, decodedir, kaldi_cmd, lmwts, wips)
+    ref_text = os.path.join(datadir,'text')
+    results = score_grid(ref_text, hypfiles, kaldi_cmd.nproc)
+    utt2spk = os.path.join(datadir,'utt2spk')
+    return(write_results(results, decodedir, ref_text, utt2spk if os.path.exists(utt2spk) else None))
+
+########## Called from the operating system ##################################################
+if __name__=="__main__":
+    if len(sys.argv) < 3:
+        print(__doc__)
+        exit(0)
+    (datadir, decodedir) = sys.argv[1:3]
+    nj = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    hypfiles = { k:f for (k,f) in hyp_files(decodedir).items() if os.path.exists(f) }
+    if not hypfiles:
+        raise RuntimeError('wer: no hypotheses in {}'.format(os.path.join(decodedir,'scoring_kaldi')))
+    start = time.time()
+    results = score_grid(os.path.join(datadir,'text'), hypfiles, nj)
+    scored = time.time()
+    utt2spk = os.path.join(datadir,'utt2spk')
+    best = write_results(results, decodedir, os.path.join(datadir,'text'), utt2spk if os.path.exists(utt2spk) else None)
+    print('wer: scored {} settings in {:.2f}s, and wrote the details in {:.2f}s'.format(len(results), scored-start, time.time()-scored))
+    print(best.line(os.path.join(decodedir,'wer_{}_{}'.format(best.lmwt, best.wip))))